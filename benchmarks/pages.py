@@ -0,0 +1,98 @@
+"""pages.py: Synthetic HTML pages for the benchmarks.
+
+The pages imitate what makes real pages expensive to preprocess: deeply nested
+layout containers, large data tables, inline scripts and styles, SVG icons and long
+attribute values. The target string sits in the last table, so searches have to
+scan the whole document before they find it.
+"""
+import os
+
+TARGET_STRING = "Needle Value"
+
+_HEAD = """<!DOCTYPE html>
+<html><head><title>Synthetic page</title>
+<style>.row td { padding: 4px; border: 1px solid #ccc; } .nav a { color: #333; }</style>
+<script>window.analytics = {"id": "UA-000000", "events": []};</script>
+</head><body>
+<nav class="nav main sticky dark"><svg viewBox="0 0 10 10"><path d="M0 0L10 10M10 0L0 10"/></svg>
+<a href="/">Home</a><a href="/climate">Climate</a><a href="/cities">Cities</a></nav>
+"""
+
+_ROW = (
+    '<tr class="row {parity}" data-row="{index}" style="height: 24px">'
+    '<td class="city">City {index}</td><td class="value">{value}</td>'
+    '<td><a href="/cities/{index}?utm_source=benchmark&amp;utm_medium=table" '
+    'onclick="track({index})">Details</a></td></tr>\n'
+)
+
+
+def _table(first_row, rows, target=False):
+    body = "".join(
+        _ROW.format(index=index, parity="even" if index % 2 == 0 else "odd", value=index * 7 % 100)
+        for index in range(first_row, first_row + rows)
+    )
+    if target:
+        body += f'<tr class="row"><td class="city">{TARGET_STRING}</td><td class="value">42</td><td></td></tr>\n'
+    return (
+        f'<section class="block"><h2>Cities {first_row} to {first_row + rows - 1}</h2>'
+        f'<script>render({first_row});</script>'
+        f'<table class="data-table"><tbody>\n{body}</tbody></table></section>\n'
+    )
+
+
+def synthetic_page(size_bytes: int, depth: int = 64, rows_per_table: int = 200) -> str:
+    """
+    Return a synthetic page of roughly the given size.
+
+    :param size_bytes: Approximate size of the page in bytes
+    :param depth: Number of nested layout containers around the tables, defaults to 64
+    :param rows_per_table: Number of rows of every table, defaults to 200
+    :return: The HTML of the page
+    """
+    opening = "".join(f'<div class="layer layer-{level}">' for level in range(depth))
+    closing = "</div>" * depth
+    parts = [_HEAD, opening]
+    size = len(_HEAD) + len(opening) + len(closing)
+    first_row = 0
+    while True:
+        table = _table(first_row, rows_per_table)
+        if size + len(table) >= size_bytes and first_row > 0:
+            break
+        parts.append(table)
+        size += len(table)
+        first_row += rows_per_table
+    parts.append(_table(first_row, 1, target=True))
+    parts.append(closing + "\n</body></html>\n")
+    return "".join(parts)
+
+
+def page_path(size_bytes: int, directory: str = ".benchmark_pages") -> str:
+    """
+    Return the path of a synthetic page of the given size, generating it on first use.
+
+    :param size_bytes: Approximate size of the page in bytes
+    :param directory: Directory the generated pages are kept in, defaults to ".benchmark_pages"
+    :return: The path of the HTML file
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"synthetic-{size_bytes}.html")
+    if not os.path.exists(path):
+        with open(path + ".tmp", "w", encoding="utf-8") as file:
+            file.write(synthetic_page(size_bytes))
+        os.replace(path + ".tmp", path)
+    return path
+
+
+def parse_size(size: str) -> int:
+    """
+    Convert a size such as "100KB" or "10MB" into bytes.
+
+    :param size: A number followed by KB or MB
+    :return: The size in bytes
+    """
+    units = {"KB": 1024, "MB": 1024 * 1024}
+    size = size.strip().upper()
+    for unit, factor in units.items():
+        if size.endswith(unit):
+            return int(float(size[:-len(unit)]) * factor)
+    return int(size)
@@ -0,0 +1,56 @@
+"""parser_backends.py: Benchmark the HTML parser backends on synthetic pages.
+
+Run from the project directory:
+
+    python -m benchmarks.parser_backends --sizes-kb 100 1000 10000
+
+For each page size this reports the time to build a full BeautifulSoup tree with
+every installed tree builder, and the time the selectolax locator needs to cut out
+the subtree around the target string and parse only that part.
+"""
+import argparse
+import time
+
+from benchmarks.pages import TARGET_STRING, synthetic_page
+from website_analysis.dom_analysis import HTMLParser, HTMLSearcher, ParentExtractor
+from website_analysis.parser_backends import SelectolaxLocator, installed_tree_builders
+
+GENERATIONS = 3
+
+
+def measure(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the HTML parser backends')
+    parser.add_argument('--sizes-kb', type=int, nargs='+', default=[100, 1000, 10000], help='Sizes of the synthetic pages in KB')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per measurement, the fastest one is reported')
+    args = parser.parse_args()
+
+    for size_kb in args.sizes_kb:
+        html = synthetic_page(size_kb * 1024)
+        print(f"{size_kb} KB page")
+
+        for builder in installed_tree_builders():
+            def full_parse():
+                parsed = HTMLParser(builder).parse(html)
+                element = HTMLSearcher().search(parsed, TARGET_STRING)
+                ParentExtractor().extract(element, GENERATIONS)
+            print(f"  {builder:<12} {measure(full_parse, args.repeat):8.3f}s")
+
+        if SelectolaxLocator.available():
+            def locate_and_parse():
+                subtree = SelectolaxLocator().locate(html, TARGET_STRING, GENERATIONS)
+                HTMLParser().parse_fragment(subtree)
+            print(f"  {'selectolax':<12} {measure(locate_and_parse, args.repeat):8.3f}s")
+
+
+if __name__ == "__main__":
+    main()
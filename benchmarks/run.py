@@ -0,0 +1,260 @@
+"""run.py: Benchmark the DOM preprocessing pipeline and compare it with stored baselines.
+
+Run from the project directory:
+
+    python -m benchmarks.run                      # results/denver.html, 100KB and 1MB pages
+    python -m benchmarks.run --sizes 10MB 100MB   # larger synthetic pages
+    python -m benchmarks.run --update-baselines   # store the results as the new baselines
+
+Every stage of the pipeline (loading, parsing, searching, extracting, preparing and
+HtmlManager.process_html) is measured on results/denver.html and on synthetic pages,
+followed by an end-to-end run of gpt-scraper.py against a stubbed LLM that returns
+canned scraping code. The report lists the wall-clock time, the peak memory traced by
+tracemalloc and the number of tokens of the HTML sent to the model. Results that are
+slower, larger or more tokens than the baselines by more than the tolerance are
+reported as regressions and make the command exit with status 1.
+
+Times are measured without tracemalloc, which slows Python code down considerably,
+and the best of --repeat runs is reported. Baselines depend on the machine, so
+regenerate them on the reference machine when it changes.
+"""
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import runpy
+import sys
+import time
+import tracemalloc
+
+from langchain.schema import AIMessage
+
+from benchmarks.pages import TARGET_STRING, page_path, parse_size
+from scraper_generation.scraper_generator import ScrapingCodeGenerator
+from website_analysis.dom_analysis import (
+    HtmlLoader,
+    HtmlManager,
+    HTMLParser,
+    HTMLPreparer,
+    HTMLSearcher,
+    ParentExtractor,
+    TokenCounter,
+)
+
+BASELINES = os.path.join(os.path.dirname(__file__), "baselines.json")
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DENVER = os.path.join(PROJECT_DIR, "results", "denver.html")
+DENVER_TARGET_STRING = "February"
+GENERATIONS = 3
+
+# Differences below these are noise, whatever the relative tolerance says
+MIN_SECONDS = 0.05
+MIN_PEAK_MB = 1.0
+
+CANNED_CODE = """```python
+rows = html_soup.find_all("tr")
+print(f"Scraped {len(rows)} rows")
+```"""
+
+
+def measure(function, repeat=1, trace_memory=True):
+    """
+    Run a function and return its result, best time and peak memory.
+
+    :param function: The function to measure
+    :param repeat: Number of timed runs, the fastest is reported
+    :param trace_memory: Run once more under tracemalloc to measure the peak memory
+    :return: A (result, seconds, peak MB or None) tuple
+    """
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    peak = None
+    if trace_memory:
+        del result
+        gc.collect()
+        tracemalloc.start()
+        try:
+            result = function()
+            peak = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        finally:
+            tracemalloc.stop()
+    return result, best, peak
+
+
+def benchmark_page(name, path, target_string, repeat, trace_memory):
+    """Measure every stage of the pipeline on one page."""
+    counter = TokenCounter.for_model(ScrapingCodeGenerator.MODEL_NAME)
+    results = {}
+
+    def record(stage, function, output=None):
+        result, seconds, peak = measure(function, repeat, trace_memory)
+        entry = {"seconds": round(seconds, 4)}
+        if peak is not None:
+            entry["peak_mb"] = round(peak, 2)
+        if output is not None:
+            entry["tokens"] = counter.count(output(result))
+        results[f"{name}/{stage}"] = entry
+        return result
+
+    html = record("load", HtmlLoader(path).load)
+    parsed_html = record("parse", lambda: HTMLParser().parse(html))
+    element = record("search", lambda: HTMLSearcher().search(parsed_html, target_string))
+    parent = record("extract", lambda: ParentExtractor().extract(element, GENERATIONS))
+    record("prepare", lambda: HTMLPreparer().prepare(parent), output=lambda prepared: prepared)
+    del html, parsed_html, element, parent
+
+    record(
+        "process_html",
+        lambda: HtmlManager(path, "file", target_string).process_html(),
+        output=lambda processed: processed,
+    )
+    record(
+        "process_html_streaming",
+        lambda: HtmlManager(path, "file", target_string, streaming=True).process_html(),
+        output=lambda processed: processed,
+    )
+    return results
+
+
+class CannedChatModel:
+    """Stands in for ChatOpenAI and answers every prompt with the same code."""
+
+    def __init__(self):
+        self.prompts = []
+
+    def __call__(self, messages):
+        self.prompts.append(messages[-1].content)
+        return AIMessage(content=CANNED_CODE)
+
+
+def benchmark_end_to_end(name, path, target_string, repeat, trace_memory):
+    """Measure a gpt-scraper.py run against the stubbed LLM."""
+    llm = CannedChatModel()
+    argv = [
+        "gpt-scraper.py",
+        "--source", path,
+        "--source-type", "file",
+        "--requirements", "Print the number of table rows",
+        "--target-string", target_string,
+        "--executor", "inline",
+        "--no-cache",
+    ]
+
+    def run():
+        original_argv, original_initialize_llm = sys.argv, ScrapingCodeGenerator.initialize_llm
+        sys.argv = argv
+        ScrapingCodeGenerator.initialize_llm = lambda generator: llm
+        stdout = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(stdout):
+                runpy.run_path(os.path.join(PROJECT_DIR, "gpt-scraper.py"), run_name="__main__")
+        except SystemExit as error:
+            # gpt-scraper.py exits with the status of the run
+            exit_code = error.code
+        else:
+            exit_code = 0
+        finally:
+            sys.argv, ScrapingCodeGenerator.initialize_llm = original_argv, original_initialize_llm
+        if exit_code != 0 or "Scraped" not in stdout.getvalue():
+            raise RuntimeError(f"The end-to-end run failed:\n{stdout.getvalue()}")
+
+    _, seconds, peak = measure(run, repeat, trace_memory)
+    entry = {"seconds": round(seconds, 4)}
+    if peak is not None:
+        entry["peak_mb"] = round(peak, 2)
+    entry["tokens"] = TokenCounter.for_model(ScrapingCodeGenerator.MODEL_NAME).count(llm.prompts[-1])
+    return {f"{name}/end_to_end": entry}
+
+
+def compare(results, baselines, time_tolerance, memory_tolerance):
+    """
+    Return a description of every result that regressed against its baseline.
+
+    :param results: The results of this run
+    :param baselines: The stored baselines
+    :param time_tolerance: Allowed relative slowdown, e.g. 0.5 for 50%
+    :param memory_tolerance: Allowed relative growth of the peak memory
+    :return: A list of human-readable regressions
+    """
+    regressions = []
+    for case, result in results.items():
+        baseline = baselines.get(case)
+        if baseline is None:
+            continue
+        if result["seconds"] - baseline["seconds"] > max(MIN_SECONDS, baseline["seconds"] * time_tolerance):
+            regressions.append(f"{case}: {result['seconds']:.3f}s, baseline {baseline['seconds']:.3f}s")
+        if "peak_mb" in result and "peak_mb" in baseline:
+            if result["peak_mb"] - baseline["peak_mb"] > max(MIN_PEAK_MB, baseline["peak_mb"] * memory_tolerance):
+                regressions.append(f"{case}: {result['peak_mb']:.1f} MB, baseline {baseline['peak_mb']:.1f} MB")
+        if result.get("tokens", 0) > baseline.get("tokens", result.get("tokens", 0)):
+            regressions.append(f"{case}: {result['tokens']} tokens, baseline {baseline['tokens']}")
+    return regressions
+
+
+def print_report(results, baselines):
+    print(f"{'case':<40} {'seconds':>10} {'peak MB':>10} {'tokens':>8}   baseline")
+    for case, result in results.items():
+        baseline = baselines.get(case)
+        reference = f"{baseline['seconds']:.3f}s" if baseline else "-"
+        peak = f"{result['peak_mb']:.1f}" if "peak_mb" in result else "-"
+        print(f"{case:<40} {result['seconds']:>10.3f} {peak:>10} {result.get('tokens', '-'):>8}   {reference}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the DOM preprocessing pipeline')
+    parser.add_argument('--sizes', type=str, nargs='+', default=['100KB', '1MB'], help='Sizes of the synthetic pages, e.g. 100KB 10MB 100MB')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per case, the fastest one is reported')
+    parser.add_argument('--no-memory', action='store_true', help='Skip the tracemalloc runs that measure peak memory')
+    parser.add_argument('--pages-dir', type=str, default='.benchmark_pages', help='Directory the synthetic pages are generated in')
+    parser.add_argument('--baselines', type=str, default=BASELINES, help='JSON file with the stored baselines')
+    parser.add_argument('--update-baselines', action='store_true', help='Store the results of this run as the baselines')
+    parser.add_argument('--output', type=str, default=None, help='Also write the results to this JSON file')
+    parser.add_argument('--time-tolerance', type=float, default=0.5, help='Allowed relative slowdown before a case counts as a regression')
+    parser.add_argument('--memory-tolerance', type=float, default=0.2, help='Allowed relative growth of the peak memory')
+    args = parser.parse_args()
+
+    trace_memory = not args.no_memory
+    results = {}
+    results.update(benchmark_page("denver", DENVER, DENVER_TARGET_STRING, args.repeat, trace_memory))
+    results.update(benchmark_end_to_end("denver", DENVER, DENVER_TARGET_STRING, args.repeat, trace_memory))
+    for size in args.sizes:
+        path = page_path(parse_size(size), args.pages_dir)
+        results.update(benchmark_page(f"synthetic-{size}", path, TARGET_STRING, args.repeat, trace_memory))
+    smallest = min(args.sizes, key=parse_size)
+    path = page_path(parse_size(smallest), args.pages_dir)
+    results.update(benchmark_end_to_end(f"synthetic-{smallest}", path, TARGET_STRING, args.repeat, trace_memory))
+
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines, "r") as file:
+            baselines = json.load(file)
+    print_report(results, baselines)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+    if args.update_baselines:
+        baselines.update(results)
+        with open(args.baselines, "w") as file:
+            json.dump(baselines, file, indent=2, sort_keys=True)
+            file.write("\n")
+        return
+
+    regressions = compare(results, baselines, args.time_tolerance, args.memory_tolerance)
+    if regressions:
+        print("\nRegressions:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
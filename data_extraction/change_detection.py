@@ -0,0 +1,188 @@
+"""change_detection.py: Remember what every page looked like, to re-scrape only pages that changed.
+
+Scheduled runs scrape the same URLs with the same requirements again and again, and
+most pages have not changed since the last run. For every URL and requirements the
+state store keeps a hash of the raw body, a hash of the part of the page the scraper
+reads (see HtmlManager.subtree_hash) and the records the scraper emitted.
+
+A page whose body is unchanged is not even parsed. A page whose body changed only
+outside the relevant part, e.g. in an ad, a timestamp or a CSRF token, is parsed
+but neither sent to the LLM nor scraped. For both, the stored records are emitted
+again, or only reported as unchanged. Only the pages that really changed are scraped.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import List, Optional
+
+
+def content_hash(text: str) -> str:
+    """
+    Return the hash a page body is compared by.
+
+    :param text: The body
+    :return: A hex digest
+    """
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class PageState:
+    """What a page looked like when its records were last extracted."""
+
+    def __init__(self, url: str, body_hash: Optional[str], subtree_hash: Optional[str], records: List[dict], scraped_at: float, checked_at: float):
+        """
+        Initialize the PageState class.
+
+        :param url: The URL or path of the page
+        :param body_hash: Hash of the raw body, None if the body was never loaded completely
+        :param subtree_hash: Hash of the part of the page the scraper reads
+        :param records: The records emitted by the scraper
+        :param scraped_at: Time the page was last scraped
+        :param checked_at: Time the page was last found unchanged, or scraped
+        """
+        self.url = url
+        self.body_hash = body_hash
+        self.subtree_hash = subtree_hash
+        self.records = records
+        self.scraped_at = scraped_at
+        self.checked_at = checked_at
+
+
+class PageStateStore:
+    """The states of scraped pages, stored in SQLite with the records compressed."""
+
+    def __init__(self, directory: str = ".page_states"):
+        """
+        Open or create the store in the given directory.
+
+        :param directory: Directory holding the store database, defaults to ".page_states"
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            os.path.join(directory, "pages.sqlite3"), check_same_thread=False, timeout=30
+        )
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS pages (
+                    url TEXT NOT NULL,
+                    requirements TEXT NOT NULL,
+                    body_hash TEXT,
+                    subtree_hash TEXT,
+                    records BLOB NOT NULL,
+                    scraped_at REAL NOT NULL,
+                    checked_at REAL NOT NULL,
+                    PRIMARY KEY (url, requirements)
+                )
+                """
+            )
+
+    def get(self, url: str, requirements: Optional[str]) -> Optional[PageState]:
+        """
+        Return the state of a page as of its last scrape.
+
+        :param url: The URL or path of the page
+        :param requirements: The requirements the page was scraped for
+        :return: The PageState, or None if the page was never scraped for these requirements
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT body_hash, subtree_hash, records, scraped_at, checked_at FROM pages WHERE url = ? AND requirements = ?",
+                (url, requirements or ""),
+            ).fetchone()
+        if row is None:
+            return None
+        body_hash, subtree_hash, records, scraped_at, checked_at = row
+        return PageState(url, body_hash, subtree_hash, json.loads(zlib.decompress(records)), scraped_at, checked_at)
+
+    def put(self, url: str, requirements: Optional[str], body_hash: Optional[str], subtree_hash: Optional[str], records: List[dict]) -> None:
+        """
+        Store the state of a page that has just been scraped.
+
+        :param url: The URL or path of the page
+        :param requirements: The requirements the page was scraped for
+        :param body_hash: Hash of the raw body, None if it was not loaded completely
+        :param subtree_hash: Hash of the part of the page the scraper reads
+        :param records: The records emitted by the scraper
+        """
+        compressed = zlib.compress(json.dumps(records, ensure_ascii=False, default=str).encode("utf-8"), 6)
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, requirements or "", body_hash, subtree_hash, compressed, now, now),
+            )
+
+    def unchanged(self, url: str, requirements: Optional[str], body_hash: Optional[str]) -> None:
+        """
+        Record that a page was found unchanged, with the hash of its current body.
+
+        The body may differ outside the part the scraper reads, storing its hash lets the
+        next run recognize the same body without parsing it.
+
+        :param url: The URL or path of the page
+        :param requirements: The requirements the page was scraped for
+        :param body_hash: Hash of the current raw body, None to keep the stored one
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE pages SET body_hash = COALESCE(?, body_hash), checked_at = ? WHERE url = ? AND requirements = ?",
+                (body_hash, time.time(), url, requirements or ""),
+            )
+
+    def forget(self, url: str, requirements: Optional[str]) -> None:
+        """
+        Remove the state of a page, so it is scraped again on the next run.
+
+        :param url: The URL or path of the page
+        :param requirements: The requirements the page was scraped for
+        """
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM pages WHERE url = ? AND requirements = ?", (url, requirements or ""))
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+
+    def close(self) -> None:
+        """Close the database."""
+        with self._lock:
+            self._connection.close()
+
+
+class RecordCollector:
+    """Keeps the records a scraper emits for one page, and passes them on to the sink of the run once it succeeded."""
+
+    def __init__(self, sink=None):
+        """
+        Initialize the RecordCollector class.
+
+        :param sink: The RecordSink of the run, defaults to printing the records as JSON lines
+        """
+        self.sink = sink
+        self.records = []
+
+    def write(self, record: dict) -> None:
+        self.records.append(record)
+
+    def write_many(self, records) -> None:
+        self.records.extend(records)
+
+    def clear(self) -> None:
+        """Drop the records collected so far, e.g. before a scraper runs again."""
+        self.records = []
+
+    def flush(self) -> None:
+        """Pass the collected records on to the sink, or print them."""
+        if self.sink is not None:
+            self.sink.write_many(self.records)
+        else:
+            for record in self.records:
+                print(json.dumps(record, ensure_ascii=False, default=str))
@@ -1,11 +1,59 @@
+import os
 import subprocess
+import tempfile
+import traceback
 
 class CodeExecutor:
     def __init__(self, file_name):
         self.file_name = file_name
 
-    def execute(self):
+    def execute(self, document=None, records_file=None):
         """
-        Execute the python file
+        Execute the python file and return its exit code
+
+        If the already loaded document is given, it is handed to the scraper through
+        the SCRAPER_DOCUMENT file so the scraper does not download it again.
+        If a records file is given, the records the scraper emits are appended to it.
+        """
+        env = dict(os.environ)
+        if records_file is not None:
+            env["SCRAPER_RECORDS"] = records_file
+        if document is None:
+            return subprocess.call(["python", self.file_name], env=env)
+
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', suffix='.html', delete=False) as file:
+            file.write(document)
+        try:
+            env["SCRAPER_DOCUMENT"] = file.name
+            return subprocess.call(["python", self.file_name], env=env)
+        finally:
+            os.remove(file.name)
+
+
+class InlineCodeExecutor:
+    def execute(self, scraping_code, document=None, parsed_document=None, emit=None):
+        """
+        Execute the scraping code in the current process and return an exit code
+
+        The scraper receives the loaded document as `response` and its parse tree as
+        `html_soup`, so neither is loaded nor parsed again, and `emit` as the function
+        its records are passed to. Only use this for trusted code: the scraper runs
+        without any isolation.
         """
-        subprocess.call(["python", self.file_name])
+        namespace = {"__name__": "__main__"}
+        if emit is not None:
+            namespace["emit"] = emit
+        if document is not None:
+            namespace["response"] = document
+        if parsed_document is not None:
+            namespace["html_soup"] = parsed_document
+        try:
+            exec(compile(scraping_code, "<scraping_code>", "exec"), namespace)
+        except SystemExit as error:
+            if error.code is None or isinstance(error.code, int):
+                return error.code or 0
+            return 1
+        except Exception:
+            traceback.print_exc()
+            return 1
+        return 0
@@ -0,0 +1,299 @@
+"""execution_pool.py: A pool of pre-warmed worker processes that run generated scrapers.
+
+Running every scraper with ``python scraping_code.py`` pays interpreter start-up and
+the bs4/website_analysis imports on each page. The workers in this pool import those
+modules once, receive compiled code objects over a pipe and send structured results
+back. Each job has a wall-clock limit, each worker a memory limit, and workers are
+replaced after a fixed number of jobs so leaks in generated code cannot accumulate.
+"""
+import contextlib
+import hashlib
+import importlib
+import io
+import marshal
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from typing import Optional
+
+try:
+    import resource
+except ImportError:  # Not available on Windows, memory limits are skipped there
+    resource = None
+
+PRELOADED_MODULES = ("bs4", "website_analysis.dom_analysis", "data_extraction.sinks")
+
+
+class ScraperResult:
+    """The structured outcome of running a generated scraper."""
+
+    def __init__(
+        self,
+        ok: bool,
+        stdout: str = "",
+        error: Optional[str] = None,
+        elapsed: float = 0.0,
+    ):
+        """
+        Initialize the ScraperResult class.
+
+        :param ok: Whether the scraper finished without raising
+        :param stdout: Everything the scraper printed
+        :param error: A traceback or reason for the failure, if any
+        :param elapsed: Wall-clock time in seconds spent running the scraper
+        """
+        self.ok = ok
+        self.stdout = stdout
+        self.error = error
+        self.elapsed = elapsed
+
+    def __repr__(self):
+        return f"ScraperResult(ok={self.ok}, elapsed={self.elapsed:.3f})"
+
+
+class CompiledCodeCache:
+    """An LRU cache of compiled code objects keyed by a hash of the source."""
+
+    def __init__(self, maxsize: int = 128):
+        """
+        Initialize the CompiledCodeCache class.
+
+        :param maxsize: Maximum number of compiled scrapers kept, defaults to 128
+        """
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(code: str) -> str:
+        """
+        Return the cache key of the source code.
+
+        :param code: Python source code
+        :return: A hex digest of the source
+        """
+        return hashlib.sha256(code.encode("utf-8")).hexdigest()
+
+    def get(self, code: str):
+        """
+        Return the key and the marshalled code object for the source, compiling on a miss.
+
+        :param code: Python source code
+        :return: A (key, marshalled code object) tuple
+        :raises SyntaxError: If the source does not compile
+        """
+        key = self.key(code)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return key, self._entries[key]
+
+        compiled = marshal.dumps(compile(code, f"<scraper {key[:12]}>", "exec"))
+        with self._lock:
+            self._entries[key] = compiled
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return key, compiled
+
+
+def _worker_main(conn, memory_limit, preload):
+    """Run jobs received over the pipe until told to stop."""
+    if resource is not None and memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    for module in preload:
+        importlib.import_module(module)
+    conn.send(("ready", None))
+
+    code_objects = {}
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+        if message is None:
+            return
+
+        key, compiled, namespace = message
+        if compiled is not None:
+            code_objects[key] = marshal.loads(compiled)
+        elif key not in code_objects:
+            conn.send(("missing", key))
+            continue
+
+        stdout = io.StringIO()
+        start = time.perf_counter()
+        namespace = dict(namespace, __name__="__main__")
+        ok, error, fatal = True, None, False
+        try:
+            with contextlib.redirect_stdout(stdout):
+                exec(code_objects[key], namespace)
+        except SystemExit as exit_error:
+            ok = exit_error.code in (None, 0)
+            error = None if ok else f"SystemExit: {exit_error.code}"
+        except MemoryError:
+            ok, error, fatal = False, "MemoryError: worker memory limit exceeded", True
+        except BaseException:
+            ok, error = False, traceback.format_exc()
+        elapsed = time.perf_counter() - start
+
+        conn.send(("done", {"ok": ok, "stdout": stdout.getvalue(), "error": error, "elapsed": elapsed}))
+        if fatal:
+            return
+
+
+class _Worker:
+    """The parent-side handle of a worker process."""
+
+    def __init__(self, context, memory_limit, preload):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main,
+            args=(child_conn, memory_limit, preload),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.jobs = 0
+        self.known_keys = set()
+        self.ready = False
+
+    def wait_ready(self, timeout):
+        """Wait until the worker has imported the preloaded modules."""
+        if not self.ready:
+            if not self.conn.poll(timeout):
+                raise EOFError(f"Worker did not start within {timeout}s")
+            self.conn.recv()
+            self.ready = True
+
+    def stop(self, timeout=1):
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class ScraperExecutionPool:
+    """Run generated scrapers in a pool of long-lived, pre-warmed worker processes."""
+
+    # Seconds a new worker may take to import the preloaded modules
+    STARTUP_TIMEOUT = 60
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        timeout: float = 60,
+        memory_limit_mb: Optional[int] = 1024,
+        max_jobs_per_worker: int = 100,
+        preload=PRELOADED_MODULES,
+        start_method: str = "spawn",
+    ):
+        """
+        Start the worker processes.
+
+        :param workers: Number of worker processes, defaults to the number of CPUs
+        :param timeout: Wall-clock limit in seconds for a single job, defaults to 60
+        :param memory_limit_mb: Address-space limit per worker in MB, None to disable, defaults to 1024
+        :param max_jobs_per_worker: Jobs after which a worker is replaced, defaults to 100
+        :param preload: Modules imported by every worker before its first job
+        :param start_method: The multiprocessing start method, defaults to "spawn"
+        """
+        self.timeout = timeout
+        self.memory_limit = memory_limit_mb * 1024 * 1024 if memory_limit_mb else None
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.preload = tuple(preload)
+        self.code_cache = CompiledCodeCache()
+        self._context = multiprocessing.get_context(start_method)
+        self._idle = queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+        self._closed = False
+        for _ in range(workers or os.cpu_count() or 1):
+            self._add_worker()
+
+    def run(self, code: str, namespace: Optional[dict] = None) -> ScraperResult:
+        """
+        Run scraping code in an idle worker and wait for its result.
+
+        Safe to call from several threads; calls block until a worker is free.
+
+        :param code: The Python source of the scraper
+        :param namespace: Picklable globals made available to the scraper
+        :return: A ScraperResult describing the run
+        """
+        try:
+            key, compiled = self.code_cache.get(code)
+        except SyntaxError:
+            return ScraperResult(False, error=traceback.format_exc())
+
+        worker = self._idle.get()
+        replace = False
+        try:
+            result, replace = self._run_on(worker, key, compiled, namespace or {})
+        except (OSError, EOFError) as error:
+            result, replace = ScraperResult(False, error=f"Worker failed: {error!r}"), True
+        finally:
+            worker.jobs += 1
+            if replace or worker.jobs >= self.max_jobs_per_worker:
+                self._replace_worker(worker)
+            else:
+                self._idle.put(worker)
+        return result
+
+    def close(self):
+        """Stop all worker processes."""
+        with self._lock:
+            self._closed = True
+            workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _run_on(self, worker, key, compiled, namespace):
+        # Starting a worker does not count against the job's time limit
+        worker.wait_ready(self.STARTUP_TIMEOUT)
+        start = time.perf_counter()
+        payload = None if key in worker.known_keys else compiled
+        worker.conn.send((key, payload, namespace))
+        while True:
+            remaining = self.timeout - (time.perf_counter() - start)
+            if remaining <= 0 or not worker.conn.poll(remaining):
+                return ScraperResult(False, error=f"Timed out after {self.timeout}s", elapsed=time.perf_counter() - start), True
+
+            status, data = worker.conn.recv()
+            if status == "missing":
+                worker.conn.send((key, compiled, namespace))
+                continue
+            worker.known_keys.add(key)
+            result = ScraperResult(data["ok"], data["stdout"], data["error"], data["elapsed"])
+            # A MemoryError ends the worker process, so it has to be replaced
+            return result, not worker.process.is_alive() or (data["error"] or "").startswith("MemoryError")
+
+    def _add_worker(self):
+        worker = _Worker(self._context, self.memory_limit, self.preload)
+        with self._lock:
+            if self._closed:
+                worker.stop()
+                return
+            self._workers.append(worker)
+        self._idle.put(worker)
+
+    def _replace_worker(self, worker):
+        with self._lock:
+            if worker in self._workers:
+                self._workers.remove(worker)
+        worker.stop(timeout=0)
+        self._add_worker()
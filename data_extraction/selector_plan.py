@@ -0,0 +1,516 @@
+"""selector_plan.py: Declarative extraction plans and a bulk extractor that applies them.
+
+A plan maps named fields to CSS or XPath selectors plus a few simple transforms:
+
+    {
+      "rows": "table.temperature-table tr",
+      "fields": {
+        "month": {"css": "td:nth-of-type(1)"},
+        "temperature": {"css": "td:nth-of-type(2)", "transforms": ["number"]},
+        "link": {"css": "a", "attribute": "href"}
+      }
+    }
+
+With "rows", every element matching it becomes one record and the field selectors
+are relative to it; without, every document becomes one record. Plans are plain
+JSON, so they can be cached, diffed and reviewed, and applying one needs neither
+exec nor a subprocess: the BulkExtractor runs a plan over thousands of documents in
+one process and returns a pandas DataFrame.
+
+CSS selectors run on selectolax (lexbor) when it is installed and on BeautifulSoup
+otherwise; XPath selectors need lxml.
+"""
+import hashlib
+import json
+import re
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import pandas as pd
+
+from website_analysis.parser_backends import _importable
+
+_NUMBER = re.compile(r"-?\d[\d,]*(?:\.\d+)?|-?\.\d+")
+
+
+def _number(value: str) -> Optional[float]:
+    match = _NUMBER.search(value)
+    if match is None:
+        return None
+    number = float(match.group(0).replace(",", ""))
+    return int(number) if number.is_integer() and "." not in match.group(0) else number
+
+
+def _converter(convert):
+    # Conversions of malformed values give None instead of failing the whole batch
+    def transform(value):
+        try:
+            return convert(value)
+        except ValueError:
+            return None
+    return transform
+
+
+TRANSFORMS: Dict[str, Callable[[str], object]] = {
+    "strip": str.strip,
+    "collapse": lambda value: " ".join(value.split()),
+    "lower": str.lower,
+    "upper": str.upper,
+    "int": _converter(lambda value: int(value.strip().replace(",", ""))),
+    "float": _converter(lambda value: float(value.strip().replace(",", ""))),
+    "number": _number,
+}
+
+
+def _regex_transform(pattern: str) -> Callable[[str], Optional[str]]:
+    # "regex:<pattern>" keeps the first group of the first match, or the whole match
+    compiled = re.compile(pattern)
+
+    def transform(value):
+        match = compiled.search(value)
+        if match is None:
+            return None
+        return match.group(1) if compiled.groups else match.group(0)
+    return transform
+
+
+def compile_transform(name: str) -> Callable[[str], object]:
+    """
+    Return the function of a transform.
+
+    :param name: A name from TRANSFORMS, or "regex:<pattern>"
+    :return: A function mapping a string to the transformed value
+    :raises ValueError: If the transform is unknown or its pattern invalid
+    """
+    if name.startswith("regex:"):
+        try:
+            return _regex_transform(name[len("regex:"):])
+        except re.error as error:
+            raise ValueError(f"Invalid regex transform {name!r}: {error}") from error
+    if name not in TRANSFORMS:
+        raise ValueError(f"Unknown transform {name!r}, expected one of {', '.join(TRANSFORMS)} or regex:<pattern>")
+    return TRANSFORMS[name]
+
+
+class FieldSpec:
+    """How to find and clean up one field of a record."""
+
+    def __init__(
+        self,
+        css: Optional[str] = None,
+        xpath: Optional[str] = None,
+        attribute: Optional[str] = None,
+        transforms: Iterable[str] = (),
+        multiple: bool = False,
+    ):
+        """
+        Initialize the FieldSpec class.
+
+        :param css: CSS selector of the element, relative to the row
+        :param xpath: XPath of the element, relative to the row, instead of css
+        :param attribute: Attribute to take instead of the text of the element
+        :param transforms: Names of the transforms applied to the value, in order
+        :param multiple: Collect the values of all matching elements into a list
+        :raises ValueError: If not exactly one selector is given or a transform is unknown
+        """
+        if (css is None) == (xpath is None):
+            raise ValueError("A field needs exactly one of css and xpath")
+        self.css = css
+        self.xpath = xpath
+        self.attribute = attribute
+        self.transforms = list(transforms)
+        self.multiple = multiple
+        self._functions = [compile_transform(name) for name in self.transforms]
+
+    def clean(self, value: Optional[str]):
+        """Apply the transforms to a raw value; None stays None."""
+        for function in self._functions:
+            if value is None:
+                break
+            value = function(value) if isinstance(value, str) else value
+        return value
+
+    def to_dict(self) -> dict:
+        spec = {"css": self.css} if self.css is not None else {"xpath": self.xpath}
+        if self.attribute:
+            spec["attribute"] = self.attribute
+        if self.transforms:
+            spec["transforms"] = self.transforms
+        if self.multiple:
+            spec["multiple"] = True
+        return spec
+
+    @classmethod
+    def from_dict(cls, spec) -> "FieldSpec":
+        if isinstance(spec, str):
+            return cls(css=spec)
+        unknown = set(spec) - {"css", "xpath", "attribute", "transforms", "multiple"}
+        if unknown:
+            raise ValueError(f"Unknown field keys: {', '.join(sorted(unknown))}")
+        return cls(**spec)
+
+
+class SelectorPlan:
+    """Named fields mapped to selectors, optionally repeated per row."""
+
+    def __init__(self, fields: Dict[str, FieldSpec], rows: Optional[str] = None, rows_xpath: Optional[str] = None):
+        """
+        Initialize the SelectorPlan class.
+
+        :param fields: The fields of a record, in column order
+        :param rows: CSS selector of the elements that each become a record
+        :param rows_xpath: XPath of the row elements, instead of rows
+        :raises ValueError: If the plan has no fields or two row selectors
+        """
+        if not fields:
+            raise ValueError("A selector plan needs at least one field")
+        if rows is not None and rows_xpath is not None:
+            raise ValueError("A plan has either rows or rows_xpath, not both")
+        self.fields = dict(fields)
+        self.rows = rows
+        self.rows_xpath = rows_xpath
+
+    @property
+    def uses_xpath(self) -> bool:
+        return self.rows_xpath is not None or any(field.xpath is not None for field in self.fields.values())
+
+    @property
+    def uses_css(self) -> bool:
+        return self.rows is not None or any(field.css is not None for field in self.fields.values())
+
+    def to_dict(self) -> dict:
+        plan = {}
+        if self.rows is not None:
+            plan["rows"] = self.rows
+        if self.rows_xpath is not None:
+            plan["rows_xpath"] = self.rows_xpath
+        plan["fields"] = {name: field.to_dict() for name, field in self.fields.items()}
+        return plan
+
+    def to_json(self) -> str:
+        """Return the plan as stable, diffable JSON."""
+        return json.dumps(self.to_dict(), indent=2, ensure_ascii=False)
+
+    def key(self) -> str:
+        """Return a hash identifying the plan."""
+        return hashlib.sha256(json.dumps(self.to_dict(), sort_keys=True).encode("utf-8")).hexdigest()
+
+    @classmethod
+    def from_dict(cls, plan: dict) -> "SelectorPlan":
+        """
+        Build a plan from its JSON structure.
+
+        :raises ValueError: If the structure is not a valid plan
+        """
+        if not isinstance(plan, dict) or not isinstance(plan.get("fields"), dict):
+            raise ValueError("A selector plan is an object with a \"fields\" object")
+        unknown = set(plan) - {"fields", "rows", "rows_xpath"}
+        if unknown:
+            raise ValueError(f"Unknown plan keys: {', '.join(sorted(unknown))}")
+        try:
+            fields = {name: FieldSpec.from_dict(spec) for name, spec in plan["fields"].items()}
+        except TypeError as error:
+            raise ValueError(f"Invalid field: {error}") from error
+        return cls(fields, rows=plan.get("rows"), rows_xpath=plan.get("rows_xpath"))
+
+    @classmethod
+    def from_json(cls, text: str) -> "SelectorPlan":
+        """
+        Parse a plan from JSON, or from an LLM answer with the JSON in a code block.
+
+        :raises ValueError: If no valid plan can be read from the text
+        """
+        match = re.search(r"```(?:json)?[ \t]*\n(.*?)```", text, re.S)
+        try:
+            plan = json.loads(match.group(1) if match else text)
+        except json.JSONDecodeError as error:
+            raise ValueError(f"The selector plan is not valid JSON: {error}") from error
+        return cls.from_dict(plan)
+
+    def save(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(self.to_json() + "\n")
+
+    @classmethod
+    def load(cls, path: str) -> "SelectorPlan":
+        with open(path, "r", encoding="utf-8") as file:
+            return cls.from_json(file.read())
+
+
+class _SelectolaxBackend:
+    name = "selectolax"
+
+    def __init__(self):
+        from selectolax.lexbor import LexborHTMLParser
+
+        self._parse = LexborHTMLParser
+
+    def parse(self, html):
+        return self._parse(html)
+
+    def css(self, node, selector):
+        return node.css(selector)
+
+    def text(self, node):
+        return node.text(deep=True)
+
+    def attribute(self, node, name):
+        return node.attributes.get(name)
+
+
+class _SoupBackend:
+    name = "bs4"
+
+    def parse(self, html):
+        from website_analysis.dom_analysis import HTMLParser
+
+        return HTMLParser().parse(html)
+
+    def css(self, node, selector):
+        return node.select(selector)
+
+    def text(self, node):
+        return node.get_text()
+
+    def attribute(self, node, name):
+        value = node.get(name)
+        # BeautifulSoup returns multi-valued attributes such as class as lists
+        return " ".join(value) if isinstance(value, list) else value
+
+
+class _LxmlBackend:
+    name = "lxml"
+
+    def __init__(self):
+        import lxml.html
+
+        self._parse = lxml.html.fromstring
+
+    def parse(self, html):
+        return self._parse(html)
+
+    def css(self, node, selector):
+        return node.cssselect(selector)
+
+    def xpath(self, node, expression):
+        return node.xpath(expression)
+
+    def text(self, node):
+        return node if isinstance(node, str) else node.text_content()
+
+    def attribute(self, node, name):
+        return node.get(name)
+
+
+def _backend_for(plan: SelectorPlan, backend: Optional[str]):
+    if backend is None:
+        if plan.uses_xpath:
+            backend = "lxml"
+        elif _importable("selectolax"):
+            backend = "selectolax"
+        else:
+            backend = "bs4"
+    if backend == "lxml":
+        if not _importable("lxml"):
+            raise ValueError("Selector plans with XPath need lxml")
+        if plan.uses_css and not _importable("cssselect"):
+            raise ValueError("Selector plans mixing XPath and CSS need cssselect")
+        return _LxmlBackend()
+    if plan.uses_xpath:
+        raise ValueError(f"The {backend} backend does not support XPath")
+    if backend == "selectolax":
+        return _SelectolaxBackend()
+    if backend == "bs4":
+        return _SoupBackend()
+    raise ValueError(f"Unknown extraction backend: {backend}")
+
+
+class BulkExtractor:
+    """Apply a selector plan to many documents in this process."""
+
+    def __init__(self, plan: SelectorPlan, backend: Optional[str] = None):
+        """
+        Initialize the BulkExtractor class.
+
+        :param plan: The selector plan to apply
+        :param backend: "selectolax", "bs4" or "lxml", defaults to the fastest one that supports the plan
+        :raises ValueError: If the backend is unknown, not installed or cannot run the plan
+        """
+        self.plan = plan
+        self.backend = _backend_for(plan, backend)
+
+    def extract(self, html: str) -> List[dict]:
+        """
+        Extract the records of one document.
+
+        Rows in which no field has a value, such as table headers, are skipped.
+
+        :param html: The HTML of the document
+        :return: One dict per record, with a key per field
+        """
+        document = self.backend.parse(html)
+        if self.plan.rows is not None:
+            rows = self.backend.css(document, self.plan.rows)
+        elif self.plan.rows_xpath is not None:
+            rows = self.backend.xpath(document, self.plan.rows_xpath)
+        else:
+            rows = [document]
+
+        records = []
+        for row in rows:
+            record = {name: self._value(row, field) for name, field in self.plan.fields.items()}
+            if any(value is not None and value != [] for value in record.values()):
+                records.append(record)
+        return records
+
+    def extract_many(self, documents: Iterable[Tuple[str, str]]) -> pd.DataFrame:
+        """
+        Extract the records of many documents into one DataFrame.
+
+        :param documents: (source, html) tuples
+        :return: A DataFrame with a source column followed by a column per field
+        """
+        records = []
+        for source, html in documents:
+            records.extend({"source": source, **record} for record in self.extract(html))
+        return self.to_frame(records)
+
+    def to_frame(self, records: List[dict]) -> pd.DataFrame:
+        """
+        Return records with a source key as a DataFrame with the columns of the plan.
+
+        :param records: Records returned by extract, each with an added source
+        :return: A DataFrame with a source column followed by a column per field
+        """
+        return pd.DataFrame.from_records(records, columns=["source", *self.plan.fields])
+
+    def extract_files(self, paths: Iterable[str], encoding: str = "utf-8") -> pd.DataFrame:
+        """
+        Extract the records of many local HTML files into one DataFrame.
+
+        :param paths: Paths of the HTML files
+        :param encoding: Encoding of the files, defaults to utf-8
+        :return: A DataFrame with a source column followed by a column per field
+        """
+        def documents():
+            for path in paths:
+                with open(path, "r", encoding=encoding, errors="replace") as file:
+                    yield path, file.read()
+
+        return self.extract_many(documents())
+
+    def _value(self, row, field):
+        if field.css is not None:
+            matches = self.backend.css(row, field.css)
+        else:
+            matches = self.backend.xpath(row, field.xpath)
+        if not field.multiple:
+            matches = matches[:1]
+        values = [self._raw(match, field) for match in matches]
+        values = [field.clean(value) for value in values]
+        if field.multiple:
+            return [value for value in values if value is not None]
+        return values[0] if values else None
+
+    def _raw(self, node, field):
+        if field.attribute:
+            return None if isinstance(node, str) else self.backend.attribute(node, field.attribute)
+        text = self.backend.text(node)
+        return text.strip() if text is not None else None
+
+
+def write_frame(frame: pd.DataFrame, path: str) -> None:
+    """
+    Write extracted records to a file in the format of its extension.
+
+    :param frame: The extracted records
+    :param path: A .csv, .json or .jsonl path
+    :raises ValueError: If the extension is not supported
+    """
+    extension = path.rsplit(".", 1)[-1].lower()
+    if extension == "csv":
+        frame.to_csv(path, index=False)
+    elif extension == "json":
+        frame.to_json(path, orient="records", force_ascii=False, indent=2)
+    elif extension == "jsonl":
+        frame.to_json(path, orient="records", force_ascii=False, lines=True)
+    else:
+        raise ValueError(f"Unsupported output format {extension!r}, use .csv, .json or .jsonl")
+
+
+def _css_step(tag) -> str:
+    # tag#id, or tag.class.class; enough to tell the element apart from its neighbours
+    if tag.get("id") and re.fullmatch(r"[A-Za-z][\w-]*", tag["id"]):
+        return f"{tag.name}#{tag['id']}"
+    classes = [name for name in tag.get("class", []) if re.fullmatch(r"-?[_A-Za-z][\w-]*", name)]
+    return tag.name + "".join(f".{name}" for name in classes)
+
+
+def _slug(text: str) -> str:
+    return re.sub(r"[^a-z0-9]+", "_", text.lower()).strip("_")
+
+
+def derive_plan(html: str, target_string: str) -> Optional[SelectorPlan]:
+    """
+    Derive a plan from the position of an example value, without asking the LLM.
+
+    The nearest ancestor of the example that repeats among its siblings (a table
+    row, a list item, a card) becomes the row, and each of its children with text
+    becomes a field, named after the table header when there is one. Columns whose
+    sampled values are all numeric get the number transform.
+
+    :param html: The HTML of a page
+    :param target_string: A value that should be extracted, e.g. "February"
+    :return: A plan, or None if the example is not found or does not sit in a repeating element
+    """
+    from website_analysis.dom_analysis import HTMLParser, HTMLSearcher
+
+    document = HTMLParser().parse(html)
+    match = HTMLSearcher().search(document, target_string)
+    if match is None:
+        return None
+    element = match if getattr(match, "name", None) else match.parent
+
+    # The row is the ancestor with the most siblings of the same tag and classes
+    row, repetitions = None, 1
+    for candidate in [element, *element.parents]:
+        if candidate.name in (None, "[document]", "html", "body") or candidate.parent is None:
+            break
+        count = sum(1 for sibling in candidate.parent.find_all(candidate.name, recursive=False) if _css_step(sibling) == _css_step(candidate))
+        if count > repetitions:
+            row, repetitions = candidate, count
+    if row is None:
+        return None
+
+    # Anchor the rows at the closest ancestor with an id or a class; descendant
+    # combinators keep the selector valid whether or not a tbody gets inserted
+    anchor = next((parent for parent in row.parents if parent.name and (parent.get("id") or parent.get("class"))), None)
+    rows = _css_step(row) if anchor is None else f"{_css_step(anchor)} {_css_step(row)}"
+
+    cells = [child for child in row.find_all(True, recursive=False) if child.get_text(strip=True)]
+    if not cells:
+        # The repeating elements hold the values themselves, e.g. list items
+        return SelectorPlan({_slug(row.name) or "value": FieldSpec(css=rows, multiple=True)})
+    headers = []
+    if row.name == "tr":
+        table = row.find_parent("table")
+        header_row = table.find(lambda tag: tag.name == "tr" and tag.find("th", recursive=False)) if table else None
+        if header_row is not None:
+            headers = [_slug(cell.get_text()) for cell in header_row.find_all(["th", "td"], recursive=False)]
+
+    samples = [sibling for sibling in row.parent.find_all(row.name, recursive=False) if _css_step(sibling) == _css_step(row)]
+    fields = {}
+    for cell in cells:
+        position = sum(1 for sibling in cell.find_previous_siblings(cell.name)) + 1
+        selector = f"{cell.name}:nth-of-type({position})"
+        index = row.find_all(True, recursive=False).index(cell)
+        name = headers[index] if index < len(headers) and headers[index] else _slug(_css_step(cell)) or cell.name
+        name = name if name not in fields else f"{name}_{index + 1}"
+
+        values = []
+        for sample in samples:
+            found = sample.find_all(cell.name, recursive=False)
+            if len(found) >= position:
+                values.append(found[position - 1].get_text(strip=True))
+        numeric = bool(values) and all(_NUMBER.fullmatch(value) for value in values if value)
+        fields[name] = FieldSpec(css=selector, transforms=["number"] if numeric else [])
+    return SelectorPlan(fields, rows=rows)
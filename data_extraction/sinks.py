@@ -0,0 +1,321 @@
+"""sinks.py: Streaming writers for the records that scrapers extract.
+
+Generated scrapers pass every record to emit(record). The records go to one sink per
+run, which buffers them in row groups of a fixed size and appends each full group to
+the current file, so memory stays flat however many pages a batch covers.
+
+Files are written under a hidden ".part" name and renamed to their final name
+(records-00000.jsonl, records-00001.jsonl, ...) once they are complete. The rename
+is atomic, so downstream jobs can pick up every finished file while the scrape is
+still running, and never see a half-written one. A new file is started once the
+current one holds --rotate-records records or --rotate-mb megabytes.
+
+Scrapers running in other processes cannot write to the sink of the run directly.
+Their emit() appends JSON lines to a spool file instead, which the run drains into
+the sink after the scraper finished.
+"""
+import csv
+import json
+import os
+import re
+import threading
+import warnings
+from typing import Iterable, List, Optional
+
+from website_analysis.parser_backends import _importable
+
+
+class RecordSink:
+    """Buffer records into row groups and write them to atomically rotated files."""
+
+    EXTENSION = None
+
+    def __init__(
+        self,
+        directory: str,
+        prefix: str = "records",
+        row_group_size: int = 1000,
+        max_records_per_file: Optional[int] = None,
+        max_bytes_per_file: Optional[int] = None,
+    ):
+        """
+        Initialize the RecordSink class.
+
+        :param directory: Directory the files are written to, created if needed
+        :param prefix: Start of the file names, defaults to "records"
+        :param row_group_size: Number of records buffered before they are written, defaults to 1000
+        :param max_records_per_file: Start a new file after this many records, defaults to no limit
+        :param max_bytes_per_file: Start a new file once the current one reaches this size, defaults to no limit
+        """
+        if row_group_size < 1:
+            raise ValueError("row_group_size must be at least 1")
+        self.directory = directory
+        self.prefix = prefix
+        self.row_group_size = row_group_size
+        self.max_records_per_file = max_records_per_file
+        self.max_bytes_per_file = max_bytes_per_file
+        self.files: List[str] = []
+        self.records_written = 0
+        self._buffer = []
+        self._file_records = 0
+        self._part = None
+        self._lock = threading.Lock()
+        self._closed = False
+        os.makedirs(directory, exist_ok=True)
+        self._index = self._next_index()
+
+    def write(self, record: dict) -> None:
+        """
+        Add a record, writing the buffered row group once it is full.
+
+        :param record: A dict of JSON-serializable values
+        """
+        with self._lock:
+            if self._closed:
+                raise ValueError("The sink is closed")
+            self._buffer.append(record)
+            if len(self._buffer) >= self.row_group_size:
+                self._flush()
+
+    def write_many(self, records: Iterable[dict]) -> None:
+        for record in records:
+            self.write(record)
+
+    def flush(self) -> None:
+        """Write the buffered records to the current file."""
+        with self._lock:
+            self._flush()
+
+    def rotate(self) -> None:
+        """Write the buffered records and publish the current file under its final name."""
+        with self._lock:
+            self._flush()
+            self._finish()
+
+    def close(self) -> None:
+        """Write the buffered records and publish the last file."""
+        with self._lock:
+            if self._closed:
+                return
+            self._flush()
+            self._finish()
+            self._closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _flush(self):
+        # Splits the buffer at the record limit of the files, so rotation is exact
+        while self._buffer:
+            group = self._buffer
+            if self.max_records_per_file:
+                room = self.max_records_per_file - self._file_records
+                group = self._buffer[:room]
+            self._buffer = self._buffer[len(group):]
+            if self._part is None:
+                self._part = os.path.join(self.directory, f".{self._name(self._index)}.part")
+                self._open(self._part)
+            self._write_group(group)
+            self._file_records += len(group)
+            self.records_written += len(group)
+            full = self.max_records_per_file and self._file_records >= self.max_records_per_file
+            large = self.max_bytes_per_file and self._size() >= self.max_bytes_per_file
+            if full or large:
+                self._finish()
+
+    def _finish(self):
+        if self._part is None:
+            return
+        self._close_file()
+        final = os.path.join(self.directory, self._name(self._index))
+        os.replace(self._part, final)
+        self.files.append(final)
+        self._part = None
+        self._file_records = 0
+        self._index += 1
+
+    def _name(self, index):
+        return f"{self.prefix}-{index:05d}.{self.EXTENSION}"
+
+    def _next_index(self):
+        # Continue after the files of earlier runs instead of overwriting them
+        pattern = re.compile(rf"{re.escape(self.prefix)}-(\d+)\.{self.EXTENSION}$")
+        indexes = [int(match.group(1)) for match in map(pattern.match, os.listdir(self.directory)) if match]
+        return max(indexes) + 1 if indexes else 0
+
+    def _open(self, path):
+        raise NotImplementedError
+
+    def _write_group(self, records):
+        raise NotImplementedError
+
+    def _size(self):
+        raise NotImplementedError
+
+    def _close_file(self):
+        raise NotImplementedError
+
+
+class JsonLinesSink(RecordSink):
+    """Write one JSON object per line."""
+
+    EXTENSION = "jsonl"
+
+    def _open(self, path):
+        self._file = open(path, "w", encoding="utf-8")
+
+    def _write_group(self, records):
+        self._file.write("".join(json.dumps(record, ensure_ascii=False, default=str) + "\n" for record in records))
+        self._file.flush()
+
+    def _size(self):
+        return self._file.tell()
+
+    def _close_file(self):
+        self._file.close()
+
+
+class CsvSink(RecordSink):
+    """
+    Write records as CSV with a header line per file.
+
+    The columns are those of the first record of the file; keys that only later
+    records have are dropped with a warning. Lists and dicts are written as JSON.
+    """
+
+    EXTENSION = "csv"
+
+    def _open(self, path):
+        self._file = open(path, "w", encoding="utf-8", newline="")
+        self._writer = None
+
+    def _write_group(self, records):
+        if self._writer is None:
+            self._writer = csv.DictWriter(self._file, fieldnames=list(records[0]), extrasaction="ignore")
+            self._writer.writeheader()
+        columns = set(self._writer.fieldnames)
+        extra = {key for record in records for key in record} - columns
+        if extra:
+            warnings.warn(f"Dropping columns missing from the first record of the file: {', '.join(sorted(extra))}")
+        self._writer.writerows({key: self._cell(value) for key, value in record.items()} for record in records)
+        self._file.flush()
+
+    @staticmethod
+    def _cell(value):
+        return json.dumps(value, ensure_ascii=False, default=str) if isinstance(value, (list, dict)) else value
+
+    def _size(self):
+        return self._file.tell()
+
+    def _close_file(self):
+        self._file.close()
+
+
+class ParquetSink(RecordSink):
+    """
+    Write records as Parquet, one row group per buffered group.
+
+    The schema is inferred from the first row group of each file. Needs pyarrow.
+    """
+
+    EXTENSION = "parquet"
+
+    def __init__(self, *args, **kwargs):
+        if not _importable("pyarrow"):
+            raise ValueError("The parquet sink needs pyarrow, install it with pip install pyarrow")
+        super().__init__(*args, **kwargs)
+
+    def _open(self, path):
+        self._path = path
+        self._writer = None
+
+    def _write_group(self, records):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self._writer is None:
+            table = pa.Table.from_pylist(records)
+            self._writer = pq.ParquetWriter(self._path, table.schema)
+        else:
+            table = pa.Table.from_pylist(records, schema=self._writer.schema)
+        self._writer.write_table(table, row_group_size=len(records))
+
+    def _size(self):
+        return os.path.getsize(self._path)
+
+    def _close_file(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+SINKS = {sink.EXTENSION: sink for sink in (JsonLinesSink, CsvSink, ParquetSink)}
+
+
+def open_sink(directory: str, format: str = "jsonl", **options) -> RecordSink:
+    """
+    Create a sink writing files of the given format.
+
+    :param directory: Directory the files are written to
+    :param format: "jsonl", "csv" or "parquet", defaults to "jsonl"
+    :param options: Further arguments of RecordSink
+    :return: The sink
+    :raises ValueError: If the format is unknown or its writer is not installed
+    """
+    if format not in SINKS:
+        raise ValueError(f"Unknown sink format {format!r}, expected one of {', '.join(SINKS)}")
+    return SINKS[format](directory, **options)
+
+
+class RecordEmitter:
+    """The emit() of generated scrapers: append records to a spool file, or print them."""
+
+    def __init__(self, path: Optional[str] = None):
+        """
+        Initialize the RecordEmitter class.
+
+        :param path: Spool file the records are appended to as JSON lines, defaults to printing them
+        """
+        self.path = path
+        self._file = None
+
+    def __call__(self, record: dict) -> None:
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        if self.path is None:
+            print(line)
+            return
+        if self._file is None:
+            # Line buffered, so every record is on disk when the scraper ends, even in a pool worker
+            self._file = open(self.path, "a", encoding="utf-8", buffering=1)
+        self._file.write(line + "\n")
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def drain_spool(path: str, sink: RecordSink) -> int:
+    """
+    Move the records of a spool file into a sink and delete the file.
+
+    :param path: The spool file written by RecordEmitter
+    :param sink: The sink of the run
+    :return: The number of records moved
+    """
+    count = 0
+    if not os.path.exists(path):
+        return count
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A scraper killed while writing leaves a partial last line
+                continue
+            sink.write(record)
+            count += 1
+    os.remove(path)
+    return count
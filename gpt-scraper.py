@@ -1,53 +1,122 @@
-from dotenv import load_dotenv
-from langchain import PromptTemplate
-from langchain.llms import OpenAI
 import argparse
-from website_analysis.dom_analysis import HtmlLoader, UrlHtmlLoader, HtmlManager
-from scraper_generation.scraper_generator import ScrapingCodeGenerator, CodeWriter
-from data_extraction.data_extractor import CodeExecutor 
+import os
+import sys
 
+# Only the standard library is imported up front: a run handed to the daemon never
+# loads the pipeline, and a local run loads it in ScrapeRunner
+from service.client import DAEMON_ENV, DEFAULT_ADDRESS, DaemonClient
 
-def main():
-    # Receive and parse arguments
+
+def build_parser():
+    # Receive and parse arguments
     parser = argparse.ArgumentParser(description='AI Web Scraper')
     parser.add_argument('--source', type=str, help='The URL or local path to HTML to scrape')
-    parser.add_argument('--source-type', type=str, choices=['url', 'file'], help='Type of the source: url or file')
+    parser.add_argument('--source-type', type=str, choices=['url', 'file', 'browser'], help='Type of the source: url, file, or browser for a URL rendered in headless Chrome')
+    parser.add_argument('--batch', type=str, help='A file with one URL per line, or a directory of HTML files, to scrape instead of --source')
+    parser.add_argument('--concurrency', type=int, default=32, help='Maximum number of pages fetched at the same time in batch mode')
+    parser.add_argument('--per-host-limit', type=int, default=4, help='Maximum number of connections per host in batch mode')
+    parser.add_argument('--crawl', action='store_true', help='Crawl from the --source or the URLs of the --batch, following pagination links')
+    parser.add_argument('--follow', type=str, default=None, help='Regular expression of further URLs to crawl besides pagination links')
+    parser.add_argument('--max-pages', type=int, default=None, help='Stop the crawl after fetching this many pages')
+    parser.add_argument('--crawl-delay', type=float, default=1.0, help='Seconds between two requests to the same host while crawling; a longer Crawl-delay in robots.txt takes precedence')
+    parser.add_argument('--crawl-checkpoint', type=str, default=None, help='File the state of the crawl is saved to, and resumed from when it exists')
     parser.add_argument('--requirements', type=str, help='The user requirements for scraping')
     parser.add_argument('--target-string', type=str, help='An example string to guide the scraper')
-    args = parser.parse_args()
+    parser.add_argument('--max-tokens', type=int, default=None, help='Token budget of the HTML sent to the model (default depends on the model)')
+    parser.add_argument('--streaming', action='store_true', help='Scan large local files incrementally and only load the part around the target string')
+    parser.add_argument('--parser', type=str, choices=['auto', 'lxml', 'html.parser'], default='auto', help='BeautifulSoup tree builder, defaults to the fastest installed one')
+    parser.add_argument('--no-locator', action='store_true', help='Parse large pages completely instead of cutting out the part around the target string with selectolax first')
+    parser.add_argument('--keep-repeated', action='store_true', help='Send every record of long lists, such as all rows of a table, to the LLM instead of a few samples')
+    parser.add_argument('--extract-with', type=str, choices=['code', 'plan'], default='code', help='Generate and run Python scrapers, or apply a declarative selector plan to every page in this process')
+    parser.add_argument('--plan-file', type=str, default=None, help='JSON selector plan to apply; if the file does not exist, the created plan is saved to it')
+    parser.add_argument('--derive-plan', action='store_true', help='Derive the selector plan from the position of --target-string instead of asking the LLM')
+    parser.add_argument('--output', type=str, default=None, help='Write the records extracted with a selector plan to this .csv, .json or .jsonl file instead of stdout')
+    parser.add_argument('--sink', type=str, default=None, help='Directory the records passed to emit() by the scrapers are written to, in rotated files')
+    parser.add_argument('--sink-format', type=str, choices=['jsonl', 'csv', 'parquet'], default='jsonl', help='Format of the record files; parquet needs pyarrow')
+    parser.add_argument('--row-group-size', type=int, default=1000, help='Number of records buffered before they are written to the record file')
+    parser.add_argument('--rotate-records', type=int, default=None, help='Start a new record file after this many records')
+    parser.add_argument('--rotate-mb', type=float, default=None, help='Start a new record file once the current one reaches this size in MB')
+    parser.add_argument('--state-store', type=str, default=None, help='Directory where the state of every scraped page is kept, so pages that did not change since the last run are not scraped again')
+    parser.add_argument('--unchanged', type=str, choices=['emit', 'mark'], default='emit', help='For unchanged pages, emit the records stored at the last run again, or only report the page as unchanged on stderr')
+    parser.add_argument('--candidates', type=int, default=1, help='Request this many scrapers at once at different temperatures, run them side by side in subprocesses and keep the first whose output contains --target-string')
+    parser.add_argument('--scraper-cache', type=str, default='.scraper_cache', help='Directory of cached generated scrapers')
+    parser.add_argument('--completion-cache', type=str, default='.completion_cache', help='Directory of cached LLM completions')
+    parser.add_argument('--completion-cache-ttl', type=float, default=None, help='Seconds after which a cached completion expires')
+    parser.add_argument('--completion-cache-size-mb', type=float, default=256, help='Maximum size of the completion cache in MB')
+    parser.add_argument('--no-cache', action='store_true', help='Always generate a new scraper instead of reusing a cached one or a cached completion')
+    parser.add_argument('--executor', type=str, choices=['subprocess', 'pool', 'inline'], default='subprocess', help='Run scrapers in a new interpreter each time, in a pool of warm worker processes, or inside this process')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes of the pool executor (default: number of CPUs)')
+    parser.add_argument('--job-timeout', type=float, default=60, help='Wall-clock limit in seconds for one scraper run in the pool executor')
+    parser.add_argument('--job-memory-mb', type=int, default=1024, help='Memory limit in MB of each pool worker')
+    parser.add_argument('--recycle-after', type=int, default=100, help='Number of scraper runs after which a pool worker is replaced')
+    parser.add_argument('--browsers', type=int, default=2, help='Maximum number of headless browsers kept running for --source-type browser')
+    parser.add_argument('--browser-contexts', type=int, default=4, help='Maximum number of pages one browser loads at the same time')
+    parser.add_argument('--browser-recycle-after', type=int, default=100, help='Number of pages after which a browser is replaced by a fresh one')
+    parser.add_argument('--http-cache', type=str, default=None, help='Directory of an on-disk HTTP cache shared by the loaders and the generated scrapers')
+    parser.add_argument('--http-cache-size-mb', type=float, default=256, help='Maximum size of the HTTP cache in MB')
+    parser.add_argument('--offline', action='store_true', help='Only use pages from the HTTP cache and never access the network')
+    parser.add_argument('--metrics-file', type=str, default=None, help='Append a JSON line with the timing and sizes of every pipeline stage to this file')
+    parser.add_argument('--metrics-port', type=int, default=None, help='Serve aggregated stage metrics for Prometheus on http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--serve', action='store_true', help='Keep running as a daemon with warm caches, workers and LLM client, and scrape what clients send to --daemon')
+    parser.add_argument('--daemon', type=str, default=os.environ.get(DAEMON_ENV), help=f'Unix socket path or host:port of the daemon; a client hands its run to the daemon when one is listening (default: ${DAEMON_ENV}, or {DEFAULT_ADDRESS} with --serve)')
+    return parser
+
 
-    source = args.source
-    source_type = args.source_type
-    USER_REQUIREMENTS = args.requirements
-    target_string = args.target_string
-    
+# Options holding paths, which the daemon would resolve against its own working directory
+PATH_OPTIONS = ("batch", "plan_file", "output", "crawl_checkpoint")
 
-    # Instantiate the HTML manager
-    manager = HtmlManager(source, source_type, target_string)
 
-    # Load Processed HTML
-    processed_html = manager.process_html()
+def run_on_daemon(args):
+    # Returns the exit code of the run, or None if no daemon is listening
+    from service.daemon import REQUEST_OPTIONS
 
-    # Instantiate ScrapingCodeGenerator with the processed_html
-    code_generator = ScrapingCodeGenerator(processed_html, source=source, source_type=source_type)
+    options = {key: getattr(args, key) for key in REQUEST_OPTIONS}
+    for key in PATH_OPTIONS:
+        if options[key]:
+            options[key] = os.path.abspath(options[key])
+    # For url and browser sources the source is a URL
+    source = options["source"]
+    if source and (options["source_type"] == "file" or "://" not in source):
+        options["source"] = os.path.abspath(source)
+    try:
+        result = DaemonClient(args.daemon).scrape(options)
+    except (ConnectionRefusedError, FileNotFoundError):
+        print(f"No daemon is listening on {args.daemon}, scraping in this process", file=sys.stderr)
+        return None
+    sys.stdout.write(result['stdout'])
+    sys.stderr.write(result['stderr'])
+    return result['exit_code']
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
 
-    # Generate scraping code
-    scraping_code = code_generator.generate_scraping_code(USER_REQUIREMENTS)
+    if args.serve:
+        from service.daemon import serve
 
-    # Instantiate CodeWriter
-    code_writer = CodeWriter('scraping_code.py')
+        try:
+            serve(args, args.daemon or DEFAULT_ADDRESS)
+        except ValueError as error:
+            parser.error(str(error))
+        return
 
-    # Write the code to a file
-    code_writer.write(scraping_code)
+    if args.daemon:
+        exit_code = run_on_daemon(args)
+        if exit_code is not None:
+            sys.exit(exit_code)
 
-    # Instantiate CodeExecutor
-    code_executor = CodeExecutor('scraping_code.py')
+    from service.runner import ScrapeRunner
 
-    # Execute the code
-    code_executor.execute()
+    try:
+        runner = ScrapeRunner(args)
+    except ValueError as error:
+        parser.error(str(error))
+    with runner:
+        sys.exit(runner.scrape(args))
 
 if __name__ == "__main__":
     main()
 
 
-# python3 gpt-scraper.py --source-type "file" --source "./results/denver.html" --requirements "Extract the average monthly temperature in denver"
\ No newline at end of file
+# python3 gpt-scraper.py --source-type "file" --source "./results/denver.html" --requirements "Extract the average monthly temperature in denver"
@@ -0,0 +1,261 @@
+"""completion_cache.py: A persistent cache of LLM completions.
+
+Completions are stored in a SQLite file under a key derived from the model, the
+sampling parameters and the messages of the request, so any request that has been
+answered before is served from disk instead of paying for the API call again. Entries
+expire after an optional time to live and the least recently used ones are evicted
+once the cache grows past its size cap.
+
+Concurrent identical requests, from threads or coroutines, are deduplicated: the
+first one calls the API and the others wait for its completion.
+
+Like the HTTP cache, the cache is configured through environment variables so that
+every LLM client of a run, in this process or in child processes, shares it.
+"""
+import asyncio
+import concurrent.futures
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Awaitable, Callable, Optional
+
+CACHE_DIR_ENV = "SCRAPER_COMPLETION_CACHE"
+CACHE_SIZE_ENV = "SCRAPER_COMPLETION_CACHE_SIZE_MB"
+CACHE_TTL_ENV = "SCRAPER_COMPLETION_CACHE_TTL"
+
+_shared_caches = {}
+_shared_lock = threading.Lock()
+
+
+class CompletionCache:
+    """A size-capped, LRU-evicted cache of completions with single-flight deduplication."""
+
+    def __init__(self, directory: str = ".completion_cache", max_size_mb: float = 256, ttl: Optional[float] = None):
+        """
+        Open or create the cache in the given directory.
+
+        :param directory: Directory holding the cache database, defaults to ".completion_cache"
+        :param max_size_mb: Maximum total size of the compressed completions in MB, defaults to 256
+        :param ttl: Seconds after which a completion expires, defaults to never
+        """
+        self.directory = directory
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._in_flight = {}  # Key -> concurrent.futures.Future of the pending completion
+        self._connection = sqlite3.connect(
+            os.path.join(directory, "completions.sqlite3"), check_same_thread=False, timeout=30
+        )
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS completions (
+                    key TEXT PRIMARY KEY,
+                    completion BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    stored_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+                """
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS completions_accessed_at ON completions (accessed_at)"
+            )
+
+    @classmethod
+    def from_env(cls) -> Optional["CompletionCache"]:
+        """
+        Return the cache configured through the environment, or None if there is none.
+
+        Instances are shared per directory within a process.
+
+        :return: The CompletionCache named by SCRAPER_COMPLETION_CACHE, or None
+        """
+        directory = os.environ.get(CACHE_DIR_ENV)
+        if not directory:
+            return None
+        max_size_mb = float(os.environ.get(CACHE_SIZE_ENV, 256))
+        ttl = float(os.environ[CACHE_TTL_ENV]) if os.environ.get(CACHE_TTL_ENV) else None
+        key = (os.path.abspath(directory), max_size_mb, ttl)
+        with _shared_lock:
+            if key not in _shared_caches:
+                _shared_caches[key] = cls(directory, max_size_mb, ttl)
+            return _shared_caches[key]
+
+    def configure_env(self, environ=os.environ) -> None:
+        """
+        Export this cache's settings so LLM clients created elsewhere use the same cache.
+
+        :param environ: The environment mapping to update, defaults to os.environ
+        """
+        environ[CACHE_DIR_ENV] = os.path.abspath(self.directory)
+        environ[CACHE_SIZE_ENV] = str(self.max_size / (1024 * 1024))
+        environ[CACHE_TTL_ENV] = "" if self.ttl is None else str(self.ttl)
+
+    @staticmethod
+    def key(model: str, params: dict, messages) -> str:
+        """
+        Return the cache key of a request.
+
+        :param model: Name of the model
+        :param params: Sampling parameters such as temperature and max_tokens
+        :param messages: The chat messages as a list of dicts, or the prompt of a completion model
+        :return: A hex digest identifying the request
+        """
+        request = json.dumps(
+            {"model": model, "params": params, "messages": messages},
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    @property
+    def stats(self) -> dict:
+        """Return the hit, miss and coalesced request counters."""
+        return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced}
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Return the cached completion and mark it as recently used.
+
+        :param key: A key returned by CompletionCache.key
+        :return: The completion, or None if it is not cached or has expired
+        """
+        completion = self._lookup(key)
+        with self._lock:
+            if completion is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return completion
+
+    def put(self, key: str, completion: str) -> None:
+        """
+        Store a completion, evicting the least recently used entries if the cache is full.
+
+        :param key: A key returned by CompletionCache.key
+        :param completion: The text of the completion
+        """
+        compressed = zlib.compress(completion.encode("utf-8"), 6)
+        if len(compressed) > self.max_size:
+            return
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?)",
+                (key, compressed, len(compressed), now, now),
+            )
+            self._evict()
+
+    def get_or_create(self, key: str, create: Callable[[], str]) -> str:
+        """
+        Return the cached completion, or create it once for all concurrent callers.
+
+        :param key: A key returned by CompletionCache.key
+        :param create: Function requesting the completion from the API
+        :return: The completion
+        """
+        completion, future, owner = self._claim(key)
+        if completion is not None:
+            return completion
+        if not owner:
+            return future.result()
+        try:
+            completion = create()
+        except BaseException as error:
+            self._release(key, future, error=error)
+            raise
+        self._release(key, future, completion)
+        return completion
+
+    async def aget_or_create(self, key: str, create: Callable[[], Awaitable[str]]) -> str:
+        """
+        Return the cached completion, or create it once for all concurrent callers.
+
+        :param key: A key returned by CompletionCache.key
+        :param create: Coroutine function requesting the completion from the API
+        :return: The completion
+        """
+        completion, future, owner = self._claim(key)
+        if completion is not None:
+            return completion
+        if not owner:
+            return await asyncio.wrap_future(future)
+        try:
+            completion = await create()
+        except BaseException as error:
+            self._release(key, future, error=error)
+            raise
+        self._release(key, future, completion)
+        return completion
+
+    def size(self) -> int:
+        """
+        Return the total size in bytes of the compressed completions in the cache.
+
+        :return: The size of the cache in bytes
+        """
+        with self._lock:
+            return self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+
+    def _claim(self, key):
+        # Returns (cached completion, future, whether this caller has to create it)
+        completion = self._lookup(key)
+        with self._lock:
+            if completion is not None:
+                self.hits += 1
+                return completion, None, False
+            if key in self._in_flight:
+                self.coalesced += 1
+                return None, self._in_flight[key], False
+            self.misses += 1
+            future = self._in_flight[key] = concurrent.futures.Future()
+            return None, future, True
+
+    def _release(self, key, future, completion=None, error=None):
+        if error is None:
+            self.put(key, completion)
+        with self._lock:
+            del self._in_flight[key]
+        if error is None:
+            future.set_result(completion)
+        else:
+            future.set_exception(error)
+
+    def _lookup(self, key):
+        now = time.time()
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT completion, stored_at FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if self.ttl is not None and row[1] < now - self.ttl:
+                self._connection.execute("DELETE FROM completions WHERE key = ?", (key,))
+                return None
+            self._connection.execute(
+                "UPDATE completions SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+        return zlib.decompress(row[0]).decode("utf-8")
+
+    def _evict(self):
+        total = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+        if total <= self.max_size:
+            return
+        rows = self._connection.execute("SELECT key, size FROM completions ORDER BY accessed_at")
+        evicted = []
+        for key, size in rows:
+            if total <= self.max_size:
+                break
+            evicted.append((key,))
+            total -= size
+        self._connection.executemany("DELETE FROM completions WHERE key = ?", evicted)
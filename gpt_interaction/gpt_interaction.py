@@ -1,11 +1,20 @@
 """gpt_interaction.py: A module to interact with GPT models using the OpenAI API."""
+import asyncio
+import email.utils
 import os
+from datetime import datetime, timezone
 from typing import Optional
 
+import aiohttp
 import openai
 
 from dotenv import load_dotenv
 
+from gpt_interaction.completion_cache import CompletionCache
+from gpt_interaction.scheduler import INTERACTIVE, APIError, RequestScheduler
+from instrumentation.tracing import get_tracer
+from website_analysis.dom_analysis import TokenCounter
+
 load_dotenv()
 
 
@@ -29,6 +38,10 @@ class GPTInteraction:
         temperature: float = 1,
         max_tokens: int = 4096,
         top_p: float = 1,
+        api_base: Optional[str] = None,
+        scheduler: Optional[RequestScheduler] = None,
+        timeout: float = 600,
+        cache: Optional[CompletionCache] = None,
     ):
         """
         Initialize the GPTInteraction class with the required parameters.
@@ -38,11 +51,15 @@ class GPTInteraction:
         :param temperature: Sampling temperature for the model, defaults to 1
         :param max_tokens: Maximum number of tokens for the model to generate, defaults to 4096
         :param top_p: Nucleus sampling parameter, defaults to 1
+        :param api_base: Base URL of an OpenAI-compatible API, defaults to OPENAI_API_BASE or OpenAI's
+        :param scheduler: Scheduler pacing the async calls, defaults to the one shared per model
+        :param timeout: Total timeout in seconds of an async call, defaults to 600
+        :param cache: Completion cache, defaults to the cache configured for this run
         """
         self.api_token = api_token or os.getenv("OPENAI_API_KEY")
         if self.api_token is None:
             raise ValueError("OpenAI API key is required")
-        openai.api_key = self.api_token
+        self.api_base = (api_base or os.getenv("OPENAI_API_BASE") or "https://api.openai.com/v1").rstrip("/")
 
         if model not in self._supported_chat_models + self._supported_completion_models:
             raise ValueError("Unsupported model")
@@ -50,6 +67,9 @@ class GPTInteraction:
         self.temperature = temperature
         self.max_tokens = max_tokens
         self.top_p = top_p
+        self.scheduler = scheduler if scheduler is not None else RequestScheduler.for_model(model)
+        self.timeout = timeout
+        self.cache = cache if cache is not None else CompletionCache.from_env()
 
     def call(self, prompt: str) -> str:
         """
@@ -58,23 +78,139 @@ class GPTInteraction:
         :param prompt: The input prompt to send to the model
         :return: The generated text from the GPT model
         """
+        if self.cache is None:
+            return self._call(prompt)
+        return self.cache.get_or_create(self._cache_key(prompt), lambda: self._call(prompt))
+
+    def _call(self, prompt):
+        with get_tracer().span("llm_request", model=self.model) as span:
+            if self.model in self._supported_completion_models:
+                response = openai.Completion.create(
+                    api_key=self.api_token,
+                    api_base=self.api_base,
+                    model=self.model,
+                    prompt=prompt,
+                    temperature=self.temperature,
+                    max_tokens=self.max_tokens,
+                    top_p=self.top_p,
+                )
+            elif self.model in self._supported_chat_models:
+                response = openai.ChatCompletion.create(
+                    api_key=self.api_token,
+                    api_base=self.api_base,
+                    model=self.model,
+                    messages=[{"role": "system", "content": prompt}],
+                    temperature=self.temperature,
+                    max_tokens=self.max_tokens,
+                    top_p=self.top_p,
+                )
+            else:
+                raise ValueError("Unsupported model")
+            _record_usage(span, response)
+
+        return _choice_text(response)
+
+    async def acall(
+        self,
+        prompt: str,
+        priority: int = INTERACTIVE,
+        session: Optional[aiohttp.ClientSession] = None,
+    ) -> str:
+        """
+        Call the GPT model asynchronously, paced by the rate limits of the model.
+
+        :param prompt: The input prompt to send to the model
+        :param priority: Lane of the request, use scheduler.BATCH for bulk generation
+        :param session: Session to send the request with, defaults to a new one
+        :return: The generated text from the GPT model
+        :raises APIError: If the request fails permanently or runs out of retries
+        """
+        if self.cache is None:
+            return await self._acall(prompt, priority, session)
+        return await self.cache.aget_or_create(
+            self._cache_key(prompt), lambda: self._acall(prompt, priority, session)
+        )
+
+    async def _acall(self, prompt, priority, session):
         if self.model in self._supported_completion_models:
-            response = openai.Completion.create(
-                model=self.model,
-                prompt=prompt,
-                temperature=self.temperature,
-                max_tokens=self.max_tokens,
-                top_p=self.top_p,
-            )
+            url = f"{self.api_base}/completions"
+            payload = {"prompt": prompt}
         elif self.model in self._supported_chat_models:
-            response = openai.ChatCompletion.create(
-                model=self.model,
-                messages=[{"role": "system", "content": prompt}],
-                temperature=self.temperature,
-                max_tokens=self.max_tokens,
-                top_p=self.top_p,
-            )
+            url = f"{self.api_base}/chat/completions"
+            payload = {"messages": [{"role": "system", "content": prompt}]}
         else:
             raise ValueError("Unsupported model")
+        payload.update(
+            model=self.model,
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            top_p=self.top_p,
+        )
+        estimated_tokens = TokenCounter.for_model(self.model).count(prompt) + self.max_tokens
+
+        async def send(session):
+            headers = {"Authorization": f"Bearer {self.api_token}"}
+            try:
+                async with session.post(url, json=payload, headers=headers) as response:
+                    if response.status >= 400:
+                        raise APIError(
+                            f"{response.status}: {await response.text()}",
+                            status=response.status,
+                            retry_after=_retry_after(response.headers.get("Retry-After")),
+                        )
+                    body = await response.json()
+            except (aiohttp.ClientConnectionError, aiohttp.ServerTimeoutError, asyncio.TimeoutError) as error:
+                # The total timeout of the session raises a bare asyncio.TimeoutError
+                raise APIError(f"Request failed: {error!r}") from error
+            usage = body.get("usage", {}).get("total_tokens")
+            if usage is not None:
+                self.scheduler.record_usage(estimated_tokens, usage)
+            return body
+
+        with get_tracer().span("llm_request", model=self.model, priority=priority) as span:
+            if session is None:
+                timeout = aiohttp.ClientTimeout(total=self.timeout)
+                async with aiohttp.ClientSession(timeout=timeout) as session:
+                    response = await self.scheduler.run(lambda: send(session), estimated_tokens, priority)
+            else:
+                response = await self.scheduler.run(lambda: send(session), estimated_tokens, priority)
+            _record_usage(span, response)
+
+        return _choice_text(response)
+
+    def _cache_key(self, prompt):
+        if self.model in self._supported_chat_models:
+            messages = [{"role": "system", "content": prompt}]
+        else:
+            messages = prompt
+        params = {"temperature": self.temperature, "max_tokens": self.max_tokens, "top_p": self.top_p}
+        return CompletionCache.key(self.model, params, messages)
+
+
+def _choice_text(response) -> str:
+    # Chat models answer with a message, completion models with text
+    choice = response["choices"][0]
+    return choice["message"]["content"] if "message" in choice else choice["text"]
+
+
+def _record_usage(span, response) -> None:
+    usage = response.get("usage") or {}
+    for key in ("prompt_tokens", "completion_tokens"):
+        if key in usage:
+            span.set(key, usage[key])
+
 
-        return response["choices"][0]["message"]["content"]
+def _retry_after(value: Optional[str]) -> Optional[float]:
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=timezone.utc)
+        return max((date - datetime.now(timezone.utc)).total_seconds(), 0)
@@ -1,10 +1,36 @@
+"""large_doc_processing.py: An incremental vector index over a folder of saved HTML pages.
+
+The index is persisted in a directory:
+
+- manifest.json records the content hash of every indexed file and the rows of
+  its chunks, so an update only re-chunks and re-embeds new or changed files and
+  drops the rows of deleted ones.
+- embeddings.npy holds one normalized float32 vector per chunk. Queries open it
+  memory-mapped and score it block by block instead of rebuilding the index.
+- chunks.jsonl holds the text and source of every chunk, and offsets.npy the byte
+  offset of each line, so only the best matches are read back.
+
+Embeddings are computed in batches. HashingEmbeddings is a deterministic local
+backend that needs no network access; any langchain Embeddings, e.g.
+OpenAIEmbeddings, can be used instead.
+"""
+import argparse
+import hashlib
+import json
 import os
+import re
+from typing import List, Optional, Tuple
+
+import numpy as np
+from bs4 import NavigableString
 from dotenv import load_dotenv
-from langchain.document_loaders import UnstructuredHTMLLoader
-from langchain.indexes import VectorstoreIndexCreator
+from langchain.embeddings.base import Embeddings
+from langchain.text_splitter import RecursiveCharacterTextSplitter
 
+from website_analysis.dom_analysis import HTMLParser
 
-load_dotenv()
+# Elements whose text is not part of the content of a page
+SKIPPED_TAGS = {"script", "style", "noscript", "template", "svg", "head"}
 
 
 def list_html_files(folder_path):
@@ -28,15 +54,295 @@ def list_html_files(folder_path):
     return html_files
 
 
-if __name__ == "__main__":
-    # Example usage
-    folder_path = "./results"
-    html_files = list_html_files(folder_path)
+def extract_text(html: str) -> str:
+    """
+    Return the visible text of an HTML page, one text node per line.
+
+    :param html: The HTML of the page
+    :return: The text without scripts, styles and other non-content elements
+    """
+    parsed_html = HTMLParser().parse(html)
+    lines = []
+    for string in parsed_html.find_all(string=True):
+        if any(parent.name in SKIPPED_TAGS for parent in string.parents):
+            continue
+        if type(string) is not NavigableString:  # Comments, doctypes and CDATA
+            continue
+        text = " ".join(string.split())
+        if text:
+            lines.append(text)
+    return "\n".join(lines)
+
+
+class HashingEmbeddings(Embeddings):
+    """Deterministic bag-of-words embeddings computed locally with the hashing trick."""
+
+    def __init__(self, dimensions: int = 512):
+        """
+        Initialize the HashingEmbeddings class.
+
+        :param dimensions: Length of the embedding vectors, defaults to 512
+        """
+        self.dimensions = dimensions
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed a batch of texts.
+
+        :param texts: The texts to embed
+        :return: One normalized vector per text
+        """
+        return [self._embed(text).tolist() for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        """
+        Embed a query.
+
+        :param text: The query to embed
+        :return: A normalized vector
+        """
+        return self._embed(text).tolist()
+
+    def _embed(self, text):
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for word in re.findall(r"\w+", text.lower()):
+            digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+            bucket = int.from_bytes(digest[:4], "little") % self.dimensions
+            # The sign bit keeps colliding words from always adding up
+            vector[bucket] += 1 if digest[4] & 1 else -1
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+class IncrementalIndex:
+    """A persisted vector index that only re-embeds files whose content changed."""
+
+    MANIFEST = "manifest.json"
+    EMBEDDINGS = "embeddings.npy"
+    CHUNKS = "chunks.jsonl"
+    OFFSETS = "offsets.npy"
+    # Rows scored at a time, bounding the memory a query needs
+    QUERY_BLOCK_ROWS = 65536
+
+    def __init__(
+        self,
+        directory: str = ".doc_index",
+        embeddings: Optional[Embeddings] = None,
+        chunk_size: int = 1000,
+        chunk_overlap: int = 100,
+        batch_size: int = 64,
+    ):
+        """
+        Open or create the index in the given directory.
+
+        :param directory: Directory holding the index files, defaults to ".doc_index"
+        :param embeddings: Embedding backend, defaults to HashingEmbeddings
+        :param chunk_size: Maximum number of characters per chunk, defaults to 1000
+        :param chunk_overlap: Number of characters shared by neighbouring chunks, defaults to 100
+        :param batch_size: Number of chunks embedded per call, defaults to 64
+        """
+        self.directory = directory
+        self.embeddings = embeddings if embeddings is not None else HashingEmbeddings()
+        self.splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        self.batch_size = batch_size
+        os.makedirs(directory, exist_ok=True)
+        self.manifest = self._load_manifest()
+
+    def update(self, folder_path: str) -> dict:
+        """
+        Bring the index up to date with the HTML files in a folder.
+
+        :param folder_path: The folder containing the HTML files
+        :return: The names of the added, changed, unchanged and removed files
+        """
+        old_files = self.manifest["files"]
+        if self.manifest.get("embeddings") != self._embeddings_name():
+            # Vectors of another backend cannot be mixed with new ones
+            old_files = {}
+        old_embeddings = self._open_embeddings()
+        old_chunks = self._open_chunks()
 
-    # Location of the HTML files.
-    loaders = [
-        UnstructuredHTMLLoader(os.path.join(folder_path, fn)) for fn in html_files
-    ]
+        summary = {"added": [], "changed": [], "unchanged": [], "removed": []}
+        kept, fresh = [], []  # (filename, digest, old rows) and (filename, digest, chunks)
+        for filename in sorted(list_html_files(folder_path)):
+            with open(os.path.join(folder_path, filename), "rb") as file:
+                content = file.read()
+            digest = hashlib.sha256(content).hexdigest()
+            entry = old_files.get(filename)
+            if entry is not None and entry["sha256"] == digest:
+                kept.append((filename, digest, entry["rows"]))
+                summary["unchanged"].append(filename)
+                continue
+            text = extract_text(content.decode("utf-8", errors="replace"))
+            fresh.append((filename, digest, self.splitter.split_text(text)))
+            summary["changed" if entry is not None else "added"].append(filename)
+        summary["removed"] = sorted(set(old_files) - set(summary["unchanged"]) - {name for name, _, _ in fresh})
 
-    index = VectorstoreIndexCreator().from_loaders(loaders)
-    print(index.query_with_sources("Is there any HTML in the documents?"))
+        if not fresh and not summary["removed"]:
+            return summary
+
+        vectors = self._embed([chunk for _, _, chunks in fresh for chunk in chunks])
+        total = sum(end - start for _, _, (start, end) in kept) + len(vectors)
+        if len(vectors):
+            dimensions = vectors.shape[1]
+        else:
+            dimensions = old_embeddings.shape[1] if old_embeddings is not None else 0
+
+        files = {}
+        temporary = {name: os.path.join(self.directory, f".{name}.tmp") for name in (self.EMBEDDINGS, self.CHUNKS, self.OFFSETS)}
+        embeddings = np.lib.format.open_memmap(
+            temporary[self.EMBEDDINGS], mode="w+", dtype=np.float32, shape=(total, dimensions)
+        )
+        offsets = np.zeros(total, dtype=np.int64)
+        row = 0
+        with open(temporary[self.CHUNKS], "wb") as chunks_file:
+            # Unchanged files keep their vectors, copied over from the previous index
+            for filename, digest, (start, end) in kept:
+                embeddings[row:row + end - start] = old_embeddings[start:end]
+                for old_row in range(start, end):
+                    offsets[row] = chunks_file.tell()
+                    chunks_file.write(self._read_line(old_chunks, old_row))
+                    row += 1
+                files[filename] = {"sha256": digest, "rows": [row - (end - start), row]}
+
+            position = 0
+            for filename, digest, chunks in fresh:
+                start = row
+                for chunk in chunks:
+                    embeddings[row] = vectors[position]
+                    offsets[row] = chunks_file.tell()
+                    chunks_file.write(json.dumps({"source": filename, "text": chunk}).encode("utf-8") + b"\n")
+                    row += 1
+                    position += 1
+                files[filename] = {"sha256": digest, "rows": [start, row]}
+        embeddings.flush()
+        del embeddings
+        np.save(temporary[self.OFFSETS], offsets)
+        if old_chunks is not None:
+            old_chunks[0].close()
+        del old_embeddings
+
+        # np.save appends .npy to names without it
+        os.replace(temporary[self.OFFSETS] + ".npy", os.path.join(self.directory, self.OFFSETS))
+        for name in (self.EMBEDDINGS, self.CHUNKS):
+            os.replace(temporary[name], os.path.join(self.directory, name))
+        self.manifest = {"version": 1, "embeddings": self._embeddings_name(), "dimensions": dimensions, "files": files}
+        self._write_manifest()
+        return summary
+
+    def query(self, text: str, k: int = 4) -> List[Tuple[float, str, str]]:
+        """
+        Return the chunks most similar to the text.
+
+        :param text: The query
+        :param k: Number of chunks to return, defaults to 4
+        :return: A list of (score, source file, chunk text) tuples, best first
+        """
+        embeddings = self._open_embeddings()
+        if embeddings is None or len(embeddings) == 0:
+            return []
+        query = np.asarray(self.embeddings.embed_query(text), dtype=np.float32)
+        query /= np.linalg.norm(query) or 1
+
+        best_scores = np.empty(0, dtype=np.float32)
+        best_rows = np.empty(0, dtype=np.int64)
+        for start in range(0, len(embeddings), self.QUERY_BLOCK_ROWS):
+            scores = embeddings[start:start + self.QUERY_BLOCK_ROWS] @ query
+            best_scores = np.concatenate([best_scores, scores])
+            best_rows = np.concatenate([best_rows, np.arange(start, start + len(scores))])
+            if len(best_scores) > k:
+                top = np.argpartition(-best_scores, k)[:k]
+                best_scores, best_rows = best_scores[top], best_rows[top]
+
+        chunks = self._open_chunks()
+        try:
+            results = []
+            for index in np.argsort(-best_scores):
+                chunk = json.loads(self._read_line(chunks, best_rows[index]))
+                results.append((float(best_scores[index]), chunk["source"], chunk["text"]))
+        finally:
+            chunks[0].close()
+        return results
+
+    def _embed(self, texts):
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            vectors.extend(self.embeddings.embed_documents(texts[start:start + self.batch_size]))
+        if not vectors:
+            return np.empty((0, 0), dtype=np.float32)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+    def _embeddings_name(self):
+        name = type(self.embeddings).__name__
+        dimensions = getattr(self.embeddings, "dimensions", None)
+        return f"{name}-{dimensions}" if dimensions else name
+
+    def _open_embeddings(self):
+        path = os.path.join(self.directory, self.EMBEDDINGS)
+        if not self.manifest["files"] or not os.path.exists(path):
+            return None
+        return np.load(path, mmap_mode="r")
+
+    def _open_chunks(self):
+        path = os.path.join(self.directory, self.CHUNKS)
+        if not self.manifest["files"] or not os.path.exists(path):
+            return None
+        return open(path, "rb"), np.load(os.path.join(self.directory, self.OFFSETS), mmap_mode="r")
+
+    @staticmethod
+    def _read_line(chunks, row):
+        file, offsets = chunks
+        file.seek(int(offsets[row]))
+        return file.readline()
+
+    def _load_manifest(self):
+        path = os.path.join(self.directory, self.MANIFEST)
+        if not os.path.exists(path):
+            return {"version": 1, "embeddings": None, "dimensions": 0, "files": {}}
+        with open(path, "r") as file:
+            return json.load(file)
+
+    def _write_manifest(self):
+        path = os.path.join(self.directory, self.MANIFEST)
+        with open(path + ".tmp", "w") as file:
+            json.dump(self.manifest, file, indent=2, sort_keys=True)
+        os.replace(path + ".tmp", path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Index saved HTML pages and search them')
+    parser.add_argument('--folder', type=str, default='./results', help='Folder of the HTML files to index')
+    parser.add_argument('--index', type=str, default='.doc_index', help='Directory of the persisted index')
+    parser.add_argument('--embeddings', type=str, choices=['hashing', 'openai'], default='hashing', help='Embed locally and offline, or with the OpenAI API')
+    parser.add_argument('--query', type=str, default='Is there any HTML in the documents?', help='The question to search for')
+    parser.add_argument('--k', type=int, default=4, help='Number of chunks to retrieve')
+    parser.add_argument('--answer', action='store_true', help='Answer the question with GPT-4 from the retrieved chunks')
+    args = parser.parse_args()
+
+    load_dotenv()
+    if args.embeddings == 'openai':
+        from langchain.embeddings import OpenAIEmbeddings
+        embeddings = OpenAIEmbeddings()
+    else:
+        embeddings = HashingEmbeddings()
+
+    index = IncrementalIndex(args.index, embeddings)
+    summary = index.update(args.folder)
+    print(", ".join(f"{len(names)} {state}" for state, names in summary.items()))
+
+    results = index.query(args.query, args.k)
+    for score, source, text in results:
+        preview = " ".join(text.split())[:200]
+        print(f"[{score:.3f}] {source}: {preview}")
+
+    if args.answer:
+        from gpt_interaction.gpt_interaction import GPTInteraction
+        context = "\n\n".join(f"Source: {source}\n{text}" for _, source, text in results)
+        prompt = f"Answer the question from the sources below and name the sources you used.\n\nQUESTION: {args.query}\n\n{context}"
+        print(GPTInteraction(max_tokens=512).call(prompt))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+"""scheduler.py: A module for scheduling requests against rate-limited LLM APIs.
+
+OpenAI limits every organisation both in requests and in tokens per minute. The
+RequestScheduler keeps a token bucket for each of the two limits and only lets a
+request through once both buckets hold enough for it, so a batch run slows down to
+the allowed rate instead of running into a storm of 429 responses. Requests that
+are rejected anyway, and server errors, are retried with jittered exponential
+backoff, honouring the Retry-After header when the server sends one.
+
+Waiting requests are served by priority lane first and in arrival order second, so
+interactive calls overtake queued batch generation. The scheduler is thread-safe
+and not bound to an event loop, so one instance can be shared by a whole process.
+"""
+import asyncio
+import heapq
+import itertools
+import random
+import threading
+import time
+import weakref
+from typing import Awaitable, Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+# Priority lanes, lower values are served first
+INTERACTIVE = 0
+BATCH = 10
+
+
+class APIError(Exception):
+    """An error response from the API."""
+
+    def __init__(self, message: str, status: Optional[int] = None, retry_after: Optional[float] = None):
+        """
+        Initialize the APIError class.
+
+        :param message: Description of the error
+        :param status: HTTP status code of the response, if any
+        :param retry_after: Seconds the server asked to wait before retrying, if any
+        """
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        """Return True for rate limiting, server errors and failed connections."""
+        return self.status is None or self.status == 429 or self.status >= 500
+
+
+class TokenBucket:
+    """A token bucket refilled continuously at a fixed rate per minute."""
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None, clock: Callable[[], float] = time.monotonic):
+        """
+        Initialize the TokenBucket class.
+
+        :param rate_per_minute: Number of tokens added per minute
+        :param capacity: Maximum number of tokens held, defaults to one minute's worth
+        :param clock: Source of the current time in seconds, replaceable in tests
+        """
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated = clock()
+
+    def delay(self, amount: float) -> float:
+        """
+        Return the seconds until the bucket holds the amount, 0 if it already does.
+
+        Amounts larger than the capacity only have to wait for a full bucket.
+
+        :param amount: Number of tokens needed
+        """
+        self._refill()
+        needed = min(amount, self.capacity) - self.tokens
+        return max(needed, 0) / self.rate
+
+    def consume(self, amount: float) -> None:
+        """
+        Take the amount out of the bucket, which may leave it in debt.
+
+        :param amount: Number of tokens to take, negative to give tokens back
+        """
+        self._refill()
+        self.tokens = min(self.tokens - amount, self.capacity)
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class RequestScheduler:
+    """Pace requests by requests and tokens per minute, with priority lanes and retries."""
+
+    # Default limits per model: (requests per minute, tokens per minute)
+    MODEL_LIMITS = {
+        "gpt-4": (200, 40000),
+        "gpt-4-0314": (200, 40000),
+        "gpt-4-32k": (200, 80000),
+        "gpt-4-32k-0314": (200, 80000),
+        "gpt-3.5-turbo": (3500, 90000),
+        "gpt-3.5-turbo-0301": (3500, 90000),
+        "text-davinci-003": (3500, 350000),
+    }
+    DEFAULT_LIMITS = (200, 40000)
+
+    _schedulers = {}
+    _schedulers_lock = threading.Lock()
+
+    @classmethod
+    def for_model(cls, model: str = "gpt-4") -> "RequestScheduler":
+        """
+        Return the scheduler shared by all requests to the model in this process.
+
+        :param model: Name of the model
+        """
+        # Rate limits apply per model, so requests to one model share a scheduler
+        with cls._schedulers_lock:
+            if model not in cls._schedulers:
+                requests_per_minute, tokens_per_minute = cls.MODEL_LIMITS.get(model, cls.DEFAULT_LIMITS)
+                cls._schedulers[model] = cls(requests_per_minute, tokens_per_minute)
+            return cls._schedulers[model]
+
+    def __init__(
+        self,
+        requests_per_minute: float = 200,
+        tokens_per_minute: float = 40000,
+        max_retries: int = 6,
+        base_delay: float = 1,
+        max_delay: float = 60,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        Initialize the RequestScheduler class.
+
+        :param requests_per_minute: Requests allowed per minute, defaults to 200
+        :param tokens_per_minute: Prompt and completion tokens allowed per minute, defaults to 40000
+        :param max_retries: Number of retries of a failed request, defaults to 6
+        :param base_delay: Backoff in seconds before the first retry, defaults to 1
+        :param max_delay: Upper bound of the backoff in seconds, defaults to 60
+        :param clock: Source of the current time in seconds, replaceable in tests
+        """
+        self.requests = TokenBucket(requests_per_minute, clock=clock)
+        self.tokens = TokenBucket(tokens_per_minute, clock=clock)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._waiting = []  # Heap of (priority, sequence, tokens, loop, future)
+        self._sequence = itertools.count()
+        self._paused_until = 0.0
+        # Event loop -> time of its pending wake-up. Weak, so the closed loops of earlier
+        # asyncio.run calls in a long-lived process are not kept alive.
+        self._wakeups = weakref.WeakKeyDictionary()
+
+    async def acquire(self, estimated_tokens: int, priority: int = BATCH) -> None:
+        """
+        Wait until the request may be sent and take its share of both limits.
+
+        :param estimated_tokens: Estimated prompt and completion tokens of the request
+        :param priority: Lane of the request, lower values are served first
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            heapq.heappush(self._waiting, (priority, next(self._sequence), estimated_tokens, loop, future))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Leave the queue to the others; _dispatch skips futures that are done
+            future.cancel()
+            self._dispatch()
+            raise
+
+    def record_usage(self, estimated_tokens: int, used_tokens: int) -> None:
+        """
+        Correct the token bucket once the real usage of a request is known.
+
+        :param estimated_tokens: The estimate passed to acquire
+        :param used_tokens: The total tokens the API reported
+        """
+        with self._lock:
+            self.tokens.consume(used_tokens - estimated_tokens)
+
+    def pause(self, seconds: float) -> None:
+        """
+        Hold back all requests, e.g. after the server answered 429.
+
+        :param seconds: Time to wait before the next request is sent
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, self.clock() + seconds)
+        self._dispatch()
+
+    async def run(self, send: Callable[[], Awaitable[T]], estimated_tokens: int, priority: int = BATCH) -> T:
+        """
+        Send a request once the limits allow it, retrying rate limiting and server errors.
+
+        :param send: Coroutine function sending the request, raising APIError on failure
+        :param estimated_tokens: Estimated prompt and completion tokens of the request
+        :param priority: Lane of the request, lower values are served first
+        :return: The result of send
+        :raises APIError: If the request fails permanently or runs out of retries
+        """
+        attempt = 0
+        while True:
+            await self.acquire(estimated_tokens, priority)
+            try:
+                return await send()
+            except asyncio.TimeoutError as timeout:
+                # A request that timed out is retried like a failed connection
+                error = APIError(f"Request timed out: {timeout!r}")
+                error.__cause__ = timeout
+            except APIError as failure:
+                error = failure
+            if not error.retryable or attempt >= self.max_retries:
+                raise error
+            if error.retry_after is not None:
+                delay = error.retry_after
+            else:
+                # Full jitter spreads the retries of requests that failed together
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+            attempt += 1
+            if error.status == 429:
+                # The limit is shared, so every request waits, not only this one
+                self.pause(delay)
+            else:
+                await asyncio.sleep(delay)
+
+    def _dispatch(self):
+        with self._lock:
+            while self._waiting:
+                priority, sequence, tokens, loop, future = self._waiting[0]
+                if future.done():
+                    heapq.heappop(self._waiting)
+                    continue
+
+                delay = max(
+                    self._paused_until - self.clock(),
+                    self.requests.delay(1),
+                    self.tokens.delay(tokens),
+                )
+                if delay > 0:
+                    self._schedule_wakeup(loop, delay)
+                    return
+
+                heapq.heappop(self._waiting)
+                self.requests.consume(1)
+                self.tokens.consume(tokens)
+                try:
+                    loop.call_soon_threadsafe(_resolve, future)
+                except RuntimeError:  # The loop of the waiting request has been closed
+                    self.requests.consume(-1)
+                    self.tokens.consume(-tokens)
+
+    def _schedule_wakeup(self, loop, delay):
+        # One pending wake-up per loop is enough, an earlier one re-checks and reschedules
+        now = self.clock()
+        wakeup_at = now + delay
+        pending = self._wakeups.get(loop)
+        if pending is not None and now < pending <= wakeup_at:
+            return
+        self._wakeups[loop] = wakeup_at
+
+        def wake():
+            with self._lock:
+                if self._wakeups.get(loop) == wakeup_at:
+                    del self._wakeups[loop]
+            self._dispatch()
+
+        try:
+            loop.call_soon_threadsafe(loop.call_later, delay, wake)
+        except RuntimeError:  # The loop of the waiting request has been closed
+            self._wakeups.pop(loop, None)
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
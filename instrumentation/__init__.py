@@ -0,0 +1,5 @@
+"""__init__.py: The Instrumentation component.
+
+Structured tracing of the scraping pipeline: timed spans around every stage, with the
+bytes, HTML sizes and tokens they handled, exported as JSON lines or as Prometheus metrics.
+"""
@@ -0,0 +1,282 @@
+"""tracing.py: Timed spans around the stages of the scraping pipeline.
+
+Every stage opens a span on the process-wide tracer:
+
+    with get_tracer().span("process_html", source=source) as span:
+        ...
+        span.set("html_bytes", len(html))
+
+Spans nest per thread and per asyncio task, and code deeper in a stage can annotate
+the innermost open span through current_span(), e.g. the loader records how many
+bytes it fetched. Finished spans are handed to the configured exporters. Without
+exporters, spans only cost a couple of clock reads.
+"""
+import contextlib
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator, List, Optional
+
+
+class Span:
+    """A timed stage of the pipeline, with attributes describing what it handled."""
+
+    def __init__(self, name: str, trace_id: str, span_id: int, parent_id: Optional[int], attributes: dict):
+        """
+        Initialize the Span class.
+
+        :param name: Name of the stage
+        :param trace_id: Identifier shared by a root span and all spans below it
+        :param span_id: Identifier of the span, unique within the process
+        :param parent_id: Identifier of the enclosing span, None for a root span
+        :param attributes: Initial attributes of the span
+        """
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.attributes = dict(attributes)
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        self.duration = None
+        self.error = None
+
+    def set(self, key: str, value) -> None:
+        """Set an attribute of the span."""
+        self.attributes[key] = value
+
+    def add(self, key: str, amount: float) -> None:
+        """Add an amount to a numeric attribute of the span, starting from 0."""
+        self.attributes[key] = self.attributes.get(key, 0) + amount
+
+    def finish(self) -> None:
+        """Record the duration of the span."""
+        self.duration = time.perf_counter() - self._start
+
+    def to_dict(self) -> dict:
+        """Return the span as a JSON-serializable dict."""
+        record = {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_time": self.start_time,
+            "duration": self.duration,
+            "attributes": self.attributes,
+        }
+        if self.error is not None:
+            record["error"] = self.error
+        return record
+
+
+class _NullSpan(Span):
+    """Returned by current_span() outside of any span; attributes set on it are dropped."""
+
+    def __init__(self):
+        super().__init__("null", "", 0, None, {})
+
+    def set(self, key, value):
+        pass
+
+    def add(self, key, amount):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Tracer:
+    """Create nested spans and hand the finished ones to exporters."""
+
+    def __init__(self, exporters: Optional[List] = None):
+        """
+        Initialize the Tracer class.
+
+        :param exporters: Objects with an export(span) method, defaults to none
+        """
+        self.exporters = list(exporters or [])
+        self._ids = itertools.count(1)
+        # The open spans, innermost last; a context variable keeps threads and tasks apart
+        self._stack = contextvars.ContextVar(f"spans-{id(self)}", default=())
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Span]:
+        """
+        Time the enclosed block as a span nested in the current span of this thread or task.
+
+        :param name: Name of the stage
+        :param attributes: Initial attributes of the span
+        :return: A context manager yielding the Span
+        """
+        stack = self._stack.get()
+        parent = stack[-1] if stack else None
+        span = Span(
+            name,
+            parent.trace_id if parent is not None else uuid.uuid4().hex,
+            next(self._ids),
+            parent.span_id if parent is not None else None,
+            attributes,
+        )
+        token = self._stack.set(stack + (span,))
+        try:
+            yield span
+        except BaseException as error:
+            span.error = f"{type(error).__name__}: {error}"
+            raise
+        finally:
+            span.finish()
+            self._stack.reset(token)
+            for exporter in self.exporters:
+                exporter.export(span)
+
+    def current_span(self) -> Span:
+        """Return the innermost open span of this thread or task, or a span that ignores attributes."""
+        stack = self._stack.get()
+        return stack[-1] if stack else _NULL_SPAN
+
+    def close(self) -> None:
+        """Close and remove all exporters."""
+        exporters, self.exporters = self.exporters, []
+        for exporter in exporters:
+            exporter.close()
+
+
+class JsonLinesExporter:
+    """Append every finished span as one JSON object per line to a file."""
+
+    def __init__(self, path: str):
+        """
+        Open the metrics file for appending.
+
+        :param path: Path of the JSON-lines file
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8")
+
+    def export(self, span: Span) -> None:
+        line = json.dumps(span.to_dict(), default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+class PrometheusExporter:
+    """Aggregate spans per stage and serve them in the Prometheus text format."""
+
+    PREFIX = "scraper_stage"
+
+    def __init__(self, port: Optional[int] = None, host: str = "127.0.0.1"):
+        """
+        Initialize the PrometheusExporter class.
+
+        :param port: Port of the /metrics endpoint, 0 for any free port, None for no endpoint
+        :param host: Interface the endpoint listens on, defaults to localhost
+        """
+        self._lock = threading.Lock()
+        self._counts = {}  # stage -> number of spans
+        self._errors = {}  # stage -> number of failed spans
+        self._sums = {}  # (stage, metric) -> sum
+        self._server = None
+        if port is not None:
+            exporter = self
+
+            class MetricsHandler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.split("?")[0] != "/metrics":
+                        self.send_error(404)
+                        return
+                    body = exporter.render().encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            self._server = ThreadingHTTPServer((host, port), MetricsHandler)
+            threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True).start()
+
+    @property
+    def port(self) -> Optional[int]:
+        """Return the port of the /metrics endpoint, if it is served."""
+        return self._server.server_address[1] if self._server is not None else None
+
+    def export(self, span: Span) -> None:
+        with self._lock:
+            self._counts[span.name] = self._counts.get(span.name, 0) + 1
+            if span.error is not None:
+                self._errors[span.name] = self._errors.get(span.name, 0) + 1
+            self._sums[(span.name, "seconds")] = self._sums.get((span.name, "seconds"), 0) + span.duration
+            for key, value in span.attributes.items():
+                # Only numbers can be summed; booleans count how often they were true
+                if isinstance(value, (int, float)):
+                    self._sums[(span.name, key)] = self._sums.get((span.name, key), 0) + value
+
+    def render(self) -> str:
+        """Return the aggregated metrics in the Prometheus text exposition format."""
+        with self._lock:
+            lines = [
+                f"# TYPE {self.PREFIX}_total counter",
+                *(f'{self.PREFIX}_total{{stage="{stage}"}} {count}' for stage, count in sorted(self._counts.items())),
+                f"# TYPE {self.PREFIX}_errors_total counter",
+                *(f'{self.PREFIX}_errors_total{{stage="{stage}"}} {count}' for stage, count in sorted(self._errors.items())),
+            ]
+            metrics = sorted({metric for _, metric in self._sums})
+            for metric in metrics:
+                name = f"{self.PREFIX}_{metric}_sum"
+                lines.append(f"# TYPE {name} counter")
+                for (stage, key), value in sorted(self._sums.items()):
+                    if key == metric:
+                        lines.append(f'{name}{{stage="{stage}"}} {value:g}')
+        return "\n".join(lines) + "\n"
+
+    def close(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+_tracer = Tracer()
+
+
+def get_tracer() -> Tracer:
+    """Return the tracer of this process."""
+    return _tracer
+
+
+def current_span() -> Span:
+    """Return the innermost open span of this thread or task on the process tracer."""
+    return _tracer.current_span()
+
+
+def configure(metrics_file: Optional[str] = None, metrics_port: Optional[int] = None) -> Tracer:
+    """
+    Replace the exporters of the process tracer.
+
+    :param metrics_file: Path of a JSON-lines file the spans are appended to
+    :param metrics_port: Port of a Prometheus /metrics endpoint
+    :return: The process tracer
+    """
+    _tracer.close()
+    exporters = []
+    if metrics_file:
+        directory = os.path.dirname(metrics_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        exporters.append(JsonLinesExporter(metrics_file))
+    if metrics_port is not None:
+        exporters.append(PrometheusExporter(metrics_port))
+    _tracer.exporters = exporters
+    return _tracer
@@ -0,0 +1,156 @@
+"""scraper_cache.py: A persistent cache of generated scraping code keyed by page layout.
+
+Pages that share a DOM layout (for example the 1st and the 500th page of a listing)
+can be scraped with the same generated code, so the expensive LLM round trip is only
+paid once per layout and set of user requirements.
+"""
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+from typing import Optional
+
+from website_analysis.dom_analysis import HTMLFingerprinter, HTMLParser
+
+
+class ScraperCache:
+    """Store generated scrapers on disk, keyed by DOM fingerprint and requirements."""
+
+    def __init__(self, directory: str = ".scraper_cache"):
+        """
+        Initialize the cache in the given directory, creating it if needed.
+
+        :param directory: Directory where cached scrapers are stored, defaults to ".scraper_cache"
+        """
+        self.directory = directory
+        self.fingerprinter = HTMLFingerprinter()
+        self.parser = HTMLParser()
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def normalize_requirements(requirements: str) -> str:
+        """
+        Normalize user requirements so trivially different phrasings share a key.
+
+        :param requirements: The user requirements for scraping
+        :return: The requirements lower-cased, with collapsed whitespace and no trailing punctuation
+        """
+        normalized = re.sub(r"\s+", " ", (requirements or "").strip().lower())
+        return normalized.rstrip(" .!?;:")
+
+    def fingerprint(self, html: str) -> str:
+        """
+        Return the structural fingerprint of an HTML snippet.
+
+        :param html: The processed HTML sent to the LLM
+        :return: A hex digest of the tag/class skeleton of the snippet
+        """
+        # Snippets are parsed as fragments, so the key does not depend on the installed tree builder
+        return self.fingerprinter.fingerprint(self.parser.parse_fragment(html))
+
+    def key(self, html: str, requirements: str) -> str:
+        """
+        Compute the cache key for a processed HTML snippet and user requirements.
+
+        :param html: The processed HTML sent to the LLM
+        :param requirements: The user requirements for scraping
+        :return: A hex digest used as the cache key
+        """
+        material = json.dumps(
+            [self.fingerprint(html), self.normalize_requirements(requirements)]
+        )
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def pattern_key(self, url_pattern: str, requirements: str) -> str:
+        """
+        Compute the cache key of the scraper shared by all crawled pages of a URL pattern.
+
+        :param url_pattern: The pattern returned by website_analysis.crawler.url_pattern
+        :param requirements: The user requirements for scraping
+        :return: A hex digest used as the cache key
+        """
+        material = json.dumps(
+            ["url_pattern", url_pattern, self.normalize_requirements(requirements)]
+        )
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def validate(code: str) -> bool:
+        """
+        Check that cached code is still usable.
+
+        :param code: The generated scraping code
+        :return: True if the code is non-empty and compiles
+        """
+        if not code or not code.strip():
+            return False
+        try:
+            compile(code, "<cached scraper>", "exec")
+        except (SyntaxError, ValueError):
+            return False
+        return True
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Return the cached scraping code for the key, or None on a miss.
+
+        Entries that cannot be read or no longer validate are removed.
+
+        :param key: The cache key
+        :return: The cached generated code, or None
+        """
+        path = self._path(key)
+        try:
+            with open(path, "r") as file:
+                entry = json.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            self.invalidate(key)
+            return None
+
+        code = entry.get("code") if isinstance(entry, dict) else None
+        if not self.validate(code):
+            self.invalidate(key)
+            return None
+        return code
+
+    def put(self, key: str, code: str, **metadata) -> bool:
+        """
+        Store generated scraping code under the key.
+
+        :param key: The cache key
+        :param code: The generated scraping code
+        :param metadata: Extra JSON-serializable information stored with the entry
+        :return: True if the code validated and was stored
+        """
+        if not self.validate(code):
+            return False
+
+        entry = dict(metadata, code=code, created=time.time())
+        # Write to a temporary file first so concurrent readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as file:
+                json.dump(entry, file)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return True
+
+    def invalidate(self, key: str) -> None:
+        """
+        Remove the entry for the key, if any.
+
+        :param key: The cache key
+        """
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
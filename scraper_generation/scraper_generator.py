@@ -1,31 +1,50 @@
+import re
 from dotenv import load_dotenv
-from langchain.llms import OpenAI
-from langchain.chat_models import ChatOpenAI
-from langchain.schema import AIMessage, HumanMessage, SystemMessage
-from langchain import PromptTemplate
+
+from gpt_interaction.completion_cache import CompletionCache
+from instrumentation.tracing import current_span, get_tracer
+from website_analysis.dom_analysis import TokenCounter
 
 class ScrapingCodeGenerator:
     MODEL_NAME = "gpt-4" # "text-davinci-003"
+    TEMPERATURE = 0.5
+    # OpenAI roles of the langchain message types, completion cache keys hold messages in the API's format
+    MESSAGE_ROLES = {"system": "system", "human": "user", "ai": "assistant"}
     SYSTEM_MESSAGE = """
 You are an expert website analyzer for a web scraping process.
 Take the user requirements and convert it into clean python code to scrape the website.
 Don't explain the code, just generate the code block itself.
     """
     SCRAPING_CODE = f"""
+import os
 from bs4 import BeautifulSoup
-from website_analysis.dom_analysis import HtmlLoader, UrlHtmlLoader
+from website_analysis.dom_analysis import BrowserHtmlLoader, HtmlLoader, HTMLParser, UrlHtmlLoader
 
-# Create HtmlLoader or UrlHtmlLoader based on the source type
+# Create HtmlLoader, UrlHtmlLoader or BrowserHtmlLoader based on the source type
 def create_html_loader(source, source_type):
     if source_type == 'url':
         return UrlHtmlLoader(source)
+    elif source_type == 'browser':
+        return BrowserHtmlLoader(source)
     else:  # source_type == 'file'
         return HtmlLoader(source)
 
-html_loader = create_html_loader("{{source}}", "{{source_type}}")
-response = html_loader.load()
+# Reuse the document the pipeline already loaded, and its parse tree, when they are
+# handed over in the globals or in the SCRAPER_DOCUMENT file; load the source otherwise
+if "html_soup" not in globals():
+    if "response" not in globals():
+        if os.environ.get("SCRAPER_DOCUMENT"):
+            html_loader = HtmlLoader(os.environ["SCRAPER_DOCUMENT"], encoding="utf-8")
+        else:
+            html_loader = create_html_loader("{{source}}", "{{source_type}}")
+        response = html_loader.load()
+    # Parse with the same backend as the pipeline, so the tree matches the HTML GPT saw
+    html_soup = HTMLParser().parse(response)
 
-html_soup = BeautifulSoup(response, 'html.parser')
+# Records passed to emit() go to the output sink of the run, or are printed as JSON lines
+if "emit" not in globals():
+    from data_extraction.sinks import RecordEmitter
+    emit = RecordEmitter(os.environ.get("SCRAPER_RECORDS") or globals().get("records_file"))
     """
     PROMPT_TEMPLATE = """
 You are an expert website analyzer for a web scraping process.
@@ -38,6 +57,9 @@ USER REQUIREMENTS:
 HTML CODE YOU NEED TO SCRAPE:
 {html}
 
+Comments such as <!-- 97 more tr elements, 100 in total --> stand for repeated elements left out of the HTML; scrape all of them.
+Pass every scraped record as a dict to emit(record), which is already defined, instead of printing it.
+
 FINISH THE PYTHON CODE TO SCRAPE THE WEBSITE:
 
 from bs4 import BeautifulSoup
@@ -51,31 +73,196 @@ html_soup = BeautifulSoup(response, 'html.parser')
     
 
 
-    def __init__(self, processed_html, source, source_type):
+    PLAN_SYSTEM_MESSAGE = """
+You are an expert website analyzer for a web scraping process.
+Take the user requirements and describe how to extract the data as a JSON selector plan.
+Don't explain the plan, just return the JSON object itself.
+    """
+    PLAN_PROMPT_TEMPLATE = """
+USER REQUIREMENTS:
+{requirements}
+
+HTML CODE YOU NEED TO SCRAPE:
+{html}
+
+Comments such as <!-- 97 more tr elements, 100 in total --> stand for repeated elements left out of the HTML; the rows selector has to match all of them.
+
+Return a JSON object with these keys:
+- "rows": a CSS selector matching each repeated record, such as a table row or a card;
+  leave it out if the page holds a single record.
+- "fields": an object mapping each column name to a field with:
+  - "css": a CSS selector of the value, relative to the row (or "xpath" instead)
+  - "attribute": optional, an attribute to read instead of the text, e.g. "href"
+  - "transforms": optional, any of "strip", "collapse", "lower", "upper", "int",
+    "float", "number" or "regex:<pattern>", applied in order
+  - "multiple": optional, true to collect every match into a list
+
+Example:
+{{"rows": "table.results tr", "fields": {{"name": {{"css": "td:nth-of-type(1)"}}, "price": {{"css": "td.price", "transforms": ["number"]}}}}}}
+            """
+
+    def __init__(self, processed_html, source, source_type, cache=None, completion_cache=None, llm=None):
         self.processed_html = processed_html
-        self.llm = self.initialize_llm()
-        self.prompt_template = self.initialize_template()
+        self._llm = llm
+        self._prompt_template = None
         self.scraping_code = self.SCRAPING_CODE.format(source=source, source_type=source_type)
+        self.cache = cache
+        self.cache_key = None
+        self.cache_hit = False
+        self.generated_code = None
+        # Without an explicit completion cache, use the one configured for this run, if any
+        self.completion_cache = completion_cache if completion_cache is not None else CompletionCache.from_env()
+
+    @property
+    def llm(self):
+        # The LLM client is only created when a cache miss actually needs it
+        if self._llm is None:
+            self._llm = self.initialize_llm()
+        return self._llm
+
+    @property
+    def prompt_template(self):
+        # langchain takes seconds to import, so it is only loaded once a prompt is needed
+        if self._prompt_template is None:
+            self._prompt_template = self.initialize_template()
+        return self._prompt_template
 
     def initialize_llm(self):
+        return self.create_llm()
+
+    @classmethod
+    def create_llm(cls):
+        """
+        Returns a chat model client, which can be shared by several generators
+        """
+        from langchain.chat_models import ChatOpenAI
+
         load_dotenv()
-        return ChatOpenAI(model_name=self.MODEL_NAME, temperature=0.5)
+        return ChatOpenAI(model_name=cls.MODEL_NAME, temperature=cls.TEMPERATURE)
+
+    def llm_for(self, temperature=None):
+        """
+        Returns the chat model, sampling at the given temperature instead of its own
+        """
+        llm = self.llm
+        if temperature is None or getattr(llm, "temperature", temperature) == temperature or not hasattr(llm, "copy"):
+            return llm
+        return llm.copy(update={"temperature": temperature})
 
     def initialize_template(self):
+        from langchain import PromptTemplate
+
         return PromptTemplate(input_variables=["requirements","html"], template=self.PROMPT_TEMPLATE)
 
-    def generate_scraping_code(self, user_requirements):
+    def generate_scraping_code(self, user_requirements, use_cache=True):
+        """
+        Returns the scraping code for the requirements and html.
+
+        The generated part is taken from the scraper cache when a scraper for the same
+        page layout and requirements exists, otherwise the LLM is asked for it.
+        Pass use_cache=False to force a fresh generation, e.g. after a cached scraper failed.
         """
-        Returns the LLM response based on the prompt, requirements and html
+        with get_tracer().span("generate_scraping_code") as span:
+            generated_code = None
+            self.cache_hit = False
+            if self.cache is not None:
+                self.cache_key = self.cache.key(self.processed_html, user_requirements)
+                if use_cache:
+                    generated_code = self.cache.get(self.cache_key)
+                    self.cache_hit = generated_code is not None
+            span.set("scraper_cache_hit", self.cache_hit)
+
+            if generated_code is None:
+                generated_code = self.request_generated_code(user_requirements, use_cache=use_cache)
+                if self.cache is not None:
+                    self.cache.put(self.cache_key, generated_code, requirements=user_requirements)
+
+            self.generated_code = generated_code
+            return self.assemble_scraping_code(generated_code)
+
+    def request_generated_code(self, user_requirements, use_cache=True, temperature=None):
+        """
+        Returns the code the LLM generates from the prompt, requirements and html.
+
+        Pass a temperature to sample at another temperature than TEMPERATURE, e.g. to get
+        different candidates for the same page.
         """
         formatted_prompt = self.prompt_template.format(requirements=user_requirements, html=self.processed_html)
+        return extract_code(self.request_completion(self.SYSTEM_MESSAGE, formatted_prompt, use_cache=use_cache, temperature=temperature))
+
+    def generate_selector_plan(self, user_requirements, use_cache=True):
+        """
+        Returns a declarative selector plan for the requirements and html.
+
+        Raises ValueError if the LLM does not answer with a valid plan.
+        """
+        from data_extraction.selector_plan import SelectorPlan
+
+        with get_tracer().span("generate_selector_plan"):
+            formatted_prompt = self.PLAN_PROMPT_TEMPLATE.format(requirements=user_requirements, html=self.processed_html)
+            # An answer that is not a valid plan is never cached
+            completion = self.request_completion(self.PLAN_SYSTEM_MESSAGE, formatted_prompt, use_cache=use_cache, validate=SelectorPlan.from_json)
+            return SelectorPlan.from_json(completion)
+
+    def request_completion(self, system_message, formatted_prompt, use_cache=True, temperature=None, validate=None):
+        """
+        Returns the LLM response to a system message and prompt.
+
+        Identical requests are answered from the completion cache; with use_cache=False
+        the LLM is asked again and the cached completion replaced. validate raises
+        ValueError for a completion that must not be cached; a cached completion it
+        rejects is requested again.
+        """
+        temperature = self.TEMPERATURE if temperature is None else temperature
+        from langchain.schema import HumanMessage, SystemMessage
+
         messages = [
-            SystemMessage(content=self.SYSTEM_MESSAGE),
+            SystemMessage(content=system_message),
             HumanMessage(content=formatted_prompt)
         ]
-        response = self.llm(messages)
-        generated_code = response.content
 
+        requested = []
+
+        def complete():
+            requested.append(True)
+            with get_tracer().span("llm_request", model=self.MODEL_NAME) as span:
+                completion = self.llm_for(temperature)(messages).content
+                counter = TokenCounter.for_model(self.MODEL_NAME)
+                span.set("prompt_tokens", sum(counter.count(message.content) for message in messages))
+                span.set("completion_tokens", counter.count(completion))
+            if validate is not None:
+                validate(completion)
+            return completion
+
+        if self.completion_cache is None:
+            return complete()
+
+        key = self.completion_cache.key(
+            self.MODEL_NAME,
+            {"temperature": temperature},
+            [{"role": self.MESSAGE_ROLES[message.type], "content": message.content} for message in messages],
+        )
+        if use_cache:
+            completion = self.completion_cache.get_or_create(key, complete)
+            current_span().set("completion_cache_hit", not requested)
+            if requested or validate is None:
+                return completion
+            try:
+                validate(completion)
+                return completion
+            except ValueError:
+                # Cached before it was validated, e.g. by an earlier version
+                completion = complete()
+                self.completion_cache.put(key, completion)
+        else:
+            completion = complete()
+            self.completion_cache.put(key, completion)
+        return completion
+
+    def assemble_scraping_code(self, generated_code):
+        """
+        Prepends the loading boilerplate for this source to the generated code
+        """
         full_scraping_code = f"""
 {self.scraping_code}
 {generated_code}
@@ -83,6 +270,16 @@ html_soup = BeautifulSoup(response, 'html.parser')
         #print(full_scraping_code)
         return full_scraping_code
 
+
+def extract_code(response_text):
+    """
+    Returns the code inside a markdown code block, or the text itself if there is none
+    """
+    match = re.search(r"```(?:python|py)?[ \t]*\n(.*?)```", response_text, re.S)
+    if match:
+        return match.group(1).strip()
+    return response_text.strip()
+
         
 
 class CodeWriter:
@@ -93,5 +290,7 @@ class CodeWriter:
         """
         Writes the scraping code to a .py python file
         """
-        with open(self.file_name, 'w') as file:
-            file.write(scraping_code)
\ No newline at end of file
+        with get_tracer().span("write_code", file_name=self.file_name) as span:
+            with open(self.file_name, 'w') as file:
+                file.write(scraping_code)
+            span.set("bytes_written", len(scraping_code.encode("utf-8")))
\ No newline at end of file
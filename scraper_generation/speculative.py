@@ -0,0 +1,301 @@
+"""speculative.py: Generate several candidate scrapers at once and keep the first one that works.
+
+A generated scraper may crash or extract nothing, and asking the LLM again costs another
+round trip. In speculative mode, N candidates are requested concurrently, each at a
+temperature of its own. Every candidate runs as soon as its code arrives, in a sandbox
+of its own: a subprocess working on the page the pipeline already loaded. Its output is
+checked against what the target string promises. The first candidate that passes wins,
+and the sandboxes of the others are killed, so getting a working scraper takes about
+one round trip instead of several.
+"""
+import contextvars
+import json
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from instrumentation.tracing import get_tracer
+
+
+def candidate_temperatures(count: int, default: float) -> List[float]:
+    """
+    Return distinct sampling temperatures for the candidates.
+
+    The first candidate samples at the default temperature of a normal run, the others
+    are spread between 0 and 1.
+
+    :param count: Number of candidates
+    :param default: The usual temperature of the generator
+    :return: The temperature of every candidate
+    """
+    if count <= 1:
+        return [default][:count]
+    spread = [round(index / (count - 1), 2) for index in range(count)]
+    return [default] + [temperature for temperature in spread if temperature != default][:count - 1]
+
+
+class CandidateResult:
+    """The outcome of running one candidate scraper."""
+
+    def __init__(self, index: int, temperature: Optional[float], generated_code: Optional[str], exit_code: int = 1, stdout: str = "", stderr: str = "", records: Optional[List] = None, elapsed: float = 0.0):
+        """
+        Initialize the CandidateResult class.
+
+        :param index: Number of the candidate
+        :param temperature: Temperature the candidate was sampled at, None for a cached scraper
+        :param generated_code: The generated part of the scraper, None if generation failed
+        :param exit_code: Exit code of the scraper
+        :param stdout: Everything the scraper printed
+        :param stderr: The error output of the scraper
+        :param records: The records the scraper emitted
+        :param elapsed: Seconds from the request to the LLM to the end of the scraper
+        """
+        self.index = index
+        self.temperature = temperature
+        self.generated_code = generated_code
+        self.exit_code = exit_code
+        self.stdout = stdout
+        self.stderr = stderr
+        self.records = records or []
+        self.elapsed = elapsed
+        # Why the candidate was rejected, None if it passed the check
+        self.reason = None
+
+    @property
+    def valid(self) -> bool:
+        return self.generated_code is not None and self.reason is None
+
+
+class OutputCheck:
+    """Tells whether the output of a scraper looks like what the target string promises."""
+
+    def __init__(self, target_string: Optional[str] = None):
+        """
+        Initialize the OutputCheck class.
+
+        :param target_string: An example value the scraper has to extract, if known
+        """
+        self.target = self.normalize(target_string) if target_string else None
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(text.split()).lower()
+
+    def __call__(self, result: CandidateResult) -> Optional[str]:
+        """
+        Check the output of a scraper.
+
+        It has to exit with status 0 and print or emit something. Emitted dicts have to
+        hold at least one value, and the target string has to appear in the output.
+
+        :param result: The result of the scraper
+        :return: The reason the output is rejected, or None if it is accepted
+        """
+        if result.exit_code != 0:
+            last_line = (result.stderr.strip().splitlines() or [""])[-1]
+            return f"exited with status {result.exit_code}" + (f": {last_line}" if last_line else "")
+        if not result.records and not result.stdout.strip():
+            return "extracted nothing"
+        records = [record for record in result.records if isinstance(record, dict)]
+        if records and not any(value not in (None, "", [], {}) for record in records for value in record.values()):
+            return "emitted only empty records"
+        if self.target is not None:
+            output = result.stdout + "\n" + "\n".join(json.dumps(record, ensure_ascii=False, default=str) for record in result.records)
+            if self.target not in self.normalize(output):
+                return "the target string is missing from the output"
+        return None
+
+
+class Sandbox:
+    """Runs one scraper in a subprocess of its own, which can be killed from another thread."""
+
+    def __init__(self, directory: str, name: str, document_path: Optional[str] = None):
+        """
+        Initialize the Sandbox class.
+
+        :param directory: Directory the code and the records of the scraper are written to
+        :param name: Name of the sandbox, unique within the directory
+        :param document_path: File holding the loaded page, handed over as SCRAPER_DOCUMENT
+        """
+        self.code_path = os.path.join(directory, f"{name}.py")
+        self.records_path = os.path.join(directory, f"{name}.jsonl")
+        self.document_path = document_path
+        self.process = None
+        self.killed = False
+
+    def start(self, scraping_code: str) -> None:
+        """
+        Write the scraper to its file and start it.
+
+        :param scraping_code: The complete scraper
+        """
+        with open(self.code_path, "w", encoding="utf-8") as file:
+            file.write(scraping_code)
+        env = dict(os.environ, SCRAPER_RECORDS=self.records_path)
+        if self.document_path is not None:
+            env["SCRAPER_DOCUMENT"] = self.document_path
+        self.process = subprocess.Popen(
+            [sys.executable, self.code_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, text=True
+        )
+
+    def wait(self, timeout: float):
+        """
+        Wait for the scraper to finish, killing it after the timeout.
+
+        :param timeout: Seconds the scraper may run
+        :return: Its (exit code, stdout, stderr, emitted records)
+        """
+        try:
+            stdout, stderr = self.process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            stdout, stderr = self.process.communicate()
+            stderr += f"\nTimed out after {timeout}s"
+        records = []
+        try:
+            with open(self.records_path, "r", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # A scraper killed while writing leaves a partial last line
+                        continue
+        except FileNotFoundError:
+            pass  # Nothing was emitted
+        return self.process.returncode, stdout, stderr, records
+
+    def kill(self) -> None:
+        """Stop the scraper if it is still running."""
+        self.killed = True
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+
+
+class SpeculativeGenerator:
+    """Race several candidate scrapers for a page and keep the first one whose output passes the check."""
+
+    def __init__(self, code_generator, candidates: int = 3, check: Optional[OutputCheck] = None, timeout: float = 60):
+        """
+        Initialize the SpeculativeGenerator class.
+
+        :param code_generator: The ScrapingCodeGenerator of the page
+        :param candidates: Number of candidates requested at the same time, defaults to 3
+        :param check: The check the output has to pass, defaults to one without target string
+        :param timeout: Seconds a candidate scraper may run, defaults to 60
+        """
+        self.code_generator = code_generator
+        self.candidates = candidates
+        self.check = check if check is not None else OutputCheck()
+        self.timeout = timeout
+        # Every candidate that finished before the winner, the winner included
+        self.results: List[CandidateResult] = []
+
+    def generate(self, requirements: str, document: Optional[str] = None) -> Optional[CandidateResult]:
+        """
+        Find a scraper for the page whose output passes the check.
+
+        A scraper from the scraper cache is tried on its own first. Otherwise, or if it
+        fails, the candidates are raced, and the winner is put into the scraper cache.
+
+        :param requirements: The user requirements
+        :param document: The loaded page, defaults to letting the scrapers load it themselves
+        :return: The result of the accepted scraper, or None if every candidate was rejected
+        """
+        generator = self.code_generator
+        self.results = []
+        with tempfile.TemporaryDirectory(prefix="candidates-") as directory:
+            document_path = None
+            if document is not None:
+                document_path = os.path.join(directory, "document.html")
+                with open(document_path, "w", encoding="utf-8") as file:
+                    file.write(document)
+
+            cached = None
+            if generator.cache is not None:
+                generator.cache_key = generator.cache.key(generator.processed_html, requirements)
+                cached = generator.cache.get(generator.cache_key)
+            if cached is not None:
+                sandbox = Sandbox(directory, "cached", document_path)
+                sandbox.start(generator.assemble_scraping_code(cached))
+                result = self._finish(0, None, cached, sandbox, time.perf_counter())
+                self.results.append(result)
+                generator.cache_hit = result.valid
+                if result.valid:
+                    generator.generated_code = cached
+                    return result
+                # The cached scraper no longer works for this page
+                generator.cache.invalidate(generator.cache_key)
+
+            winner = self._race(requirements, directory, document_path)
+
+        if winner is not None:
+            generator.generated_code = winner.generated_code
+            if generator.cache is not None:
+                generator.cache.put(generator.cache_key, winner.generated_code, requirements=requirements)
+        return winner
+
+    def _race(self, requirements, directory, document_path):
+        generator = self.code_generator
+        finished = queue.Queue()
+        lock = threading.Lock()
+        cancelled = threading.Event()
+        sandboxes = []
+
+        def candidate(index, temperature):
+            start = time.perf_counter()
+            try:
+                # Always a fresh sample: a cached completion would replay a candidate that was
+                # rejected before, or the one the stale cached scraper was generated from
+                generated_code = generator.request_generated_code(requirements, use_cache=False, temperature=temperature)
+            except Exception as error:
+                result = CandidateResult(index, temperature, None, elapsed=time.perf_counter() - start)
+                result.reason = f"generation failed: {error!r}"
+                finished.put(result)
+                return
+            # Once a winner is known, no further sandbox is started
+            with lock:
+                if cancelled.is_set():
+                    finished.put(None)
+                    return
+                sandbox = Sandbox(directory, f"candidate-{index}", document_path)
+                sandbox.start(generator.assemble_scraping_code(generated_code))
+                sandboxes.append(sandbox)
+            finished.put(self._finish(index, temperature, generated_code, sandbox, start))
+
+        temperatures = candidate_temperatures(self.candidates, generator.TEMPERATURE)
+        executor = ThreadPoolExecutor(len(temperatures), thread_name_prefix="candidate")
+        for index, temperature in enumerate(temperatures):
+            # Each candidate's spans nest in the trace of the page
+            executor.submit(contextvars.copy_context().run, candidate, index, temperature)
+
+        winner = None
+        for _ in temperatures:
+            result = finished.get()
+            if result is None:
+                continue
+            self.results.append(result)
+            if result.valid:
+                winner = result
+                break
+
+        with lock:
+            cancelled.set()
+            for sandbox in sandboxes:
+                sandbox.kill()
+        # Requests to the LLM still in flight are left to finish in the background
+        executor.shutdown(wait=winner is None, cancel_futures=True)
+        return winner
+
+    def _finish(self, index, temperature, generated_code, sandbox, start):
+        with get_tracer().span("execute", executor="sandbox", candidate=index) as span:
+            exit_code, stdout, stderr, records = sandbox.wait(self.timeout)
+            span.set("exit_code", exit_code)
+        result = CandidateResult(index, temperature, generated_code, exit_code, stdout, stderr, records, time.perf_counter() - start)
+        result.reason = "cancelled" if sandbox.killed else self.check(result)
+        return result
@@ -0,0 +1,5 @@
+"""__init__.py: The Service component.
+
+Runs the scraping pipeline with state shared across pages, and keeps it warm in a
+daemon that thin command-line clients hand their work to.
+"""
@@ -0,0 +1,87 @@
+"""client.py: A thin client for the scraper daemon.
+
+Only the standard library is imported here, so a CLI invocation that hands its work
+to a running daemon starts in milliseconds instead of loading langchain, the parsers
+and the caches itself.
+"""
+import http.client
+import json
+import socket
+from typing import Optional, Tuple, Union
+
+DAEMON_ENV = "SCRAPER_DAEMON"
+DEFAULT_ADDRESS = ".scraper.sock"
+
+
+def parse_address(address: str) -> Union[str, Tuple[str, int]]:
+    """
+    Interpret a daemon address.
+
+    :param address: "host:port" or "http://host:port" for TCP, anything else is the path of a Unix socket
+    :return: A (host, port) tuple, or the socket path
+    """
+    location = address[len("http://"):] if address.startswith("http://") else address
+    host, separator, port = location.rpartition(":")
+    if separator and port.isdigit() and "/" not in location:
+        return host or "127.0.0.1", int(port)
+    return address
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class DaemonClient:
+    """Send scrape requests to a daemon started with gpt-scraper.py --serve."""
+
+    def __init__(self, address: str = DEFAULT_ADDRESS, timeout: Optional[float] = None):
+        """
+        Initialize the DaemonClient class.
+
+        :param address: Unix socket path or host:port of the daemon, defaults to ".scraper.sock"
+        :param timeout: Socket timeout in seconds, defaults to waiting as long as the scrape takes
+        """
+        self.address = parse_address(address)
+        self.timeout = timeout
+
+    def health(self) -> dict:
+        """
+        Return the status of the daemon.
+
+        :raises OSError: If no daemon listens on the address
+        """
+        return self._request("GET", "/health")
+
+    def scrape(self, options: dict) -> dict:
+        """
+        Run a scrape on the daemon and wait for it to finish.
+
+        :param options: The arguments describing what to scrape, e.g. source and requirements
+        :return: A dict with the exit_code and the stdout and stderr of the run
+        :raises OSError: If no daemon listens on the address
+        """
+        return self._request("POST", "/scrape", options)
+
+    def _request(self, method, path, payload=None):
+        if isinstance(self.address, tuple):
+            connection = http.client.HTTPConnection(*self.address, timeout=self.timeout)
+        else:
+            connection = _UnixHTTPConnection(self.address, timeout=self.timeout)
+        try:
+            body = json.dumps(payload).encode("utf-8") if payload is not None else None
+            connection.request(method, path, body=body, headers={"Content-Type": "application/json"})
+            response = connection.getresponse()
+            data = json.loads(response.read().decode("utf-8"))
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise RuntimeError(f"The daemon answered {response.status}: {data.get('error')}")
+        return data
@@ -0,0 +1,254 @@
+"""daemon.py: Keep a warm scraper process behind a local HTTP API.
+
+Started with `gpt-scraper.py --serve`, the daemon imports the pipeline, creates the
+LLM client and sets up the caches and the worker pool once, and then answers
+
+    GET  /health    {"ok": true, "pid": ..., "requests": ...}
+    POST /scrape    {"source": ..., "source_type": ..., "requirements": ..., ...}
+
+on a Unix socket or a TCP port. A scrape request only carries what to scrape; the
+caches, the parser, the executor and the metrics are configured by the daemon's own
+command line. The response holds the exit code and everything the run printed.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator
+
+from service.client import parse_address
+
+# Arguments a client may set per request, everything else is fixed when the daemon starts
+REQUEST_OPTIONS = (
+    "source",
+    "source_type",
+    "batch",
+    "concurrency",
+    "per_host_limit",
+    "crawl",
+    "follow",
+    "max_pages",
+    "crawl_delay",
+    "crawl_checkpoint",
+    "requirements",
+    "target_string",
+    "max_tokens",
+    "streaming",
+    "no_locator",
+    "keep_repeated",
+    "extract_with",
+    "plan_file",
+    "derive_plan",
+    "output",
+    "unchanged",
+    "candidates",
+)
+
+
+class _ThreadOutput(io.TextIOBase):
+    """Stands in for sys.stdout or sys.stderr and sends each request thread's output to its own buffer."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._local = threading.local()
+
+    @property
+    def encoding(self):
+        return getattr(self.stream, "encoding", "utf-8")
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        buffer = getattr(self._local, "buffer", None)
+        return (buffer if buffer is not None else self.stream).write(text)
+
+    def flush(self):
+        if getattr(self._local, "buffer", None) is None:
+            self.stream.flush()
+
+    @contextlib.contextmanager
+    def capture(self) -> Iterator[io.StringIO]:
+        self._local.buffer = io.StringIO()
+        try:
+            yield self._local.buffer
+        finally:
+            self._local.buffer = None
+
+
+class _UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class ScraperDaemon:
+    """Serve scrape requests with one long-lived ScrapeRunner."""
+
+    def __init__(self, runner, defaults: argparse.Namespace, address: str):
+        """
+        Bind the server.
+
+        :param runner: The ScrapeRunner that handles every request
+        :param defaults: Arguments of the daemon, the base of every request's arguments
+        :param address: Unix socket path or host:port to listen on, port 0 picks a free port
+        :raises OSError: If another daemon already listens on the address
+        """
+        self.runner = runner
+        self.defaults = defaults
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._stdout = _ThreadOutput(sys.stdout)
+        self._stderr = _ThreadOutput(sys.stderr)
+
+        handler = self._handler()
+        location = parse_address(address)
+        if isinstance(location, tuple):
+            self.server = ThreadingHTTPServer(location, handler)
+            self.server.daemon_threads = True
+            self.socket_path = None
+        else:
+            self._remove_stale_socket(location)
+            self.server = _UnixHTTPServer(location, handler)
+            self.socket_path = location
+
+    @property
+    def address(self) -> str:
+        """Return the address clients connect to."""
+        if self.socket_path is not None:
+            return self.socket_path
+        host, port = self.server.server_address[:2]
+        return f"{host}:{port}"
+
+    def serve_forever(self) -> None:
+        """Answer requests until shutdown() is called; output of the runs goes to the clients."""
+        self._redirect_output()
+        try:
+            self.server.serve_forever()
+        finally:
+            sys.stdout, sys.stderr = self._stdout.stream, self._stderr.stream
+
+    def _redirect_output(self):
+        # Also checked per request, in case something replaced the streams since the daemon started
+        if sys.stdout is not self._stdout:
+            self._stdout.stream, sys.stdout = sys.stdout, self._stdout
+        if sys.stderr is not self._stderr:
+            self._stderr.stream, sys.stderr = sys.stderr, self._stderr
+
+    def shutdown(self) -> None:
+        """Stop serve_forever() from another thread."""
+        self.server.shutdown()
+
+    def close(self) -> None:
+        """Close the listening socket."""
+        self.server.server_close()
+        if self.socket_path is not None and os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    def scrape(self, options: dict) -> dict:
+        """
+        Run one scrape request and collect its output.
+
+        :param options: Per-request arguments, see REQUEST_OPTIONS
+        :return: A dict with the exit_code, stdout and stderr of the run
+        """
+        unknown = set(options) - set(REQUEST_OPTIONS)
+        if unknown:
+            raise ValueError(f"Options that can only be set when the daemon starts: {', '.join(sorted(unknown))}")
+        args = argparse.Namespace(**vars(self.defaults))
+        for key, value in options.items():
+            setattr(args, key, value)
+
+        with self._lock:
+            self.requests += 1
+            self._redirect_output()
+        with self._stdout.capture() as stdout, self._stderr.capture() as stderr:
+            try:
+                exit_code = self.runner.scrape(args)
+            except Exception:
+                traceback.print_exc()
+                exit_code = 1
+        return {"exit_code": exit_code, "stdout": stdout.getvalue(), "stderr": stderr.getvalue()}
+
+    def _handler(self):
+        daemon = self
+
+        class DaemonHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/health":
+                    self._reply(404, {"error": f"Unknown path {self.path}"})
+                    return
+                self._reply(200, {"ok": True, "pid": os.getpid(), "requests": daemon.requests})
+
+            def do_POST(self):
+                if self.path != "/scrape":
+                    self._reply(404, {"error": f"Unknown path {self.path}"})
+                    return
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    options = json.loads(self.rfile.read(length).decode("utf-8") or "{}")
+                    result = daemon.scrape(options)
+                except ValueError as error:
+                    self._reply(400, {"error": str(error)})
+                    return
+                self._reply(200, result)
+
+            def _reply(self, status, payload):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return DaemonHandler
+
+    @staticmethod
+    def _remove_stale_socket(path):
+        # A socket file left behind by a daemon that died is removed; a live daemon is not replaced
+        if not os.path.exists(path):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.remove(path)
+            return
+        finally:
+            probe.close()
+        raise OSError(f"A daemon is already listening on {path}")
+
+
+def serve(args: argparse.Namespace, address: str) -> None:
+    """
+    Run the daemon until it is interrupted or receives SIGTERM.
+
+    :param args: Parsed arguments of gpt-scraper.py, they configure the runner
+    :param address: Unix socket path or host:port to listen on
+    """
+    from service.runner import ScrapeRunner
+
+    # The output of scrapers in fresh interpreters cannot be sent back, so they run in the pool
+    if args.executor == "subprocess":
+        args.executor = "pool"
+
+    with ScrapeRunner(args) as runner:
+        runner.warm_up()
+        daemon = ScraperDaemon(runner, args, address)
+        signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=daemon.shutdown).start())
+        print(f"Serving on {daemon.address}", flush=True)
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            daemon.close()
@@ -0,0 +1,574 @@
+"""runner.py: Run the scraping pipeline with state that is set up once per process.
+
+The runner holds everything that is expensive to create and can be shared between
+pages: the scraper cache, the pool of warm worker processes, the LLM client, and the
+configuration of the parser backend, the HTTP cache, the completion cache and the
+metrics exporters. gpt-scraper.py creates one runner per invocation; the daemon
+keeps one alive across requests.
+"""
+import argparse
+import contextlib
+import contextvars
+import os
+import sys
+import tempfile
+import time
+
+from instrumentation.tracing import configure as configure_tracing, current_span, get_tracer
+
+# The RecordCollector of the page being scraped. The daemon serves requests on several
+# threads with one runner, so it is kept per thread and context, not on the runner.
+_collector = contextvars.ContextVar('collector', default=None)
+
+
+class ScrapeRunner:
+    """Scrape single pages or batches with shared caches, workers and LLM client."""
+
+    def __init__(self, args: argparse.Namespace, llm=None):
+        """
+        Configure the process from the command-line arguments.
+
+        :param args: Parsed arguments of gpt-scraper.py
+        :param llm: Chat model shared by all pages, defaults to one created per page on demand
+        :raises ValueError: If the requested parser backend is not available
+        """
+        from data_extraction.execution_pool import ScraperExecutionPool
+        from gpt_interaction.completion_cache import CompletionCache
+        from scraper_generation.scraper_cache import ScraperCache
+        from website_analysis.browser_pool import configure_env as configure_browser_env
+        from website_analysis.http_cache import HttpCache
+        from website_analysis.parser_backends import configure_env as configure_parser_env
+
+        # The generated scrapers parse the page with the same tree builder as the pipeline
+        configure_parser_env(args.parser)
+        # Pages with --source-type browser are rendered by a pool of browsers kept for the whole run
+        configure_browser_env(args.browsers, args.browser_contexts, args.browser_recycle_after)
+
+        # Stages are always timed, the exporters decide where the spans go
+        configure_tracing(args.metrics_file, args.metrics_port)
+
+        # Loaders in this process and in the scraper processes pick the HTTP cache up from the environment
+        if args.http_cache or args.offline:
+            http_cache = HttpCache(args.http_cache or '.http_cache', args.http_cache_size_mb, offline=args.offline)
+            http_cache.configure_env()
+
+        self.cache = None if args.no_cache else ScraperCache(args.scraper_cache)
+        if not args.no_cache:
+            # Every LLM client of the run picks the completion cache up from the environment
+            CompletionCache(args.completion_cache, args.completion_cache_size_mb, args.completion_cache_ttl).configure_env()
+
+        # Records of every page go to one sink, so files rotate across the whole batch
+        self.sink = None
+        if args.sink:
+            from data_extraction.sinks import open_sink
+
+            max_bytes = int(args.rotate_mb * 1024 * 1024) if args.rotate_mb else None
+            self.sink = open_sink(args.sink, args.sink_format, row_group_size=args.row_group_size, max_records_per_file=args.rotate_records, max_bytes_per_file=max_bytes)
+
+        # Pages whose relevant part did not change since the last run are not scraped again
+        self.states = None
+        if args.state_store:
+            from data_extraction.change_detection import PageStateStore
+
+            self.states = PageStateStore(args.state_store)
+
+        self.executor = args.executor
+        self.pool = None
+        if args.executor == 'pool':
+            self.pool = ScraperExecutionPool(workers=args.workers, timeout=args.job_timeout, memory_limit_mb=args.job_memory_mb, max_jobs_per_worker=args.recycle_after)
+        self.llm = llm
+
+    def scrape(self, args: argparse.Namespace) -> int:
+        """
+        Scrape the --source or every page of the --batch of the arguments, or crawl from them.
+
+        :param args: Parsed arguments describing what to scrape
+        :return: 0 if every page was scraped, 1 otherwise
+        """
+        if args.extract_with == 'plan':
+            return self.extract_with_plan(args)
+        if args.crawl:
+            return 1 if self.crawl(args) else 0
+        if args.batch:
+            return 1 if self.scrape_batch(args) else 0
+        return 0 if self.scrape_page(args.source, args.source_type, args) == 0 else 1
+
+    def extract_with_plan(self, args):
+        """
+        Apply one selector plan to the --source or to every page of the --batch.
+
+        The plan is read from --plan-file, or created on the first page, by the LLM or,
+        with --derive-plan, from the position of --target-string, and saved to --plan-file.
+        The records of all pages are written to --output, or as CSV to stdout.
+        """
+        from data_extraction.selector_plan import BulkExtractor, SelectorPlan, write_frame
+
+        plan = None
+        if args.plan_file and os.path.exists(args.plan_file):
+            plan = SelectorPlan.load(args.plan_file)
+        extractor = None if plan is None else BulkExtractor(plan)
+
+        failures = 0
+        records = []
+        for source, source_type, html, fetched in self.pages(args):
+            with get_tracer().span('scrape_page', source=source, source_type=source_type) as span:
+                if fetched is not None:
+                    span.set('fetch_seconds', fetched.elapsed)
+                    span.set('bytes_fetched', len(html.encode('utf-8')))
+                if extractor is None:
+                    try:
+                        html, plan = self.create_plan(source, source_type, args, html)
+                    except ValueError as error:
+                        print(f"Could not create a selector plan from {source}: {error}", file=sys.stderr)
+                        return 1
+                    if plan is None:
+                        print(f"Could not create a selector plan from {source}", file=sys.stderr)
+                        return 1
+                    if args.plan_file:
+                        plan.save(args.plan_file)
+                    extractor = BulkExtractor(plan)
+                elif html is None:
+                    html = self.load(source, source_type)
+
+                with get_tracer().span('extract', backend=extractor.backend.name) as extract_span:
+                    page_records = extractor.extract(html)
+                    extract_span.set('records', len(page_records))
+                if not page_records:
+                    print(f"The selector plan found nothing in {source}", file=sys.stderr)
+                    failures += 1
+                page_records = ({'source': source, **record} for record in page_records)
+                if self.sink is not None:
+                    # Streamed to the sink instead of collected, so memory stays flat
+                    self.sink.write_many(page_records)
+                else:
+                    records.extend(page_records)
+
+        frame = extractor.to_frame(records) if extractor is not None and self.sink is None else None
+        if frame is not None:
+            if args.output:
+                write_frame(frame, args.output)
+            else:
+                frame.to_csv(sys.stdout, index=False)
+        return 1 if failures else 0
+
+    def pages(self, args):
+        # (source, source type, html or None, FetchedPage or None) of every page to scrape
+        if args.crawl:
+            pages = self.crawler(args).stream(self.seeds(args))
+        elif args.batch:
+            from website_analysis.fetcher import AsyncHtmlFetcher, read_sources
+
+            fetcher = AsyncHtmlFetcher(concurrency=args.concurrency, per_host_limit=args.per_host_limit)
+            pages = fetcher.stream(read_sources(args.batch))
+        else:
+            yield args.source, args.source_type, None, None
+            return
+
+        for page in pages:
+            if not page.ok:
+                print(f"Failed to fetch {page.source}: {page.error}", file=sys.stderr)
+                continue
+            yield page.source, page.source_type, page.html, page
+
+    def create_plan(self, source, source_type, args, html=None):
+        # Returns the HTML of the page and a selector plan for it
+        from data_extraction.selector_plan import derive_plan
+        from scraper_generation.scraper_generator import ScrapingCodeGenerator
+
+        manager = self.html_manager(source, source_type, args)
+        processed_html = manager.process_html() if html is None else manager.process(html)
+        html = manager.html if manager.html is not None else self.load(source, source_type)
+
+        if args.derive_plan:
+            return html, derive_plan(html, args.target_string) if args.target_string else None
+        code_generator = ScrapingCodeGenerator(processed_html, source=source, source_type=source_type, llm=self.llm)
+        return html, code_generator.generate_selector_plan(args.requirements)
+
+    @staticmethod
+    def html_manager(source, source_type, args):
+        from scraper_generation.scraper_generator import ScrapingCodeGenerator
+        from website_analysis.dom_analysis import HtmlManager
+
+        return HtmlManager(source, source_type, args.target_string, model=ScrapingCodeGenerator.MODEL_NAME, max_tokens=args.max_tokens, streaming=args.streaming, use_locator=not args.no_locator, collapse_repetitions=not args.keep_repeated)
+
+    @staticmethod
+    def load(source, source_type):
+        from website_analysis.dom_analysis import BrowserHtmlLoader, HtmlLoader, UrlHtmlLoader
+
+        loaders = {'url': UrlHtmlLoader, 'browser': BrowserHtmlLoader}
+        loader = loaders.get(source_type, HtmlLoader)(source)
+        with get_tracer().span('load', source_type=type(loader).__name__):
+            return loader.load()
+
+    def execute_scraper(self, scraping_code, html=None, parsed_html=None):
+        with get_tracer().span('execute', executor=self.executor) as span:
+            return_code = self.run_scraper(scraping_code, html, parsed_html)
+            span.set('exit_code', return_code)
+        return return_code
+
+    def run_scraper(self, scraping_code, html=None, parsed_html=None):
+        from data_extraction.data_extractor import CodeExecutor, InlineCodeExecutor
+        from scraper_generation.scraper_generator import CodeWriter
+
+        # The scraper gets the document that has already been loaded instead of fetching it again
+        if self.executor == 'inline':
+            # Execute the code in this process, reusing the parse tree as well
+            code_executor = InlineCodeExecutor()
+            target = self.records_target()
+            emit = target.write if target is not None else None
+            return code_executor.execute(scraping_code, html, parsed_html, emit=emit)
+
+        if self.pool is None:
+            # Instantiate CodeWriter
+            code_writer = CodeWriter('scraping_code.py')
+
+            # Write the code to a file
+            code_writer.write(scraping_code)
+
+            # Instantiate CodeExecutor
+            code_executor = CodeExecutor('scraping_code.py')
+
+            # Execute the code in a fresh interpreter
+            with self.spool() as records_file:
+                return_code = code_executor.execute(document=html, records_file=records_file)
+                if return_code == 0:
+                    self.drain(records_file)
+            return return_code
+
+        # Execute the code in a warm worker process
+        namespace = {} if html is None else {'response': html}
+        with self.spool() as records_file:
+            if records_file is not None:
+                namespace['records_file'] = records_file
+            result = self.pool.run(scraping_code, namespace)
+            if result.ok:
+                self.drain(records_file)
+        print(result.stdout, end='')
+        if not result.ok:
+            print(result.error, file=sys.stderr)
+        return 0 if result.ok else 1
+
+    def records_target(self):
+        # Where the records emitted by a scraper go: the collector of the page, the sink, or stdout (None)
+        collector = _collector.get()
+        return collector if collector is not None else self.sink
+
+    @contextlib.contextmanager
+    def spool(self):
+        # A file scrapers in other processes emit their records to, see drain()
+        if self.records_target() is None:
+            yield None
+            return
+
+        descriptor, path = tempfile.mkstemp(prefix='records-', suffix='.jsonl')
+        os.close(descriptor)
+        try:
+            yield path
+        finally:
+            # The records of a scraper that failed are dropped
+            if os.path.exists(path):
+                os.remove(path)
+
+    def drain(self, records_file):
+        # Moves the records of a scraper that succeeded from its spool file to the records target
+        if records_file is not None:
+            from data_extraction.sinks import drain_spool
+
+            drain_spool(records_file, self.records_target())
+
+    @contextlib.contextmanager
+    def collecting(self):
+        # Keeps the records of a page while they are emitted. The caller flushes them to the
+        # sink only if the page was scraped, so a failed attempt leaves no records behind.
+        from data_extraction.change_detection import RecordCollector
+
+        collector = RecordCollector(self.sink)
+        token = _collector.set(collector)
+        try:
+            yield collector
+        finally:
+            _collector.reset(token)
+
+    def keep_records(self, collector, source, args, body_hash, subtree_hash):
+        # Hands the records of a page that was scraped to the sink and stores its state
+        collector.flush()
+        if self.states is not None:
+            self.states.put(source, args.requirements, body_hash, subtree_hash, collector.records)
+
+    def unchanged_page(self, source, args, body_hash, subtree_hash=None):
+        """
+        Return the stored state of a page if the part its scraper reads has not changed.
+
+        Without a subtree hash, the raw bodies are compared, otherwise the subtrees.
+
+        :return: The PageState of the last scrape, or None if the page has to be scraped
+        """
+        state = self.states.get(source, args.requirements)
+        if state is None:
+            return None
+        if subtree_hash is None:
+            unchanged = body_hash is not None and body_hash == state.body_hash
+        else:
+            unchanged = subtree_hash == state.subtree_hash
+        if not unchanged:
+            return None
+        self.states.unchanged(source, args.requirements, body_hash)
+        return state
+
+    def replay(self, state, args):
+        # Emits the stored records of an unchanged page again, or only reports it
+        span = current_span()
+        span.set('unchanged', True)
+        span.set('records', len(state.records))
+        if args.unchanged == 'emit':
+            from data_extraction.change_detection import RecordCollector
+
+            collector = RecordCollector(self.sink)
+            collector.write_many(state.records)
+            collector.flush()
+        else:
+            scraped_at = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(state.scraped_at))
+            print(f"Unchanged since {scraped_at}: {state.url}", file=sys.stderr)
+        return 0
+
+    def scrape_page(self, source, source_type, args, html=None, fetched=None):
+        # Every page gets its own trace, the stages below nest in it
+        with get_tracer().span('scrape_page', source=source, source_type=source_type) as span:
+            if fetched is not None:
+                # Batch pages were fetched before the trace started
+                span.set('fetch_seconds', fetched.elapsed)
+                span.set('bytes_fetched', len(fetched.html.encode('utf-8')))
+            return_code, _ = self.generate_and_run(source, source_type, args, html)
+            span.set('exit_code', return_code)
+        return return_code
+
+    def generate_and_run(self, source, source_type, args, html=None):
+        # Returns the exit code of the scraper and the generated part of its code
+        from scraper_generation.scraper_generator import ScrapingCodeGenerator
+
+        # Instantiate the HTML manager
+        manager = self.html_manager(source, source_type, args)
+
+        # An unchanged body is recognized before the page is parsed
+        body_hash = None
+        if self.states is not None:
+            from data_extraction.change_detection import content_hash
+
+            if html is None and not args.streaming:
+                html = self.load(source, source_type)
+            body_hash = content_hash(html) if html is not None else None
+            state = self.unchanged_page(source, args, body_hash)
+            if state is not None:
+                return self.replay(state, args), None
+
+        # Load Processed HTML, reusing the page if it has already been fetched
+        if html is None:
+            processed_html = manager.process_html()
+        else:
+            processed_html = manager.process(html)
+
+        # A body that changed only outside the part the scraper reads is not scraped either
+        subtree_hash = None
+        if self.states is not None:
+            subtree_hash = manager.subtree_hash()
+            state = self.unchanged_page(source, args, body_hash, subtree_hash)
+            if state is not None:
+                return self.replay(state, args), None
+
+        # Instantiate ScrapingCodeGenerator with the processed_html
+        code_generator = ScrapingCodeGenerator(processed_html, source=source, source_type=source_type, cache=self.cache, llm=self.llm)
+
+        if args.candidates > 1:
+            with self.collecting() as collector:
+                return_code = self.generate_speculatively(code_generator, manager.html, args)
+            if return_code == 0:
+                self.keep_records(collector, source, args, body_hash, subtree_hash)
+            return return_code, code_generator.generated_code
+
+        # Generate scraping code
+        scraping_code = code_generator.generate_scraping_code(args.requirements)
+
+        with self.collecting() as collector:
+            # Execute the code
+            return_code = self.execute_scraper(scraping_code, manager.html, manager.parsed_html)
+
+            # A cached scraper that no longer works for this page is dropped and regenerated
+            if return_code != 0 and code_generator.cache_hit:
+                self.cache.invalidate(code_generator.cache_key)
+                scraping_code = code_generator.generate_scraping_code(args.requirements, use_cache=False)
+                collector.clear()
+                return_code = self.execute_scraper(scraping_code, manager.html, manager.parsed_html)
+
+        if return_code == 0:
+            self.keep_records(collector, source, args, body_hash, subtree_hash)
+
+        return return_code, code_generator.generated_code
+
+    def generate_speculatively(self, code_generator, html, args):
+        """
+        Race --candidates scrapers for the page and pass on the output of the first one that works.
+
+        The candidates run in subprocesses whatever the executor, so the losers can be killed.
+        """
+        from scraper_generation.speculative import OutputCheck, SpeculativeGenerator
+
+        speculation = SpeculativeGenerator(code_generator, candidates=args.candidates, check=OutputCheck(args.target_string), timeout=args.job_timeout)
+        with get_tracer().span('speculate', candidates=args.candidates) as span:
+            winner = speculation.generate(args.requirements, html)
+            span.set('tried', len(speculation.results))
+            span.set('winner', winner.index if winner is not None else None)
+        if winner is None:
+            for result in speculation.results:
+                print(f"Candidate {result.index} rejected: {result.reason}", file=sys.stderr)
+            return 1
+
+        # Only the output of the accepted scraper is passed on
+        print(winner.stdout, end='')
+        target = self.records_target()
+        if target is not None:
+            target.write_many(winner.records)
+        else:
+            from data_extraction.sinks import RecordEmitter
+
+            emit = RecordEmitter()
+            for record in winner.records:
+                emit(record)
+        return 0
+
+    def scrape_batch(self, args):
+        from website_analysis.fetcher import AsyncHtmlFetcher, read_sources
+
+        # Pages are fetched concurrently and processed one by one as soon as they arrive
+        fetcher = AsyncHtmlFetcher(concurrency=args.concurrency, per_host_limit=args.per_host_limit)
+        failures = 0
+        for page in fetcher.stream(read_sources(args.batch)):
+            if not page.ok:
+                print(f"Failed to fetch {page.source}: {page.error}", file=sys.stderr)
+                failures += 1
+                continue
+            if self.scrape_page(page.source, page.source_type, args, html=page.html, fetched=page) != 0:
+                failures += 1
+        return failures
+
+    def crawl(self, args):
+        """
+        Crawl from the --source or the URLs of the --batch, following pagination links.
+
+        The first page of every URL pattern gets a generated scraper, the following pages
+        of the pattern reuse it. With the scraper cache, the scraper of a pattern is also
+        kept across runs, so a resumed crawl does not generate it again.
+
+        :return: The number of pages that could not be scraped
+        """
+        from website_analysis.crawler import url_pattern
+
+        failures = 0
+        scrapers = {}
+        crawler = self.crawler(args)
+        for page in crawler.stream(self.seeds(args)):
+            if not page.ok:
+                print(f"Failed to fetch {page.source}: {page.error}", file=sys.stderr)
+                failures += 1
+                continue
+            pattern = url_pattern(page.source)
+            with get_tracer().span('scrape_page', source=page.source, source_type='url') as span:
+                span.set('fetch_seconds', page.elapsed)
+                span.set('bytes_fetched', len(page.html.encode('utf-8')))
+                span.set('url_pattern', pattern)
+                return_code = self.scrape_crawled_page(page, pattern, scrapers, args)
+                span.set('exit_code', return_code)
+            if return_code != 0:
+                failures += 1
+        if crawler.disallowed:
+            print(f"Skipped {crawler.disallowed} pages disallowed by robots.txt", file=sys.stderr)
+        return failures
+
+    def scrape_crawled_page(self, page, pattern, scrapers, args):
+        from scraper_generation.scraper_generator import ScrapingCodeGenerator
+
+        body_hash = None
+        if self.states is not None:
+            from data_extraction.change_detection import content_hash
+
+            body_hash = content_hash(page.html)
+            state = self.unchanged_page(page.source, args, body_hash)
+            if state is not None:
+                return self.replay(state, args)
+
+        key = self.cache.pattern_key(pattern, args.requirements) if self.cache is not None else None
+        generated_code = scrapers.get(pattern)
+        if generated_code is None and key is not None:
+            generated_code = self.cache.get(key)
+        if generated_code is not None:
+            # The page is not shown to the LLM, the scraper of its pattern runs on it
+            subtree_hash = None
+            if self.states is not None:
+                # Only minimized to tell whether the part the scraper reads has changed
+                manager = self.html_manager(page.source, 'url', args)
+                manager.process(page.html)
+                subtree_hash = manager.subtree_hash()
+                state = self.unchanged_page(page.source, args, body_hash, subtree_hash)
+                if state is not None:
+                    return self.replay(state, args)
+            code_generator = ScrapingCodeGenerator(None, source=page.source, source_type='url', llm=self.llm)
+            with self.collecting() as collector:
+                return_code = self.execute_scraper(code_generator.assemble_scraping_code(generated_code), page.html)
+            if return_code == 0:
+                scrapers[pattern] = generated_code
+                self.keep_records(collector, page.source, args, body_hash, subtree_hash)
+                return return_code
+            # The page differs from the others of its pattern, a scraper is generated for it
+            scrapers.pop(pattern, None)
+            if key is not None:
+                self.cache.invalidate(key)
+
+        return_code, generated_code = self.generate_and_run(page.source, 'url', args, html=page.html)
+        if return_code == 0 and generated_code is not None:
+            scrapers[pattern] = generated_code
+            if key is not None:
+                self.cache.put(key, generated_code, requirements=args.requirements, url_pattern=pattern)
+        return return_code
+
+    @staticmethod
+    def seeds(args):
+        # The URLs a crawl starts from
+        if args.source:
+            return [args.source]
+        from website_analysis.fetcher import read_sources
+
+        return [source for source, source_type in read_sources(args.batch) if source_type == 'url']
+
+    @staticmethod
+    def crawler(args):
+        from website_analysis.crawler import CrawlFrontier, Crawler
+
+        frontier = CrawlFrontier(args.crawl_checkpoint)
+        return Crawler(frontier, follow=args.follow, max_pages=args.max_pages, delay=args.crawl_delay, concurrency=args.concurrency, per_host_limit=args.per_host_limit)
+
+    def warm_up(self) -> None:
+        """
+        Import the pipeline and create the LLM client ahead of the first page.
+        """
+        from scraper_generation.scraper_generator import ScrapingCodeGenerator
+        from website_analysis.dom_analysis import HTMLParser, TokenCounter
+
+        HTMLParser().parse_fragment("<p></p>")
+        TokenCounter.for_model(ScrapingCodeGenerator.MODEL_NAME).count("")
+        if self.llm is None:
+            self.llm = ScrapingCodeGenerator.create_llm()
+
+    def close(self) -> None:
+        """Stop the worker processes, publish the last records file and stop the metrics exporters."""
+        if self.pool is not None:
+            self.pool.close()
+        if self.sink is not None:
+            self.sink.close()
+        if self.states is not None:
+            self.states.close()
+        get_tracer().close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,117 @@
+"""test_api_clustering.py: Tests for grouping captured API calls by endpoint."""
+import json
+import threading
+from types import SimpleNamespace
+
+import openai
+
+from website_analysis import utils
+from website_analysis.api_clustering import Schema, chunk_summaries, cluster_api_calls, url_template
+
+
+def event_call(event_id, cursor, venue=None):
+    event = {"id": event_id, "title": f"Event {event_id}", "date": "2024-05-01"}
+    if venue is not None:
+        event["venue"] = venue
+    return {
+        "url": f"https://ra.example/api/events/{event_id}?cursor={cursor}&area=london",
+        "method": "get",
+        "status": 200,
+        "content_type": "application/json; charset=utf-8",
+        "response": json.dumps({"event": event, "related": [event_id + 1, event_id + 2]}),
+    }
+
+
+def graphql_call(operation, page):
+    payload = {"operationName": operation, "variables": {"page": page}}
+    response = {"data": {"listing": {"page": page}}} if operation == "Listing" else {"data": {"me": None}}
+    return {"url": "https://ra.example/graphql", "method": "POST", "payload": json.dumps(payload), "response": response}
+
+
+def test_ids_and_volatile_parameters_become_placeholders():
+    assert url_template("https://RA.example/api/events/1234?cursor=abc&area=london") == "ra.example/api/events/{n}?area=london&cursor={value}"
+    assert url_template("https://ra.example/user/6f1c2a9e-0b7d-4d41-9a43-1f0c8e2b7c55/avatar") == "ra.example/user/{uuid}/avatar"
+    assert url_template("https://ra.example/events/concert-in-london-1834567?id=99&id=100") == "ra.example/events/{n}?id={n}"
+    assert url_template("https://ra.example/v2/search?q=techno") == "ra.example/v2/search?q=techno"
+
+
+def test_calls_of_an_endpoint_share_one_cluster_and_schema():
+    calls = [event_call(number, f"c{number}", venue={"name": "Fabric"} if number % 2 else None) for number in range(1000, 1200)]
+    calls += [graphql_call("Listing", page) for page in range(1, 4)] + [graphql_call("Viewer", 1)]
+    clusters = cluster_api_calls(calls)
+
+    assert [(cluster.method, cluster.template, cluster.operation, cluster.calls) for cluster in clusters] == [
+        ("GET", "ra.example/api/events/{n}?area=london&cursor={value}", None, 200),
+        ("POST", "ra.example/graphql", "Listing", 3),
+        ("POST", "ra.example/graphql", "Viewer", 1),
+    ]
+    summary = clusters[0].to_dict()
+    assert summary["example_url"] == "https://ra.example/api/events/1000?cursor=c1000&area=london"
+    assert summary["status"] == [200] and summary["content_type"] == "application/json"
+    assert summary["response_schema"] == {
+        "event": {"id": "integer", "title": "string", "date": "string", "venue?": {"name": "string"}},
+        "related": ["integer"],
+    }
+    assert clusters[1].to_dict()["payload_schema"] == {"operationName": "string", "variables": {"page": "integer"}}
+    assert clusters[2].to_dict()["response_schema"] == {"data": {"me": "null"}}
+
+    # One representative stands for the 200 calls
+    assert len(json.dumps(summary)) * 20 < len(json.dumps(calls))
+
+
+def test_schema_merges_types_and_summarizes_maps():
+    schema = Schema().add({"price": 12}).add({"price": 12.5}).add({"price": None, "tags": []})
+    assert schema.to_dict() == {"price": "number|null", "tags?": []}
+
+    by_id = {str(number): {"name": f"Venue {number}"} for number in range(100)}
+    assert Schema().add(by_id).to_dict() == {"{key}": {"name": "string"}}
+    assert Schema().add([1, {"a": True}]).add("text").to_dict() == {"oneOf": [[{"oneOf": [{"a": "boolean"}, "integer"]}], "string"]}
+
+
+def test_summaries_are_chunked_by_token_budget():
+    calls = [{"url": f"https://ra.example/api/resource{number}/1"} for number in range(10)]
+    summaries = [json.dumps(cluster.to_dict(), separators=(",", ":")) for cluster in cluster_api_calls(calls)]
+    chunks = chunk_summaries(cluster_api_calls(calls), len(summaries[0]) * 3, len)
+
+    assert [len(chunk) for chunk in chunks] == [3, 3, 3, 1]
+    assert [summary["url"] for chunk in chunks for summary in chunk] == [f"ra.example/api/resource{number}/{{n}}" for number in range(10)]
+
+
+def test_large_captures_are_analyzed_in_parallel_chunks(monkeypatch):
+    prompts = []
+    lock = threading.Lock()
+
+    def create(prompt, **options):
+        with lock:
+            prompts.append(prompt)
+        names = [json.loads(line)["url"] for line in prompt.split("\n") if line.startswith("{")]
+        table = "\n".join(f"| {name} | - | - |" for name in names)
+        return SimpleNamespace(choices=[SimpleNamespace(text=f"{utils.TABLE_HEADER}\n| --- | :---: | --- |\n{table}")])
+
+    monkeypatch.setattr(openai, "api_key", "test")
+    monkeypatch.setattr(openai.Completion, "create", create)
+    calls = [event_call(number, number) for number in range(1000, 1100)]
+    calls += [{"url": f"https://ra.example/api/list{number}?page={page}"} for number in range(30) for page in range(5)]
+
+    result = utils.analyze_api_calls(calls, chunk_tokens=200)
+    lines = result.splitlines()
+    assert len(prompts) > 1
+    assert lines[:2] == [utils.TABLE_HEADER, utils.TABLE_SEPARATOR] and lines.count(utils.TABLE_HEADER) == 1
+    assert len(lines) == 2 + 31 and not any(line.startswith("| -") for line in lines)
+    # Every endpoint is in exactly one prompt, and the event calls are summarized once
+    assert sum(prompt.count("ra.example/api/events/{n}") for prompt in prompts) == 1
+
+
+def test_tables_of_two_chunks_merge_into_one(monkeypatch):
+    answers = iter([
+        f"{utils.TABLE_HEADER}\n|---|---|---|\n| /api/events | - | events |",
+        f"{utils.TABLE_HEADER}\n|:--|:--|:--|\n| /api/venues | - | venues |\n",
+    ])
+    monkeypatch.setattr(openai, "api_key", "test")
+    monkeypatch.setattr(utils, "MAX_PARALLEL_PROMPTS", 1)
+    monkeypatch.setattr(openai.Completion, "create", lambda prompt, **options: SimpleNamespace(choices=[SimpleNamespace(text=next(answers))]))
+
+    calls = [{"url": "https://ra.example/api/events"}, {"url": "https://ra.example/api/venues"}]
+    assert utils.analyze_api_calls(calls, chunk_tokens=1).splitlines() == [
+        utils.TABLE_HEADER, utils.TABLE_SEPARATOR, "| /api/events | - | events |", "| /api/venues | - | venues |",
+    ]
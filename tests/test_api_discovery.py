@@ -0,0 +1,159 @@
+"""test_api_discovery.py: Tests for discovering the API endpoints of a page."""
+import json
+import shutil
+import subprocess
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from website_analysis.api_discovery import (
+    INSTRUMENTATION_SCRIPT,
+    WAIT_FOR_IDLE_SCRIPT,
+    ApiDiscoverer,
+    collect_endpoints,
+)
+from website_analysis.parser_backends import _importable
+
+# Loads a first page of events, then searches, and loads one more page per scroll
+PAGE = """<!DOCTYPE html>
+<html><body style="height: 5000px">
+<ul id="events"></ul>
+<script>
+var page = 1;
+function load() {
+  return fetch('/api/events?page=' + page++).then(function (response) { return response.json(); });
+}
+load().then(function () {
+  setTimeout(function () {
+    var xhr = new XMLHttpRequest();
+    xhr.open('post', '/api/search');
+    xhr.setRequestHeader('Content-Type', 'application/json');
+    xhr.send(JSON.stringify({query: 'london'}));
+  }, 100);
+});
+window.addEventListener('scroll', function () {
+  if (page <= 3) { load().then(function () { document.body.style.height = (5000 * page) + 'px'; }); }
+});
+</script>
+</body></html>
+"""
+
+# Runs the instrumentation in node, with XMLHttpRequest standing on top of node's fetch
+NODE_HARNESS = """
+const [instrumentation, waitForIdle, base] = JSON.parse(require('fs').readFileSync(0, 'utf8'));
+globalThis.window = globalThis;
+globalThis.location = {href: base + '/index.html'};
+globalThis.XMLHttpRequest = class {
+  constructor() { this.listeners = []; this.headers = null; }
+  open(method, url) { this.request = [method, new URL(url, location.href).href]; }
+  addEventListener(name, listener) { this.listeners.push(listener); }
+  getResponseHeader(name) { return this.headers && this.headers.get(name); }
+  send(body) {
+    originalFetch(this.request[1], {method: this.request[0], body: body}).then((response) => {
+      this.status = response.status;
+      this.headers = response.headers;
+      return response.text();
+    }).then(() => this.listeners.forEach((listener) => listener.call(this)));
+  }
+};
+const originalFetch = globalThis.fetch;
+eval(instrumentation);
+
+const start = Date.now();
+fetch(base + '/api/events?page=1').then((response) => response.text()).then(() => setTimeout(() => {
+  const xhr = new XMLHttpRequest();
+  xhr.open('post', '/api/search');
+  xhr.send(JSON.stringify({query: 'london'}));
+}, 100));
+new Function(waitForIdle)(500, 5000, (idle) => {
+  console.log(JSON.stringify({idle: idle, elapsed: Date.now() - start, requests: window.__scraperNetwork.requests}));
+});
+"""
+
+
+class ApiHandler(SimpleHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith("/api/"):
+            return self.respond_json({"events": [self.path]}, delay=0.2)
+        return super().do_GET()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self.respond_json({"results": []}, delay=0.3)
+
+    def respond_json(self, data, delay):
+        time.sleep(delay)
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(tmp_path):
+    (tmp_path / "index.html").write_text(PAGE)
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), partial(ApiHandler, directory=str(tmp_path)))
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_repeated_requests_are_reported_once():
+    endpoints = collect_endpoints([
+        {"url": "https://ra.example/api/events?page=1#top", "method": "GET", "payload": None, "content_type": None},
+        {"url": "https://ra.example/api/events?page=1", "method": "GET", "payload": None, "content_type": "application/json", "status": 200},
+        {"url": "https://ra.example/graphql", "method": "POST", "payload": '{"page": 1}', "content_type": "application/json"},
+        {"url": "https://ra.example/graphql", "method": "POST", "payload": '{"page": 2}', "content_type": "application/json"},
+    ])
+    assert [(endpoint.method, endpoint.url, endpoint.payload) for endpoint in endpoints] == [
+        ("GET", "https://ra.example/api/events?page=1", None),
+        ("POST", "https://ra.example/graphql", '{"page": 1}'),
+        ("POST", "https://ra.example/graphql", '{"page": 2}'),
+    ]
+    assert endpoints[0].is_json and endpoints[0].status == 200
+
+
+@pytest.mark.skipif(shutil.which("node") is None, reason="node is not installed")
+def test_network_idle_waits_for_requests_started_by_responses(server):
+    script = json.dumps([INSTRUMENTATION_SCRIPT, WAIT_FOR_IDLE_SCRIPT, server])
+    output = subprocess.run(["node", "-e", NODE_HARNESS], input=script, capture_output=True, text=True, timeout=30, check=True).stdout
+    result = json.loads(output)
+
+    # Idle once the search, started 100 ms after the first response, has been quiet for 500 ms
+    assert result["idle"]
+    assert 1000 <= result["elapsed"] < 3000
+    endpoints = collect_endpoints(result["requests"])
+    assert [(endpoint.method, endpoint.url, endpoint.payload, endpoint.content_type) for endpoint in endpoints] == [
+        ("GET", f"{server}/api/events?page=1", None, "application/json"),
+        ("POST", f"{server}/api/search", '{"query":"london"}', "application/json"),
+    ]
+
+
+@pytest.mark.skipif(
+    not _importable("selenium") or not any(map(shutil.which, ["google-chrome", "chromium", "chromium-browser"])),
+    reason="selenium or Chrome is not installed",
+)
+def test_discovery_scrolls_while_pages_keep_loading(server):
+    start = time.perf_counter()
+    with ApiDiscoverer(quiet_period=0.5) as discoverer:
+        endpoints = discoverer.discover(f"{server}/index.html")
+    elapsed = time.perf_counter() - start
+
+    assert [(endpoint.method, endpoint.url.replace(server, "")) for endpoint in endpoints] == [
+        ("GET", "/api/events?page=1"),
+        ("POST", "/api/search"),
+        ("GET", "/api/events?page=2"),
+        ("GET", "/api/events?page=3"),
+    ]
+    assert endpoints[1].payload == '{"query":"london"}' and all(endpoint.is_json for endpoint in endpoints)
+    assert elapsed < 20
@@ -0,0 +1,31 @@
+"""test_benchmarks.py: Tests for the benchmark harness, on the smallest inputs."""
+from benchmarks.pages import TARGET_STRING, parse_size, synthetic_page
+from benchmarks.run import DENVER, DENVER_TARGET_STRING, benchmark_end_to_end, benchmark_page, compare
+
+
+def test_synthetic_pages_have_the_requested_size():
+    page = synthetic_page(parse_size("100KB"))
+    assert abs(len(page) - 100 * 1024) < 20 * 1024
+    assert page.count(TARGET_STRING) == 1
+
+
+def test_every_stage_is_measured():
+    results = benchmark_page("denver", DENVER, DENVER_TARGET_STRING, repeat=1, trace_memory=True)
+    assert set(results) == {
+        f"denver/{stage}"
+        for stage in ("load", "parse", "search", "extract", "prepare", "process_html", "process_html_streaming")
+    }
+    assert results["denver/process_html"]["tokens"] > 0
+    assert "peak_mb" in results["denver/parse"]
+
+
+def test_end_to_end_run_uses_the_canned_llm():
+    results = benchmark_end_to_end("denver", DENVER, DENVER_TARGET_STRING, repeat=1, trace_memory=False)
+    assert results["denver/end_to_end"]["tokens"] > 0
+
+
+def test_regressions_beyond_the_tolerance_are_reported():
+    baselines = {"page/parse": {"seconds": 1.0, "peak_mb": 100.0, "tokens": 500}}
+    assert compare({"page/parse": {"seconds": 1.2, "peak_mb": 110.0, "tokens": 500}}, baselines, 0.5, 0.2) == []
+    regressions = compare({"page/parse": {"seconds": 2.0, "peak_mb": 150.0, "tokens": 600}}, baselines, 0.5, 0.2)
+    assert len(regressions) == 3
@@ -0,0 +1,232 @@
+"""test_browser_pool.py: Tests for the pool of headless browsers, driven against a fake Chrome."""
+import os
+import signal
+import stat
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from website_analysis.browser_pool import BrowserPool, BrowserError
+from website_analysis.dom_analysis import BrowserHtmlLoader, HtmlManager
+
+# Speaks the part of the DevTools protocol the pool uses. Pages are fetched over HTTP and
+# "rendered" by filling <div id="app"> in, and the target and process that served them
+# are appended as a comment. The most tabs navigating at once is saved to max-tabs.
+FAKE_CHROME = '''
+import asyncio, itertools, json, os, sys, urllib.request
+from aiohttp import web
+
+user_data_dir = next(argument.split("=", 1)[1] for argument in sys.argv if argument.startswith("--user-data-dir="))
+ids = itertools.count(1)
+navigating = [0, 0]
+
+
+def render(url):
+    html = urllib.request.urlopen(url).read().decode()
+    return html.replace('<div id="app"></div>', '<div id="app"><p>rendered</p></div>')
+
+
+async def devtools(request):
+    websocket = web.WebSocketResponse(max_msg_size=0)
+    await websocket.prepare(request)
+    documents = {}
+
+    async def handle(message):
+        method, params, session = message["method"], message["params"], message.get("sessionId")
+        result = {}
+        if method == "Target.createBrowserContext":
+            result = {"browserContextId": f"context-{next(ids)}"}
+        elif method == "Target.createTarget":
+            result = {"targetId": f"target-{next(ids)}"}
+        elif method == "Target.attachToTarget":
+            result = {"sessionId": "session-" + params["targetId"]}
+        elif method == "Page.navigate":
+            navigating[0] += 1
+            navigating[1] = max(navigating)
+            with open(os.path.join(user_data_dir, "..", "max-tabs"), "w") as file:
+                file.write(str(navigating[1]))
+            try:
+                html = await asyncio.get_running_loop().run_in_executor(None, render, params["url"])
+            except Exception as error:
+                result = {"frameId": "frame", "errorText": str(error)}
+            else:
+                target = session.split("-", 1)[1]
+                documents[session] = html + f"<!-- {target} {os.getpid()} -->"
+                result = {"frameId": "frame"}
+            finally:
+                navigating[0] -= 1
+            await websocket.send_json({"id": message["id"], "sessionId": session, "result": result})
+            if "errorText" not in result:
+                await websocket.send_json({"method": "Page.loadEventFired", "sessionId": session, "params": {}})
+            return
+        elif method == "Runtime.evaluate":
+            if "outerHTML" in params["expression"]:
+                result = {"result": {"type": "string", "value": documents[session]}}
+            else:
+                result = {"result": {"type": "boolean", "value": True}}
+        await websocket.send_json({"id": message["id"], "sessionId": session, "result": result})
+        if method == "Browser.close":
+            os._exit(0)
+
+    async for message in websocket:
+        asyncio.ensure_future(handle(json.loads(message.data)))
+    return websocket
+
+
+async def main():
+    app = web.Application()
+    app.router.add_get("/devtools/browser/fake", devtools)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    with open(os.path.join(user_data_dir, "DevToolsActivePort"), "w") as file:
+        file.write(f"{port}\\n/devtools/browser/fake")
+    await asyncio.Event().wait()
+
+asyncio.run(main())
+'''
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        time.sleep(0.2 if self.path.startswith("/slow") else 0)
+        body = f'<html><body><h1>{self.path}</h1><div id="app"></div></body></html>'.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), PageHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def chrome(tmp_path, monkeypatch):
+    # Profiles go below tmp_path, so the fake can save its counters next to them
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    executable = tmp_path / "chrome"
+    executable.write_text(f"#!{sys.executable}\n{FAKE_CHROME}")
+    executable.chmod(executable.stat().st_mode | stat.S_IEXEC)
+    return str(executable)
+
+
+@pytest.fixture
+def pools(chrome):
+    def create(**options):
+        pool = BrowserPool(binary=chrome, quiet_period=0, **options)
+        created.append(pool)
+        return pool
+
+    created = []
+    yield create
+    for pool in created:
+        pool.close()
+
+
+def served_by(html):
+    # (target, pid) of the tab and browser that rendered the page
+    target, pid = html.rsplit("<!-- ", 1)[1].split()[:2]
+    return target, int(pid)
+
+
+def test_pages_are_rendered_in_reused_tabs(server, pools):
+    pool = pools()
+    first = BrowserHtmlLoader(f"{server}/events?page=1", pool=pool).load()
+    second = BrowserHtmlLoader(f"{server}/events?page=2", pool=pool).load()
+
+    assert '<div id="app"><p>rendered</p></div>' in first and "<h1>/events?page=2</h1>" in second
+    # The second page is loaded in the tab and the browser of the first one
+    assert served_by(first) == served_by(second)
+    assert pool.started == 1
+
+
+def test_concurrent_pages_are_capped_per_browser(server, pools, tmp_path):
+    pool = pools(size=1, max_contexts=2)
+    with ThreadPoolExecutor(6) as executor:
+        pages = list(executor.map(pool.load, [f"{server}/slow/{number}" for number in range(6)]))
+
+    assert [page.split("<h1>")[1].split("</h1>")[0] for page in pages] == [f"/slow/{number}" for number in range(6)]
+    assert len({served_by(page)[1] for page in pages}) == 1
+    assert len({served_by(page)[0] for page in pages}) == 2
+    assert (tmp_path / "max-tabs").read_text() == "2"
+
+
+def test_busy_browsers_grow_the_pool_up_to_its_size(server, pools):
+    pool = pools(size=2, max_contexts=1)
+    with ThreadPoolExecutor(4) as executor:
+        pages = list(executor.map(pool.load, [f"{server}/slow/{number}" for number in range(4)]))
+
+    assert pool.started == 2
+    assert len({served_by(page)[1] for page in pages}) == 2
+
+
+def test_browsers_are_recycled_after_a_number_of_pages(server, pools):
+    pool = pools(recycle_after=2)
+    pids = [served_by(pool.load(f"{server}/page/{number}"))[1] for number in range(5)]
+
+    assert pids[0] == pids[1] != pids[2] == pids[3] != pids[4]
+    assert pool.started == 3
+    # Retired browsers have been shut down
+    for pid in pids[:4]:
+        with pytest.raises(ProcessLookupError):
+            for _ in range(50):
+                os.kill(pid, 0)
+                time.sleep(0.1)
+
+
+def test_a_crashed_browser_is_replaced(server, pools):
+    pool = pools()
+    pid = served_by(pool.load(f"{server}/first"))[1]
+    os.kill(pid, signal.SIGKILL)
+    time.sleep(0.5)
+
+    html = pool.load(f"{server}/second")
+    assert "<h1>/second</h1>" in html and served_by(html)[1] != pid
+    assert pool.started == 2
+
+
+def test_pools_use_their_own_debugging_ports(server, pools):
+    first, second = pools(), pools()
+    first.load(f"{server}/a")
+    second.load(f"{server}/b")
+    assert first.workers[0].port != second.workers[0].port
+
+
+def test_failed_pages_raise_and_the_tab_is_not_reused(pools):
+    pool = pools()
+    with pytest.raises(BrowserError, match="Could not load"):
+        pool.load("http://127.0.0.1:9/unreachable")
+    assert pool.workers[0]._tabs == []
+
+
+def test_manager_renders_browser_sources(server, pools, monkeypatch):
+    pool = pools()
+    monkeypatch.setattr(BrowserPool, "from_env", classmethod(lambda cls: pool))
+    manager = HtmlManager(f"{server}/events", "browser", "rendered", collapse_repetitions=False)
+
+    assert "rendered" in manager.process_html()
+    assert "<p>rendered</p>" in manager.html
+
+
+def test_missing_chrome_is_reported(monkeypatch):
+    monkeypatch.setenv("SCRAPER_CHROME", "")
+    monkeypatch.setenv("PATH", "")
+    with pytest.raises(ValueError, match="No Chrome"):
+        BrowserPool()
@@ -0,0 +1,150 @@
+"""test_change_detection.py: Tests for re-scraping only the pages that changed since the last run."""
+import json
+import os
+import runpy
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from langchain.schema import AIMessage
+
+from data_extraction.change_detection import PageStateStore, content_hash
+from service.runner import ScrapeRunner
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(__file__))
+
+EMITTING_CODE = """```python
+for item in html_soup.select("li"):
+    emit({"item": item.get_text()})
+```"""
+
+# The script is removed by the minimizer, so a new token changes the body but not the relevant part
+PAGE = """<html><head><script>var csrf = "{token}";</script></head>
+<body><h1>{name}</h1><ul>{items}</ul></body></html>"""
+
+
+class ListingHandler(BaseHTTPRequestHandler):
+    pages = {}
+    token = "a"
+
+    def do_GET(self):
+        items = "".join(f"<li class='item'>{item}</li>" for item in self.pages[self.path])
+        body = PAGE.format(token=self.token, name=self.path, items=items).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class CountingChatModel:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, messages):
+        self.calls += 1
+        return AIMessage(content=EMITTING_CODE)
+
+
+@pytest.fixture
+def site(tmp_path):
+    ListingHandler.pages = {f"/{name}": [f"{name} item {number}" for number in range(30)] for name in "abc"}
+    ListingHandler.token = "a"
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), ListingHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    batch = tmp_path / "urls.txt"
+    batch.write_text("".join(f"http://127.0.0.1:{httpd.server_address[1]}/{name}\n" for name in "abc"))
+    yield str(batch)
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def run(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    parser = runpy.run_path(os.path.join(PROJECT_DIR, "gpt-scraper.py"), run_name="gpt_scraper")["build_parser"]()
+
+    def scrape(batch, *options):
+        args = parser.parse_args([
+            "--batch", batch, "--requirements", "All items", "--target-string", "item 1",
+            "--no-cache", "--executor", "inline", "--state-store", str(tmp_path / "states"), *options,
+        ])
+        llm = CountingChatModel()
+        with ScrapeRunner(args, llm=llm) as runner:
+            assert runner.scrape(args) == 0
+        output = capsys.readouterr()
+        records = [json.loads(line)["item"] for line in output.out.splitlines() if line.startswith("{")]
+        return llm.calls, records, output.err
+
+    return scrape
+
+
+def test_only_changed_pages_are_scraped_again(site, run):
+    calls, records, _ = run(site)
+    assert calls == 3 and len(records) == 90
+
+    # Nothing changed, the stored records are emitted again
+    calls, again, _ = run(site)
+    assert calls == 0 and again == records
+
+    # Every body changes, but only page c changes where the scraper reads it: in a record
+    # that the collapsed HTML shown to the LLM leaves out
+    ListingHandler.token = "b"
+    ListingHandler.pages["/c"][20] = "c item 20, sold out"
+    calls, changed, _ = run(site)
+    assert calls == 1
+    assert changed[:60] == records[:60] and "c item 20, sold out" in changed[60:]
+
+
+def test_unchanged_pages_can_be_only_reported(site, run):
+    run(site)
+    ListingHandler.pages["/b"].append("b item 30")
+    calls, records, err = run(site, "--unchanged", "mark")
+
+    assert calls == 1
+    assert records == [f"b item {number}" for number in range(31)]
+    assert err.count("Unchanged since") == 2 and "/a" in err and "/c" in err
+
+
+def test_store_keeps_states_per_url_and_requirements(tmp_path):
+    store = PageStateStore(str(tmp_path))
+    store.put("https://ra.example/events", "Events", content_hash("<p>1</p>"), "subtree", [{"title": "Fabric"}])
+    store.put("https://ra.example/events", "Venues", None, "other", [])
+
+    state = store.get("https://ra.example/events", "Events")
+    assert (state.body_hash, state.subtree_hash, state.records) == (content_hash("<p>1</p>"), "subtree", [{"title": "Fabric"}])
+
+    store.unchanged("https://ra.example/events", "Events", content_hash("<p>2</p>"))
+    assert store.get("https://ra.example/events", "Events").body_hash == content_hash("<p>2</p>")
+    assert store.get("https://ra.example/events", "Venues").body_hash is None
+
+    store.forget("https://ra.example/events", "Venues")
+    assert store.get("https://ra.example/events", "Venues") is None and len(store) == 1
+    store.close()
+
+
+def test_concurrent_requests_collect_their_own_records(tmp_path):
+    parser = runpy.run_path(os.path.join(PROJECT_DIR, "gpt-scraper.py"), run_name="gpt_scraper")["build_parser"]()
+    args = parser.parse_args(["--no-cache", "--executor", "inline", "--state-store", str(tmp_path / "states"), "--sink", str(tmp_path / "records")])
+    barrier = threading.Barrier(2)
+    collected = {}
+
+    def request(name):
+        with runner.collecting() as collector:
+            barrier.wait()
+            runner.records_target().write({"request": name})
+            barrier.wait()
+            collected[name] = (runner.records_target() is collector, collector.records)
+
+    with ScrapeRunner(args, llm=CountingChatModel()) as runner:
+        threads = [threading.Thread(target=request, args=(name,)) for name in "ab"]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert runner.records_target() is runner.sink
+
+    assert collected == {"a": (True, [{"request": "a"}]), "b": (True, [{"request": "b"}])}
@@ -0,0 +1,115 @@
+"""test_completion_cache.py: Tests for the persistent completion cache."""
+import asyncio
+import threading
+import time
+
+import openai
+from langchain.schema import AIMessage
+
+from gpt_interaction.completion_cache import CompletionCache
+from gpt_interaction.gpt_interaction import GPTInteraction
+from scraper_generation.scraper_generator import ScrapingCodeGenerator
+
+
+def test_identical_requests_share_a_key():
+    messages = [{"role": "user", "content": "Hello"}]
+    key = CompletionCache.key("gpt-4", {"temperature": 0.5, "max_tokens": 10}, messages)
+    assert key == CompletionCache.key("gpt-4", {"max_tokens": 10, "temperature": 0.5}, messages)
+    assert key != CompletionCache.key("gpt-4", {"temperature": 0.6, "max_tokens": 10}, messages)
+    assert key != CompletionCache.key("gpt-3.5-turbo", {"temperature": 0.5, "max_tokens": 10}, messages)
+
+
+def test_concurrent_identical_requests_call_the_api_once(tmp_path):
+    cache = CompletionCache(str(tmp_path))
+    calls = []
+
+    def create():
+        calls.append(1)
+        time.sleep(0.2)
+        return "Bonjour"
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(cache.get_or_create("key", create)))
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == ["Bonjour"] * 5 and len(calls) == 1
+    assert cache.stats == {"hits": 0, "misses": 1, "coalesced": 4}
+    assert CompletionCache(str(tmp_path)).get("key") == "Bonjour"  # Persisted
+
+
+def test_concurrent_identical_coroutines_call_the_api_once(tmp_path):
+    cache = CompletionCache(str(tmp_path))
+    calls = []
+
+    async def create():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return "Bonjour"
+
+    async def scenario():
+        return await asyncio.gather(*(cache.aget_or_create("key", create) for _ in range(5)))
+
+    assert asyncio.run(scenario()) == ["Bonjour"] * 5 and len(calls) == 1
+    assert asyncio.run(cache.aget_or_create("key", create)) == "Bonjour"
+    assert cache.stats == {"hits": 1, "misses": 1, "coalesced": 4}
+
+
+def test_entries_expire_and_are_evicted(tmp_path):
+    cache = CompletionCache(str(tmp_path), ttl=0.1)
+    cache.put("old", "x")
+    time.sleep(0.2)
+    assert cache.get("old") is None
+
+    cache = CompletionCache(str(tmp_path / "lru"))
+    completion = "print(html_soup.title)\n" * 50
+    cache.put("a", completion)
+    cache.max_size = cache.size() * 2  # Room for exactly two entries
+    cache.put("b", completion)
+    cache.get("a")
+    cache.put("c", completion)
+    assert cache.get("a") is not None and cache.get("b") is None
+
+
+def test_gpt_interaction_calls_go_through_the_cache(tmp_path, monkeypatch):
+    requests = []
+
+    def create(**kwargs):
+        requests.append(kwargs)
+        return {"choices": [{"message": {"role": "assistant", "content": "Bonjour"}}]}
+
+    monkeypatch.setattr(openai.ChatCompletion, "create", create)
+    gpt = GPTInteraction(api_token="test-key", cache=CompletionCache(str(tmp_path)))
+
+    assert gpt.call("Translate 'Hello'") == gpt.call("Translate 'Hello'") == "Bonjour"
+    assert len(requests) == 1 and requests[0]["api_key"] == "test-key"
+
+
+class FakeChatModel:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, messages):
+        self.calls += 1
+        return AIMessage(content=f"```python\nprint({self.calls})\n```")
+
+
+def test_scraping_code_generator_reuses_completions(tmp_path):
+    completion_cache = CompletionCache(str(tmp_path))
+    llm = FakeChatModel()
+
+    def generate(use_cache=True):
+        generator = ScrapingCodeGenerator("<td>January</td>", "page.html", "file", completion_cache=completion_cache)
+        generator._llm = llm
+        return generator.generate_scraping_code("Print the months", use_cache=use_cache)
+
+    first = generate()
+    assert generate() == first and llm.calls == 1
+    # Regenerating after a failed scraper has to ask the model again
+    assert "print(2)" in generate(use_cache=False)
+    assert "print(2)" in generate() and llm.calls == 2
@@ -0,0 +1,191 @@
+"""test_crawler.py: Tests for the polite crawl frontier."""
+import json
+import os
+import runpy
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from langchain.schema import AIMessage
+
+from gpt_interaction.completion_cache import CACHE_DIR_ENV, CACHE_SIZE_ENV, CACHE_TTL_ENV
+from service.runner import ScrapeRunner
+from website_analysis.crawler import (
+    CrawlFrontier,
+    Crawler,
+    SeenUrls,
+    extract_links,
+    is_pagination_link,
+    normalize_url,
+    url_pattern,
+)
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(__file__))
+LAST_PAGE = 5
+
+EMITTING_CODE = """```python
+for row in html_soup.select("li.event"):
+    emit({"event": row.get_text()})
+```"""
+
+
+class ListingHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    requests = []
+    active = 0
+    max_active = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with self.lock:
+            type(self).requests.append(self.path)
+            type(self).active += 1
+            type(self).max_active = max(self.max_active, self.active)
+        try:
+            time.sleep(0.02)
+            if self.path == "/robots.txt":
+                self.respond("User-agent: *\nDisallow: /private\n", "text/plain")
+            elif self.path.startswith("/events"):
+                page = int(self.path.partition("page=")[2] or 1)
+                events = "".join(f'<li class="event">Event {page}.{index}</li>' for index in range(3))
+                links = '<a href="/private/admin">Admin</a><a href="/events#top">Top</a>'
+                links += "".join(f'<a href="/events?page={number}">{number}</a>' for number in range(1, 4))
+                if page < LAST_PAGE:
+                    links += f'<a href="?page={page + 1}">Next</a>'
+                links += f'<a href="/venues/{page}">Venue</a>'
+                self.respond(f"<html><body><ul>{events}</ul>{links}</body></html>")
+            else:
+                self.respond(f"<html><body><h1>{self.path}</h1></body></html>")
+        finally:
+            with self.lock:
+                type(self).active -= 1
+
+    def respond(self, text, content_type="text/html"):
+        body = text.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    ListingHandler.requests, ListingHandler.max_active = [], 0
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), ListingHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_urls_are_normalized_into_patterns():
+    assert normalize_url("HTTP://Shop.Example:80/items?b=2&a=1#reviews") == "http://shop.example/items?a=1&b=2"
+    assert url_pattern("https://shop.example/items?page=2&sort=price") == "shop.example/items?page&sort"
+    assert url_pattern("https://shop.example/item/123/reviews") == url_pattern("https://shop.example/item/9/reviews")
+
+
+def test_pagination_links_are_recognized():
+    page = "https://shop.example/items?sort=price&page=2"
+    assert is_pagination_link(page, "https://shop.example/items?sort=price&page=3")
+    assert is_pagination_link("https://blog.example/posts", "https://blog.example/posts/page/2")
+    assert is_pagination_link(page, "https://shop.example/search?q=lamp", rel=["next"])
+    assert is_pagination_link(page, "https://shop.example/items?cursor=abc", text="»")
+    assert not is_pagination_link(page, "https://shop.example/items?sort=name&page=3")
+    assert not is_pagination_link(page, "https://other.example/items?sort=price&page=3", rel=["next"])
+    assert not is_pagination_link(page, "https://shop.example/items?page=2&sort=price", text="Next")
+
+    links = extract_links('<a href="?page=2#top" rel="next">Next <b>page</b></a><a href="mailto:a@b.c">Mail</a>', page)
+    assert links == [("https://shop.example/items?page=2", ["next"], "Next page")]
+
+
+def test_seen_urls_are_compact():
+    seen = SeenUrls()
+    urls = [f"https://shop.example/item/{index}" for index in range(100000)]
+    assert all(seen.add(url) for url in urls)
+    assert not seen.add(urls[5]) and urls[99999] in seen
+    assert "https://shop.example/item/100000" not in seen
+
+    hashes = seen.to_bytes()
+    assert len(hashes) == 8 * len(urls)
+    assert urls[42] in SeenUrls(hashes)
+
+
+def test_crawler_follows_pagination_politely(server):
+    crawler = Crawler(delay=0.05, concurrency=4, per_host_limit=2, follow=r"/(venues|private)/")
+    start = time.perf_counter()
+    pages = list(crawler.stream([f"{server}/events"]))
+    elapsed = time.perf_counter() - start
+
+    crawled = sorted(page.source.replace(server, "") for page in pages)
+    assert crawled == sorted(
+        ["/events"] + [f"/events?page={page}" for page in range(1, LAST_PAGE + 1)]
+        + [f"/venues/{page}" for page in range(1, LAST_PAGE + 1)]
+    )
+    # Links to pages already seen, such as the numbered page links, are not fetched again
+    assert len(ListingHandler.requests) == len(set(ListingHandler.requests))
+    assert ListingHandler.requests.count("/robots.txt") == 1
+    assert crawler.disallowed == 1 and "/private/admin" not in ListingHandler.requests
+    assert elapsed >= 0.05 * (len(pages) - 1)
+    assert ListingHandler.max_active <= 2
+
+
+def test_disallowed_urls_do_not_use_up_the_page_budget(server):
+    seeds = [f"{server}/private/{number}" for number in range(5)] + [f"{server}/events"]
+    crawler = Crawler(delay=0, max_pages=1, concurrency=1)
+    pages = list(crawler.stream(seeds))
+    assert [page.source for page in pages] == [f"{server}/events"]
+    assert crawler.disallowed == 5 and crawler.frontier.fetched == 1
+
+
+def test_crawl_resumes_from_its_checkpoint(server, tmp_path):
+    checkpoint = str(tmp_path / "crawl.checkpoint")
+    first = Crawler(CrawlFrontier(checkpoint), delay=0, max_pages=2, respect_robots=False)
+    assert len(list(first.stream([f"{server}/events"]))) == 2
+
+    requested = list(ListingHandler.requests)
+    with open(checkpoint, "rb") as file:
+        assert json.loads(file.readline())["fetched"] == 2
+
+    # The pages of the first crawl count towards max_pages, the queued ones do not
+    limited = Crawler(CrawlFrontier(checkpoint), delay=0, max_pages=3, respect_robots=False)
+    assert limited.frontier.fetched == 2
+    assert len(list(limited.stream([f"{server}/events"]))) == 1
+
+    resumed = Crawler(CrawlFrontier(checkpoint), delay=0, respect_robots=False)
+    sources = [page.source.replace(server, "") for page in resumed.stream([f"{server}/events"])]
+    assert "/events" not in sources and f"/events?page={LAST_PAGE}" in sources
+    assert not set(requested) & set(ListingHandler.requests[len(requested):])
+
+
+def test_runner_reuses_one_scraper_per_url_pattern(server, tmp_path, monkeypatch):
+    class CountingChatModel:
+        calls = 0
+
+        def __call__(self, messages):
+            CountingChatModel.calls += 1
+            return AIMessage(content=EMITTING_CODE)
+
+    monkeypatch.chdir(tmp_path)
+    # The runner configures the completion cache of the run in the environment
+    for name in (CACHE_DIR_ENV, CACHE_SIZE_ENV, CACHE_TTL_ENV):
+        monkeypatch.setenv(name, "")
+    parser = runpy.run_path(os.path.join(PROJECT_DIR, "gpt-scraper.py"), run_name="gpt_scraper")["build_parser"]()
+    args = parser.parse_args([
+        "--source", f"{server}/events?page=1", "--source-type", "url", "--crawl", "--crawl-delay", "0",
+        "--requirements", "Every event", "--target-string", "Event 1.0", "--executor", "inline",
+        "--sink", str(tmp_path / "records"), "--crawl-checkpoint", str(tmp_path / "crawl.checkpoint"),
+        "--scraper-cache", str(tmp_path / "scrapers"), "--completion-cache", str(tmp_path / "completions"),
+    ])
+    with ScrapeRunner(args, llm=CountingChatModel()) as runner:
+        assert runner.scrape(args) == 0
+
+    with open(runner.sink.files[0]) as file:
+        events = {json.loads(line)["event"] for line in file}
+    assert events == {f"Event {page}.{index}" for page in range(1, LAST_PAGE + 1) for index in range(3)}
+    assert CountingChatModel.calls == 1
@@ -0,0 +1,94 @@
+"""test_daemon.py: Tests for the warm scraper daemon and its thin client."""
+import os
+import runpy
+import threading
+
+import pytest
+
+from benchmarks.run import DENVER, CannedChatModel
+from service.client import DaemonClient, parse_address
+from service.daemon import ScraperDaemon
+from service.runner import ScrapeRunner
+
+GPT_SCRAPER = os.path.join(os.path.dirname(os.path.dirname(__file__)), "gpt-scraper.py")
+
+
+@pytest.fixture
+def cli():
+    return runpy.run_path(GPT_SCRAPER, run_name="gpt_scraper")
+
+
+@pytest.fixture
+def daemon(cli, tmp_path):
+    args = cli["build_parser"]().parse_args(["--executor", "inline", "--no-cache"])
+    llm = CannedChatModel()
+    runner = ScrapeRunner(args, llm=llm)
+    daemon = ScraperDaemon(runner, args, str(tmp_path / "scraper.sock"))
+    thread = threading.Thread(target=daemon.serve_forever)
+    thread.start()
+    yield daemon, llm
+    daemon.shutdown()
+    thread.join()
+    daemon.close()
+    runner.close()
+
+
+def test_addresses_are_tcp_or_unix_sockets():
+    assert parse_address("127.0.0.1:8765") == ("127.0.0.1", 8765)
+    assert parse_address("http://localhost:8765") == ("localhost", 8765)
+    assert parse_address(":8765") == ("127.0.0.1", 8765)
+    assert parse_address("/run/scraper.sock") == "/run/scraper.sock"
+    assert parse_address(".scraper.sock") == ".scraper.sock"
+
+
+def test_daemon_scrapes_with_the_shared_llm(daemon):
+    server, llm = daemon
+    client = DaemonClient(server.address)
+    options = {
+        "source": DENVER,
+        "source_type": "file",
+        "requirements": "Print the number of table rows",
+        "target_string": "February",
+    }
+    for _ in range(2):
+        result = client.scrape(options)
+        assert result["exit_code"] == 0
+        assert "Scraped" in result["stdout"]
+
+    assert len(llm.prompts) == 2
+    assert client.health()["requests"] == 2
+
+
+def test_daemon_rejects_options_fixed_at_startup(daemon):
+    server, _ = daemon
+    with pytest.raises(RuntimeError, match="executor"):
+        DaemonClient(server.address).scrape({"source": DENVER, "executor": "subprocess"})
+
+
+def test_client_falls_back_without_a_daemon(cli, tmp_path):
+    args = cli["build_parser"]().parse_args(["--daemon", str(tmp_path / "missing.sock")])
+    assert cli["run_on_daemon"](args) is None
+
+
+def test_client_sends_absolute_paths(cli, tmp_path, monkeypatch):
+    sent = []
+
+    class RecordingClient:
+        def __init__(self, address):
+            pass
+
+        def scrape(self, options):
+            sent.append(options)
+            return {"stdout": "", "stderr": "", "exit_code": 0}
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(cli["run_on_daemon"].__globals__, "DaemonClient", RecordingClient)
+    parser = cli["build_parser"]()
+    args = parser.parse_args(["--daemon", "scraper.sock", "--source", "pages/denver.html", "--source-type", "file", "--output", "out/records.jsonl"])
+    assert cli["run_on_daemon"](args) == 0
+    assert sent[0]["source"] == str(tmp_path / "pages" / "denver.html")
+    assert sent[0]["output"] == str(tmp_path / "out" / "records.jsonl")
+
+    args = parser.parse_args(["--daemon", "scraper.sock", "--source", "https://ra.example/events", "--source-type", "url", "--batch", "urls.txt"])
+    cli["run_on_daemon"](args)
+    assert sent[1]["source"] == "https://ra.example/events" and sent[1]["batch"] == str(tmp_path / "urls.txt")
@@ -0,0 +1,36 @@
+"""test_data_extractor.py: Tests that scrapers reuse the document loaded by the pipeline."""
+import os
+
+from data_extraction.data_extractor import CodeExecutor, InlineCodeExecutor
+from scraper_generation.scraper_generator import ScrapingCodeGenerator
+from website_analysis.dom_analysis import HTMLParser
+
+DOCUMENT = "<html><body><p class='city'>Denver</p></body></html>"
+
+
+def build_scraper():
+    # The source does not exist, so the scraper only works if it gets the document
+    generator = ScrapingCodeGenerator(DOCUMENT, source="missing.html", source_type="file")
+    return generator.assemble_scraping_code("print(html_soup.find('p', class_='city').text)")
+
+
+def test_subprocess_executor_hands_over_the_document(tmp_path, capfd, monkeypatch):
+    monkeypatch.setenv("PYTHONPATH", os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    scraper_path = tmp_path / "scraping_code.py"
+    scraper_path.write_text(build_scraper())
+
+    assert CodeExecutor(str(scraper_path)).execute(document=DOCUMENT) == 0
+    assert capfd.readouterr().out == "Denver\n"
+
+
+def test_inline_executor_reuses_the_parse_tree(capsys):
+    parsed = HTMLParser().parse(DOCUMENT)
+    parsed.p.string = "Parsed once"
+
+    assert InlineCodeExecutor().execute(build_scraper(), DOCUMENT, parsed) == 0
+    assert capsys.readouterr().out == "Parsed once\n"
+
+
+def test_inline_executor_reports_failures(capsys):
+    assert InlineCodeExecutor().execute("raise ValueError('nothing found')") == 1
+    assert "nothing found" in capsys.readouterr().err
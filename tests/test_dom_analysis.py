@@ -0,0 +1,168 @@
+"""test_dom_analysis.py: Tests for the DOM analysis pipeline."""
+from website_analysis.dom_analysis import (
+    HtmlManager,
+    HTMLMinimizer,
+    HTMLParser,
+    HTMLPreparer,
+    HTMLProcessingPipeline,
+    HTMLSearcher,
+    ParentExtractor,
+    RepetitionCollapser,
+    TokenCounter,
+)
+
+PAGE = """
+<html><body>
+  <div id="nav" data-city="Denver (CO)"><a href="/denver">Home</a></div>
+  <table class="climate">
+    <tr><td>January</td><td>Avg. high 45.0 (7.2)</td></tr>
+    <tr><td>February</td><td>Avg. high 46.4 (8.0)</td></tr>
+  </table>
+  <p>Denver is the capital of COLORADO.</p>
+</body></html>
+"""
+
+
+def build_pipeline():
+    return HTMLProcessingPipeline(HTMLParser(), HTMLSearcher(), ParentExtractor(), HTMLPreparer())
+
+
+def test_search_matches_text_case_insensitively():
+    parsed = HTMLParser().parse(PAGE)
+    match = HTMLSearcher().search(parsed, "colorado")
+    assert match == "Denver is the capital of COLORADO."
+
+
+def test_target_strings_are_matched_literally():
+    parsed = HTMLParser().parse(PAGE)
+    searcher = HTMLSearcher()
+    assert searcher.search(parsed, "45.0 (7.2)") == "Avg. high 45.0 (7.2)"
+    assert searcher.search(parsed, "4.\\.0") is None
+
+
+def test_search_all_returns_every_candidate_in_document_order():
+    parsed = HTMLParser().parse(PAGE)
+    matches = HTMLSearcher().search_all(parsed, "avg. high")
+    assert [str(match.element) for match in matches] == [
+        "Avg. high 45.0 (7.2)",
+        "Avg. high 46.4 (8.0)",
+    ]
+    assert matches[0].position < matches[1].position
+    assert {match.kind for match in matches} == {"text"}
+
+
+def test_attributes_are_searched_when_no_text_matches():
+    parsed = HTMLParser().parse(PAGE)
+    matches = HTMLSearcher().search_all(parsed, "Denver (CO)")
+    assert [match.element.get("id") for match in matches] == ["nav"]
+    assert matches[0].kind == "attributes"
+
+
+def test_index_is_built_once_per_document():
+    parsed = HTMLParser().parse(PAGE)
+    searcher = HTMLSearcher()
+    index = searcher.index(parsed)
+    searcher.search(parsed, "January")
+    searcher.search(parsed, "February")
+    assert searcher.index(parsed) is index
+
+
+def test_pipeline_processes_several_targets_against_one_parse():
+    results = build_pipeline().process_all(PAGE, ["January", "capital"], generations=1)
+    assert results["January"] == "<td>January</td>"
+    assert results["capital"] == "<p>Denver is the capital of COLORADO.</p>"
+
+
+NOISY_PAGE = """
+<html><head><script>var tracking = 1;</script><style>td { color: red; }</style></head>
+<body>
+  <!-- navigation -->
+  <nav class="nav main sticky dark"><svg><path d="M0 0L10 10"/></svg>
+    <img src="data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAAB" alt="logo"></nav>
+  <div class="content">
+    <table class="climate" style="width: 100%" onclick="track()">
+      <tr><td>January</td><td>42</td></tr>
+      <tr><td>February</td><td>45</td></tr>
+    </table>
+  </div>
+  <footer>""" + "<p>Filler paragraph with plenty of words in it.</p>" * 200 + """</footer>
+</body></html>
+"""
+
+
+def test_minimizer_drops_non_content():
+    parsed = HTMLParser().parse(NOISY_PAGE)
+    minimized = HTMLMinimizer().minimize(parsed.find("nav"))
+    assert minimized == '<nav class="nav main"><img src="data:…" alt="logo"></nav>'
+
+    table = HTMLMinimizer().minimize(parsed.find("table"))
+    assert table == (
+        '<table class="climate"><tr><td>January</td><td>42</td></tr>'
+        "<tr><td>February</td><td>45</td></tr></table>"
+    )
+    assert "tracking" not in HTMLMinimizer().minimize(parsed)
+    assert parsed.find("script") is not None  # The parse tree is left untouched
+
+
+def test_minimizer_keeps_the_fallback_image_of_a_picture():
+    parsed = HTMLParser().parse(
+        '<div class="card"><picture><source srcset="/lamp.webp" type="image/webp">'
+        '<source srcset="/lamp.avif" type="image/avif"><img src="/lamp.jpg" alt="Brass lamp"></picture></div>'
+    )
+    assert HTMLMinimizer().minimize(parsed.find("div")) == '<div class="card"><picture><img src="/lamp.jpg" alt="Brass lamp"></picture></div>'
+
+
+def test_manager_fills_but_never_exceeds_the_token_budget():
+    manager = HtmlManager("page.html", "file", "January", max_tokens=200, collapse_repetitions=False)
+    processed = manager.process(NOISY_PAGE)
+
+    assert processed.startswith('<div class="content"><table')
+    assert TokenCounter.for_model(manager.model).count(processed) <= 200
+
+
+def test_manager_sends_the_whole_page_when_it_fits():
+    manager = HtmlManager("page.html", "file", "January", max_tokens=10000)
+    processed = manager.process(NOISY_PAGE)
+    assert processed.startswith("<html><head></head><body><nav")
+    assert processed.endswith("</footer></body></html>")
+
+
+def test_manager_truncates_when_the_target_is_missing():
+    manager = HtmlManager("page.html", "file", "not on the page", max_tokens=50)
+    processed = manager.process(NOISY_PAGE)
+    assert TokenCounter.for_model(manager.model).count(processed) <= 50
+
+
+LISTING_PAGE = "<html><body><h1>Products</h1><ul class=\"grid\">" + "".join(
+    f'<li class="card"><a href="/p/{index}">Product {index}</a><span class="price">${index}.99</span></li>'
+    for index in range(200)
+) + "</ul><p>Prices include tax.</p></body></html>"
+
+
+def test_collapser_keeps_samples_and_the_target_record():
+    parsed = HTMLParser().parse(LISTING_PAGE)
+    target = HTMLSearcher().search(parsed, "Product 150")
+    minimizer = HTMLMinimizer(collapser=RepetitionCollapser(samples=2))
+    minimized = minimizer.minimize(parsed.find("ul"), keep=target)
+
+    assert minimized.count("<li") == 3
+    assert "Product 0<" in minimized and "Product 1<" in minimized and "Product 150<" in minimized
+    assert "<!-- 148 more li.card elements, 200 in total --><li" in minimized
+    assert "<!-- 49 more li.card elements, 200 in total --></ul>" in minimized
+
+
+def test_collapser_leaves_short_and_mixed_lists_alone():
+    parsed = HTMLParser().parse(PAGE + NOISY_PAGE)
+    collapser = RepetitionCollapser()
+    assert HTMLMinimizer(collapser=collapser).minimize(parsed.find("table")) == HTMLMinimizer().minimize(parsed.find("table"))
+
+
+def test_manager_sends_sample_records_of_long_lists():
+    collapsed = HtmlManager("page.html", "file", "Product 120", max_tokens=3000).process(LISTING_PAGE)
+    full = HtmlManager("page.html", "file", "Product 120", max_tokens=100000, collapse_repetitions=False).process(LISTING_PAGE)
+
+    # The whole page fits once the list is collapsed, with the target record kept
+    assert collapsed.startswith("<html><body><h1>Products</h1>")
+    assert "Product 120<" in collapsed and "Prices include tax." in collapsed
+    counter = TokenCounter.for_model("gpt-4")
+    assert counter.count(collapsed) * 10 < counter.count(full)
@@ -0,0 +1,47 @@
+"""test_execution_pool.py: Tests for the warm scraper execution pool."""
+import pytest
+
+from data_extraction.execution_pool import CompiledCodeCache, ScraperExecutionPool
+
+
+@pytest.fixture(scope="module")
+def pool():
+    with ScraperExecutionPool(workers=1, timeout=5, max_jobs_per_worker=3) as pool:
+        yield pool
+
+
+def test_runs_code_with_injected_namespace(pool):
+    code = "from bs4 import BeautifulSoup\nprint(BeautifulSoup(html, 'html.parser').p.text)"
+    result = pool.run(code, {"html": "<p>Denver</p>"})
+    assert result.ok
+    assert result.stdout == "Denver\n"
+
+
+def test_failures_are_reported(pool):
+    result = pool.run("raise ValueError('no rows found')")
+    assert not result.ok
+    assert "ValueError: no rows found" in result.error
+
+    result = pool.run("def broken(:")
+    assert not result.ok and "SyntaxError" in result.error
+
+
+def test_workers_are_recycled():
+    with ScraperExecutionPool(workers=1, max_jobs_per_worker=2) as pool:
+        pids = [pool.run("import os\nprint(os.getpid())").stdout for _ in range(4)]
+    assert pids[0] == pids[1] != pids[2] == pids[3]
+
+
+def test_timeout_replaces_worker():
+    with ScraperExecutionPool(workers=1, timeout=0.5) as pool:
+        result = pool.run("while True:\n    pass")
+        assert not result.ok and "Timed out" in result.error
+        assert pool.run("print('still working')").stdout == "still working\n"
+
+
+def test_compiled_code_is_reused():
+    cache = CompiledCodeCache(maxsize=1)
+    key, compiled = cache.get("x = 1")
+    assert cache.get("x = 1") == (key, compiled)
+    cache.get("x = 2")
+    assert len(cache._entries) == 1
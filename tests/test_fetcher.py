@@ -0,0 +1,98 @@
+"""test_fetcher.py: Tests for the concurrent batch fetcher."""
+import os
+import runpy
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from service.runner import ScrapeRunner
+from website_analysis.fetcher import AsyncHtmlFetcher, read_sources
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(__file__))
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path.startswith("/missing"):
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = f"<html><body><p>{self.path}</p></body></html>".encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), PageHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_stream_fetches_every_url(server):
+    sources = [(f"{server}/page/{i}", "url") for i in range(20)]
+    sources.append((f"{server}/missing", "url"))
+    fetcher = AsyncHtmlFetcher(concurrency=5, per_host_limit=2)
+
+    pages = list(fetcher.stream(sources))
+
+    assert len(pages) == 21
+    ok = {page.source: page.html for page in pages if page.ok}
+    assert len(ok) == 20
+    assert "/page/7" in ok[f"{server}/page/7"]
+    assert [page.source for page in pages if not page.ok] == [f"{server}/missing"]
+
+
+def test_stream_can_stop_early(server):
+    sources = [(f"{server}/page/{i}", "url") for i in range(50)]
+    fetcher = AsyncHtmlFetcher(concurrency=2, buffer_size=1)
+
+    for page in fetcher.stream(sources):
+        assert page.ok
+        break
+
+
+def test_fetch_failures_are_reported_on_stderr(server, tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    batch = tmp_path / "urls.txt"
+    batch.write_text(f"{server}/missing\n")
+    parser = runpy.run_path(os.path.join(PROJECT_DIR, "gpt-scraper.py"), run_name="gpt_scraper")["build_parser"]()
+    args = parser.parse_args(["--batch", str(batch), "--requirements", "Everything", "--no-cache", "--executor", "inline"])
+    with ScrapeRunner(args) as runner:
+        assert runner.scrape(args) == 1
+
+    output = capsys.readouterr()
+    assert output.out == "" and f"Failed to fetch {server}/missing" in output.err
+
+
+def test_read_sources(tmp_path):
+    (tmp_path / "b.html").write_text("<p>b</p>")
+    (tmp_path / "a.htm").write_text("<p>a</p>")
+    (tmp_path / "notes.txt").write_text("ignored")
+    assert read_sources(str(tmp_path)) == [
+        (str(tmp_path / "a.htm"), "file"),
+        (str(tmp_path / "b.html"), "file"),
+    ]
+
+    url_file = tmp_path / "urls.txt"
+    url_file.write_text("# listings\nhttps://example.com/1\n\nhttps://example.com/2\n")
+    assert read_sources(str(url_file)) == [
+        ("https://example.com/1", "url"),
+        ("https://example.com/2", "url"),
+    ]
+
+    pages = list(AsyncHtmlFetcher().stream(read_sources(str(tmp_path))))
+    assert sorted(page.html for page in pages) == ["<p>a</p>", "<p>b</p>"]
@@ -0,0 +1,113 @@
+"""test_flow_store.py: Tests for the captured flow store and the replay server."""
+import threading
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+from website_analysis.dom_analysis import UrlHtmlLoader
+from website_analysis.flow_store import Flow, FlowRecorder, FlowStore, ReplayServer
+from website_analysis.http_cache import HttpCache
+
+SCRIPT = b"console.log('tracking');" * 100
+HTML = [("Content-Type", "text/html; charset=utf-8")]
+JSON = [("Content-Type", "application/json")]
+
+
+def listing_page(page):
+    return f"<html><body><h1>Events, page {page}</h1><script src='/app.js'></script></body></html>".encode()
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = FlowStore(str(tmp_path / "flows"))
+    for page in (1, 2):
+        store.add(Flow("GET", f"https://ra.example/events/london?page={page}", 200, response_headers=HTML, response_body=listing_page(page)))
+        store.add(Flow("GET", "https://ra.example/app.js", 200, response_headers=[("Content-Type", "text/javascript")], response_body=SCRIPT))
+    store.add(Flow("POST", "https://ra.example/graphql", 200, request_body=b'{"page": 1}', response_headers=JSON, response_body=b'{"events": [1]}'))
+    store.add(Flow("POST", "https://ra.example/graphql", 200, request_body=b'{"page": 2}', response_headers=JSON, response_body=b'{"events": [2]}'))
+    store.add(Flow("GET", "https://ra.example/event/1234", 404, response_headers=HTML, response_body=b"Not found"))
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def replay(store):
+    def start(**options):
+        server = ReplayServer(store, **options)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    servers = []
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_flows_are_indexed_and_bodies_stored_once(store):
+    assert store.stats()["flows"] == 7
+    # 14 request and response bodies, of which the script served twice and the empty bodies are stored once
+    assert store.stats()["bodies"] == 9
+
+    pages = list(store.query(host="RA.example", content_type="text/html", status=200))
+    assert [flow.url for flow in pages] == [f"https://ra.example/events/london?page={page}" for page in (1, 2)]
+    assert pages[1].response_body == listing_page(2) and pages[1].text().startswith("<html>")
+    assert [flow.status for flow in store.query(path_template="/event/{n}")] == [404]
+    assert [flow.request_body for flow in store.query(method="post")] == [b'{"page": 1}', b'{"page": 2}']
+
+
+def test_replay_as_a_proxy(replay):
+    server = replay()
+    proxies = {"http": server.url}
+
+    response = requests.get("http://ra.example/events/london?page=2", proxies=proxies)
+    assert response.status_code == 200 and response.headers["X-Replay"] == "hit"
+    assert response.content == listing_page(2)
+    assert response.headers["Content-Type"] == "text/html; charset=utf-8"
+
+    graphql = requests.post("http://ra.example/graphql", data=b'{"page": 2}', proxies=proxies)
+    assert graphql.json() == {"events": [2]}
+    assert requests.get("http://ra.example/event/1234", proxies=proxies).status_code == 404
+
+    missing = requests.get("http://ra.example/not-captured", proxies=proxies)
+    assert missing.status_code == 404 and missing.headers["X-Replay"] == "miss"
+    assert (server.hits, server.misses) == (3, 1)
+
+
+def test_replay_of_one_origin_serves_recorded_responses_in_order(store, replay):
+    store.add(Flow("GET", "https://ra.example/api/status", 200, response_headers=JSON, response_body=b'{"state": "queued"}'))
+    store.add(Flow("GET", "https://ra.example/api/status", 200, response_headers=JSON, response_body=b'{"state": "done"}'))
+    server = replay(origin="https://ra.example")
+
+    states = [requests.get(f"{server.url}/api/status").json()["state"] for _ in range(3)]
+    assert states == ["queued", "done", "done"]
+
+
+def test_stored_pages_load_offline(store, tmp_path):
+    cache = HttpCache(str(tmp_path / "http"), offline=True)
+    assert store.export_to_cache(cache) == 2
+
+    html = UrlHtmlLoader("https://ra.example/events/london?page=1", cache=cache).load()
+    assert html == listing_page(1).decode()
+
+
+def test_recorder_stores_mitmproxy_flows(store):
+    class Headers(dict):
+        def items(self, multi=False):
+            return list(super().items())
+
+    request = SimpleNamespace(
+        method="GET", pretty_url="https://ra.example/events/paris", headers=Headers({"Accept": "text/html"}),
+        get_content=lambda strict: b"", timestamp_start=100.0,
+    )
+    response = SimpleNamespace(
+        status_code=200, headers=Headers({"Content-Type": "text/html"}),
+        get_content=lambda strict: b"<p>Paris</p>", timestamp_end=100.25,
+    )
+    FlowRecorder(store).response(SimpleNamespace(request=request, response=response))
+
+    flow = list(store.query(path_template="/events/paris"))[0]
+    assert flow.request_headers == [("Accept", "text/html")]
+    assert (flow.response_body, flow.duration) == (b"<p>Paris</p>", 0.25)
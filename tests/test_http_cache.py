@@ -0,0 +1,100 @@
+"""test_http_cache.py: Tests for the conditional-GET HTTP cache."""
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from website_analysis.dom_analysis import UrlHtmlLoader
+from website_analysis.fetcher import AsyncHtmlFetcher
+from website_analysis.http_cache import CacheMissError, HttpCache
+
+
+class ETagHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    statuses = []
+
+    def do_GET(self):
+        etag = f'"{self.path}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.statuses.append(304)
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = f"<html><body>{self.path} café</body></html>".encode()
+        self.statuses.append(200)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    ETagHandler.statuses = []
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), ETagHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_loader_revalidates_cached_pages(server, tmp_path):
+    cache = HttpCache(str(tmp_path))
+    first = UrlHtmlLoader(f"{server}/page", cache=cache).load()
+    second = UrlHtmlLoader(f"{server}/page", cache=cache).load()
+
+    assert first == second == "<html><body>/page café</body></html>"
+    assert ETagHandler.statuses == [200, 304]
+
+
+def test_fetcher_shares_the_cache(server, tmp_path):
+    cache = HttpCache(str(tmp_path))
+    UrlHtmlLoader(f"{server}/page", cache=cache).load()
+
+    pages = list(AsyncHtmlFetcher(cache=cache).stream([(f"{server}/page", "url")]))
+
+    assert pages[0].html == "<html><body>/page café</body></html>"
+    assert ETagHandler.statuses == [200, 304]
+
+
+def test_offline_mode_never_touches_the_network(server, tmp_path):
+    UrlHtmlLoader(f"{server}/page", cache=HttpCache(str(tmp_path))).load()
+    offline = HttpCache(str(tmp_path), offline=True)
+
+    assert "café" in UrlHtmlLoader(f"{server}/page", cache=offline).load()
+    with pytest.raises(CacheMissError):
+        UrlHtmlLoader(f"{server}/other", cache=offline).load()
+    assert ETagHandler.statuses == [200]
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = HttpCache(str(tmp_path))
+    body = "<p>Denver</p>" * 100
+    cache.put("a", body)
+    cache.max_size = cache.size() * 2  # Room for exactly two entries
+    cache.put("b", body)
+    cache.get("a")
+    cache.put("c", body)
+
+    assert cache.size() <= cache.max_size
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+
+
+def test_configuration_is_shared_through_the_environment(tmp_path, monkeypatch):
+    cache = HttpCache(str(tmp_path), offline=True)
+    environ = {}
+    cache.configure_env(environ)
+    for name, value in environ.items():
+        monkeypatch.setenv(name, value)
+
+    shared = UrlHtmlLoader("http://example.invalid/").cache
+    assert shared.offline and shared is HttpCache.from_env()
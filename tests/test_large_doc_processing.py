@@ -0,0 +1,70 @@
+"""test_large_doc_processing.py: Tests for the incremental document index."""
+import numpy as np
+
+from gpt_interaction.large_doc_processing import HashingEmbeddings, IncrementalIndex, extract_text
+
+PAGES = {
+    "denver.html": "<html><head><title>x</title></head><body><p>Denver is the capital of Colorado.</p>"
+                   "<script>var ignored = 1;</script></body></html>",
+    "boston.html": "<html><body><p>Boston is the capital of Massachusetts.</p></body></html>",
+    "austin.html": "<html><body><p>Austin is the capital of Texas.</p></body></html>",
+}
+
+
+class CountingEmbeddings(HashingEmbeddings):
+    def __init__(self):
+        super().__init__(dimensions=256)
+        self.embedded = []
+
+    def embed_documents(self, texts):
+        self.embedded.append(len(texts))
+        return super().embed_documents(texts)
+
+
+def write_pages(folder, pages):
+    for filename, html in pages.items():
+        (folder / filename).write_text(html, encoding="utf-8")
+
+
+def test_extract_text_skips_scripts():
+    assert extract_text(PAGES["denver.html"]) == "Denver is the capital of Colorado."
+
+
+def test_only_new_and_changed_files_are_embedded(tmp_path):
+    folder = tmp_path / "results"
+    folder.mkdir()
+    write_pages(folder, PAGES)
+    embeddings = CountingEmbeddings()
+    index = IncrementalIndex(str(tmp_path / "index"), embeddings, batch_size=2)
+
+    summary = index.update(str(folder))
+    assert sorted(summary["added"]) == sorted(PAGES)
+    assert embeddings.embedded == [2, 1]  # Batched
+
+    embeddings.embedded.clear()
+    assert index.update(str(folder))["unchanged"] == sorted(PAGES)
+    assert embeddings.embedded == []
+
+    (folder / "austin.html").write_text("<p>Austin has the Texas State Capitol.</p>", encoding="utf-8")
+    (folder / "boston.html").unlink()
+    summary = index.update(str(folder))
+    assert summary["changed"] == ["austin.html"] and summary["removed"] == ["boston.html"]
+    assert embeddings.embedded == [1]
+
+    # A new instance queries the persisted index without embedding any document
+    reopened = IncrementalIndex(str(tmp_path / "index"), CountingEmbeddings())
+    score, source, text = reopened.query("capital of Colorado", k=1)[0]
+    assert (source, text) == ("denver.html", "Denver is the capital of Colorado.")
+    assert [source for _, source, _ in reopened.query("texas capitol", k=2)] == ["austin.html", "denver.html"]
+    assert isinstance(reopened._open_embeddings(), np.memmap)
+
+
+def test_changing_the_embedding_backend_rebuilds_the_index(tmp_path):
+    folder = tmp_path / "results"
+    folder.mkdir()
+    write_pages(folder, PAGES)
+    IncrementalIndex(str(tmp_path / "index"), HashingEmbeddings(dimensions=64)).update(str(folder))
+
+    index = IncrementalIndex(str(tmp_path / "index"), CountingEmbeddings())
+    assert sorted(index.update(str(folder))["added"]) == sorted(PAGES)
+    assert index._open_embeddings().shape == (3, 256)
@@ -0,0 +1,93 @@
+"""test_parser_backends.py: Parity tests for the HTML parser backends."""
+import pytest
+
+from website_analysis import parser_backends
+from website_analysis.dom_analysis import HtmlManager, HTMLParser, HTMLSearcher, ParentExtractor
+from website_analysis.parser_backends import SelectolaxLocator
+
+ROWS = "".join(
+    f"<tr><td>City {i}</td><td><a href='/city/{i}' title='Link {i}'>{i}</a></td></tr>"
+    for i in range(50)
+)
+PAGE = (
+    "<html><head><title>Cities</title></head><body>"
+    "<div id='nav'><a href='/'>Home</a><img src='logo.png' alt='logo-img'></div>"
+    "<main><h1>Climate</h1><table class='climate'><tbody>" + ROWS + "</tbody></table>"
+    "<p>Denver is the capital of <b>COLORADO</b> &amp; its largest city.</p>"
+    "<!-- generated at night --></main></body></html>"
+)
+# Relies on the parser to insert <html>, <body> and <tbody>
+BARE_PAGE = "<div><table><tr><td>January</td><td>42</td></tr></table></div><p>Other text</p>"
+
+TARGETS = [
+    ("city 7", 1),
+    ("city 7", 3),
+    ("city 7", 6),
+    ("logo-img", 0),
+    ("logo-img", 1),
+    ("Link 12", 2),
+    ("colorado", 2),
+    ("& its largest", 1),
+    ("generated at night", 1),
+]
+
+
+def subtree(backend, html, target_string, generations):
+    if backend == "selectolax":
+        located = SelectolaxLocator().locate(html, target_string, generations)
+    else:
+        if backend == "lxml":
+            pytest.importorskip("lxml")
+        parsed = HTMLParser(backend).parse(html)
+        element = HTMLSearcher().search(parsed, target_string)
+        located = str(ParentExtractor().extract(element, generations))
+    # Serialize every backend's subtree the same way
+    return str(HTMLParser().parse_fragment(located))
+
+
+@pytest.fixture(params=["lxml", "selectolax"])
+def backend(request):
+    if request.param == "selectolax" and not SelectolaxLocator.available():
+        pytest.skip("selectolax is not installed")
+    return request.param
+
+
+@pytest.mark.parametrize("target_string, generations", TARGETS)
+def test_backends_pick_the_same_subtree(backend, target_string, generations):
+    expected = subtree("html.parser", PAGE, target_string, generations)
+    assert subtree(backend, PAGE, target_string, generations) == expected
+
+
+@pytest.mark.parametrize("generations", [1, 2, 3, 4, 5])
+def test_locator_skips_elements_the_page_leaves_out(generations):
+    if not SelectolaxLocator.available():
+        pytest.skip("selectolax is not installed")
+    expected = subtree("html.parser", BARE_PAGE, "january", generations)
+    located = subtree("selectolax", BARE_PAGE, "january", generations)
+    # The inserted <tbody> is part of the HTML, but not counted as a generation
+    assert located.replace("<tbody>", "").replace("</tbody>", "") == expected
+
+
+def test_fastest_installed_builder_is_the_default(monkeypatch):
+    monkeypatch.delenv(parser_backends.PARSER_ENV, raising=False)
+    assert HTMLParser().parser_type == parser_backends.installed_tree_builders()[0]
+
+    environ = {}
+    parser_backends.configure_env("html.parser", environ)
+    monkeypatch.setenv(parser_backends.PARSER_ENV, environ[parser_backends.PARSER_ENV])
+    assert HTMLParser().parser_type == "html.parser"
+
+    with pytest.raises(ValueError):
+        parser_backends.configure_env("html5lib", {})
+
+
+def test_manager_output_does_not_depend_on_the_locator(monkeypatch):
+    if not SelectolaxLocator.available():
+        pytest.skip("selectolax is not installed")
+    monkeypatch.setattr(HtmlManager, "LOCATOR_MIN_SIZE", 0)
+
+    located = HtmlManager("page.html", "file", "City 7", max_tokens=80)
+    full = HtmlManager("page.html", "file", "City 7", max_tokens=80, use_locator=False)
+
+    assert located.process(PAGE) == full.process(PAGE)
+    assert located.parsed_html is None  # Only the located part was parsed
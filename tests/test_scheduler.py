@@ -0,0 +1,144 @@
+"""test_scheduler.py: Tests for the rate-limit-aware request scheduler."""
+import asyncio
+import gc
+import time
+
+import pytest
+from aiohttp import web
+
+from gpt_interaction.gpt_interaction import GPTInteraction
+from gpt_interaction.scheduler import BATCH, INTERACTIVE, APIError, RequestScheduler, TokenBucket
+
+
+class FakeOpenAI:
+    """A local OpenAI-compatible endpoint answering with a scripted list of statuses."""
+
+    def __init__(self, statuses, retry_after=None, delays=()):
+        self.statuses = list(statuses)
+        self.retry_after = retry_after
+        self.delays = list(delays)
+        self.requests = []
+
+    async def chat_completions(self, request):
+        self.requests.append((time.monotonic(), await request.json(), request.headers.get("Authorization")))
+        if self.delays:
+            await asyncio.sleep(self.delays.pop(0))
+        status = self.statuses.pop(0) if self.statuses else 200
+        if status != 200:
+            headers = {"Retry-After": str(self.retry_after)} if self.retry_after is not None else {}
+            return web.json_response({"error": {"message": "try again"}}, status=status, headers=headers)
+        return web.json_response({
+            "choices": [{"message": {"role": "assistant", "content": "Bonjour"}}],
+            "usage": {"total_tokens": 12},
+        })
+
+    async def serve(self, coroutine_function):
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        try:
+            return await coroutine_function(f"http://127.0.0.1:{port}/v1")
+        finally:
+            await runner.cleanup()
+
+
+def gpt(api_base, timeout=600, **scheduler_options):
+    scheduler = RequestScheduler(base_delay=0.01, **scheduler_options)
+    return GPTInteraction(api_token="test-key", api_base=api_base, max_tokens=20, timeout=timeout, scheduler=scheduler)
+
+
+def test_acall_honours_retry_after():
+    server = FakeOpenAI([429], retry_after=0.3)
+
+    async def scenario(api_base):
+        return await gpt(api_base).acall("Translate 'Hello'")
+
+    assert asyncio.run(server.serve(scenario)) == "Bonjour"
+    (first, payload, authorization), (second, _, _) = server.requests
+    assert second - first >= 0.3
+    assert payload["model"] == "gpt-4" and authorization == "Bearer test-key"
+
+
+def test_server_errors_are_retried_but_client_errors_are_not():
+    server = FakeOpenAI([500, 502, 400])
+
+    async def scenario(api_base):
+        with pytest.raises(APIError) as error:
+            await gpt(api_base).acall("Translate 'Hello'")
+        return error.value
+
+    error = asyncio.run(server.serve(scenario))
+    assert error.status == 400
+    assert len(server.requests) == 3
+
+
+def test_timed_out_requests_are_retried():
+    server = FakeOpenAI([], delays=[2])
+
+    async def scenario(api_base):
+        return await gpt(api_base, timeout=0.5).acall("Translate 'Hello'")
+
+    assert asyncio.run(server.serve(scenario)) == "Bonjour"
+    assert len(server.requests) == 2
+
+    attempts = []
+
+    async def send():
+        attempts.append(time.monotonic())
+        raise asyncio.TimeoutError()
+
+    with pytest.raises(APIError, match="timed out") as error:
+        asyncio.run(RequestScheduler(base_delay=0.01, max_retries=2).run(send, 10))
+    assert len(attempts) == 3 and isinstance(error.value.__cause__, asyncio.TimeoutError)
+
+
+def test_interactive_requests_overtake_queued_batch_requests():
+    scheduler = RequestScheduler()
+    scheduler.requests = TokenBucket(600, capacity=1)  # One request every 0.1s
+    order = []
+
+    async def request(name, priority):
+        await scheduler.acquire(10, priority)
+        order.append(name)
+
+    async def scenario():
+        await scheduler.acquire(10)  # Empty the bucket, so the others have to queue
+        batch = [asyncio.ensure_future(request(f"batch {i}", BATCH)) for i in range(2)]
+        await asyncio.sleep(0.01)
+        interactive = asyncio.ensure_future(request("interactive", INTERACTIVE))
+        await asyncio.gather(*batch, interactive)
+
+    asyncio.run(scenario())
+    assert order == ["interactive", "batch 0", "batch 1"]
+
+
+def test_closed_loops_are_not_kept_alive():
+    scheduler = RequestScheduler()
+    scheduler.pause(3600)  # Every request waits, with a wake-up pending on its loop
+
+    async def scenario():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(scheduler.acquire(10), 0.05)
+
+    for _ in range(3):
+        asyncio.run(scenario())
+    gc.collect()
+    assert len(scheduler._wakeups) == 0 and scheduler._waiting == []
+
+
+def test_token_bucket_paces_estimated_tokens():
+    now = [0.0]
+    bucket = TokenBucket(6000, clock=lambda: now[0])  # 100 tokens per second
+
+    assert bucket.delay(6000) == 0
+    bucket.consume(6000)
+    assert bucket.delay(500) == pytest.approx(5)
+    now[0] += 5
+    assert bucket.delay(500) == 0
+
+    bucket.consume(500 + 1000)  # Used more than estimated
+    assert bucket.delay(1) == pytest.approx(10.01)
@@ -0,0 +1,62 @@
+"""test_scraper_cache.py: Tests for the layout-keyed scraper cache."""
+from scraper_generation.scraper_cache import ScraperCache
+from scraper_generation.scraper_generator import ScrapingCodeGenerator
+
+
+PAGE_ONE = """
+<table class="results"><tr class="row"><td>Denver</td><td>10</td></tr>
+<tr class="row"><td>Boulder</td><td>12</td></tr></table>
+"""
+PAGE_TWO = """
+<table class="results"><tr class="row"><td>Aspen</td><td>3</td></tr>
+<tr class="row"><td>Vail</td><td>4</td></tr><tr class="row"><td>Eagle</td><td>5</td></tr></table>
+"""
+OTHER_LAYOUT = "<ul class='results'><li>Denver</li></ul>"
+
+
+class FakeGenerator(ScrapingCodeGenerator):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = 0
+
+    def request_generated_code(self, user_requirements, use_cache=True):
+        self.calls += 1
+        return "print(html_soup.find_all('tr'))"
+
+
+def test_same_layout_and_requirements_share_a_key(tmp_path):
+    cache = ScraperCache(str(tmp_path))
+    assert cache.key(PAGE_ONE, "Extract the cities.") == cache.key(
+        PAGE_TWO, "  extract the   CITIES"
+    )
+    assert cache.key(PAGE_ONE, "Extract the cities") != cache.key(
+        OTHER_LAYOUT, "Extract the cities"
+    )
+    assert cache.key(PAGE_ONE, "Extract the cities") != cache.key(
+        PAGE_ONE, "Extract the temperatures"
+    )
+
+
+def test_invalid_entries_are_misses(tmp_path):
+    cache = ScraperCache(str(tmp_path))
+    assert not cache.put("key", "def broken(:")
+    assert cache.get("key") is None
+
+    (tmp_path / "corrupt.json").write_text("{not json")
+    assert cache.get("corrupt") is None
+    assert not (tmp_path / "corrupt.json").exists()
+
+
+def test_generator_reuses_cached_scraper(tmp_path):
+    cache = ScraperCache(str(tmp_path))
+    first = FakeGenerator(PAGE_ONE, source="one.html", source_type="file", cache=cache)
+    first_code = first.generate_scraping_code("Extract the cities")
+    assert first.calls == 1 and not first.cache_hit
+
+    second = FakeGenerator(PAGE_TWO, source="two.html", source_type="file", cache=cache)
+    second_code = second.generate_scraping_code("Extract the cities")
+    assert second.calls == 0 and second.cache_hit
+    assert "two.html" in second_code and "one.html" in first_code
+
+    second.generate_scraping_code("Extract the cities", use_cache=False)
+    assert second.calls == 1
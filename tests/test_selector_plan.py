@@ -0,0 +1,187 @@
+"""test_selector_plan.py: Tests for declarative selector plans and the bulk extractor."""
+import os
+import runpy
+
+import pandas as pd
+import pytest
+from langchain.schema import AIMessage
+
+from data_extraction.selector_plan import BulkExtractor, FieldSpec, SelectorPlan, compile_transform, derive_plan
+from gpt_interaction.completion_cache import CACHE_DIR_ENV, CACHE_SIZE_ENV, CACHE_TTL_ENV
+from scraper_generation.scraper_generator import ScrapingCodeGenerator
+from service.runner import ScrapeRunner
+from website_analysis.parser_backends import _importable
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(__file__))
+DENVER = os.path.join(PROJECT_DIR, "results", "denver.html")
+
+PRODUCTS = """
+<html><body><div id="products">
+  <div class="card"><a href="/p/1">Lamp</a><span class="price">$1,299.50</span><i>new</i><i>sale</i></div>
+  <div class="card"><a href="/p/2">Chair</a><span class="price">$45</span></div>
+  <div class="card"><a href="/p/3">Desk</a><span class="price">call us</span></div>
+</div></body></html>
+"""
+
+PRODUCT_PLAN = {
+    "rows": "#products div.card",
+    "fields": {
+        "name": {"css": "a"},
+        "link": {"css": "a", "attribute": "href"},
+        "price": {"css": "span.price", "transforms": ["number"]},
+        "tags": {"css": "i", "multiple": True},
+    },
+}
+
+BACKENDS = [
+    "bs4",
+    pytest.param("selectolax", marks=pytest.mark.skipif(not _importable("selectolax"), reason="selectolax is not installed")),
+]
+
+
+def load_denver():
+    with open(DENVER, "r") as file:
+        return file.read()
+
+
+def test_plans_round_trip_through_json():
+    plan = SelectorPlan.from_dict(PRODUCT_PLAN)
+    assert SelectorPlan.from_json(plan.to_json()).to_dict() == PRODUCT_PLAN
+    assert SelectorPlan.from_json(f"Here you go:\n```json\n{plan.to_json()}\n```").key() == plan.key()
+
+
+@pytest.mark.parametrize("plan", [
+    {"fields": {}},
+    {"fields": {"name": {"css": "a", "xpath": "//a"}}},
+    {"fields": {"name": {"css": "a", "transforms": ["shout"]}}},
+    {"fields": {"name": {"css": "a", "colour": "red"}}},
+    {"rows": "tr", "rows_xpath": "//tr", "fields": {"name": "td"}},
+])
+def test_invalid_plans_are_rejected(plan):
+    with pytest.raises(ValueError):
+        SelectorPlan.from_dict(plan)
+
+
+def test_transforms():
+    assert compile_transform("number")("$1,299.50") == 1299.5
+    assert compile_transform("number")("12 items") == 12
+    assert compile_transform("int")("n/a") is None
+    assert compile_transform("regex:(\\d{4})-\\d\\d")("Due 2023-05") == "2023"
+    assert FieldSpec(css="td", transforms=["collapse", "upper"]).clean("  a \n b ") == "A B"
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_rows_fields_attributes_and_lists(backend):
+    records = BulkExtractor(SelectorPlan.from_dict(PRODUCT_PLAN), backend).extract(PRODUCTS)
+    assert records == [
+        {"name": "Lamp", "link": "/p/1", "price": 1299.5, "tags": ["new", "sale"]},
+        {"name": "Chair", "link": "/p/2", "price": 45, "tags": []},
+        {"name": "Desk", "link": "/p/3", "price": None, "tags": []},
+    ]
+
+
+@pytest.mark.skipif(not _importable("lxml"), reason="lxml is not installed")
+def test_xpath_plans_run_on_lxml():
+    plan = SelectorPlan.from_dict({
+        "rows_xpath": "//div[@class='card']",
+        "fields": {"name": {"xpath": "./a"}, "link": {"xpath": "./a/@href"}},
+    })
+    extractor = BulkExtractor(plan)
+    assert extractor.backend.name == "lxml"
+    assert extractor.extract(PRODUCTS)[0] == {"name": "Lamp", "link": "/p/1"}
+
+
+def test_documents_without_rows_become_one_record():
+    plan = SelectorPlan.from_dict({"fields": {"title": "title", "headings": {"css": "h2", "multiple": True}}})
+    frame = BulkExtractor(plan).extract_many([("a", load_denver()), ("b", "<p>empty</p>")])
+    assert list(frame.columns) == ["source", "title", "headings"]
+    assert frame.loc[0, "title"] == "Denver Climate Information"
+    assert len(frame) == 1
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_derived_plan_extracts_the_whole_table(backend):
+    plan = derive_plan(load_denver(), "February")
+    assert plan.rows == "table.temperature-table tr"
+    assert list(plan.fields) == ["month", "average_temperature_f"]
+
+    frame = BulkExtractor(plan, backend).extract_many([("denver", load_denver())])
+    assert len(frame) == 12
+    assert frame.loc[1].to_dict() == {"source": "denver", "month": "February", "average_temperature_f": 45}
+    assert pd.api.types.is_integer_dtype(frame["average_temperature_f"])
+
+
+def test_derive_plan_needs_the_example():
+    assert derive_plan(load_denver(), "Not on the page") is None
+
+
+def test_llm_answers_are_parsed_into_plans(tmp_path):
+    class PlanChatModel:
+        def __call__(self, messages):
+            return AIMessage(content=f"```json\n{SelectorPlan.from_dict(PRODUCT_PLAN).to_json()}\n```")
+
+    generator = ScrapingCodeGenerator(PRODUCTS, source="products.html", source_type="file", llm=PlanChatModel())
+    plan = generator.generate_selector_plan("Extract name, link and price of every product")
+    assert plan.to_dict() == PRODUCT_PLAN
+
+
+def test_runner_applies_one_plan_to_a_batch(tmp_path):
+    pages = tmp_path / "pages"
+    pages.mkdir()
+    for index in range(3):
+        (pages / f"denver-{index}.html").write_text(load_denver())
+    plan_file, output = str(tmp_path / "plan.json"), str(tmp_path / "records.csv")
+
+    parser = runpy.run_path(os.path.join(PROJECT_DIR, "gpt-scraper.py"), run_name="gpt_scraper")["build_parser"]()
+    args = parser.parse_args([
+        "--batch", str(pages), "--target-string", "February", "--no-cache",
+        "--extract-with", "plan", "--derive-plan", "--plan-file", plan_file, "--output", output,
+    ])
+    with ScrapeRunner(args) as runner:
+        assert runner.scrape(args) == 0
+
+    assert SelectorPlan.load(plan_file).rows == "table.temperature-table tr"
+    frame = pd.read_csv(output)
+    assert len(frame) == 36 and frame["source"].nunique() == 3
+
+
+def test_invalid_plans_are_reported_and_never_cached(tmp_path, monkeypatch, capsys):
+    class PlanChatModel:
+        answer = "```json\n{\"fields\": 3}\n```"
+        calls = 0
+
+        def __call__(self, messages):
+            PlanChatModel.calls += 1
+            return AIMessage(content=self.answer)
+
+    monkeypatch.chdir(tmp_path)
+    # The runner configures the completion cache of the run in the environment
+    for name in (CACHE_DIR_ENV, CACHE_SIZE_ENV, CACHE_TTL_ENV):
+        monkeypatch.setenv(name, "")
+    parser = runpy.run_path(os.path.join(PROJECT_DIR, "gpt-scraper.py"), run_name="gpt_scraper")["build_parser"]()
+    args = parser.parse_args([
+        "--source", DENVER, "--source-type", "file", "--requirements", "Monthly temperatures",
+        "--extract-with", "plan", "--completion-cache", str(tmp_path / "completions"),
+    ])
+    llm = PlanChatModel()
+    with ScrapeRunner(args, llm=llm) as runner:
+        assert runner.scrape(args) == 1
+    output = capsys.readouterr()
+    assert output.out == "" and "Could not create a selector plan" in output.err
+
+    llm.answer = f"```json\n{derive_plan(load_denver(), 'February').to_json()}\n```"
+    with ScrapeRunner(args, llm=llm) as runner:
+        assert runner.scrape(args) == 0
+    assert PlanChatModel.calls == 2 and "February" in capsys.readouterr().out
+
+
+def test_plan_messages_stay_out_of_the_csv(tmp_path, capsys):
+    plan_file = str(tmp_path / "plan.json")
+    SelectorPlan.from_dict(PRODUCT_PLAN).save(plan_file)
+    parser = runpy.run_path(os.path.join(PROJECT_DIR, "gpt-scraper.py"), run_name="gpt_scraper")["build_parser"]()
+    args = parser.parse_args(["--source", DENVER, "--source-type", "file", "--no-cache", "--extract-with", "plan", "--plan-file", plan_file])
+    with ScrapeRunner(args) as runner:
+        assert runner.scrape(args) == 1
+
+    output = capsys.readouterr()
+    assert "found nothing" not in output.out and "The selector plan found nothing" in output.err
@@ -0,0 +1,191 @@
+"""test_sinks.py: Tests for the streaming record sinks."""
+import csv
+import json
+import os
+import runpy
+import tracemalloc
+
+import pytest
+from langchain.schema import AIMessage
+
+from data_extraction.sinks import CsvSink, JsonLinesSink, RecordEmitter, drain_spool, open_sink
+from gpt_interaction.completion_cache import CACHE_DIR_ENV, CACHE_SIZE_ENV, CACHE_TTL_ENV
+from service.runner import ScrapeRunner
+from website_analysis.parser_backends import _importable
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(__file__))
+DENVER = os.path.join(PROJECT_DIR, "results", "denver.html")
+
+EMITTING_CODE = """```python
+for row in html_soup.find_all("tr")[1:13]:
+    month, temperature = [cell.get_text() for cell in row.find_all("td")]
+    emit({"month": month, "temperature": int(temperature)})
+```"""
+
+# Emits records, then fails on the page
+FAILING_CODE = """```python
+emit({"month": "stale"})
+html_soup.find("table").find("missing").get_text()
+```"""
+
+
+def read_jsonl(path):
+    with open(path, "r", encoding="utf-8") as file:
+        return [json.loads(line) for line in file]
+
+
+def test_files_rotate_after_the_record_limit(tmp_path):
+    with JsonLinesSink(str(tmp_path), row_group_size=300, max_records_per_file=1000) as sink:
+        sink.write_many({"index": index} for index in range(2500))
+    assert [os.path.basename(path) for path in sink.files] == [
+        "records-00000.jsonl", "records-00001.jsonl", "records-00002.jsonl",
+    ]
+    assert [len(read_jsonl(path)) for path in sink.files] == [1000, 1000, 500]
+    assert read_jsonl(sink.files[2])[-1] == {"index": 2499}
+    assert sorted(os.listdir(tmp_path)) == sorted(os.path.basename(path) for path in sink.files)
+
+
+def test_finished_files_are_published_while_writing(tmp_path):
+    sink = JsonLinesSink(str(tmp_path), row_group_size=100, max_records_per_file=200)
+    sink.write_many({"index": index} for index in range(300))
+    # The first file is complete, the second is still being written under a hidden name
+    assert sorted(os.listdir(tmp_path)) == [".records-00001.jsonl.part", "records-00000.jsonl"]
+    sink.close()
+    assert sorted(os.listdir(tmp_path)) == ["records-00000.jsonl", "records-00001.jsonl"]
+
+
+def test_files_rotate_by_size_and_continue_after_earlier_runs(tmp_path):
+    with JsonLinesSink(str(tmp_path), row_group_size=10, max_bytes_per_file=2000) as sink:
+        sink.write_many({"text": "x" * 90} for _ in range(100))
+    assert len(sink.files) > 3
+    assert all(os.path.getsize(path) < 2000 + 10 * 110 for path in sink.files)
+
+    with JsonLinesSink(str(tmp_path)) as later:
+        later.write({"text": "later"})
+    assert later.files == [os.path.join(str(tmp_path), f"records-{len(sink.files):05d}.jsonl")]
+
+
+def test_csv_sink_writes_a_header_per_file(tmp_path):
+    with CsvSink(str(tmp_path), max_records_per_file=3) as sink:
+        sink.write({"name": "Lamp", "tags": ["new", "sale"]})
+        sink.write({"name": "Chair", "tags": []})
+        with pytest.warns(UserWarning, match="colour"):
+            sink.write({"name": "Desk", "tags": None, "colour": "oak"})
+            sink.flush()
+        sink.write({"name": "Bed", "colour": "white"})
+
+    with open(sink.files[0], newline="") as file:
+        rows = list(csv.DictReader(file))
+    assert rows == [
+        {"name": "Lamp", "tags": '["new", "sale"]'},
+        {"name": "Chair", "tags": "[]"},
+        {"name": "Desk", "tags": ""},
+    ]
+    with open(sink.files[1], newline="") as file:
+        assert list(csv.DictReader(file)) == [{"name": "Bed", "colour": "white"}]
+
+
+@pytest.mark.skipif(_importable("pyarrow"), reason="pyarrow is installed")
+def test_parquet_needs_pyarrow(tmp_path):
+    with pytest.raises(ValueError, match="pyarrow"):
+        open_sink(str(tmp_path), "parquet")
+
+
+@pytest.mark.skipif(not _importable("pyarrow"), reason="pyarrow is not installed")
+def test_parquet_sink_writes_row_groups(tmp_path):
+    import pyarrow.parquet as pq
+
+    with open_sink(str(tmp_path), "parquet", row_group_size=100) as sink:
+        sink.write_many({"index": index, "name": f"row {index}"} for index in range(250))
+    metadata = pq.ParquetFile(sink.files[0]).metadata
+    assert metadata.num_rows == 250 and metadata.num_row_groups == 3
+
+
+def test_memory_stays_flat(tmp_path):
+    record = {"name": "x" * 200, "value": 42}
+    with JsonLinesSink(str(tmp_path), row_group_size=500, max_records_per_file=20000) as sink:
+        tracemalloc.start()
+        try:
+            sink.write_many(dict(record, index=index) for index in range(100000))
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    assert sink.records_written == 100000
+    assert peak < 2 * 1024 * 1024
+
+
+def test_spooled_records_are_drained_into_the_sink(tmp_path, capsys):
+    spool = str(tmp_path / "spool.jsonl")
+    emit = RecordEmitter(spool)
+    emit({"month": "January"})
+    emit({"month": "February"})
+    with open(spool, "a") as file:
+        file.write('{"month": "Ma')  # A scraper killed mid-write
+    emit.close()
+
+    with JsonLinesSink(str(tmp_path / "out")) as sink:
+        assert drain_spool(spool, sink) == 2
+    assert not os.path.exists(spool)
+    assert read_jsonl(sink.files[0]) == [{"month": "January"}, {"month": "February"}]
+
+    RecordEmitter()({"month": "March"})
+    assert capsys.readouterr().out == '{"month": "March"}\n'
+
+
+@pytest.mark.parametrize("executor", ["inline", "subprocess", "pool"])
+def test_generated_scrapers_emit_into_the_sink_of_the_run(tmp_path, monkeypatch, executor):
+    class EmittingChatModel:
+        def __call__(self, messages):
+            return AIMessage(content=EMITTING_CODE)
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("PYTHONPATH", PROJECT_DIR)
+    parser = runpy.run_path(os.path.join(PROJECT_DIR, "gpt-scraper.py"), run_name="gpt_scraper")["build_parser"]()
+    args = parser.parse_args([
+        "--source", DENVER, "--source-type", "file", "--requirements", "Monthly temperatures",
+        "--target-string", "February", "--no-cache", "--executor", executor,
+        "--sink", str(tmp_path / "records"), "--rotate-records", "5",
+    ])
+    with ScrapeRunner(args, llm=EmittingChatModel()) as runner:
+        assert runner.scrape(args) == 0
+
+    records = [record for path in runner.sink.files for record in read_jsonl(path)]
+    assert len(runner.sink.files) == 3
+    assert records[1] == {"month": "February", "temperature": 45}
+    assert len(records) == 12
+
+
+@pytest.mark.parametrize("executor", ["inline", "subprocess", "pool"])
+def test_records_of_a_failed_scraper_never_reach_the_sink(tmp_path, monkeypatch, capsys, executor):
+    class ChatModel:
+        answer = FAILING_CODE
+
+        def __call__(self, messages):
+            return AIMessage(content=self.answer)
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("PYTHONPATH", PROJECT_DIR)
+    # The runner configures the completion cache of the run in the environment
+    for name in (CACHE_DIR_ENV, CACHE_SIZE_ENV, CACHE_TTL_ENV):
+        monkeypatch.setenv(name, "")
+    parser = runpy.run_path(os.path.join(PROJECT_DIR, "gpt-scraper.py"), run_name="gpt_scraper")["build_parser"]()
+
+    def scrape(sink):
+        args = parser.parse_args([
+            "--source", DENVER, "--source-type", "file", "--requirements", "Monthly temperatures",
+            "--target-string", "February", "--executor", executor, "--sink", str(tmp_path / sink),
+            "--scraper-cache", str(tmp_path / "scrapers"), "--completion-cache", str(tmp_path / "completions"),
+        ])
+        with ScrapeRunner(args, llm=llm) as runner:
+            exit_code = runner.scrape(args)
+        return exit_code, [record for path in runner.sink.files for record in read_jsonl(path)]
+
+    llm = ChatModel()
+    assert scrape("failed") == (1, [])
+    # The traceback stays out of the scraped output
+    assert "AttributeError" not in capsys.readouterr().out
+
+    # The cached scraper fails again before the regenerated one runs
+    llm.answer = EMITTING_CODE
+    exit_code, records = scrape("retried")
+    assert exit_code == 0 and len(records) == 12 and {"month": "stale"} not in records
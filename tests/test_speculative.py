@@ -0,0 +1,153 @@
+"""test_speculative.py: Tests for racing candidate scrapers and keeping the first valid one."""
+import json
+import os
+import runpy
+import time
+
+import pytest
+from langchain.schema import AIMessage
+
+from gpt_interaction.completion_cache import CompletionCache
+from scraper_generation.scraper_cache import ScraperCache
+from scraper_generation.scraper_generator import ScrapingCodeGenerator
+from scraper_generation.speculative import CandidateResult, OutputCheck, SpeculativeGenerator, candidate_temperatures
+from service.runner import ScrapeRunner
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(__file__))
+DENVER = os.path.join(PROJECT_DIR, "results", "denver.html")
+
+MONTHS = """
+for row in html_soup.find_all("tr")[1:13]:
+    month, temperature = [cell.get_text() for cell in row.find_all("td")]
+    emit({"month": month, "temperature": int(temperature)})
+"""
+CRASHING = 'html_soup.find("table").find("missing").get_text()'
+WRONG_COLUMN = 'emit({"title": html_soup.title.get_text() if html_soup.title else "Denver"})'
+NOTHING = 'rows = html_soup.find_all("article")'
+SLOW = """
+import os, time
+with open(os.environ["SLOW_PID_FILE"], "w") as file:
+    file.write(str(os.getpid()))
+time.sleep(30)
+""" + MONTHS
+
+
+class TemperatureChatModel:
+    """Answers with the code given for the temperature it samples at, after a delay."""
+
+    def __init__(self, answers, temperature=ScrapingCodeGenerator.TEMPERATURE, delays=None):
+        self.answers = answers
+        self.temperature = temperature
+        self.delays = delays or {}
+        self.requested = []
+
+    def copy(self, update):
+        clone = TemperatureChatModel(self.answers, update["temperature"], self.delays)
+        clone.requested = self.requested
+        return clone
+
+    def __call__(self, messages):
+        self.requested.append(self.temperature)
+        time.sleep(self.delays.get(self.temperature, 0))
+        return AIMessage(content=f"```python\n{self.answers[self.temperature]}\n```")
+
+
+@pytest.fixture
+def environment(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("PYTHONPATH", PROJECT_DIR)
+    monkeypatch.setenv("SLOW_PID_FILE", str(tmp_path / "slow.pid"))
+    with open(DENVER, "r", encoding="utf-8") as file:
+        return file.read()
+
+
+def generator_for(llm, cache=None, completion_cache=None):
+    return ScrapingCodeGenerator("<table></table>", source=DENVER, source_type="file", cache=cache, completion_cache=completion_cache, llm=llm)
+
+
+def test_temperatures_are_distinct_and_start_with_the_default():
+    assert candidate_temperatures(1, 0.5) == [0.5]
+    assert candidate_temperatures(3, 0.5) == [0.5, 0.0, 1.0]
+    assert candidate_temperatures(4, 0.5) == [0.5, 0.0, 0.33, 0.67]
+
+
+def test_first_valid_candidate_wins_and_the_others_are_killed(environment, tmp_path):
+    llm = TemperatureChatModel({0.5: CRASHING, 0.0: SLOW, 1.0: MONTHS}, delays={1.0: 0.5})
+    speculation = SpeculativeGenerator(generator_for(llm), candidates=3, check=OutputCheck("February"))
+
+    start = time.perf_counter()
+    winner = speculation.generate("Monthly temperatures", environment)
+    assert time.perf_counter() - start < 15
+
+    assert winner.temperature == 1.0 and winner.records[1] == {"month": "February", "temperature": 45}
+    assert sorted(llm.requested) == [0.0, 0.5, 1.0]
+    crashed = next(result for result in speculation.results if result.temperature == 0.5)
+    assert crashed.reason.startswith("exited with status 1") and "AttributeError" in crashed.reason
+
+    # The slow candidate was still running when the winner was found
+    pid = int((tmp_path / "slow.pid").read_text())
+    for _ in range(50):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            break
+        time.sleep(0.1)
+    else:
+        pytest.fail("The losing candidate is still running")
+
+
+def test_candidates_are_fresh_samples_despite_the_completion_cache(environment, tmp_path):
+    completions = CompletionCache(str(tmp_path / "completions"))
+    llm = TemperatureChatModel({0.5: NOTHING, 0.0: WRONG_COLUMN, 1.0: CRASHING})
+    assert SpeculativeGenerator(generator_for(llm, completion_cache=completions), candidates=3, check=OutputCheck("February")).generate("Temperatures", environment) is None
+
+    # The rejected completions are cached, but the next race asks the LLM again
+    llm.answers = {0.5: NOTHING, 0.0: MONTHS, 1.0: CRASHING}
+    winner = SpeculativeGenerator(generator_for(llm, completion_cache=completions), candidates=3, check=OutputCheck("February")).generate("Temperatures", environment)
+    assert winner is not None and winner.temperature == 0.0
+    assert sorted(llm.requested) == [0.0, 0.0, 0.5, 0.5, 1.0, 1.0]
+
+
+def test_output_check_rejects_wrong_shapes():
+    check = OutputCheck("  february ")
+
+    def result(stdout="", records=None, exit_code=0):
+        return CandidateResult(0, 0.5, "code", exit_code=exit_code, stdout=stdout, records=records)
+
+    assert check(result(records=[{"month": "February"}])) is None
+    assert check(result(stdout="Average in February: 45\n")) is None
+    assert check(result()) == "extracted nothing"
+    assert check(result(records=[{"month": ""}, {"month": None}])) == "emitted only empty records"
+    assert check(result(records=[{"month": "March"}])) == "the target string is missing from the output"
+    assert check(result(records=[{"month": "February"}], exit_code=2)) == "exited with status 2"
+
+
+def test_a_working_cached_scraper_is_used_without_asking_the_llm(environment, tmp_path):
+    cache = ScraperCache(str(tmp_path / "scrapers"))
+    generator = generator_for(TemperatureChatModel({0.5: MONTHS, 0.0: NOTHING, 1.0: NOTHING}), cache)
+    assert SpeculativeGenerator(generator, candidates=3, check=OutputCheck("February")).generate("Temperatures", environment) is not None
+
+    llm = TemperatureChatModel({})
+    speculation = SpeculativeGenerator(generator_for(llm, cache), candidates=3, check=OutputCheck("February"))
+    winner = speculation.generate("Temperatures", environment)
+    assert winner.temperature is None and len(winner.records) == 12
+    assert llm.requested == []
+
+
+def test_runner_passes_on_only_the_winning_output(environment, monkeypatch, capsys):
+    parser = runpy.run_path(os.path.join(PROJECT_DIR, "gpt-scraper.py"), run_name="gpt_scraper")["build_parser"]()
+    args = parser.parse_args([
+        "--source", DENVER, "--source-type", "file", "--requirements", "Monthly temperatures",
+        "--target-string", "February", "--no-cache", "--executor", "inline", "--candidates", "3",
+    ])
+    llm = TemperatureChatModel({0.5: NOTHING, 0.0: WRONG_COLUMN, 1.0: MONTHS})
+    with ScrapeRunner(args, llm=llm) as runner:
+        assert runner.scrape(args) == 0
+
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith("{")]
+    assert len(records) == 12 and records[1] == {"month": "February", "temperature": 45}
+
+    llm.answers = {0.5: NOTHING, 0.0: WRONG_COLUMN, 1.0: CRASHING}
+    with ScrapeRunner(args, llm=llm) as runner:
+        assert runner.scrape(args) == 1
+    assert capsys.readouterr().err.count("rejected") == 3
@@ -0,0 +1,69 @@
+"""test_streaming.py: Tests for the bounded-memory subtree extraction of large files."""
+import tracemalloc
+
+import pytest
+
+from website_analysis.dom_analysis import HtmlManager, HTMLParser, HTMLSearcher, ParentExtractor
+from website_analysis.streaming import StreamingSubtreeExtractor
+
+ROWS = "".join(f"<div class='row'><span>item {i}</span><br></div>\n" for i in range(1500))
+PAGE = (
+    "<html>\n<body>\n" + ROWS
+    + "<table id='climate'>\n<tr><td>Needle Value</td><td><img src='x.png' alt='logo-img'></td></tr>"
+    + "</table>\n<ul><li>one<li>two Café</ul>\n</body></html>"
+)
+
+
+@pytest.fixture
+def page_path(tmp_path):
+    path = tmp_path / "page.html"
+    path.write_text(PAGE, encoding="utf-8")
+    return str(path)
+
+
+@pytest.mark.parametrize(
+    "target_string, generations",
+    [
+        ("needle value", 1),
+        ("needle value", 3),
+        ("needle value", 10),
+        ("logo-img", 0),
+        ("logo-img", 2),
+        ("item 5", 2),
+        ("two café", 2),
+    ],
+)
+def test_streaming_matches_the_full_parse(page_path, target_string, generations):
+    subtree = StreamingSubtreeExtractor(chunk_size=4096).extract(page_path, target_string, generations)
+
+    # The scanner follows the nesting rules of html.parser, lxml closes the <li> elements
+    parsed = HTMLParser("html.parser").parse(PAGE)
+    element = HTMLSearcher().search(parsed, target_string)
+    expected = ParentExtractor().extract(element, generations)
+    assert str(HTMLParser().parse_fragment(subtree)).strip() == str(expected).strip()
+
+
+def test_missing_target(page_path):
+    assert StreamingSubtreeExtractor().extract(page_path, "not on the page", 2) is None
+
+
+def test_peak_memory_is_bounded_by_the_subtree(tmp_path):
+    large_page = PAGE.replace(ROWS, ROWS * 4)
+    path = tmp_path / "large.html"
+    path.write_text(large_page, encoding="utf-8")
+
+    tracemalloc.start()
+    try:
+        subtree = StreamingSubtreeExtractor(chunk_size=4096).extract(str(path), "needle value", 2)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert subtree.startswith("<tr>")
+    assert peak < len(large_page) / 5
+
+
+def test_manager_streams_local_files(page_path):
+    manager = HtmlManager(page_path, "file", "Needle Value", streaming=True)
+    processed = manager.process_html()
+    assert "Needle Value" in processed
+    assert manager.html is None  # The scraper reads the file itself
@@ -0,0 +1,115 @@
+"""test_tracing.py: Tests for the pipeline spans and their exporters."""
+import asyncio
+import json
+import os
+import urllib.request
+
+import pytest
+
+from instrumentation import tracing
+from instrumentation.tracing import JsonLinesExporter, PrometheusExporter, Tracer
+from website_analysis.dom_analysis import HtmlManager
+
+DENVER = os.path.join(os.path.dirname(os.path.dirname(__file__)), "results", "denver.html")
+
+
+class CollectingExporter:
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+    def close(self):
+        pass
+
+
+def test_spans_nest_and_share_the_trace():
+    exporter = CollectingExporter()
+    tracer = Tracer([exporter])
+    with tracer.span("scrape_page") as root:
+        with tracer.span("load") as child:
+            tracer.current_span().add("bytes_fetched", 10)
+            tracer.current_span().add("bytes_fetched", 5)
+
+    assert [span.name for span in exporter.spans] == ["load", "scrape_page"]
+    assert child.parent_id == root.span_id and root.parent_id is None
+    assert child.trace_id == root.trace_id
+    assert child.attributes == {"bytes_fetched": 15}
+    assert root.duration >= child.duration
+
+
+def test_failed_spans_record_the_error():
+    exporter = CollectingExporter()
+    tracer = Tracer([exporter])
+    with pytest.raises(ValueError):
+        with tracer.span("execute"):
+            raise ValueError("boom")
+    assert exporter.spans[0].error == "ValueError: boom"
+
+
+def test_concurrent_tasks_get_separate_traces():
+    tracer = Tracer([CollectingExporter()])
+
+    async def page():
+        with tracer.span("scrape_page") as root:
+            await asyncio.sleep(0.01)
+            with tracer.span("load") as child:
+                return root.trace_id, child.trace_id
+
+    async def main():
+        return await asyncio.gather(page(), page())
+
+    (root_a, child_a), (root_b, child_b) = asyncio.run(main())
+    assert root_a == child_a and root_b == child_b and root_a != root_b
+
+
+def test_spans_outside_a_span_are_ignored():
+    span = Tracer().current_span()
+    span.set("bytes_fetched", 1)
+    assert span.attributes == {}
+
+
+def test_json_lines_exporter_appends_every_span(tmp_path):
+    path = str(tmp_path / "metrics.jsonl")
+    tracer = Tracer([JsonLinesExporter(path)])
+    with tracer.span("process_html", html_chars_before=100):
+        pass
+    tracer.close()
+
+    with open(path) as file:
+        records = [json.loads(line) for line in file]
+    assert records[0]["name"] == "process_html"
+    assert records[0]["attributes"] == {"html_chars_before": 100}
+    assert records[0]["duration"] >= 0
+
+
+def test_prometheus_endpoint_aggregates_per_stage():
+    exporter = PrometheusExporter(port=0)
+    tracer = Tracer([exporter])
+    try:
+        for tokens in (100, 50):
+            with tracer.span("process_html", html_tokens_after=tokens):
+                pass
+        with urllib.request.urlopen(f"http://127.0.0.1:{exporter.port}/metrics") as response:
+            body = response.read().decode("utf-8")
+    finally:
+        tracer.close()
+
+    assert 'scraper_stage_total{stage="process_html"} 2' in body
+    assert 'scraper_stage_html_tokens_after_sum{stage="process_html"} 150' in body
+    assert 'scraper_stage_seconds_sum{stage="process_html"}' in body
+
+
+def test_pipeline_stages_report_sizes(monkeypatch):
+    exporter = CollectingExporter()
+    monkeypatch.setattr(tracing, "_tracer", Tracer([exporter]))
+    with tracing.get_tracer().span("scrape_page"):
+        HtmlManager(DENVER, "file", "February").process_html()
+
+    spans = {span.name: span for span in exporter.spans}
+    assert spans["load"].attributes["bytes_fetched"] == os.path.getsize(DENVER)
+    process = spans["process_html"].attributes
+    assert process["html_chars_before"] > process["html_chars_after"] > 0
+    assert process["html_tokens_after"] > 0
+    assert spans["process_html"].parent_id == spans["scrape_page"].span_id
@@ -0,0 +1,295 @@
+"""api_clustering.py: Group captured API calls by endpoint and summarize each group.
+
+This module is a part of the Website Structure Analysis component.
+A site calls the same few endpoints over and over, with different IDs, cursors and
+timestamps. Calls are grouped by a template of their URL, in which IDs in the path and
+the values of volatile query parameters are replaced by placeholders, and the JSON
+bodies of a group are merged into one schema. The LLM then sees one compact
+representative per endpoint instead of every call.
+"""
+import json
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Optional
+from urllib.parse import parse_qsl, urlsplit
+
+# Query parameters whose values change from call to call without selecting another resource
+VOLATILE_PARAMETERS = {
+    "_", "after", "before", "cb", "cursor", "limit", "nonce", "offset", "page", "page_size",
+    "pagesize", "per_page", "rand", "random", "session", "sid", "sig", "signature", "since",
+    "skip", "start", "t", "timestamp", "token", "ts", "until", "v",
+}
+
+UUID = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$", re.IGNORECASE)
+HEX = re.compile(r"^[0-9a-f]{16,}$", re.IGNORECASE)
+NUMBER = re.compile(r"^-?\d+(\.\d+)?$")
+# Slugs that end in an ID, such as concert-in-london-1234567
+SLUG_ID = re.compile(r"^[\w.-]*\d{4,}$")
+
+
+def placeholder(value: str) -> Optional[str]:
+    """
+    Return the placeholder of a path segment or query value that is an identifier.
+
+    :param value: A path segment or query value
+    :return: {n}, {uuid} or {hex}, or None if the value does not look like an identifier
+    """
+    if NUMBER.match(value):
+        return "{n}"
+    if UUID.match(value):
+        return "{uuid}"
+    if HEX.match(value) and re.search(r"\d", value):
+        return "{hex}"
+    if SLUG_ID.match(value):
+        return "{n}"
+    return None
+
+
+def url_template(url: str) -> str:
+    """
+    Return the template of a URL, shared by all calls of the same endpoint.
+
+    IDs in the path become placeholders and query parameters are sorted by name. Volatile
+    parameters and parameters with ID values keep only their name and a placeholder.
+
+    :param url: An absolute URL
+    :return: The template, such as api.example/events/{n}?cursor={value}&type=club
+    """
+    parts = urlsplit(url)
+    path = "/".join(placeholder(segment) or segment for segment in parts.path.split("/")) or "/"
+    query = []
+    for name, value in sorted(parse_qsl(parts.query, keep_blank_values=True)):
+        if name.lower() in VOLATILE_PARAMETERS:
+            value = "{value}"
+        else:
+            value = placeholder(value) or value
+        if f"{name}={value}" not in query:
+            query.append(f"{name}={value}")
+    template = (parts.netloc or "").lower() + path
+    return f"{template}?{'&'.join(query)}" if query else template
+
+
+def parse_json(text) -> Optional[object]:
+    """
+    Return the parsed JSON of a body, or None if it is not JSON.
+
+    :param text: A body as bytes, str, or an already parsed value
+    :return: The parsed value, or None
+    """
+    if text is None or isinstance(text, (dict, list)):
+        return text
+    if isinstance(text, bytes):
+        text = text.decode("utf-8", errors="replace")
+    try:
+        return json.loads(text)
+    except ValueError:
+        return None
+
+
+class Schema:
+    """The merged shape of many JSON values, with the share of objects each key occurs in."""
+
+    # Objects with more keys, e.g. maps keyed by ID, are summarized by their values
+    MAX_PROPERTIES = 40
+
+    def __init__(self):
+        self.types = set()
+        self.objects = 0
+        self.properties: Dict[str, "Schema"] = {}
+        self.present = Counter()
+        self.items = None
+
+    def add(self, value) -> "Schema":
+        """
+        Merge a JSON value into the schema.
+
+        :param value: A parsed JSON value
+        :return: The schema itself
+        """
+        if value is None:
+            self.types.add("null")
+        elif isinstance(value, bool):
+            self.types.add("boolean")
+        elif isinstance(value, int):
+            self.types.add("integer")
+        elif isinstance(value, float):
+            self.types.add("number")
+        elif isinstance(value, str):
+            self.types.add("string")
+        elif isinstance(value, list):
+            self.types.add("array")
+            if self.items is None:
+                self.items = Schema()
+            for item in value:
+                self.items.add(item)
+        elif isinstance(value, dict):
+            self.types.add("object")
+            self.objects += 1
+            for key, item in value.items():
+                self.properties.setdefault(key, Schema()).add(item)
+                self.present[key] += 1
+        return self
+
+    def to_dict(self):
+        """
+        Return a compact notation of the schema.
+
+        Scalars are type names such as "integer|null", objects are dicts of their keys,
+        with a "?" after keys missing from some objects, and arrays are a list holding
+        the schema of their items.
+
+        :return: The schema as a JSON-serializable value
+        """
+        alternatives = [name for name in ("string", "integer", "number", "boolean", "null") if name in self.types]
+        if "number" in alternatives and "integer" in alternatives:
+            alternatives.remove("integer")
+        shapes = []
+        if "object" in self.types:
+            shapes.append(self._object())
+        if "array" in self.types:
+            shapes.append([self.items.to_dict()] if self.items is not None and self.items.types else [])
+        if not shapes:
+            return "|".join(alternatives) or "unknown"
+        if alternatives or len(shapes) > 1:
+            return {"oneOf": shapes + ["|".join(alternatives)] if alternatives else shapes}
+        return shapes[0]
+
+    def _object(self):
+        if len(self.properties) > self.MAX_PROPERTIES:
+            values = Schema()
+            for schema in self.properties.values():
+                values._merge(schema)
+            return {"{key}": values.to_dict()}
+        return {
+            key + ("" if self.present[key] == self.objects else "?"): schema.to_dict()
+            for key, schema in self.properties.items()
+        }
+
+    def _merge(self, other):
+        self.types |= other.types
+        self.objects += other.objects
+        self.present.update(other.present)
+        for key, schema in other.properties.items():
+            self.properties.setdefault(key, Schema())._merge(schema)
+        if other.items is not None:
+            if self.items is None:
+                self.items = Schema()
+            self.items._merge(other.items)
+
+
+class ApiCluster:
+    """The calls of one endpoint, with a representative call and the merged schemas of their bodies."""
+
+    # Characters of a request payload that is not JSON kept in the example
+    MAX_PAYLOAD_CHARS = 300
+
+    def __init__(self, method: str, template: str, operation: Optional[str] = None):
+        """
+        Initialize the ApiCluster class.
+
+        :param method: The HTTP method of the calls
+        :param template: The URL template of the calls
+        :param operation: The GraphQL operation name of the calls, if any
+        """
+        self.method = method
+        self.template = template
+        self.operation = operation
+        self.calls = 0
+        self.example = None
+        self.statuses = Counter()
+        self.content_types = Counter()
+        self.request_schema = Schema()
+        self.response_schema = Schema()
+
+    def add(self, call: dict) -> None:
+        """
+        Add a captured call to the cluster.
+
+        :param call: The call, see cluster_api_calls()
+        """
+        self.calls += 1
+        if self.example is None:
+            self.example = call
+        if call.get("status") is not None:
+            self.statuses[call["status"]] += 1
+        if call.get("content_type"):
+            self.content_types[call["content_type"].split(";")[0].strip()] += 1
+        payload = parse_json(call.get("payload"))
+        if payload is not None:
+            self.request_schema.add(payload)
+        response = parse_json(call.get("response"))
+        if response is not None:
+            self.response_schema.add(response)
+
+    def to_dict(self) -> dict:
+        """
+        Return the compact representative of the cluster shown to the LLM.
+
+        :return: A JSON-serializable dict
+        """
+        summary = {"method": self.method, "url": self.template, "calls": self.calls, "example_url": self.example["url"]}
+        if self.operation:
+            summary["operation"] = self.operation
+        if self.request_schema.types:
+            summary["payload_schema"] = self.request_schema.to_dict()
+        elif self.example.get("payload"):
+            payload = self.example["payload"]
+            if isinstance(payload, bytes):
+                payload = payload.decode("utf-8", errors="replace")
+            summary["example_payload"] = payload[:self.MAX_PAYLOAD_CHARS]
+        if self.statuses:
+            summary["status"] = sorted(self.statuses)
+        if self.content_types:
+            summary["content_type"] = self.content_types.most_common(1)[0][0]
+        if self.response_schema.types:
+            summary["response_schema"] = self.response_schema.to_dict()
+        return summary
+
+
+def cluster_api_calls(api_calls: Iterable[dict]) -> List[ApiCluster]:
+    """
+    Group captured API calls by endpoint.
+
+    Each call is a dict with a "url" and optionally a "method" (GET by default), the
+    request "payload", the "response" body, its "status" and "content_type", as
+    recorded by ApiDiscoverer or taken from the flow store. GraphQL calls to the same
+    URL are told apart by their operation name.
+
+    :param api_calls: The captured calls
+    :return: The clusters, in the order their first call was made
+    """
+    clusters = {}
+    for call in api_calls:
+        method = (call.get("method") or "GET").upper()
+        payload = parse_json(call.get("payload"))
+        operation = payload.get("operationName") if isinstance(payload, dict) else None
+        key = (method, url_template(call["url"]), operation)
+        if key not in clusters:
+            clusters[key] = ApiCluster(*key)
+        clusters[key].add(call)
+    return list(clusters.values())
+
+
+def chunk_summaries(clusters: List[ApiCluster], max_tokens: int, count_tokens) -> List[List[dict]]:
+    """
+    Split the representatives of the clusters into chunks that fit a token budget.
+
+    A single representative larger than the budget gets a chunk of its own.
+
+    :param clusters: The clusters
+    :param max_tokens: Token budget of the representatives in one chunk
+    :param count_tokens: Function returning the number of tokens of a string
+    :return: The representatives, chunk by chunk
+    """
+    chunks, chunk, used = [], [], 0
+    for cluster in clusters:
+        summary = cluster.to_dict()
+        tokens = count_tokens(json.dumps(summary, separators=(",", ":")))
+        if chunk and used + tokens > max_tokens:
+            chunks.append(chunk)
+            chunk, used = [], 0
+        chunk.append(summary)
+        used += tokens
+    if chunk:
+        chunks.append(chunk)
+    return chunks
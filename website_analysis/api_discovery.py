@@ -0,0 +1,322 @@
+"""api_discovery.py: A module for discovering the API endpoints a web page calls.
+
+This module is a part of the Website Structure Analysis component.
+It loads a page in a headless browser whose XMLHttpRequest and fetch are instrumented
+before any script of the page runs. The hooks count the requests in flight, so the page
+counts as loaded once nothing has been in flight for a quiet period, instead of after a
+fixed sleep. The page is then scrolled as long as scrolling triggers new requests, to
+catch the endpoints of infinite scrolling. Every endpoint is reported with its method,
+payload and response content type.
+"""
+import argparse
+from typing import Dict, Iterable, List, Optional
+from urllib.parse import urldefrag
+
+from website_analysis.parser_backends import _importable
+
+# Installed on every new document before the scripts of the page run
+INSTRUMENTATION_SCRIPT = """
+(function () {
+  if (window.__scraperNetwork) return;
+  var network = window.__scraperNetwork = {inflight: 0, lastActivity: Date.now(), requests: [], listeners: []};
+
+  function changed() {
+    network.lastActivity = Date.now();
+    network.listeners.slice().forEach(function (listener) { listener(); });
+  }
+  function started(record) {
+    network.requests.push(record);
+    network.inflight += 1;
+    changed();
+  }
+  function finished(record, status, contentType) {
+    record.status = status;
+    record.content_type = contentType;
+    network.inflight -= 1;
+    changed();
+  }
+  function serialize(body) {
+    if (body === undefined || body === null) return null;
+    if (typeof body === 'string') return body;
+    if (body instanceof URLSearchParams) return body.toString();
+    if (typeof FormData !== 'undefined' && body instanceof FormData) {
+      return new URLSearchParams(Array.from(body.entries()).filter(function (entry) {
+        return typeof entry[1] === 'string';
+      })).toString();
+    }
+    try { return JSON.stringify(body); } catch (error) { return String(body); }
+  }
+
+  var open = XMLHttpRequest.prototype.open, send = XMLHttpRequest.prototype.send;
+  XMLHttpRequest.prototype.open = function (method, url) {
+    this.__scraperRecord = {method: String(method).toUpperCase(), url: new URL(url, location.href).href};
+    return open.apply(this, arguments);
+  };
+  XMLHttpRequest.prototype.send = function (body) {
+    var record = this.__scraperRecord;
+    if (record) {
+      record.payload = serialize(body);
+      started(record);
+      this.addEventListener('loadend', function () {
+        finished(record, this.status, this.getResponseHeader('Content-Type'));
+      });
+    }
+    return send.apply(this, arguments);
+  };
+
+  var fetch = window.fetch;
+  window.fetch = function (input, init) {
+    var request = input instanceof Request ? input : null;
+    var record = {
+      method: String((init && init.method) || (request && request.method) || 'GET').toUpperCase(),
+      url: new URL(request ? request.url : String(input), location.href).href,
+      payload: serialize(init && init.body)
+    };
+    started(record);
+    return fetch.apply(this, arguments).then(function (response) {
+      finished(record, response.status, response.headers.get('Content-Type'));
+      return response;
+    }, function (error) {
+      finished(record, 0, null);
+      throw error;
+    });
+  };
+})();
+"""
+
+# Resolves once no request has been in flight for the quiet period, re-checked on every hook event
+WAIT_FOR_IDLE_SCRIPT = """
+var quiet = arguments[0], timeout = arguments[1], done = arguments[arguments.length - 1];
+var network = window.__scraperNetwork;
+if (!network) { done(true); return; }
+var timer = null, deadline = null;
+function finish(idle) {
+  clearTimeout(timer);
+  clearTimeout(deadline);
+  network.listeners.splice(network.listeners.indexOf(check), 1);
+  done(idle);
+}
+function check() {
+  clearTimeout(timer);
+  if (network.inflight === 0) {
+    timer = setTimeout(function () { finish(true); }, Math.max(0, quiet - (Date.now() - network.lastActivity)));
+  }
+}
+network.listeners.push(check);
+deadline = setTimeout(function () { finish(false); }, timeout);
+check();
+"""
+
+
+class ApiEndpoint:
+    """An endpoint requested by a page through XMLHttpRequest or fetch."""
+
+    def __init__(
+        self,
+        url: str,
+        method: str = "GET",
+        payload: Optional[str] = None,
+        content_type: Optional[str] = None,
+        status: Optional[int] = None,
+    ):
+        """
+        Initialize the ApiEndpoint class.
+
+        :param url: The absolute URL of the request
+        :param method: The HTTP method, defaults to GET
+        :param payload: The request body, None if there was none
+        :param content_type: The Content-Type of the response, None if it did not arrive
+        :param status: The HTTP status of the response, 0 if the request failed
+        """
+        self.url = url
+        self.method = method
+        self.payload = payload
+        self.content_type = content_type
+        self.status = status
+
+    @property
+    def is_json(self) -> bool:
+        """Return True if the endpoint answers with JSON, the easiest kind to scrape."""
+        return "json" in (self.content_type or "").lower()
+
+    def to_dict(self) -> dict:
+        return {
+            "url": self.url,
+            "method": self.method,
+            "payload": self.payload,
+            "content_type": self.content_type,
+            "status": self.status,
+        }
+
+    def __repr__(self):
+        return f"ApiEndpoint({self.method} {self.url}, {self.content_type})"
+
+
+def collect_endpoints(records: Iterable[Dict]) -> List[ApiEndpoint]:
+    """
+    Turn the requests recorded by the instrumentation into endpoints.
+
+    Requests with the same method, URL and payload are reported once, in the order
+    of their first occurrence.
+
+    :param records: Dicts with url, method, payload, content_type and status
+    :return: A list of ApiEndpoint objects
+    """
+    endpoints = {}
+    for record in records:
+        url = urldefrag(record["url"])[0]
+        key = (record.get("method") or "GET", url, record.get("payload"))
+        if key not in endpoints:
+            endpoints[key] = ApiEndpoint(url, key[0], key[2], record.get("content_type"), record.get("status"))
+        elif endpoints[key].content_type is None:
+            # A later identical request may have been answered where the first was not yet
+            endpoints[key].content_type = record.get("content_type")
+            endpoints[key].status = record.get("status")
+    return list(endpoints.values())
+
+
+def create_driver(headless: bool = True):
+    """
+    Create a Chrome WebDriver.
+
+    :param headless: Run Chrome without a window, defaults to True
+    :return: The WebDriver
+    :raises ValueError: If selenium is not installed
+    """
+    if not _importable("selenium"):
+        raise ValueError("API discovery needs selenium, install it with pip install selenium")
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+    from selenium.webdriver.chrome.service import Service
+
+    chrome_options = Options()
+    for argument in ("--disable-infobars", "--no-sandbox", "--disable-dev-shm-usage", "--disable-gpu"):
+        chrome_options.add_argument(argument)
+    if headless:
+        chrome_options.add_argument("--headless")
+    if _importable("webdriver_manager"):
+        from webdriver_manager.chrome import ChromeDriverManager
+
+        service = Service(executable_path=ChromeDriverManager().install())
+    else:  # Selenium 4.6+ finds or downloads the driver itself
+        service = Service()
+    return webdriver.Chrome(service=service, options=chrome_options)
+
+
+class ApiDiscoverer:
+    """Find the API endpoints a page requests while it loads and while it is scrolled."""
+
+    def __init__(self, driver=None, quiet_period: float = 0.5, timeout: float = 15, max_scrolls: int = 10):
+        """
+        Initialize the ApiDiscoverer class.
+
+        :param driver: A Chrome WebDriver, defaults to a headless one created on first use
+        :param quiet_period: Seconds without a request in flight after which the network counts as idle, defaults to 0.5
+        :param timeout: Maximum seconds to wait for the network to become idle, defaults to 15
+        :param max_scrolls: Maximum number of scrolls to the bottom of the page, defaults to 10
+        """
+        self._driver = driver
+        self._owns_driver = driver is None
+        self._instrumented = False
+        self.quiet_period = quiet_period
+        self.timeout = timeout
+        self.max_scrolls = max_scrolls
+
+    @property
+    def driver(self):
+        if self._driver is None:
+            self._driver = create_driver()
+        return self._driver
+
+    def discover(self, url: str) -> List[ApiEndpoint]:
+        """
+        Load the page, scroll it while that triggers requests, and return the endpoints it called.
+
+        :param url: The URL of the page
+        :return: The endpoints in the order they were first requested
+        """
+        self.instrument()
+        self.driver.get(url)
+        if not self._instrumented:
+            # Without the DevTools protocol the hooks only see requests made after the load
+            self.driver.execute_script(INSTRUMENTATION_SCRIPT)
+        self.wait_for_network_idle()
+        self.scroll_while_requesting()
+        return collect_endpoints(self.driver.execute_script("return window.__scraperNetwork.requests;"))
+
+    def instrument(self) -> None:
+        """Install the hooks into every document the browser loads from now on."""
+        if self._instrumented:
+            return
+        try:
+            self.driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {"source": INSTRUMENTATION_SCRIPT})
+            self._instrumented = True
+        except Exception:  # Drivers other than Chrome's do not speak the DevTools protocol
+            self._instrumented = False
+
+    def wait_for_network_idle(self) -> bool:
+        """
+        Wait until no request has been in flight for the quiet period.
+
+        :return: True if the network became idle, False if the timeout passed first
+        """
+        self.driver.set_script_timeout(self.timeout + 5)
+        return bool(self.driver.execute_async_script(WAIT_FOR_IDLE_SCRIPT, self.quiet_period * 1000, self.timeout * 1000))
+
+    def scroll_while_requesting(self) -> int:
+        """
+        Scroll to the bottom of the page until a scroll triggers no new request.
+
+        :return: The number of scrolls
+        """
+        for scrolls in range(self.max_scrolls):
+            before = self._request_count()
+            self.driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
+            self.wait_for_network_idle()
+            if self._request_count() == before:
+                return scrolls + 1
+        return self.max_scrolls
+
+    def _request_count(self):
+        return self.driver.execute_script("return window.__scraperNetwork ? window.__scraperNetwork.requests.length : 0;")
+
+    def close(self) -> None:
+        """Quit the browser if it was created by the discoverer."""
+        if self._owns_driver and self._driver is not None:
+            self._driver.quit()
+            self._driver = None
+            self._instrumented = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def discover_endpoints(url: str, **options) -> List[ApiEndpoint]:
+    """
+    Return the API endpoints a page calls, using a headless Chrome.
+
+    :param url: The URL of the page
+    :param options: Further arguments of ApiDiscoverer
+    :return: A list of ApiEndpoint objects
+    """
+    with ApiDiscoverer(**options) as discoverer:
+        return discoverer.discover(url)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List the API endpoints a web page calls")
+    parser.add_argument("url", help="The URL of the page")
+    parser.add_argument("--quiet-period", type=float, default=0.5, help="Seconds without requests after which the page counts as loaded")
+    parser.add_argument("--max-scrolls", type=int, default=10, help="Maximum number of scrolls to the bottom of the page")
+    args = parser.parse_args()
+
+    print("API Endpoints:")
+    for endpoint in discover_endpoints(args.url, quiet_period=args.quiet_period, max_scrolls=args.max_scrolls):
+        print(endpoint.method, endpoint.url, endpoint.content_type or "", endpoint.payload or "")
+
+
+if __name__ == "__main__":
+    main()
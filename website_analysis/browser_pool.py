@@ -0,0 +1,468 @@
+"""browser_pool.py: A pool of long-lived headless browsers for loading dynamic pages.
+
+This module is a part of the Website Structure Analysis component.
+Starting Chrome takes longer than loading most pages, so the browsers are started once
+and kept: every page is loaded in a tab of an isolated browser context, and tabs are
+reused for later pages. Each browser is driven directly over the DevTools protocol on a
+debugging port of its own choosing, so any number of pools can run side by side. A
+browser runs at most a fixed number of tabs at once, is health-checked before it is
+used, and is replaced by a fresh one after a number of pages, so leaks and crashes
+do not accumulate.
+
+The pool runs its own event loop in a background thread, so the synchronous loaders
+and scrapers can share it.
+"""
+import asyncio
+import atexit
+import contextlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from typing import List, Optional
+
+import aiohttp
+
+from website_analysis.api_discovery import INSTRUMENTATION_SCRIPT, WAIT_FOR_IDLE_SCRIPT
+
+CHROME_ENV = "SCRAPER_CHROME"
+BROWSERS_ENV = "SCRAPER_BROWSERS"
+CONTEXTS_ENV = "SCRAPER_BROWSER_CONTEXTS"
+RECYCLE_ENV = "SCRAPER_BROWSER_RECYCLE_AFTER"
+CHROME_NAMES = ("google-chrome", "google-chrome-stable", "chromium", "chromium-browser", "chrome")
+
+_shared_pools = {}
+_shared_lock = threading.Lock()
+
+
+class BrowserError(RuntimeError):
+    """Raised when a browser cannot be started or fails to load a page."""
+
+
+def configure_env(size: int, max_contexts: int, recycle_after: int, environ=None) -> None:
+    """
+    Export the pool settings so the loaders of this process and of child processes share them.
+
+    :param size: Maximum number of browsers
+    :param max_contexts: Maximum number of pages a browser loads at the same time
+    :param recycle_after: Number of pages after which a browser is replaced
+    :param environ: The environment mapping to update, defaults to os.environ
+    """
+    environ = os.environ if environ is None else environ
+    environ[BROWSERS_ENV] = str(size)
+    environ[CONTEXTS_ENV] = str(max_contexts)
+    environ[RECYCLE_ENV] = str(recycle_after)
+
+
+def find_chrome() -> Optional[str]:
+    """
+    Return the Chrome executable named by SCRAPER_CHROME, or the first one on the PATH.
+
+    :return: The path of the executable, or None if there is none
+    """
+    if os.environ.get(CHROME_ENV):
+        return os.environ[CHROME_ENV]
+    return next(filter(None, map(shutil.which, CHROME_NAMES)), None)
+
+
+class _DevToolsConnection:
+    # A DevTools websocket; commands of all tabs share it, told apart by their session id
+
+    def __init__(self, session, websocket):
+        self._session = session
+        self._websocket = websocket
+        self._next_id = 0
+        self._pending = {}
+        self._waiters = {}
+        self._reader = asyncio.ensure_future(self._read())
+
+    @classmethod
+    async def connect(cls, url):
+        session = aiohttp.ClientSession()
+        try:
+            websocket = await session.ws_connect(url, max_msg_size=0)
+        except BaseException:
+            await session.close()
+            raise
+        return cls(session, websocket)
+
+    @property
+    def closed(self):
+        return self._reader.done()
+
+    async def send(self, method, params=None, session_id=None, timeout=30):
+        self._next_id += 1
+        message = {"id": self._next_id, "method": method, "params": params or {}}
+        if session_id is not None:
+            message["sessionId"] = session_id
+        future = asyncio.get_running_loop().create_future()
+        self._pending[message["id"]] = future
+        try:
+            await self._websocket.send_str(json.dumps(message))
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._pending.pop(message["id"], None)
+
+    def expect(self, method, session_id=None):
+        # Registered before the command that causes the event, so the event cannot be missed
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault((session_id, method), []).append(future)
+        return future
+
+    async def close(self):
+        self._reader.cancel()
+        await self._websocket.close()
+        await self._session.close()
+
+    async def _read(self):
+        try:
+            async for message in self._websocket:
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                data = json.loads(message.data)
+                if "id" in data:
+                    future = self._pending.get(data["id"])
+                    if future is None or future.done():
+                        continue
+                    if "error" in data:
+                        future.set_exception(BrowserError(data["error"].get("message", "DevTools error")))
+                    else:
+                        future.set_result(data.get("result", {}))
+                else:
+                    for future in self._waiters.pop((data.get("sessionId"), data.get("method")), []):
+                        if not future.done():
+                            future.set_result(data.get("params", {}))
+        finally:
+            error = BrowserError("The connection to the browser was closed")
+            waiting = list(self._pending.values()) + [future for futures in self._waiters.values() for future in futures]
+            for future in waiting:
+                if not future.done():
+                    future.set_exception(error)
+            self._waiters.clear()
+
+
+class _Tab:
+    # A page target in a browser context of its own, attached to the connection
+    def __init__(self, context_id, target_id, session_id):
+        self.context_id = context_id
+        self.target_id = target_id
+        self.session_id = session_id
+
+
+class BrowserWorker:
+    """One headless Chrome process, loading pages in reused tabs."""
+
+    def __init__(self, binary: str, max_contexts: int = 4, quiet_period: float = 0.5, arguments: tuple = ()):
+        """
+        Initialize the BrowserWorker class.
+
+        :param binary: The Chrome executable
+        :param max_contexts: Maximum number of pages loaded at the same time, defaults to 4
+        :param quiet_period: Seconds without XHR or fetch request in flight after which a
+            loaded page counts as rendered, defaults to 0.5
+        :param arguments: Further command-line arguments of Chrome
+        """
+        self.binary = binary
+        self.max_contexts = max_contexts
+        self.quiet_period = quiet_period
+        self.arguments = tuple(arguments)
+        self.process = None
+        self.connection = None
+        self.port = None
+        self.pages = 0
+        self.active = 0
+        self.retiring = False
+        self.checked_at = 0.0
+        self._tabs: List[_Tab] = []
+        self._slots = None
+        self._user_data_dir = None
+
+    async def start(self, timeout: float = 30) -> None:
+        """
+        Launch the browser and connect to its debugging port.
+
+        :param timeout: Seconds to wait for the browser to open its debugging port, defaults to 30
+        :raises BrowserError: If the browser exits or does not open the port in time
+        """
+        self._user_data_dir = tempfile.mkdtemp(prefix="scraper-chrome-")
+        arguments = [
+            self.binary,
+            "--headless=new",
+            # Chrome picks a free port and writes it to DevToolsActivePort
+            "--remote-debugging-port=0",
+            f"--user-data-dir={self._user_data_dir}",
+            "--no-first-run",
+            "--no-default-browser-check",
+            "--disable-gpu",
+            "--disable-dev-shm-usage",
+            "--disable-extensions",
+            "--mute-audio",
+            *self.arguments,
+            "about:blank",
+        ]
+        if hasattr(os, "geteuid") and os.geteuid() == 0:
+            # Chrome refuses to start its sandbox as root, e.g. in containers
+            arguments.insert(1, "--no-sandbox")
+        self.process = await asyncio.create_subprocess_exec(
+            *arguments, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+
+        port_file = os.path.join(self._user_data_dir, "DevToolsActivePort")
+        deadline = time.monotonic() + timeout
+        while True:
+            lines = []
+            if os.path.exists(port_file):
+                with open(port_file, "r") as file:
+                    lines = file.read().split()
+            if len(lines) >= 2:
+                break
+            if self.process.returncode is not None:
+                raise BrowserError(f"{self.binary} exited with status {self.process.returncode}")
+            if time.monotonic() > deadline:
+                await self.close()
+                raise BrowserError(f"{self.binary} did not open a debugging port within {timeout} seconds")
+            await asyncio.sleep(0.05)
+
+        self.port = int(lines[0])
+        self.connection = await _DevToolsConnection.connect(f"ws://127.0.0.1:{self.port}{lines[1]}")
+        self._slots = asyncio.Semaphore(self.max_contexts)
+        self.checked_at = time.monotonic()
+
+    async def healthy(self, timeout: float = 5) -> bool:
+        """
+        Check that the browser is running and answers over its debugging port.
+
+        :param timeout: Seconds to wait for the answer, defaults to 5
+        :return: True if the browser is usable
+        """
+        if self.process is None or self.process.returncode is not None or self.connection is None or self.connection.closed:
+            return False
+        try:
+            await self.connection.send("Browser.getVersion", timeout=timeout)
+        except (BrowserError, asyncio.TimeoutError):
+            return False
+        self.checked_at = time.monotonic()
+        return True
+
+    async def load(self, url: str, timeout: float = 30) -> str:
+        """
+        Load a page in a free tab and return its HTML once it has been rendered.
+
+        :param url: The URL of the page
+        :param timeout: Seconds to wait for the page, defaults to 30
+        :return: The HTML of the rendered document
+        :raises BrowserError: If the page cannot be loaded
+        """
+        async with self._slots:
+            self.active += 1
+            try:
+                tab = self._tabs.pop() if self._tabs else await self._open_tab()
+                try:
+                    html = await self._navigate(tab, url, timeout)
+                except BaseException:
+                    # A tab in an unknown state is closed rather than reused
+                    with contextlib.suppress(Exception):
+                        await self._close_tab(tab)
+                    raise
+                self._tabs.append(tab)
+                return html
+            finally:
+                self.active -= 1
+                self.pages += 1
+
+    async def close(self) -> None:
+        """Close the browser and remove its profile."""
+        if self.connection is not None and not self.connection.closed:
+            with contextlib.suppress(Exception):
+                await self.connection.send("Browser.close", timeout=5)
+        if self.connection is not None:
+            await self.connection.close()
+        if self.process is not None and self.process.returncode is None:
+            with contextlib.suppress(ProcessLookupError):
+                self.process.terminate()
+            try:
+                await asyncio.wait_for(self.process.wait(), 5)
+            except asyncio.TimeoutError:
+                self.process.kill()
+                await self.process.wait()
+        if self._user_data_dir is not None:
+            shutil.rmtree(self._user_data_dir, ignore_errors=True)
+
+    async def _open_tab(self):
+        send = self.connection.send
+        context_id = (await send("Target.createBrowserContext"))["browserContextId"]
+        target_id = (await send("Target.createTarget", {"url": "about:blank", "browserContextId": context_id}))["targetId"]
+        session_id = (await send("Target.attachToTarget", {"targetId": target_id, "flatten": True}))["sessionId"]
+        await send("Page.enable", session_id=session_id)
+        # Counts the requests of the page, to know when it has finished rendering
+        await send("Page.addScriptToEvaluateOnNewDocument", {"source": INSTRUMENTATION_SCRIPT}, session_id=session_id)
+        return _Tab(context_id, target_id, session_id)
+
+    async def _navigate(self, tab, url, timeout):
+        send = self.connection.send
+        loaded = self.connection.expect("Page.loadEventFired", tab.session_id)
+        result = await send("Page.navigate", {"url": url}, session_id=tab.session_id, timeout=timeout)
+        if result.get("errorText"):
+            loaded.cancel()
+            raise BrowserError(f"Could not load {url}: {result['errorText']}")
+        await asyncio.wait_for(loaded, timeout)
+
+        # Wait until the requests the scripts of the page make have settled
+        wait_for_idle = (
+            "new Promise(function (done) { (function () {" + WAIT_FOR_IDLE_SCRIPT + "})"
+            f"({self.quiet_period * 1000}, {timeout * 1000}, done); }})"
+        )
+        await send("Runtime.evaluate", {"expression": wait_for_idle, "awaitPromise": True}, session_id=tab.session_id, timeout=timeout + 5)
+        document = await send(
+            "Runtime.evaluate",
+            {"expression": "document.documentElement ? document.documentElement.outerHTML : ''", "returnByValue": True},
+            session_id=tab.session_id,
+            timeout=timeout,
+        )
+        return document["result"].get("value", "")
+
+    async def _close_tab(self, tab):
+        await self.connection.send("Target.closeTarget", {"targetId": tab.target_id}, timeout=5)
+        await self.connection.send("Target.disposeBrowserContext", {"browserContextId": tab.context_id}, timeout=5)
+
+
+class BrowserPool:
+    """Headless browsers kept running to load dynamic pages, shared by the loaders of a process."""
+
+    def __init__(
+        self,
+        size: int = 2,
+        max_contexts: int = 4,
+        recycle_after: int = 100,
+        binary: Optional[str] = None,
+        page_timeout: float = 30,
+        quiet_period: float = 0.5,
+        health_check_interval: float = 30,
+    ):
+        """
+        Initialize the BrowserPool class. Browsers are started when they are first needed.
+
+        :param size: Maximum number of browsers, defaults to 2
+        :param max_contexts: Maximum number of pages a browser loads at the same time, defaults to 4
+        :param recycle_after: Number of pages after which a browser is replaced, defaults to 100
+        :param binary: The Chrome executable, defaults to $SCRAPER_CHROME or the first Chrome on the PATH
+        :param page_timeout: Seconds to wait for a page, defaults to 30
+        :param quiet_period: Seconds without XHR or fetch request after which a page counts as rendered, defaults to 0.5
+        :param health_check_interval: Seconds after which an idle browser is checked again before use, defaults to 30
+        :raises ValueError: If no Chrome executable is found
+        """
+        self.binary = binary or find_chrome()
+        if not self.binary:
+            raise ValueError(f"No Chrome or Chromium found, install one or set {CHROME_ENV} to its path")
+        self.size = size
+        self.max_contexts = max_contexts
+        self.recycle_after = recycle_after
+        self.page_timeout = page_timeout
+        self.quiet_period = quiet_period
+        self.health_check_interval = health_check_interval
+        self.workers: List[BrowserWorker] = []
+        self.started = 0
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._workers_lock = None
+
+    @classmethod
+    def from_env(cls) -> "BrowserPool":
+        """
+        Return the pool configured through the environment, or with the default settings.
+
+        Instances are shared per settings within a process, and closed when it exits.
+
+        :return: The shared BrowserPool
+        :raises ValueError: If no Chrome executable is found
+        """
+        key = (
+            find_chrome(),
+            int(os.environ.get(BROWSERS_ENV, 2)),
+            int(os.environ.get(CONTEXTS_ENV, 4)),
+            int(os.environ.get(RECYCLE_ENV, 100)),
+        )
+        with _shared_lock:
+            if key not in _shared_pools:
+                pool = cls(size=key[1], max_contexts=key[2], recycle_after=key[3], binary=key[0])
+                atexit.register(pool.close)
+                _shared_pools[key] = pool
+            return _shared_pools[key]
+
+    def load(self, url: str) -> str:
+        """
+        Load a page in one of the browsers and return its rendered HTML.
+
+        :param url: The URL of the page
+        :return: The HTML of the rendered document
+        :raises BrowserError: If the page cannot be loaded
+        """
+        return asyncio.run_coroutine_threadsafe(self._load(url), self._event_loop()).result()
+
+    def close(self) -> None:
+        """Close all browsers and stop the event loop of the pool."""
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = self._thread = None
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._close_workers(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _event_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name="browser-pool", daemon=True)
+                self._thread.start()
+            return self._loop
+
+    async def _load(self, url):
+        worker = await self._worker()
+        try:
+            return await worker.load(url, self.page_timeout)
+        finally:
+            if worker.pages >= self.recycle_after and not worker.retiring:
+                # Replaced by a fresh browser for the next pages, closed once its last page is done
+                worker.retiring = True
+                self.workers.remove(worker)
+            if worker.retiring and worker.active == 0:
+                await worker.close()
+
+    async def _worker(self):
+        if self._workers_lock is None:
+            self._workers_lock = asyncio.Lock()
+        async with self._workers_lock:
+            for worker in list(self.workers):
+                due = time.monotonic() - worker.checked_at > self.health_check_interval
+                broken = worker.process.returncode is not None or worker.connection.closed
+                if broken or (due and worker.active == 0 and not await worker.healthy()):
+                    self.workers.remove(worker)
+                    await worker.close()
+
+            free = [worker for worker in self.workers if worker.active < worker.max_contexts]
+            if not free and len(self.workers) < self.size:
+                worker = BrowserWorker(self.binary, self.max_contexts, self.quiet_period)
+                await worker.start()
+                self.workers.append(worker)
+                self.started += 1
+                return worker
+            # The least busy browser; if all are full, the page waits for a free tab there
+            return min(free or self.workers, key=lambda worker: worker.active)
+
+    async def _close_workers(self):
+        workers, self.workers = self.workers, []
+        for worker in workers:
+            await worker.close()
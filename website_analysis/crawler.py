@@ -0,0 +1,530 @@
+"""crawler.py: A module for crawling listings that span many pages.
+
+This module is a part of the Website Structure Analysis component.
+Starting from seed URLs, the crawler fetches every page with the concurrent fetcher
+and follows the pagination links it finds, plus any other links matching a pattern.
+It stays polite to every host: robots.txt is fetched once per host and honoured,
+connections per host are limited and requests to the same host are spaced out.
+URLs already seen are skipped with a compact set of 64-bit hashes, and the state of
+the crawl can be checkpointed to disk so an interrupted crawl resumes where it stopped.
+"""
+import asyncio
+import bisect
+import hashlib
+import heapq
+import html.parser
+import json
+import os
+import re
+import tempfile
+import threading
+import urllib.robotparser
+from array import array
+from collections import deque
+from typing import AsyncIterator, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import parse_qsl, urldefrag, urlencode, urljoin, urlsplit, urlunsplit
+
+import aiohttp
+
+from website_analysis.fetcher import AsyncHtmlFetcher, FetchedPage
+
+USER_AGENT = "gpt-scraper"
+# Query parameters and path segments that select a page of a listing
+PAGE_PARAMETERS = {"page", "p", "pg", "pagenum", "page_num", "offset", "start", "from", "skip"}
+PAGE_SEGMENT = re.compile(r"/(?:page|p)/\d+/?$")
+NEXT_TEXTS = {"next", "next page", "more", "load more", "older", "older posts", ">", ">>", "›", "»", "→"}
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalize_url(url: str) -> str:
+    """
+    Return the form of a URL used to recognize it as already seen.
+
+    The fragment is dropped, scheme and host are lower-cased, default ports removed
+    and query parameters sorted.
+
+    :param url: An absolute URL
+    :return: The normalized URL
+    """
+    parts = urlsplit(urldefrag(url)[0])
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, host, parts.path or "/", query, ""))
+
+
+def path_template(path: str) -> str:
+    """
+    Return the template of a URL path, with the segments containing digits replaced by {n}.
+
+    :param path: The path of a URL, such as /item/123/reviews
+    :return: The template, such as /item/{n}/reviews
+    """
+    return "/".join("{n}" if re.search(r"\d", segment) else segment for segment in path.split("/")) or "/"
+
+
+def url_pattern(url: str) -> str:
+    """
+    Return the pattern of a URL, shared by the pages of a listing and by detail pages alike.
+
+    Path segments containing digits become {n} and query values are dropped, so
+    https://shop.example/items?page=2 and ?page=3 share the pattern shop.example/items?page.
+
+    :param url: An absolute URL
+    :return: The pattern of the URL
+    """
+    parts = urlsplit(url)
+    names = sorted({name for name, _ in parse_qsl(parts.query, keep_blank_values=True)})
+    pattern = (parts.hostname or "").lower() + path_template(parts.path)
+    return f"{pattern}?{'&'.join(names)}" if names else pattern
+
+
+class SeenUrls:
+    """
+    A set of URLs stored as sorted 64-bit hashes, about 8 bytes per URL.
+
+    New hashes are collected in a small set and merged into the sorted array once it
+    grows, so millions of URLs take megabytes instead of the gigabytes of a set of strings.
+    Two different URLs share a hash with a probability of about n² / 2⁶⁵.
+    """
+
+    def __init__(self, hashes: bytes = b""):
+        """
+        Initialize the SeenUrls class.
+
+        :param hashes: The output of to_bytes() of an earlier set
+        """
+        self._sorted = array("Q")
+        self._sorted.frombytes(hashes)
+        self._recent = set()
+
+    def add(self, url: str) -> bool:
+        """
+        Add a URL to the set.
+
+        :param url: The URL, normalized with normalize_url
+        :return: True if the URL was not in the set before
+        """
+        digest = self._hash(url)
+        if digest in self._recent or self._find(digest):
+            return False
+        self._recent.add(digest)
+        if len(self._recent) > max(4096, len(self._sorted) // 16):
+            self._merge()
+        return True
+
+    def __contains__(self, url: str) -> bool:
+        digest = self._hash(url)
+        return digest in self._recent or self._find(digest)
+
+    def __len__(self) -> int:
+        return len(self._sorted) + len(self._recent)
+
+    def to_bytes(self) -> bytes:
+        """Return the hashes of the set, to be passed to SeenUrls() again."""
+        self._merge()
+        return self._sorted.tobytes()
+
+    def _find(self, digest):
+        index = bisect.bisect_left(self._sorted, digest)
+        return index < len(self._sorted) and self._sorted[index] == digest
+
+    def _merge(self):
+        # Both sides are sorted, so merging streams into the new array without a list in between
+        self._sorted = array("Q", heapq.merge(self._sorted, sorted(self._recent)))
+        self._recent = set()
+
+    @staticmethod
+    def _hash(url):
+        return int.from_bytes(hashlib.blake2b(url.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class CrawlFrontier:
+    """The URLs still to crawl and those already seen, optionally checkpointed to a file."""
+
+    def __init__(self, checkpoint: Optional[str] = None, checkpoint_every: int = 50):
+        """
+        Initialize the CrawlFrontier class, resuming from the checkpoint if it exists.
+
+        :param checkpoint: File the state of the crawl is saved to and resumed from
+        :param checkpoint_every: Number of finished pages after which the state is saved, defaults to 50
+        """
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+        self.queue = deque()
+        self.seen = SeenUrls()
+        self.in_flight = set()
+        self.fetched = 0
+        self._finished_since_save = 0
+        self._lock = threading.Lock()
+        if checkpoint and os.path.exists(checkpoint):
+            self.load()
+
+    def add(self, url: str) -> bool:
+        """
+        Queue a URL unless it has been seen before.
+
+        :param url: An absolute URL
+        :return: True if the URL was queued
+        """
+        with self._lock:
+            if not self.seen.add(normalize_url(url)):
+                return False
+            self.queue.append(url)
+            return True
+
+    def pop(self) -> Optional[str]:
+        """Return the next URL to crawl, or None if the queue is empty."""
+        with self._lock:
+            if not self.queue:
+                return None
+            url = self.queue.popleft()
+            self.in_flight.add(url)
+            self.fetched += 1
+            return url
+
+    def done(self, url: str) -> None:
+        """
+        Mark a URL as finished, so it is not crawled again after a resume.
+
+        :param url: A URL returned by pop()
+        """
+        with self._lock:
+            self.in_flight.discard(url)
+            self._finished_since_save += 1
+            save = self.checkpoint and self._finished_since_save >= self.checkpoint_every
+        if save:
+            self.save()
+
+    def skip(self, url: str) -> None:
+        """
+        Mark a URL as finished without fetching it, so it does not count as a fetched page.
+
+        :param url: A URL returned by pop()
+        """
+        with self._lock:
+            self.fetched -= 1
+        self.done(url)
+
+    def __len__(self) -> int:
+        return len(self.queue) + len(self.in_flight)
+
+    def save(self) -> None:
+        """Write the state to the checkpoint file, replacing the previous one atomically."""
+        if not self.checkpoint:
+            return
+        with self._lock:
+            # URLs handed out but not finished are crawled again after a resume
+            state = {"pending": sorted(self.in_flight) + list(self.queue), "fetched": self.fetched, "in_flight": len(self.in_flight)}
+            hashes = self.seen.to_bytes()
+            self._finished_since_save = 0
+            directory = os.path.dirname(os.path.abspath(self.checkpoint))
+            os.makedirs(directory, exist_ok=True)
+            descriptor, temporary = tempfile.mkstemp(dir=directory, prefix=".checkpoint-")
+            with os.fdopen(descriptor, "wb") as file:
+                # A JSON line with the queue, followed by the hashes of the seen URLs
+                file.write(json.dumps(state).encode("utf-8") + b"\n")
+                file.write(hashes)
+            os.replace(temporary, self.checkpoint)
+
+    def load(self) -> None:
+        """Restore the state from the checkpoint file."""
+        with open(self.checkpoint, "rb") as file:
+            state = json.loads(file.readline())
+            hashes = file.read()
+        with self._lock:
+            self.seen = SeenUrls(hashes)
+            self.queue = deque(state["pending"])
+            self.in_flight = set()
+            # Only the URLs in flight are fetched again, the queued ones were never counted
+            self.fetched = state["fetched"] - state.get("in_flight", 0)
+
+
+class _LinkParser(html.parser.HTMLParser):
+    # Collects (href, rel, text) of every <a> and <link> with an href
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.links = []
+        self._open = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in ("a", "link"):
+            return
+        attributes = dict(attrs)
+        if not attributes.get("href"):
+            return
+        link = [attributes["href"], (attributes.get("rel") or "").lower().split(), []]
+        self.links.append(link)
+        if tag == "a":
+            self._open = link
+
+    def handle_endtag(self, tag):
+        if tag == "a":
+            self._open = None
+
+    def handle_data(self, data):
+        if self._open is not None:
+            self._open[2].append(data)
+
+
+def extract_links(html_text: str, base_url: str) -> List[Tuple[str, List[str], str]]:
+    """
+    Return the links of a page.
+
+    :param html_text: The HTML of the page
+    :param base_url: The URL of the page, relative links are resolved against it
+    :return: A list of (absolute URL without fragment, rel values, link text) tuples
+    """
+    parser = _LinkParser()
+    parser.feed(html_text)
+    parser.close()
+    links = []
+    for href, rel, text in parser.links:
+        url = urldefrag(urljoin(base_url, href.strip()))[0]
+        if urlsplit(url).scheme in ("http", "https"):
+            links.append((url, rel, re.sub(r"\s+", " ", "".join(text)).strip()))
+    return links
+
+
+def is_pagination_link(page_url: str, url: str, rel: Iterable[str] = (), text: str = "") -> bool:
+    """
+    Check whether a link of a page leads to another page of the same listing.
+
+    That is the case for rel="next" or "prev" links, links reading "Next" or "»",
+    and links that only differ from the page in a page number, such as ?page=3 or /page/3.
+
+    :param page_url: The URL of the page holding the link
+    :param url: The absolute URL of the link
+    :param rel: The rel values of the link
+    :param text: The text of the link
+    :return: True if the link is a pagination link
+    """
+    page, link = urlsplit(page_url), urlsplit(url)
+    if (page.scheme, page.netloc) != (link.scheme, link.netloc) or normalize_url(page_url) == normalize_url(url):
+        return False
+    if "next" in rel or "prev" in rel or text.lower() in NEXT_TEXTS:
+        return True
+
+    def listing(parts):
+        # The URL without its page number
+        query = sorted((name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True) if name.lower() not in PAGE_PARAMETERS)
+        return PAGE_SEGMENT.sub("", parts.path).rstrip("/"), query
+
+    numbered = PAGE_SEGMENT.search(link.path) or any(name.lower() in PAGE_PARAMETERS for name, _ in parse_qsl(link.query))
+    return bool(numbered) and listing(page) == listing(link)
+
+
+class RobotsCache:
+    """The robots.txt rules of every host of a crawl, fetched once per host."""
+
+    def __init__(self, user_agent: str = USER_AGENT):
+        """
+        Initialize the RobotsCache class.
+
+        :param user_agent: The user agent the rules are looked up for
+        """
+        self.user_agent = user_agent
+        self._parsers = {}
+        self._locks = {}
+
+    async def allowed(self, session: aiohttp.ClientSession, url: str) -> bool:
+        """
+        Check whether robots.txt of the host allows fetching the URL.
+
+        :param session: The session robots.txt is fetched with on the first URL of a host
+        :param url: The URL to check
+        :return: True if the URL may be fetched
+        """
+        return (await self._parser(session, url)).can_fetch(self.user_agent, url)
+
+    def crawl_delay(self, url: str) -> Optional[float]:
+        """
+        Return the Crawl-delay robots.txt asks for, if it has been fetched and sets one.
+
+        :param url: A URL of the host
+        :return: The delay in seconds, or None
+        """
+        parser = self._parsers.get(self._root(url))
+        delay = parser.crawl_delay(self.user_agent) if parser is not None else None
+        return float(delay) if delay is not None else None
+
+    async def _parser(self, session, url):
+        root = self._root(url)
+        lock = self._locks.setdefault(root, asyncio.Lock())
+        async with lock:
+            # Only the first URL of a host fetches robots.txt, the others wait for it
+            if root not in self._parsers:
+                self._parsers[root] = await self._fetch(session, root + "/robots.txt")
+        return self._parsers[root]
+
+    @staticmethod
+    async def _fetch(session, robots_url):
+        parser = urllib.robotparser.RobotFileParser(robots_url)
+        try:
+            async with session.get(robots_url) as response:
+                # The same rules as RobotFileParser.read(): 401 and 403 forbid everything, other errors nothing
+                if response.status in (401, 403):
+                    parser.disallow_all = True
+                elif response.status >= 400:
+                    parser.allow_all = True
+                else:
+                    parser.parse((await response.text(errors="replace")).splitlines())
+        except (aiohttp.ClientError, asyncio.TimeoutError, UnicodeDecodeError):
+            parser.allow_all = True
+        return parser
+
+    @staticmethod
+    def _root(url):
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+
+class Crawler(AsyncHtmlFetcher):
+    """Fetch seed URLs and the pages they link to, politely and without repeating a URL."""
+
+    def __init__(
+        self,
+        frontier: Optional[CrawlFrontier] = None,
+        follow: Optional[str] = None,
+        max_pages: Optional[int] = None,
+        delay: float = 1.0,
+        respect_robots: bool = True,
+        user_agent: str = USER_AGENT,
+        **fetcher_options,
+    ):
+        """
+        Initialize the Crawler class.
+
+        :param frontier: The queue and seen set of the crawl, defaults to a new one in memory
+        :param follow: Regular expression of further URLs to crawl besides pagination links
+        :param max_pages: Stop after fetching this many pages, counting those of resumed crawls
+        :param delay: Seconds between two requests to the same host, defaults to 1; a longer
+            Crawl-delay in robots.txt takes precedence
+        :param respect_robots: Skip URLs that robots.txt disallows, defaults to True
+        :param user_agent: The User-Agent header, also used to look up the robots.txt rules
+        :param fetcher_options: Further arguments of AsyncHtmlFetcher
+        """
+        headers = {"User-Agent": user_agent, **(fetcher_options.pop("headers", None) or {})}
+        super().__init__(headers=headers, **fetcher_options)
+        self.frontier = frontier if frontier is not None else CrawlFrontier()
+        self.follow = re.compile(follow) if follow else None
+        self.max_pages = max_pages
+        self.delay = delay
+        self.respect_robots = respect_robots
+        self.user_agent = user_agent
+        self.disallowed = 0
+
+    def discover_links(self, html_text: str, page_url: str) -> List[str]:
+        """
+        Return the links of a page the crawl follows.
+
+        :param html_text: The HTML of the page
+        :param page_url: The URL of the page
+        :return: Pagination links and links matching the follow pattern, in document order
+        """
+        return [
+            url
+            for url, rel, text in extract_links(html_text, page_url)
+            if is_pagination_link(page_url, url, rel, text) or (self.follow is not None and self.follow.search(url))
+        ]
+
+    async def fetch_all(self, sources: Iterable[str]) -> AsyncIterator[FetchedPage]:
+        """
+        Crawl from the seed URLs, yielding each page as soon as it has arrived.
+
+        Seeds that have been seen by a resumed crawl are not fetched again.
+
+        :param sources: The seed URLs
+        :return: An async iterator of FetchedPage objects
+        """
+        for url in sources:
+            self.frontier.add(url)
+        results = asyncio.Queue(maxsize=self.buffer_size)
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.per_host_limit)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        robots = RobotsCache(self.user_agent)
+        next_request = {}
+        active = 0
+
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=self.headers) as session:
+
+            async def worker():
+                nonlocal active
+                while True:
+                    url = None if self._limit_reached() else self.frontier.pop()
+                    if url is None:
+                        # Pages still being fetched may add links to the queue
+                        if active == 0:
+                            return
+                        await asyncio.sleep(0.05)
+                        continue
+                    active += 1
+                    try:
+                        page = await self._crawl(session, robots, next_request, url)
+                    finally:
+                        active -= 1
+                    if page is not None:
+                        await results.put(page)
+
+            async def run_workers():
+                try:
+                    await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+                finally:
+                    await results.put(None)
+
+            workers = asyncio.ensure_future(run_workers())
+            try:
+                while True:
+                    page = await results.get()
+                    if page is None:
+                        break
+                    yield page
+                await workers
+            finally:
+                workers.cancel()
+
+    def stream(self, sources: Iterable[str]) -> Iterator[FetchedPage]:
+        """
+        Crawl on a background event loop and yield pages synchronously.
+
+        A page counts as finished once the consumer asks for the next one, so after an
+        interruption the page being processed is crawled again on resume. The frontier
+        is checkpointed when the crawl ends or the iterator is closed.
+
+        :param sources: The seed URLs
+        :return: An iterator of FetchedPage objects in completion order
+        """
+        try:
+            for page in super().stream(sources):
+                yield page
+                self.frontier.done(page.source)
+        finally:
+            self.frontier.save()
+
+    def _limit_reached(self):
+        return self.max_pages is not None and self.frontier.fetched >= self.max_pages
+
+    async def _crawl(self, session, robots, next_request, url):
+        use_robots = self.respect_robots and not (self.cache is not None and self.cache.offline)
+        if use_robots and not await robots.allowed(session, url):
+            self.disallowed += 1
+            # Only fetched pages count towards max_pages
+            self.frontier.skip(url)
+            return None
+
+        # Reserve the next free slot of the host before waiting, so concurrent workers queue up behind it
+        loop = asyncio.get_running_loop()
+        host = urlsplit(url).netloc
+        delay = max(self.delay, robots.crawl_delay(url) or 0)
+        slot = max(loop.time(), next_request.get(host, 0))
+        next_request[host] = slot + delay
+        await asyncio.sleep(slot - loop.time())
+
+        page = await self._fetch(session, url, "url")
+        if page.ok:
+            links = await loop.run_in_executor(None, self.discover_links, page.html, url)
+            for link in links:
+                self.frontier.add(link)
+        return page
@@ -5,54 +5,224 @@ It is responsible for handling DOM parsing, element identification, and content
 As the module evolves, it may include additional functionality related to DOM analysis.
 """
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, NavigableString, Tag
 import requests
+import bisect
+import hashlib
+import html as html_lib
+import os
 import re
+import warnings
+
+import tiktoken
+
+from instrumentation.tracing import current_span, get_tracer
+from website_analysis.http_cache import CacheMissError, HttpCache
+from website_analysis.parser_backends import default_locator, default_parser_type
+from website_analysis.streaming import StreamingSubtreeExtractor
 
 
 class HtmlLoader:
-    def __init__(self, html_location):
+    def __init__(self, html_location, encoding=None):
         self.html_location = html_location
+        self.encoding = encoding
 
     def load(self):
-        with open(self.html_location, 'r') as file:
+        with open(self.html_location, 'r', encoding=self.encoding) as file:
             html_code = file.read()
+            current_span().add("bytes_fetched", file.buffer.tell())
         return html_code
     
 class UrlHtmlLoader:
-    def __init__(self, url):
+    def __init__(self, url, session=None, timeout=30, cache=None):
         self.url = url
+        # A shared requests.Session keeps connections alive across loaders
+        self.session = session if session is not None else requests
+        self.timeout = timeout
+        # Without an explicit cache, use the one configured for this run, if any
+        self.cache = cache if cache is not None else HttpCache.from_env()
 
     def load(self):
-        response = requests.get(self.url)
+        span = current_span()
+        if self.cache is None:
+            response = self.session.get(self.url, timeout=self.timeout)
+            response.raise_for_status()  # Raise an exception if the request was unsuccessful
+            span.add("bytes_fetched", len(response.content))
+            return response.text
+
+        cached = self.cache.get(self.url)
+        if self.cache.offline:
+            if cached is None:
+                raise CacheMissError(f"{self.url} is not in the HTTP cache")
+            span.set("http_cache", "offline")
+            return cached.body
+
+        # Revalidate the cached copy, the server answers 304 if it is still current
+        headers = cached.conditional_headers() if cached is not None else {}
+        response = self.session.get(self.url, headers=headers, timeout=self.timeout)
+        if cached is not None and response.status_code == 304:
+            span.set("http_cache", "revalidated")
+            return cached.body
         response.raise_for_status()  # Raise an exception if the request was unsuccessful
+        span.add("bytes_fetched", len(response.content))
+        span.set("http_cache", "miss")
+        self.cache.put(
+            self.url,
+            response.text,
+            etag=response.headers.get('ETag'),
+            last_modified=response.headers.get('Last-Modified'),
+        )
         return response.text
-    
+
+
+
+class BrowserHtmlLoader:
+    def __init__(self, url, pool=None):
+        self.url = url
+        # Without an explicit pool, use the browsers shared by the process, started on first use
+        self.pool = pool
+
+    def load(self):
+        from website_analysis.browser_pool import BrowserPool
+
+        pool = self.pool if self.pool is not None else BrowserPool.from_env()
+        html_code = pool.load(self.url)
+        current_span().add("bytes_fetched", len(html_code.encode()))
+        return html_code
 
 class HTMLParser:
-    def __init__(self, parser_type='html.parser'):
-        self.parser_type = parser_type
+    def __init__(self, parser_type=None):
+        # Without an explicit tree builder, use the one configured for this run or the fastest installed
+        self.parser_type = parser_type or default_parser_type()
 
     def parse(self, html):
         return BeautifulSoup(html, self.parser_type)
 
+    def parse_fragment(self, html):
+        # lxml wraps fragments into <html><body>, html.parser keeps them as they are.
+        # Extracted subtrees are small, so the slower builder costs little here
+        return BeautifulSoup(html, 'html.parser')
+
+
+class SearchMatch:
+    def __init__(self, element, position, kind):
+        # The matching text node or tag, its position in document order,
+        # and whether the target was found in its "text" or its "attributes"
+        self.element = element
+        self.position = position
+        self.kind = kind
+
+    def __repr__(self):
+        return f"SearchMatch({self.kind!r}, position={self.position})"
+
+
+class _ConcatenatedIndex:
+    # Strings joined by a separator that never occurs in a target, plus the offset
+    # of each string so that a hit can be mapped back to its element
+    SEPARATOR = "\x00"
+
+    def __init__(self, strings, elements, positions):
+        self.elements = elements
+        self.positions = positions
+        self.offsets = []
+        offset = 0
+        for string in strings:
+            self.offsets.append(offset)
+            offset += len(string) + 1
+        self.text = self.SEPARATOR.join(strings)
+
+    def find(self, needle, kind):
+        matches = []
+        if not needle or self.SEPARATOR in needle:
+            return matches
+        start = self.text.find(needle)
+        while start != -1:
+            index = bisect.bisect_right(self.offsets, start) - 1
+            matches.append(SearchMatch(self.elements[index], self.positions[index], kind))
+            # Continue after the matched element so each element is reported once
+            next_offset = self.offsets[index + 1] if index + 1 < len(self.offsets) else len(self.text)
+            start = self.text.find(needle, next_offset)
+        return matches
+
+
+class DocumentIndex:
+    """A flat index of the text and attribute values of a parsed document.
+
+    The document is walked once; afterwards any number of target strings can be
+    looked up with plain substring searches over two concatenated strings.
+    """
+
+    def __init__(self, parsed_html):
+        self.document = parsed_html
+        texts, text_nodes, text_positions = [], [], []
+        attributes, attribute_tags, attribute_positions = [], [], []
+        for position, node in enumerate(parsed_html.descendants):
+            if isinstance(node, NavigableString):
+                texts.append(node.lower())
+                text_nodes.append(node)
+                text_positions.append(position)
+            elif node.attrs:
+                attributes.append(self._attributes_text(node))
+                attribute_tags.append(node)
+                attribute_positions.append(position)
+
+        self._text = _ConcatenatedIndex(texts, text_nodes, text_positions)
+        self._attributes = _ConcatenatedIndex(attributes, attribute_tags, attribute_positions)
+
+    def find_text(self, target_string):
+        """
+        Return a match for every text node containing the target, ignoring case
+        """
+        return self._text.find(target_string.lower(), "text")
+
+    def find_attributes(self, target_string):
+        """
+        Return a match for every tag with an attribute name or value containing the target
+        """
+        return self._attributes.find(target_string, "attributes")
+
+    def search(self, target_string):
+        """
+        Return the text matches of the target, or its attribute matches if there are none
+        """
+        if not target_string:
+            return []
+        return self.find_text(target_string) or self.find_attributes(target_string)
+
+    @staticmethod
+    def _attributes_text(tag):
+        parts = []
+        for name, value in tag.attrs.items():
+            if isinstance(value, (list, tuple)):
+                value = " ".join(value)
+            parts.append(f"{name}={value}")
+        return " ".join(parts)
 
-class HTMLSearcher:
-    def search(self, parsed_html, target_string):
-        # Case Insensitive Search
-        elements_containing_string = parsed_html(text=re.compile(target_string, re.I))
-
-        # If not found in text nodes, search within tags
-        if not elements_containing_string:
-            elements_containing_string = parsed_html(string=lambda text: target_string in text)
 
-            # If still not found, search within tag attributes
-            if not elements_containing_string:
-                elements_containing_string = parsed_html(lambda tag: target_string in str(tag.attrs))
+class HTMLSearcher:
+    def __init__(self):
+        self._index = None
+
+    def index(self, parsed_html):
+        """
+        Return the index of the document, building it on the first query
+        """
+        if self._index is None or self._index.document is not parsed_html:
+            self._index = DocumentIndex(parsed_html)
+        return self._index
+
+    def search_all(self, parsed_html, target_string):
+        """
+        Return every text node containing the target string (case insensitive),
+        or every tag whose attributes contain it if no text node does, in document order
+        """
+        return self.index(parsed_html).search(target_string)
 
-        if elements_containing_string:
+    def search(self, parsed_html, target_string):
+        matches = self.search_all(parsed_html, target_string)
+        if matches:
             # Just take the first occurrence for this example
-            return elements_containing_string[0]
+            return matches[0].element
         else:
             return None
 
@@ -75,6 +245,257 @@ class HTMLPreparer:
         return prepared_html
 
 
+class TokenCounter:
+    """Count and truncate text in the tokens of a given model."""
+
+    _counters = {}
+
+    @classmethod
+    def for_model(cls, model="gpt-4"):
+        # Loading an encoding is slow, so counters are shared per model
+        if model not in cls._counters:
+            cls._counters[model] = cls(model)
+        return cls._counters[model]
+
+    def __init__(self, model="gpt-4"):
+        try:
+            try:
+                self.encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                self.encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as error:  # The encoding files could not be downloaded
+            warnings.warn(f"Falling back to estimated token counts: {error}")
+            self.encoding = None
+
+    def count(self, text):
+        if self.encoding is None:
+            return (len(text) + 3) // 4
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def truncate(self, text, max_tokens):
+        if self.encoding is None:
+            return text[:max_tokens * 4]
+        tokens = self.encoding.encode(text, disallowed_special=())
+        return self.encoding.decode(tokens[:max_tokens])
+
+
+class HTMLMinimizer:
+    """Serialize an element without the parts that cost tokens but do not help scraping.
+
+    Scripts, styles, SVGs and other non-content nodes are dropped, as are comments,
+    inline styles and event handlers. Class lists and long attribute values are
+    shortened and whitespace is collapsed. The parse tree itself is not modified.
+    """
+
+    REMOVED_TAGS = {
+        "script", "style", "svg", "noscript", "template", "iframe", "link", "meta",
+        "canvas", "object", "embed", "base",
+    }
+    # Removed without their children: lxml does not know <source> is void and nests the
+    # following siblings in it, such as the fallback <img> of a <picture>
+    UNWRAPPED_TAGS = {"source"}
+    REMOVED_ATTRIBUTES = {"style", "srcset", "sizes", "integrity", "nonce", "crossorigin"}
+    VOID_TAGS = {
+        "area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta",
+        "param", "source", "track", "wbr",
+    }
+    ELLIPSIS = "\u2026"
+
+    def __init__(self, max_classes=2, max_attribute_length=60, collapser=None):
+        self.max_classes = max_classes
+        self.max_attribute_length = max_attribute_length
+        self.collapser = collapser
+
+    def prepare(self, element):
+        # Lets the minimizer replace the HTMLPreparer in an HTMLProcessingPipeline
+        return self.minimize(element)
+
+    def minimize(self, element, keep=None):
+        """
+        Serialize the element in its minimized form.
+
+        :param element: A parsed BeautifulSoup document or tag
+        :param keep: An element the collapser must not leave out, with its ancestors
+        :return: The minimized HTML
+        """
+        kept = {id(node) for node in [keep, *keep.parents]} if keep is not None else set()
+        parts = []
+        # Iterative walk: a stack of nodes to open, and closing tags as plain strings
+        stack = [element]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, str) and not isinstance(node, NavigableString):
+                parts.append(node)
+            elif isinstance(node, NavigableString):
+                # Skips comments, doctypes and CDATA, and whitespace between tags
+                if type(node) is NavigableString and not node.isspace():
+                    parts.append(html_lib.escape(re.sub(r"\s+", " ", node), quote=False))
+            elif node.name in self.REMOVED_TAGS:
+                continue
+            elif node.name in self.UNWRAPPED_TAGS:
+                stack.extend(reversed(self._children(node, kept)))
+            elif node.name == "[document]":
+                stack.extend(reversed(self._children(node, kept)))
+            else:
+                parts.append(f"<{node.name}{self._attributes(node)}>")
+                if node.name not in self.VOID_TAGS:
+                    stack.append(f"</{node.name}>")
+                    stack.extend(reversed(self._children(node, kept)))
+        return re.sub(r" {2,}", " ", "".join(parts)).strip()
+
+    def _children(self, node, kept):
+        if self.collapser is None:
+            return node.contents
+        return self.collapser.collapse(node.contents, kept)
+
+    def _attributes(self, tag):
+        parts = []
+        for name, value in tag.attrs.items():
+            if name in self.REMOVED_ATTRIBUTES or name.startswith("on"):
+                continue
+            if isinstance(value, (list, tuple)):
+                if name == "class" and len(value) > self.max_classes:
+                    value = value[:self.max_classes]
+                value = " ".join(value)
+            if value.startswith("data:"):
+                value = "data:" + self.ELLIPSIS
+            elif len(value) > self.max_attribute_length:
+                value = value[:self.max_attribute_length] + self.ELLIPSIS
+            parts.append(f' {name}="{html_lib.escape(value)}"')
+        return "".join(parts)
+
+
+class HTMLFingerprinter:
+    """Summarise the tag/class skeleton of a subtree, ignoring text and attribute values.
+
+    Consecutive siblings with an identical skeleton are collapsed into one, so two
+    listing pages that only differ in the number of rows share a fingerprint.
+    """
+
+    def skeleton(self, element):
+        """
+        Return the structural skeleton of the element as a compact string.
+
+        :param element: A parsed BeautifulSoup document or tag
+        :return: A string such as ``div.card(h2()p.price())``
+        """
+        # Iterative post-order walk so that deeply nested documents do not hit the
+        # recursion limit. Each frame holds a tag and the skeletons of its children.
+        stack = [(element, [])]
+        iterators = [iter(self._child_tags(element))]
+        while True:
+            child = next(iterators[-1], None)
+            if child is not None:
+                stack.append((child, []))
+                iterators.append(iter(self._child_tags(child)))
+                continue
+
+            tag, children = stack.pop()
+            iterators.pop()
+            collapsed = [
+                part
+                for index, part in enumerate(children)
+                if index == 0 or part != children[index - 1]
+            ]
+            node = f"{self._signature(tag)}({''.join(collapsed)})"
+            if not stack:
+                return node
+            stack[-1][1].append(node)
+
+    def fingerprint(self, element):
+        """
+        Return a stable hash of the structural skeleton of the element.
+
+        :param element: A parsed BeautifulSoup document or tag
+        :return: A hex digest identifying the layout of the element
+        """
+        return hashlib.sha256(self.skeleton(element).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _child_tags(element):
+        return [child for child in element.children if isinstance(child, Tag)]
+
+    @staticmethod
+    def _signature(tag):
+        classes = tag.get("class") or []
+        return ".".join([tag.name or ""] + sorted(classes))
+
+
+class RepetitionCollapser:
+    """Shorten lists of repeated records to a few samples before they are sent to the LLM.
+
+    Siblings sharing a tag/class signature, such as the rows of a table or the cards of
+    a product grid, are records of one list. Only the first few of them and the one
+    holding the target string are kept; the others are replaced by a comment telling
+    how many were left out. A selector written for the samples matches them all.
+    """
+
+    def __init__(self, samples=3, min_repeats=6):
+        """
+        Initialize the RepetitionCollapser class.
+
+        :param samples: Number of records kept from each list, defaults to 3
+        :param min_repeats: Lists shorter than this are kept whole, defaults to 6
+        """
+        self.samples = samples
+        self.min_repeats = min_repeats
+
+    def collapse(self, children, kept=frozenset()):
+        """
+        Return the children of an element with the surplus records left out.
+
+        Each run of left out siblings is replaced by a comment string such as
+        ``<!-- 97 more tr elements, 100 in total -->``.
+
+        :param children: The child nodes of an element
+        :param kept: ids of the nodes that must not be left out
+        :return: The remaining child nodes and comment strings, in document order
+        """
+        groups = {}
+        for child in children:
+            if isinstance(child, Tag) and child.name not in HTMLMinimizer.VOID_TAGS:
+                groups.setdefault(HTMLFingerprinter._signature(child), []).append(child)
+
+        omitted = {}
+        for signature, group in groups.items():
+            if len(group) < self.min_repeats:
+                continue
+            for tag in group[self.samples:]:
+                if id(tag) not in kept:
+                    omitted[id(tag)] = signature
+        if not omitted:
+            return children
+
+        collapsed = []
+        run = {}  # Signatures of the siblings left out since the last kept tag
+        pending = []  # Text after the last left out sibling, dropped if another follows
+        for child in children:
+            if id(child) in omitted:
+                signature = omitted[id(child)]
+                run[signature] = run.get(signature, 0) + 1
+                pending = []
+            elif run and not isinstance(child, Tag):
+                pending.append(child)
+            else:
+                if run:
+                    collapsed.append(self._annotation(run, groups))
+                    collapsed.extend(pending)
+                    run, pending = {}, []
+                collapsed.append(child)
+        if run:
+            collapsed.append(self._annotation(run, groups))
+            collapsed.extend(pending)
+        return collapsed
+
+    @staticmethod
+    def _annotation(run, groups):
+        counts = ", ".join(
+            f"{count} more {signature} elements, {len(groups[signature])} in total"
+            for signature, count in run.items()
+        )
+        return f"<!-- {counts} -->"
+
+
 class HTMLProcessingPipeline:
     def __init__(self, parser, searcher, extractor, preparer):
         self.parser = parser
@@ -84,6 +505,19 @@ class HTMLProcessingPipeline:
 
     def process(self, html, target_string, generations):
         parsed_html = self.parser.parse(html)
+        return self.process_parsed(parsed_html, target_string, generations)
+
+    def process_all(self, html, target_strings, generations):
+        """
+        Process several target strings against one parse and one index of the page
+        """
+        parsed_html = self.parser.parse(html)
+        return {
+            target_string: self.process_parsed(parsed_html, target_string, generations)
+            for target_string in target_strings
+        }
+
+    def process_parsed(self, parsed_html, target_string, generations):
         target_element = self.searcher.search(parsed_html, target_string)
         parent_element = self.extractor.extract(target_element, generations)
         prepared_html = self.preparer.prepare(parent_element)
@@ -91,36 +525,147 @@ class HTMLProcessingPipeline:
     
 
 class HtmlManager:
-    def __init__(self, source, source_type, target_string, max_length=4000):
-        self.max_length = max_length
+    # Tokens of HTML sent to each model, leaving room for the prompt and the generated code
+    TOKEN_BUDGETS = {
+        "gpt-4": 3000,
+        "gpt-4-0314": 3000,
+        "gpt-4-32k": 16000,
+        "gpt-4-32k-0314": 16000,
+        "gpt-3.5-turbo": 1500,
+        "gpt-3.5-turbo-0301": 1500,
+        "text-davinci-003": 1500,
+    }
+    DEFAULT_TOKEN_BUDGET = 3000
+    # Generations above the target read from disk in streaming mode, or cut out by the locator
+    STREAMING_GENERATIONS = 8
+    # Pages from this many characters on are cut down by the subtree locator before parsing
+    LOCATOR_MIN_SIZE = 256 * 1024
+
+    def __init__(self, source, source_type, target_string, model="gpt-4", max_tokens=None, max_generations=20, streaming=False, use_locator=True, collapse_repetitions=True):
         self.target_string = target_string
+        self.streaming = streaming
+        self.collapse_repetitions = collapse_repetitions
+        self.locator = default_locator() if use_locator else None
+        self.model = model
+        self.max_tokens = max_tokens or self.TOKEN_BUDGETS.get(model, self.DEFAULT_TOKEN_BUDGET)
+        self.max_generations = max_generations
+        # The loaded document and its parse tree are kept so that the generated
+        # scraper can reuse them instead of downloading and parsing the page again
+        self.html = None
+        self.parsed_html = None
+        # The element the processed HTML was minimized from
+        self.subtree = None
         if source_type == 'url':
             self.loader = UrlHtmlLoader(source)
+        elif source_type == 'browser':
+            self.loader = BrowserHtmlLoader(source)
         else:  # source_type == 'file'
             self.loader = HtmlLoader(source)
         
     def process_html(self):
-        html = self.loader.load()
-
-        if len(html) >= self.max_length:
-            # Create instances of each class
+        if self.streaming and isinstance(self.loader, HtmlLoader):
+            return self.process_streaming()
+        with get_tracer().span("load", source_type=type(self.loader).__name__):
+            html = self.loader.load()
+        return self.process(html)
+
+    def process_streaming(self):
+        """
+        Process only the subtree around the target string of a local file,
+        without reading the whole file into memory
+        """
+        with get_tracer().span("process_html", streaming=True) as span:
+            span.set("html_chars_before", os.path.getsize(self.loader.html_location))
+            extractor = StreamingSubtreeExtractor()
+            subtree = extractor.extract(self.loader.html_location, self.target_string, self.STREAMING_GENERATIONS)
+            if subtree is not None:
+                processed_html = self.process_parsed(HTMLParser().parse_fragment(subtree))
+                # Only a part of the document was loaded, the scraper has to read the file itself
+                self.html = None
+                self.parsed_html = None
+                self._record_output(span, processed_html)
+                return processed_html
+
+        return self.process(self.loader.load())
+
+    def process(self, html):
+        """
+        Minimize already loaded HTML down to the largest part around the target string
+        that fits into the token budget of the model
+        """
+        with get_tracer().span("process_html", streaming=False) as span:
+            span.set("html_chars_before", len(html))
+            self.html = html
             parser = HTMLParser()
-            searcher = HTMLSearcher()
-            extractor = ParentExtractor()
-            preparer = HTMLPreparer()
-
-            # Create an instance of the pipeline using the instances of the classes
-            pipeline = HTMLProcessingPipeline(parser, searcher, extractor, preparer)
 
-            # Call the `process` method of the pipeline with the necessary parameters
-            target_string = self.target_string
-            generations = 3
-            processed_html = pipeline.process(html, target_string, generations)
-        else:
-            processed_html = html
-            
-
-        return processed_html 
+            subtree = None
+            if self.locator is not None and self.target_string and len(html) >= self.LOCATOR_MIN_SIZE:
+                subtree = self.locator.locate(html, self.target_string, self.STREAMING_GENERATIONS)
+            if subtree is not None:
+                # Only the part around the target is parsed, the scraper parses the page itself
+                self.parsed_html = None
+                processed_html = self.process_parsed(parser.parse_fragment(subtree))
+            else:
+                self.parsed_html = parser.parse(html)
+                processed_html = self.process_parsed(self.parsed_html)
+            span.set("located", subtree is not None)
+            self._record_output(span, processed_html)
+            return processed_html
+
+    def _record_output(self, span, processed_html):
+        span.set("html_chars_after", len(processed_html))
+        span.set("html_tokens_after", TokenCounter.for_model(self.model).count(processed_html))
+
+    def process_parsed(self, parsed_html):
+        """
+        Minimize a parse tree down to the largest part around the target string
+        that fits into the token budget of the model
+        """
+        # Create instances of each class
+        searcher = HTMLSearcher()
+        extractor = ParentExtractor()
+        # Long lists are cut down to a few sample records, so more of the page around them fits
+        minimizer = HTMLMinimizer(collapser=RepetitionCollapser() if self.collapse_repetitions else None)
+        counter = TokenCounter.for_model(self.model)
+
+        target_element = searcher.search(parsed_html, self.target_string) if self.target_string else None
+        if target_element is None:
+            # Nothing to center on, send as much of the page as fits
+            self.subtree = parsed_html
+            return counter.truncate(minimizer.minimize(parsed_html), self.max_tokens)
+
+        # Climb from the target towards the root while the minimized subtree still fits
+        processed_html = None
+        element = target_element
+        for generations in range(1, self.max_generations + 1):
+            parent = extractor.extract(target_element, generations)
+            if parent is element and processed_html is not None:
+                break  # Reached the root of the document
+            element = parent
+            candidate = minimizer.minimize(element, keep=target_element)
+            if counter.count(candidate) > self.max_tokens:
+                break
+            processed_html = candidate
+            self.subtree = element
+
+        if processed_html is None:
+            # Even the closest parent is too large, keep its beginning
+            self.subtree = extractor.extract(target_element, 1)
+            processed_html = counter.truncate(minimizer.minimize(self.subtree, keep=target_element), self.max_tokens)
+
+        return processed_html
+
+    def subtree_hash(self):
+        """
+        Return a hash of the minimized part of the page the processed HTML was taken from.
+
+        Unlike the processed HTML, it covers every record of collapsed lists and the part cut
+        off by the token budget, so it changes whenever the data the scraper reads changes.
+        Returns None before the HTML has been processed.
+        """
+        if self.subtree is None:
+            return None
+        return hashlib.blake2b(HTMLMinimizer().minimize(self.subtree).encode("utf-8"), digest_size=16).hexdigest()
 
 
 def main():
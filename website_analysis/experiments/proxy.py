@@ -16,6 +16,8 @@ from webdriver_manager.chrome import ChromeDriverManager
 
 from mitmproxy import http
 
+from website_analysis.flow_store import FlowRecorder, FlowStore
+
 
 class RequestInterceptor:
     """A class for intercepting and storing HTTP requests and responses."""
@@ -57,7 +59,8 @@ async def run_mitmproxy(mitm_options, master_ref, shutdown_event, started_event)
     """
     request_interceptor = RequestInterceptor()
     master = DumpMaster(mitm_options)
-    master.addons.add(request_interceptor)
+    # Every flow is also written to the flow store, to be analysed and replayed offline
+    master.addons.add(request_interceptor, FlowRecorder(FlowStore(".flow_store")))
     master_ref.append(master)
 
     async def set_started():
@@ -98,7 +101,8 @@ async def main():
     chrome_options.add_argument("--no-sandbox")
     chrome_options.add_argument("--disable-dev-shm-usage")
     chrome_options.add_argument("--disable-gpu")
-    chrome_options.add_argument("--remote-debugging-port=9222")
+    # Let Chrome pick a free debugging port, so several captures can run at the same time
+    chrome_options.add_argument("--remote-debugging-port=0")
     chrome_options.add_argument("--headless")
     chrome_options.add_argument("--proxy-server=http://127.0.0.1:8080")
 
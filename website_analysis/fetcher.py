@@ -0,0 +1,239 @@
+"""fetcher.py: A module for fetching many HTML sources concurrently.
+
+This module is a part of the Website Structure Analysis component.
+It loads batches of URLs with a bounded-concurrency asyncio client that keeps
+connections alive per host, and hands every page over as soon as it arrives so the
+DOM analysis of one page overlaps with the download of the others.
+"""
+import asyncio
+import os
+import queue
+import threading
+import time
+from typing import AsyncIterator, Iterable, Iterator, List, Optional, Tuple
+
+import aiohttp
+
+from website_analysis.dom_analysis import HtmlLoader
+from website_analysis.http_cache import CacheMissError, HttpCache
+
+_DONE = object()
+
+
+class FetchedPage:
+    """The outcome of fetching a single source."""
+
+    def __init__(
+        self,
+        source: str,
+        source_type: str,
+        html: Optional[str] = None,
+        error: Optional[BaseException] = None,
+        elapsed: float = 0.0,
+    ):
+        """
+        Initialize the FetchedPage class.
+
+        :param source: The URL or local path that was fetched
+        :param source_type: Type of the source: url or file
+        :param html: The HTML of the page, None if fetching failed
+        :param error: The exception raised while fetching, if any
+        :param elapsed: Time in seconds spent fetching the page
+        """
+        self.source = source
+        self.source_type = source_type
+        self.html = html
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def ok(self) -> bool:
+        """Return True if the page was fetched successfully."""
+        return self.error is None
+
+
+def read_sources(path: str) -> List[Tuple[str, str]]:
+    """
+    Read the sources of a batch from a file of URLs or a directory of HTML files.
+
+    Blank lines and lines starting with '#' in a URL file are ignored.
+
+    :param path: A text file with one URL per line, or a directory of .html/.htm files
+    :return: A list of (source, source_type) tuples
+    """
+    if os.path.isdir(path):
+        return [
+            (os.path.join(path, filename), "file")
+            for filename in sorted(os.listdir(path))
+            if filename.lower().endswith((".html", ".htm"))
+        ]
+
+    with open(path, "r") as file:
+        lines = [line.strip() for line in file]
+    return [(line, "url") for line in lines if line and not line.startswith("#")]
+
+
+class AsyncHtmlFetcher:
+    """Fetch HTML sources concurrently over pooled keep-alive connections."""
+
+    def __init__(
+        self,
+        concurrency: int = 32,
+        per_host_limit: int = 4,
+        timeout: float = 30,
+        buffer_size: int = 64,
+        headers: Optional[dict] = None,
+        cache: Optional[HttpCache] = None,
+    ):
+        """
+        Initialize the AsyncHtmlFetcher class.
+
+        :param concurrency: Maximum number of sources fetched at the same time, defaults to 32
+        :param per_host_limit: Maximum number of open connections per host, defaults to 4
+        :param timeout: Total timeout in seconds for a single request, defaults to 30
+        :param buffer_size: Number of fetched pages held before fetching pauses, defaults to 64
+        :param headers: Extra HTTP headers sent with every request
+        :param cache: HTTP cache used for URLs, defaults to the cache configured for this run
+        """
+        self.concurrency = concurrency
+        self.per_host_limit = per_host_limit
+        self.timeout = timeout
+        self.buffer_size = buffer_size
+        self.headers = headers or {}
+        self.cache = cache if cache is not None else HttpCache.from_env()
+
+    async def fetch_all(
+        self, sources: Iterable[Tuple[str, str]]
+    ) -> AsyncIterator[FetchedPage]:
+        """
+        Fetch all sources, yielding each page as soon as it has arrived.
+
+        Pages are yielded in completion order, not in the order of the sources.
+
+        :param sources: An iterable of (source, source_type) tuples
+        :return: An async iterator of FetchedPage objects
+        """
+        results = asyncio.Queue(maxsize=self.buffer_size)
+        pending = iter(sources)
+        connector = aiohttp.TCPConnector(
+            limit=self.concurrency, limit_per_host=self.per_host_limit
+        )
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+
+        async with aiohttp.ClientSession(
+            connector=connector, timeout=timeout, headers=self.headers
+        ) as session:
+
+            async def worker():
+                # Workers share one iterator, so at most `concurrency` fetches run at once
+                for source, source_type in pending:
+                    await results.put(await self._fetch(session, source, source_type))
+
+            async def run_workers():
+                try:
+                    await asyncio.gather(
+                        *(worker() for _ in range(self.concurrency))
+                    )
+                finally:
+                    await results.put(_DONE)
+
+            workers = asyncio.ensure_future(run_workers())
+            try:
+                while True:
+                    page = await results.get()
+                    if page is _DONE:
+                        break
+                    yield page
+                await workers
+            finally:
+                workers.cancel()
+
+    def stream(self, sources: Iterable[Tuple[str, str]]) -> Iterator[FetchedPage]:
+        """
+        Fetch all sources on a background event loop and yield pages synchronously.
+
+        This lets a synchronous pipeline process each page while the rest are still
+        being downloaded. Closing the iterator early stops the remaining fetches.
+
+        :param sources: An iterable of (source, source_type) tuples
+        :return: An iterator of FetchedPage objects in completion order
+        """
+        pages = queue.Queue(maxsize=self.buffer_size)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        async def produce():
+            async for page in self.fetch_all(sources):
+                put(page)
+                if stop.is_set():
+                    break
+
+        def run():
+            try:
+                asyncio.run(produce())
+            except BaseException as error:  # Surface loop failures in the consumer
+                put(error)
+            finally:
+                put(_DONE)
+
+        thread = threading.Thread(target=run, name="html-fetcher", daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = pages.get()
+                if item is _DONE:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+    async def _fetch(
+        self, session: aiohttp.ClientSession, source: str, source_type: str
+    ) -> FetchedPage:
+        start = time.perf_counter()
+        try:
+            if source_type == "url":
+                html = await self._fetch_url(session, source)
+            else:  # source_type == 'file'
+                loop = asyncio.get_running_loop()
+                html = await loop.run_in_executor(None, HtmlLoader(source).load)
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError, UnicodeDecodeError, CacheMissError) as error:
+            return FetchedPage(
+                source, source_type, error=error, elapsed=time.perf_counter() - start
+            )
+        return FetchedPage(
+            source, source_type, html=html, elapsed=time.perf_counter() - start
+        )
+
+    async def _fetch_url(self, session: aiohttp.ClientSession, url: str) -> str:
+        cached = self.cache.get(url) if self.cache is not None else None
+        if self.cache is not None and self.cache.offline:
+            if cached is None:
+                raise CacheMissError(f"{url} is not in the HTTP cache")
+            return cached.body
+
+        # Revalidate the cached copy, the server answers 304 if it is still current
+        headers = cached.conditional_headers() if cached is not None else {}
+        async with session.get(url, headers=headers) as response:
+            if cached is not None and response.status == 304:
+                return cached.body
+            response.raise_for_status()
+            html = await response.text()
+            if self.cache is not None:
+                self.cache.put(
+                    url,
+                    html,
+                    etag=response.headers.get("ETag"),
+                    last_modified=response.headers.get("Last-Modified"),
+                )
+            return html
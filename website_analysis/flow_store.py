@@ -0,0 +1,503 @@
+"""flow_store.py: An indexed on-disk store of captured HTTP flows and a server replaying them.
+
+This module is a part of the Website Structure Analysis component.
+Flows captured by the proxy experiment (method, URL, headers, bodies, status and
+timing) are written to a SQLite file one by one as they arrive, indexed by host, path
+template, content type and status. Bodies are stored compressed and once per distinct
+content, so the same script or image served on every page takes the space of one copy.
+
+The replay server answers requests from the stored flows, as an HTTP proxy for the
+browser or as a plain server, so a site can be analysed again and again at local disk
+speed without touching the network. export_to_cache() hands the stored pages to the
+HTTP cache, where the loaders pick them up in offline mode.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit, urlunsplit
+
+from website_analysis.crawler import path_template
+from website_analysis.http_cache import HttpCache
+
+# Headers that describe the original connection or encoding, not the stored content
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailer",
+    "transfer-encoding", "upgrade", "content-encoding", "content-length",
+}
+
+
+class Flow:
+    """A captured HTTP request with its response."""
+
+    def __init__(
+        self,
+        method: str,
+        url: str,
+        status: int,
+        request_headers: Optional[List[Tuple[str, str]]] = None,
+        request_body: bytes = b"",
+        response_headers: Optional[List[Tuple[str, str]]] = None,
+        response_body: bytes = b"",
+        started_at: Optional[float] = None,
+        duration: float = 0.0,
+    ):
+        """
+        Initialize the Flow class.
+
+        :param method: The HTTP method of the request
+        :param url: The absolute URL of the request
+        :param status: The HTTP status of the response
+        :param request_headers: The request headers as (name, value) pairs
+        :param request_body: The decoded request body
+        :param response_headers: The response headers as (name, value) pairs
+        :param response_body: The decoded response body
+        :param started_at: Time the request was sent, defaults to now
+        :param duration: Seconds until the response was complete
+        """
+        self.method = method.upper()
+        self.url = url
+        self.status = status
+        self.request_headers = list(request_headers or [])
+        self.request_body = request_body or b""
+        self.response_headers = list(response_headers or [])
+        self.response_body = response_body or b""
+        self.started_at = started_at if started_at is not None else time.time()
+        self.duration = duration
+
+    @property
+    def host(self) -> str:
+        return (urlsplit(self.url).hostname or "").lower()
+
+    @property
+    def path_template(self) -> str:
+        return path_template(urlsplit(self.url).path)
+
+    @property
+    def content_type(self) -> Optional[str]:
+        """Return the media type of the response, without parameters such as the charset."""
+        value = self.header("Content-Type")
+        return value.split(";")[0].strip().lower() if value else None
+
+    def header(self, name: str) -> Optional[str]:
+        """
+        Return the value of a response header.
+
+        :param name: The header name, case insensitive
+        :return: The first value of the header, or None
+        """
+        name = name.lower()
+        return next((value for key, value in self.response_headers if key.lower() == name), None)
+
+    def text(self) -> str:
+        """Return the response body decoded with the charset of its Content-Type, UTF-8 by default."""
+        charset = "utf-8"
+        for parameter in (self.header("Content-Type") or "").split(";")[1:]:
+            key, _, value = parameter.strip().partition("=")
+            if key.lower() == "charset" and value:
+                charset = value.strip('"')
+        try:
+            return self.response_body.decode(charset, errors="replace")
+        except LookupError:
+            return self.response_body.decode("utf-8", errors="replace")
+
+    @classmethod
+    def from_mitmproxy(cls, flow) -> "Flow":
+        """
+        Convert a mitmproxy HTTPFlow that has a response.
+
+        :param flow: A mitmproxy.http.HTTPFlow
+        :return: The Flow
+        """
+        request, response = flow.request, flow.response
+        started_at = request.timestamp_start
+        finished_at = response.timestamp_end or started_at
+        return cls(
+            request.method,
+            request.pretty_url,
+            response.status_code,
+            list(request.headers.items(multi=True)),
+            request.get_content(strict=False) or b"",
+            list(response.headers.items(multi=True)),
+            response.get_content(strict=False) or b"",
+            started_at=started_at,
+            duration=finished_at - started_at,
+        )
+
+    def __repr__(self):
+        return f"Flow({self.method} {self.url}, {self.status}, {self.content_type})"
+
+
+class FlowStore:
+    """Captured flows in SQLite, indexed for lookups, with bodies deduplicated by hash."""
+
+    def __init__(self, directory: str = ".flow_store"):
+        """
+        Open or create the store in the given directory.
+
+        :param directory: Directory holding the store database, defaults to ".flow_store"
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            os.path.join(directory, "flows.sqlite3"), check_same_thread=False, timeout=30
+        )
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS bodies (
+                    hash TEXT PRIMARY KEY,
+                    body BLOB NOT NULL,
+                    size INTEGER NOT NULL
+                )
+                """
+            )
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS flows (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    method TEXT NOT NULL,
+                    url TEXT NOT NULL,
+                    address TEXT NOT NULL,
+                    host TEXT NOT NULL,
+                    path_template TEXT NOT NULL,
+                    status INTEGER NOT NULL,
+                    content_type TEXT,
+                    request_headers TEXT NOT NULL,
+                    request_body TEXT NOT NULL,
+                    response_headers TEXT NOT NULL,
+                    response_body TEXT NOT NULL,
+                    started_at REAL NOT NULL,
+                    duration REAL NOT NULL
+                )
+                """
+            )
+            for column in ("host", "path_template", "content_type", "status"):
+                self._connection.execute(f"CREATE INDEX IF NOT EXISTS flows_{column} ON flows ({column})")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS flows_address ON flows (address, method)")
+
+    def add(self, flow: Flow) -> int:
+        """
+        Store a flow, committing it right away so an interrupted capture keeps what it has.
+
+        :param flow: The flow
+        :return: The id of the stored flow
+        """
+        with self._lock, self._connection:
+            request_body = self._put_body(flow.request_body)
+            response_body = self._put_body(flow.response_body)
+            cursor = self._connection.execute(
+                "INSERT INTO flows (method, url, address, host, path_template, status, content_type, request_headers,"
+                " request_body, response_headers, response_body, started_at, duration)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    flow.method, flow.url, flow_address(flow.url), flow.host, flow.path_template, flow.status,
+                    flow.content_type, json.dumps(flow.request_headers), request_body,
+                    json.dumps(flow.response_headers), response_body, flow.started_at, flow.duration,
+                ),
+            )
+            return cursor.lastrowid
+
+    def query(
+        self,
+        host: Optional[str] = None,
+        path_template: Optional[str] = None,
+        content_type: Optional[str] = None,
+        status: Optional[int] = None,
+        method: Optional[str] = None,
+    ) -> Iterator[Flow]:
+        """
+        Return the stored flows matching all given criteria, in the order they were captured.
+
+        :param host: The host of the URL, such as ra.co
+        :param path_template: The path with numeric segments replaced, such as /events/{n}
+        :param content_type: The media type of the response, such as application/json
+        :param status: The HTTP status of the response
+        :param method: The HTTP method of the request
+        :return: An iterator of Flow objects
+        """
+        criteria = {
+            "host": host.lower() if host else None,
+            "path_template": path_template,
+            "content_type": content_type.lower() if content_type else None,
+            "status": status,
+            "method": method.upper() if method else None,
+        }
+        conditions = [(f"{column} = ?", value) for column, value in criteria.items() if value is not None]
+        where = " WHERE " + " AND ".join(condition for condition, _ in conditions) if conditions else ""
+        with self._lock:
+            ids = [row[0] for row in self._connection.execute(
+                f"SELECT id FROM flows{where} ORDER BY id", [value for _, value in conditions]
+            )]
+        for flow_id in ids:
+            yield self.get(flow_id)
+
+    def candidates(self, method: str, url: str) -> List[int]:
+        """
+        Return the ids of the flows recorded for a request, in the order they were captured.
+
+        The scheme is ignored, so flows captured over https are found for http requests.
+
+        :param method: The HTTP method
+        :param url: The absolute URL
+        :return: A list of flow ids
+        """
+        with self._lock:
+            return [row[0] for row in self._connection.execute(
+                "SELECT id FROM flows WHERE address = ? AND method = ? ORDER BY id", (flow_address(url), method.upper())
+            )]
+
+    def get(self, flow_id: int) -> Optional[Flow]:
+        """
+        Return a stored flow with its bodies.
+
+        :param flow_id: The id returned by add()
+        :return: The Flow, or None if there is no such flow
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT method, url, status, request_headers, request_body, response_headers, response_body,"
+                " started_at, duration FROM flows WHERE id = ?",
+                (flow_id,),
+            ).fetchone()
+            if row is None:
+                return None
+            method, url, status, request_headers, request_body, response_headers, response_body, started_at, duration = row
+            return Flow(
+                method, url, status,
+                [tuple(header) for header in json.loads(request_headers)], self._get_body(request_body),
+                [tuple(header) for header in json.loads(response_headers)], self._get_body(response_body),
+                started_at=started_at, duration=duration,
+            )
+
+    def request_body_hash(self, flow_id: int) -> Optional[str]:
+        """Return the hash of the request body of a stored flow."""
+        with self._lock:
+            row = self._connection.execute("SELECT request_body FROM flows WHERE id = ?", (flow_id,)).fetchone()
+        return row[0] if row else None
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Return the number of flows, of distinct bodies and the size of the stored bodies.
+
+        :return: A dict with flows, bodies and body_bytes
+        """
+        with self._lock:
+            flows = self._connection.execute("SELECT COUNT(*) FROM flows").fetchone()[0]
+            bodies, size = self._connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM bodies").fetchone()
+        return {"flows": flows, "bodies": bodies, "body_bytes": size}
+
+    def __len__(self) -> int:
+        return self.stats()["flows"]
+
+    def export_to_cache(self, cache: HttpCache) -> int:
+        """
+        Put the HTML pages of the store into an HTTP cache, for the loaders in offline mode.
+
+        :param cache: The HTTP cache
+        :return: The number of pages exported
+        """
+        count = 0
+        for flow in self.query(content_type="text/html", status=200, method="GET"):
+            cache.put(flow.url, flow.text(), etag=flow.header("ETag"), last_modified=flow.header("Last-Modified"))
+            count += 1
+        return count
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def _put_body(self, body):
+        digest = body_hash(body)
+        compressed = zlib.compress(body, 6)
+        self._connection.execute(
+            "INSERT OR IGNORE INTO bodies VALUES (?, ?, ?)", (digest, compressed, len(compressed))
+        )
+        return digest
+
+    def _get_body(self, digest):
+        row = self._connection.execute("SELECT body FROM bodies WHERE hash = ?", (digest,)).fetchone()
+        return zlib.decompress(row[0]) if row else b""
+
+
+def body_hash(body: bytes) -> str:
+    """Return the key a body is stored under."""
+    return hashlib.sha256(body).hexdigest()
+
+
+def flow_address(url: str) -> str:
+    """
+    Return the URL without scheme and fragment, as flows are looked up for replay.
+
+    :param url: An absolute URL
+    :return: host[:port]/path?query with a lower-cased host
+    """
+    parts = urlsplit(url)
+    return urlunsplit(("", parts.netloc.lower(), parts.path or "/", parts.query, "")).lstrip("/")
+
+
+class FlowRecorder:
+    """A mitmproxy addon writing every completed flow to a FlowStore."""
+
+    def __init__(self, store: FlowStore):
+        """
+        Initialize the FlowRecorder class.
+
+        :param store: The store the flows are written to
+        """
+        self.store = store
+
+    def response(self, flow) -> None:
+        """
+        Store a flow once its response is complete.
+
+        :param flow: The mitmproxy.http.HTTPFlow
+        """
+        self.store.add(Flow.from_mitmproxy(flow))
+
+
+class ReplayServer(ThreadingHTTPServer):
+    """
+    Serve the flows of a store, as an HTTP proxy or as a plain server.
+
+    Proxy requests carry the full URL. Plain requests are looked up under the origin
+    given to the server, or under the Host header. Repeated requests for the same URL
+    get its recorded responses in order, the last one repeating, and requests with a
+    body prefer flows recorded with the same body. Unknown requests get a 404.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, store: FlowStore, address: Tuple[str, int] = ("127.0.0.1", 0), origin: Optional[str] = None):
+        """
+        Initialize the ReplayServer class and bind its address.
+
+        :param store: The store the flows are served from
+        :param address: Host and port to listen on, defaults to a free port on 127.0.0.1
+        :param origin: Scheme and host plain requests are served for, such as https://ra.co
+        """
+        super().__init__(address, _ReplayHandler)
+        self.store = store
+        self.origin = origin.rstrip("/") if origin else None
+        self.hits = 0
+        self.misses = 0
+        self._served = {}
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def find(self, method: str, url: str, body: bytes = b"") -> Optional[Flow]:
+        """
+        Return the flow to answer a request with.
+
+        :param method: The HTTP method of the request
+        :param url: The absolute URL of the request
+        :param body: The request body
+        :return: The Flow, or None if none was recorded for the request
+        """
+        ids = self.store.candidates(method, url)
+        if body:
+            digest = body_hash(body)
+            ids = [flow_id for flow_id in ids if self.store.request_body_hash(flow_id) == digest] or ids
+        if not ids:
+            with self._lock:
+                self.misses += 1
+            return None
+        key = (method.upper(), flow_address(url), body_hash(body))
+        with self._lock:
+            served = self._served.get(key, 0)
+            self._served[key] = served + 1
+            self.hits += 1
+        return self.store.get(ids[min(served, len(ids) - 1)])
+
+
+class _ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.replay()
+
+    do_POST = do_PUT = do_PATCH = do_DELETE = do_HEAD = do_OPTIONS = do_GET
+
+    def do_CONNECT(self):
+        # Serving https would need a certificate the browser trusts; the flows are served over http instead
+        self.send_error(501, "Replay serves https flows over http, request http:// URLs instead")
+
+    def replay(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.path.startswith(("http://", "https://")):
+            url = self.path
+        elif self.server.origin:
+            url = self.server.origin + self.path
+        else:
+            url = f"http://{self.headers.get('Host', '')}{self.path}"
+
+        flow = self.server.find(self.command, url, body)
+        if flow is None:
+            self.send_response(404)
+            self.send_header("X-Replay", "miss")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.send_response(flow.status)
+        for name, value in flow.response_headers:
+            if name.lower() not in HOP_BY_HOP_HEADERS:
+                self.send_header(name, value)
+        self.send_header("X-Replay", "hit")
+        self.send_header("Content-Length", str(len(flow.response_body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(flow.response_body)
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect and replay captured HTTP flows")
+    parser.add_argument("--store", type=str, default=".flow_store", help="Directory of the flow store")
+    commands = parser.add_subparsers(dest="command", required=True)
+    listing = commands.add_parser("list", help="List the stored flows")
+    listing.add_argument("--host", type=str, default=None)
+    listing.add_argument("--path-template", type=str, default=None)
+    listing.add_argument("--content-type", type=str, default=None)
+    listing.add_argument("--status", type=int, default=None)
+    serve = commands.add_parser("serve", help="Serve the stored flows")
+    serve.add_argument("--port", type=int, default=8081)
+    serve.add_argument("--origin", type=str, default=None, help="Scheme and host plain requests are served for, such as https://ra.co")
+    export = commands.add_parser("export", help="Put the stored HTML pages into an HTTP cache for --offline runs")
+    export.add_argument("--http-cache", type=str, default=".http_cache")
+    args = parser.parse_args()
+
+    store = FlowStore(args.store)
+    if args.command == "list":
+        for flow in store.query(args.host, args.path_template, args.content_type, args.status):
+            print(flow.method, flow.status, flow.content_type or "", flow.url)
+        print(store.stats())
+    elif args.command == "serve":
+        server = ReplayServer(store, ("127.0.0.1", args.port), origin=args.origin)
+        print(f"Replaying {len(store)} flows on {server.url}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+    else:
+        print(f"Exported {store.export_to_cache(HttpCache(args.http_cache))} pages to {args.http_cache}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""http_cache.py: An on-disk HTTP response cache for the HTML loaders.
+
+This module is a part of the Website Structure Analysis component.
+Responses are stored compressed in a SQLite file, revalidated with ETag and
+Last-Modified headers and evicted least-recently-used first once the cache grows past
+its size cap. In offline mode only cached responses are served, which makes repeated
+runs reproducible and free of network traffic.
+
+The cache is configured through environment variables so that generated scrapers,
+which run in their own processes, share the cache of the run that started them.
+"""
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Optional
+
+CACHE_DIR_ENV = "SCRAPER_HTTP_CACHE"
+CACHE_SIZE_ENV = "SCRAPER_HTTP_CACHE_SIZE_MB"
+CACHE_OFFLINE_ENV = "SCRAPER_HTTP_CACHE_OFFLINE"
+
+_shared_caches = {}
+_shared_lock = threading.Lock()
+
+
+class CacheMissError(LookupError):
+    """Raised in offline mode when a URL is not in the cache."""
+
+
+class CachedResponse:
+    """A response body stored in the cache together with its validators."""
+
+    def __init__(self, url: str, body: str, etag: Optional[str], last_modified: Optional[str]):
+        """
+        Initialize the CachedResponse class.
+
+        :param url: The URL of the response
+        :param body: The decoded response body
+        :param etag: The ETag header of the response, if any
+        :param last_modified: The Last-Modified header of the response, if any
+        """
+        self.url = url
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def conditional_headers(self) -> dict:
+        """
+        Return the headers that ask the server to answer 304 if the response is unchanged.
+
+        :return: A dict with If-None-Match and/or If-Modified-Since
+        """
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class HttpCache:
+    """A size-capped, LRU-evicted cache of HTTP response bodies stored in SQLite."""
+
+    def __init__(self, directory: str = ".http_cache", max_size_mb: float = 256, offline: bool = False):
+        """
+        Open or create the cache in the given directory.
+
+        :param directory: Directory holding the cache database, defaults to ".http_cache"
+        :param max_size_mb: Maximum total size of the compressed bodies in MB, defaults to 256
+        :param offline: Only serve cached responses and never touch the network, defaults to False
+        """
+        self.directory = directory
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.offline = offline
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            os.path.join(directory, "responses.sqlite3"), check_same_thread=False, timeout=30
+        )
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS responses (
+                    url TEXT PRIMARY KEY,
+                    body BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    stored_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+                """
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)"
+            )
+
+    @classmethod
+    def from_env(cls) -> Optional["HttpCache"]:
+        """
+        Return the cache configured through the environment, or None if there is none.
+
+        Instances are shared per directory within a process.
+
+        :return: The HttpCache named by SCRAPER_HTTP_CACHE, or None
+        """
+        directory = os.environ.get(CACHE_DIR_ENV)
+        if not directory:
+            return None
+        offline = os.environ.get(CACHE_OFFLINE_ENV, "") not in ("", "0", "false")
+        max_size_mb = float(os.environ.get(CACHE_SIZE_ENV, 256))
+        key = (os.path.abspath(directory), max_size_mb, offline)
+        with _shared_lock:
+            if key not in _shared_caches:
+                _shared_caches[key] = cls(directory, max_size_mb, offline)
+            return _shared_caches[key]
+
+    def configure_env(self, environ=os.environ) -> None:
+        """
+        Export this cache's settings so loaders in child processes use the same cache.
+
+        :param environ: The environment mapping to update, defaults to os.environ
+        """
+        environ[CACHE_DIR_ENV] = os.path.abspath(self.directory)
+        environ[CACHE_SIZE_ENV] = str(self.max_size / (1024 * 1024))
+        environ[CACHE_OFFLINE_ENV] = "1" if self.offline else "0"
+
+    def get(self, url: str) -> Optional[CachedResponse]:
+        """
+        Return the cached response for the URL and mark it as recently used.
+
+        :param url: The requested URL
+        :return: A CachedResponse, or None if the URL is not cached
+        """
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT body, etag, last_modified FROM responses WHERE url = ?", (url,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._connection.execute(
+                "UPDATE responses SET accessed_at = ? WHERE url = ?", (time.time(), url)
+            )
+        body, etag, last_modified = row
+        return CachedResponse(url, zlib.decompress(body).decode("utf-8"), etag, last_modified)
+
+    def put(self, url: str, body: str, etag: Optional[str] = None, last_modified: Optional[str] = None) -> None:
+        """
+        Store a response body, evicting the least recently used entries if the cache is full.
+
+        :param url: The requested URL
+        :param body: The decoded response body
+        :param etag: The ETag header of the response, if any
+        :param last_modified: The Last-Modified header of the response, if any
+        """
+        compressed = zlib.compress(body.encode("utf-8"), 6)
+        if len(compressed) > self.max_size:
+            return
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, compressed, len(compressed), etag, last_modified, now, now),
+            )
+            self._evict()
+
+    def size(self) -> int:
+        """
+        Return the total size in bytes of the compressed bodies in the cache.
+
+        :return: The size of the cache in bytes
+        """
+        with self._lock:
+            return self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def _evict(self):
+        total = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_size:
+            return
+        rows = self._connection.execute("SELECT url, size FROM responses ORDER BY accessed_at")
+        evicted = []
+        for url, size in rows:
+            if total <= self.max_size:
+                break
+            evicted.append((url,))
+            total -= size
+        self._connection.executemany("DELETE FROM responses WHERE url = ?", evicted)
@@ -0,0 +1,154 @@
+"""parser_backends.py: A module for choosing the fastest installed HTML parser.
+
+This module is a part of the Website Structure Analysis component.
+Two kinds of backends are supported:
+
+- Tree builders for BeautifulSoup. lxml (libxml2) builds the same tree as the
+  standard library's html.parser faster, and is used when installed.
+- A subtree locator built on selectolax (lexbor). It parses the whole page in C,
+  finds the target string and cuts out the HTML of one of its ancestors, so that
+  BeautifulSoup only has to build a tree for that small part of a large page.
+
+On well-formed documents all backends pick the same subtree. They repair broken
+markup differently, however: lexbor follows the HTML5 algorithm and inserts the
+elements a page leaves out (html, head, body and the tbody of tables), while
+html.parser does not. The locator does not count inserted elements as generations,
+so the common case of tables without a tbody still lines up.
+"""
+import os
+import re
+from typing import List, Optional
+
+PARSER_ENV = "SCRAPER_HTML_PARSER"
+
+# BeautifulSoup tree builders, fastest first
+TREE_BUILDERS = ("lxml", "html.parser")
+
+# Elements the HTML5 algorithm inserts when a page leaves them out
+IMPLIED_TAGS = ("html", "head", "body", "tbody")
+
+
+def _importable(module: str) -> bool:
+    try:
+        __import__(module)
+    except ImportError:
+        return False
+    return True
+
+
+def installed_tree_builders() -> List[str]:
+    """
+    Return the installed BeautifulSoup tree builders, fastest first.
+
+    :return: A list of builder names, always ending with html.parser
+    """
+    return [
+        builder for builder in TREE_BUILDERS
+        if builder == "html.parser" or _importable(builder)
+    ]
+
+
+def default_parser_type() -> str:
+    """
+    Return the tree builder to use: the one configured for this run, or the fastest installed.
+
+    :return: The name of a BeautifulSoup tree builder
+    """
+    configured = os.environ.get(PARSER_ENV, "auto")
+    if configured != "auto":
+        return configured
+    return installed_tree_builders()[0]
+
+
+def configure_env(parser_type: str, environ=None) -> None:
+    """
+    Select the tree builder of this run, including the generated scrapers running in child processes.
+
+    :param parser_type: A tree builder name, or "auto" for the fastest installed one
+    :param environ: The environment to update, defaults to os.environ
+    """
+    environ = os.environ if environ is None else environ
+    if parser_type not in ("auto",) + TREE_BUILDERS:
+        raise ValueError(f"Unknown HTML parser: {parser_type}")
+    if parser_type != "auto" and parser_type not in installed_tree_builders():
+        raise ValueError(f"The {parser_type} HTML parser is not installed")
+    environ[PARSER_ENV] = parser_type
+
+
+class SelectolaxLocator:
+    """Locate the subtree around a target string with the lexbor HTML5 parser."""
+
+    @classmethod
+    def available(cls) -> bool:
+        """Return True if selectolax is installed."""
+        return _importable("selectolax.lexbor")
+
+    def locate(self, html: str, target_string: str, generations: int) -> Optional[str]:
+        """
+        Return the HTML of the ancestor of the first occurrence of the target string.
+
+        Like HTMLSearcher, text is searched case-insensitively first and attribute
+        names and values are only searched if no text contains the target.
+
+        :param html: The HTML of the page
+        :param target_string: The example string to look for
+        :param generations: Number of parents to climb from the matching text node or tag
+        :return: The HTML source of the subtree, or None if the target was not found
+        """
+        from selectolax.lexbor import LexborHTMLParser
+
+        if not target_string:
+            return None
+        tree = LexborHTMLParser(html)
+        node = self._find_text(tree, target_string.lower())
+        if node is None:
+            node = self._find_attributes(tree, target_string)
+        if node is None:
+            return None
+
+        implied = {
+            tag for tag in IMPLIED_TAGS
+            if not re.search(rf"<{tag}[\s/>]", html, re.IGNORECASE)
+        }
+        climbed = 0
+        while climbed < generations and node.parent is not None:
+            node = node.parent
+            if node.tag not in implied:
+                climbed += 1
+        if node.is_document_node or node.tag in implied:
+            # Climbed past the outermost element the page has: the whole document
+            return html
+        return node.html
+
+    @staticmethod
+    def _find_text(tree, target):
+        for node in tree.root.traverse(include_text=True):
+            if node.is_text_node:
+                text = node.text(deep=False)
+            elif node.is_comment_node:
+                text = node.comment_content or ""
+            else:
+                continue
+            if target in text.lower():
+                return node
+        return None
+
+    @staticmethod
+    def _find_attributes(tree, target_string):
+        for node in tree.root.traverse():
+            attributes = node.attributes
+            if not attributes:
+                continue
+            text = " ".join(f"{name}={value or ''}" for name, value in attributes.items())
+            if target_string in text:
+                return node
+        return None
+
+
+def default_locator() -> Optional[SelectolaxLocator]:
+    """
+    Return the fastest installed subtree locator, or None if there is none.
+
+    :return: A SelectolaxLocator, or None
+    """
+    return SelectolaxLocator() if SelectolaxLocator.available() else None
@@ -0,0 +1,192 @@
+"""streaming.py: A module for extracting a subtree from very large HTML files.
+
+This module is a part of the Website Structure Analysis component.
+Instead of reading a whole file into memory and building a full parse tree, the file
+is scanned incrementally with the standard library's event-based HTML parser. The scan
+tracks the byte offsets of the open elements, locates the first occurrence of the
+target string and the ancestor the requested number of generations above it, and then
+only that ancestor's bytes are read back from disk. Peak memory is bounded by the
+extracted subtree and the read chunk size, not by the document.
+"""
+from html.parser import HTMLParser as EventHTMLParser
+from typing import Optional, Tuple
+
+
+class _StopScan(Exception):
+    """Raised from a parser callback once the subtree has been located."""
+
+
+class _SubtreeScanner(EventHTMLParser):
+    """Track open elements and their offsets until the target's ancestor is closed.
+
+    The file is decoded as latin-1, so that every character corresponds to exactly
+    one byte and character offsets can be used to seek in the file.
+    """
+
+    VOID_TAGS = {
+        "area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta",
+        "param", "source", "track", "wbr",
+    }
+
+    def __init__(self, target_string, generations, in_attributes):
+        super().__init__(convert_charrefs=True)
+        # Compare in the same byte-per-character space the file is decoded in
+        target = target_string.encode("utf-8").decode("latin-1")
+        self.target = target if in_attributes else target.lower()
+        self.generations = generations
+        self.in_attributes = in_attributes
+        self.stack = []  # (tag, offset of its start tag)
+        self.text = []  # Text seen since the last tag, possibly split across chunks
+        self.line_starts = {1: 0}
+        self.line = 1
+        self.fed = 0
+        self.anchor_depth = None
+        self.start = None
+        self.end = None
+        self.closing_tag = None
+
+    def feed_chunk(self, chunk):
+        index = chunk.find("\n")
+        while index != -1:
+            self.line += 1
+            self.line_starts[self.line] = self.fed + index + 1
+            index = chunk.find("\n", index + 1)
+        self.fed += len(chunk)
+        self.feed(chunk)
+        # Positions reported from now on are never before the parser's current line
+        current_line = self.getpos()[0]
+        for line in [line for line in self.line_starts if line < current_line]:
+            del self.line_starts[line]
+
+    def finish(self):
+        self.close()
+        self._check_text()
+
+    def handle_starttag(self, tag, attrs):
+        self._check_text()
+        offset = self._offset()
+        if tag not in self.VOID_TAGS:
+            self.stack.append((tag, offset))
+            self._check_attributes(attrs, len(self.stack) - 1)
+        else:
+            self._check_attributes(attrs, None, offset)
+
+    def handle_startendtag(self, tag, attrs):
+        self._check_text()
+        self._check_attributes(attrs, None, self._offset())
+
+    def handle_endtag(self, tag):
+        self._check_text()
+        for index in range(len(self.stack) - 1, -1, -1):
+            if self.stack[index][0] == tag:
+                break
+        else:
+            return  # A stray end tag, ignored like the tree builder does
+
+        if self.anchor_depth is not None and index <= self.anchor_depth:
+            self.end = self._offset()
+            # The anchor's own end tag is not part of the slice read back
+            if index == self.anchor_depth:
+                self.closing_tag = f"</{tag}>"
+            raise _StopScan()
+        del self.stack[index:]
+
+    def handle_data(self, data):
+        if self.anchor_depth is None and not self.in_attributes:
+            self.text.append(data)
+
+    def _check_text(self):
+        if self.text:
+            text, self.text = "".join(self.text), []
+            if self.target in text.lower():
+                # The text node's parent is the first generation
+                self._anchor(len(self.stack) - self.generations)
+
+    def _check_attributes(self, attrs, depth, void_offset=None):
+        if self.anchor_depth is not None or not self.in_attributes:
+            return
+        if any(self.target in f"{name}={value or ''}" for name, value in attrs):
+            if depth is None:
+                # An element without children: generation 0 is the tag itself,
+                # generation 1 the element it is in
+                if self.generations == 0:
+                    self.start = void_offset
+                    self.end = void_offset + len(self.get_starttag_text())
+                    raise _StopScan()
+                depth = len(self.stack)
+            self._anchor(depth - self.generations)
+
+    def _anchor(self, depth):
+        if depth < 0:
+            # Climbed past the outermost element: the whole document is the subtree
+            self.start, self.end, self.anchor_depth = 0, None, -1
+            raise _StopScan()
+        self.anchor_depth = depth
+        self.start = self.stack[depth][1]
+
+    def _offset(self):
+        line, column = self.getpos()
+        return self.line_starts[line] + column
+
+
+class StreamingSubtreeExtractor:
+    """Extract the subtree around a target string from an HTML file in bounded memory."""
+
+    def __init__(self, chunk_size: int = 1024 * 1024):
+        """
+        Initialize the StreamingSubtreeExtractor class.
+
+        :param chunk_size: Number of bytes read from the file at a time, defaults to 1 MB
+        """
+        self.chunk_size = chunk_size
+
+    def locate(self, path: str, target_string: str, generations: int) -> Optional[Tuple[int, int, str]]:
+        """
+        Find the byte range of the ancestor of the first occurrence of the target string.
+
+        Like HTMLSearcher, text is searched case-insensitively first and attribute
+        values are only searched if no text contains the target.
+
+        :param path: Path of the HTML file
+        :param target_string: The example string to look for
+        :param generations: Number of parents to climb from the matching text node or tag
+        :return: A (start, end, closing_tag) tuple, or None if the target was not found.
+            end is None when the subtree runs to the end of the file, and closing_tag is
+            the end tag to append to the slice, if any.
+        """
+        if not target_string:
+            return None
+        for in_attributes in (False, True):
+            scanner = _SubtreeScanner(target_string, generations, in_attributes)
+            try:
+                with open(path, "rb") as file:
+                    while True:
+                        chunk = file.read(self.chunk_size)
+                        if not chunk:
+                            break
+                        scanner.feed_chunk(chunk.decode("latin-1"))
+                scanner.finish()
+            except _StopScan:
+                pass
+            if scanner.start is not None:
+                return scanner.start, scanner.end, scanner.closing_tag
+        return None
+
+    def extract(self, path: str, target_string: str, generations: int, encoding: str = "utf-8") -> Optional[str]:
+        """
+        Return the HTML of the ancestor of the first occurrence of the target string.
+
+        :param path: Path of the HTML file
+        :param target_string: The example string to look for
+        :param generations: Number of parents to climb from the matching text node or tag
+        :param encoding: Encoding of the file, defaults to "utf-8"
+        :return: The HTML source of the subtree, or None if the target was not found
+        """
+        location = self.locate(path, target_string, generations)
+        if location is None:
+            return None
+        start, end, closing_tag = location
+        with open(path, "rb") as file:
+            file.seek(start)
+            data = file.read() if end is None else file.read(end - start)
+        return data.decode(encoding, errors="replace") + (closing_tag or "")
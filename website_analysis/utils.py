@@ -2,6 +2,16 @@
 
 import openai
 import json
+from concurrent.futures import ThreadPoolExecutor
+
+from website_analysis.api_clustering import chunk_summaries, cluster_api_calls
+
+# Token budget of the endpoint summaries sent in one prompt, larger captures are split
+CHUNK_TOKENS = 2500
+# Maximum number of prompts sent at the same time
+MAX_PARALLEL_PROMPTS = 4
+TABLE_HEADER = "| API | Payload | Response |"
+TABLE_SEPARATOR = "|---|---|---|"
 
 
 def load_config():
@@ -15,37 +25,82 @@ def load_config():
     return config_data
 
 
-config = load_config()
-openai_api_key = config["openai"]["api_key"]
+def configure_openai():
+    """
+    Set up the OpenAI API client with the key from the configuration file.
 
-# Set up the OpenAI API client
-openai.api_key = openai_api_key
+    Called on first use rather than at import time, so importing this module neither
+    needs config.json nor spends time reading it.
+    """
+    if openai.api_key is None:
+        openai.api_key = load_config()["openai"]["api_key"]
 
 
-def analyze_api_calls(api_calls):
+def analyze_api_calls(api_calls, chunk_tokens=CHUNK_TOKENS):
     """
     Analyze API calls using GPT-3 and return the analysis results.
 
-    :param api_calls: A list of API calls to analyze
+    The calls are grouped by endpoint first, so the prompt holds one summary with the
+    merged schemas per endpoint instead of every call. If the summaries exceed the
+    token budget, they are split into chunks that are analyzed in parallel.
+
+    :param api_calls: A list of API calls to analyze, see cluster_api_calls()
+    :param chunk_tokens: Token budget of the endpoint summaries in one prompt
     :return: The API analysis results as a formatted string
     """
+    from website_analysis.dom_analysis import TokenCounter
+
+    configure_openai()
+
+    counter = TokenCounter.for_model("gpt-3.5-turbo")
+    chunks = chunk_summaries(cluster_api_calls(api_calls), chunk_tokens, counter.count)
+    if not chunks:
+        return ""
+    with ThreadPoolExecutor(min(len(chunks), MAX_PARALLEL_PROMPTS)) as executor:
+        results = list(executor.map(analyze_endpoint_summaries, chunks))
+
+    # Every chunk answers with a table, their rows are joined under a single header
+    rows = [line for result in results for line in result.splitlines() if is_table_row(line)]
+    return "\n".join([TABLE_HEADER, TABLE_SEPARATOR] + rows) if len(results) > 1 else results[0]
+
+
+def is_table_row(line):
+    """
+    Check whether a line of an analysis is a row of its table, not its header or separator.
+
+    :param line: A line of the answer to analyze_endpoint_summaries()
+    :return: True for a row with content
+    """
+    line = line.strip()
+    return bool(line) and line != TABLE_HEADER and not set(line) <= set("|-: ")
+
+
+def analyze_endpoint_summaries(summaries):
+    """
+    Ask GPT-3 to identify the APIs among endpoint summaries.
+
+    :param summaries: The representatives of the endpoints, see ApiCluster.to_dict()
+    :return: The analysis of the endpoints as a table
+    """
     # Prepare the API calls data for input to GPT-3
-    api_calls_data = json.dumps(api_calls, indent=2)
+    api_calls_data = "\n".join(json.dumps(summary, separators=(",", ":")) for summary in summaries)
 
     # Construct the GPT-3 prompt
     prompt = (
         f"We are trying to identify a website's internal API. \n\n"
-        f"Here are all XML and JSON results we found when navigating this website:\n\n"
+        f"Here are the endpoints we found when navigating this website, one per line with the number "
+        f"of calls, an example URL and the merged JSON schemas of payloads and responses "
+        f"(keys ending in ? are optional). Placeholders such as {{n}} in URLs stand for IDs:\n\n"
         f"{api_calls_data}\n\n"
         f"Can you please identify any APIs and return them in the following format:\n\n"
-        f"| API | Payload | Response |\n"
+        f"{TABLE_HEADER}\n"
     )
 
     # Call the GPT-3 API
     response = openai.Completion.create(
         engine="davinci-codex",
         prompt=prompt,
-        max_tokens=150,
+        max_tokens=min(150 * len(summaries), 1500),
         n=1,
         stop=None,
         temperature=0.5,